@@ -1,5 +1,8 @@
 import os
 import sys
+import gzip
+import json
+import mock
 import os.path
 import unittest
 import subprocess
@@ -7,8 +10,272 @@ import shutil
 
 import time
 import datetime
+import tempfile
 from google.cloud import storage
 from tremium.config import HubConfigurationManager
+from tremium.file_watcher import DirectoryWatcher
+from tremium.uplink import UplinkScheduler, PRIORITY_FRESH, PRIORITY_LOGS, PRIORITY_BACKFILL
+from tremium.columnar import register_data_files, transcode_data_files, read_columnar_batch
+from tremium.file_management import load_state_file
+
+
+class UnitTestDirectoryWatcher(unittest.TestCase):
+
+    ''' Holds the tests for the detection of completed files (data collector daemon) '''
+
+    def check_watcher(self, directory_watcher, work_dir):
+
+        ''' Checks that files are reported once complete (closed, or moved in the folder) '''
+
+        with open(os.path.join(work_dir, "audio-data_2018-06-01_13-57-19.json"), "w") as data_h:
+            data_h.write("test")
+        with open(os.path.join(work_dir, "audio-data_2018-06-02_13-57-19.json.part"), "w") as data_h:
+            data_h.write("test")
+        os.rename(os.path.join(work_dir, "audio-data_2018-06-02_13-57-19.json.part"), 
+                  os.path.join(work_dir, "audio-data_2018-06-02_13-57-19.json"))
+
+        completed_files = set()
+        for _ in range(5):
+            completed_files |= directory_watcher.wait_for_files(0.5)
+        assert {"audio-data_2018-06-01_13-57-19.json", "audio-data_2018-06-02_13-57-19.json"} <= completed_files
+
+        # nothing new is reported
+        assert directory_watcher.wait_for_files(0.5) == set()
+
+
+    def test_inotify_watcher(self):
+
+        work_dir = tempfile.mkdtemp()
+        directory_watcher = DirectoryWatcher(work_dir, 0.1)
+
+        try :
+            assert directory_watcher.uses_inotify
+            self.check_watcher(directory_watcher, work_dir)
+
+        finally:
+            directory_watcher.close()
+            shutil.rmtree(work_dir)
+
+
+    def test_polling_watcher(self):
+
+        work_dir = tempfile.mkdtemp()
+        directory_watcher = DirectoryWatcher(work_dir, 0.1)
+        directory_watcher.close()
+        directory_watcher.scanned_states = directory_watcher._scan()
+
+        try :
+            self.check_watcher(directory_watcher, work_dir)
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class FakeBlob():
+
+    ''' Stand-in for a cloud storage blob : without a chunk size, the file is read and sent in a single request '''
+
+    def __init__(self):
+        self.chunk_size = None
+        self.sent_chunks = []
+
+    def upload_from_file(self, file_obj, size=None):
+        data = file_obj.read(size if self.chunk_size is None else self.chunk_size)
+        while data:
+            self.sent_chunks.append((time.time(), len(data)))
+            data = file_obj.read(size if self.chunk_size is None else self.chunk_size)
+
+
+class UnitTestUplinkScheduler(unittest.TestCase):
+
+    ''' Holds the tests for the uplink scheduler of the data collector (priority classes, daily budget, rate cap) '''
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.config_manager = HubConfigurationManager(os.environ['TREMIUM_CONFIG_FILE'])
+        self.config_manager.config_data["hub-file-transfer-dir"] = self.work_dir
+        self.config_manager.config_data["hub-state-dir"] = os.path.join(self.work_dir, ".hub-state")
+        self.config_manager.config_data["uplink-fresh-time"] = 3600
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+    def test_priorities_and_budget(self):
+
+        '''
+        Test goals :
+            - ensure fresh data files go first, then log files, then backfill (old data files)
+            - ensure a class only uses its share of the daily budget, refused files are deferred for the day
+            - ensure the budget and the deferred files are reset the next day
+        '''
+
+        self.config_manager.config_data["uplink-daily-budget"] = 400
+        self.config_manager.config_data["uplink-class-budget-ratios"] = [1.0, 0.5, 0.25]
+        elements = ["audio-data_old.json", "bluetooth-server-logs.log", "audio-data_new.json"]
+        for element in elements:
+            with open(os.path.join(self.work_dir, element), "w") as element_h:
+                element_h.write("x" * 100)
+        os.utime(os.path.join(self.work_dir, "audio-data_old.json"), (time.time() - 7200, time.time() - 7200))
+
+        uplink_scheduler = UplinkScheduler(self.config_manager)
+        assert uplink_scheduler.order(elements) == ["audio-data_new.json", "bluetooth-server-logs.log", "audio-data_old.json"]
+        assert [uplink_scheduler.get_priority(element) for element in uplink_scheduler.order(elements)] == \
+               [PRIORITY_FRESH, PRIORITY_LOGS, PRIORITY_BACKFILL]
+
+        # fresh data and logs fit their share, backfill does not (200 bytes sent, backfill share is 100)
+        for element in uplink_scheduler.order(elements):
+            if uplink_scheduler.admit(100, uplink_scheduler.get_priority(element), element):
+                uplink_scheduler.record_upload(100)
+        assert uplink_scheduler.order(elements) == ["audio-data_new.json", "bluetooth-server-logs.log"]
+        assert uplink_scheduler.admit(200, PRIORITY_FRESH)
+        assert not uplink_scheduler.admit(201, PRIORITY_FRESH)
+
+        # the deferral is persisted, then reset with the budget the next day
+        uplink_scheduler = UplinkScheduler(self.config_manager)
+        assert "audio-data_old.json" not in uplink_scheduler.order(elements)
+        next_day_time = time.time() + 86400
+        assert "audio-data_old.json" in uplink_scheduler.order(elements, next_day_time)
+        assert uplink_scheduler.admit(100, PRIORITY_BACKFILL, "audio-data_old.json", next_day_time)
+
+
+    def test_rate_cap(self):
+
+        ''' Test goals : ensure uploads are held to the uplink rate cap (file contents untouched) '''
+
+        self.config_manager.config_data["uplink-max-rate"] = 200000
+        self.config_manager.config_data["uplink-chunk-size"] = 20000
+        file_data = os.urandom(600000)
+        with open(os.path.join(self.work_dir, "audio-data.json"), "wb") as element_h:
+            element_h.write(file_data)
+
+        uplink_scheduler = UplinkScheduler(self.config_manager)
+        start_time = time.time()
+        with open(os.path.join(self.work_dir, "audio-data.json"), "rb") as element_h:
+            rate_limited_h = uplink_scheduler.limit_rate(element_h)
+            read_data = rate_limited_h.read(100000) + rate_limited_h.read()
+
+        # the bucket holds one second worth of bytes, the rest goes at the capped rate
+        assert read_data == file_data
+        assert time.time() - start_time >= 1.8
+
+
+    def test_chunked_upload(self):
+
+        ''' Test goals : ensure a capped upload is sent a chunk at a time, at the capped rate '''
+
+        self.config_manager.config_data["uplink-max-rate"] = 300000
+        self.config_manager.config_data["uplink-chunk-size"] = 20000
+        with open(os.path.join(self.work_dir, "audio-data.json"), "wb") as element_h:
+            element_h.write(os.urandom(900000))
+
+        blob = FakeBlob()
+        with open(os.path.join(self.work_dir, "audio-data.json"), "rb") as element_h:
+            UplinkScheduler(self.config_manager).upload(blob, element_h, 900000)
+
+        # chunks of 256 KB, sent at the capped rate once the bucket is empty
+        assert blob.chunk_size == 262144 and [size for _, size in blob.sent_chunks] == [262144, 262144, 262144, 113568]
+        sent_rate = sum(size for _, size in blob.sent_chunks[1 : ]) / (blob.sent_chunks[-1][0] - blob.sent_chunks[0][0])
+        assert sent_rate <= 300000 * 1.1
+
+
+class UnitTestColumnarTranscoder(unittest.TestCase):
+
+    ''' Holds the tests for the transcoding of the node data files into columnar batches '''
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.config_manager = HubConfigurationManager(os.environ['TREMIUM_CONFIG_FILE'])
+        self.config_manager.config_data["hub-file-transfer-dir"] = os.path.join(self.work_dir, "transfer")
+        self.config_manager.config_data["hub-columnar-dir"] = os.path.join(self.work_dir, "columnar")
+        self.config_manager.config_data["hub-state-dir"] = os.path.join(self.work_dir, ".hub-state")
+        self.config_manager.config_data["transcode-enabled"] = True
+        self.config_manager.config_data["transcode-format"] = "json"
+        self.config_manager.config_data["transcode-batch-rows"] = 50
+        os.makedirs(self.config_manager.config_data["hub-file-transfer-dir"])
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+    def test_transcode(self):
+
+        '''
+        Test goals :
+            - ensure the records are written as columnar batches, partitioned by node and day, in
+              batches of at most "transcode-batch-rows" records
+            - ensure the schema is inferred (int columns widen to float), records that do not fit go to the rejects
+            - ensure only the transcoded data files are deleted (files without valid records are left as is)
+        '''
+
+        transfer_dir = self.config_manager.config_data["hub-file-transfer-dir"]
+        midnight_time = time.mktime(datetime.datetime(2019, 9, 8).timetuple())
+        with open(os.path.join(transfer_dir, "node-archived-data-2019-09-08_01-10-00-000000.json"), "w") as data_file_h:
+            for record_index in reversed(range(120)):
+                data_file_h.write(json.dumps({"time" : midnight_time + (record_index - 70) * 60, "rms" : record_index,
+                                              "peaks" : [record_index, 2], "label" : None}) + "\n")
+            data_file_h.write('{"time" : 1567900000, "rms" : "loud"}\n')
+            data_file_h.write("not a record\n")
+            data_file_h.write(json.dumps({"time" : midnight_time, "rms" : 0.5, "label" : "idle"}) + "\n")
+        with open(os.path.join(transfer_dir, "notes.json"), "w") as notes_h:
+            notes_h.write("{\n  \"pretty\" : true\n}\n")
+        raw_size = os.path.getsize(os.path.join(transfer_dir, "node-archived-data-2019-09-08_01-10-00-000000.json"))
+
+        register_data_files(self.config_manager, "dev_node_columnar_01", ["node-archived-data-2019-09-08_01-10-00-000000.json"])
+        elements = ["node-archived-data-2019-09-08_01-10-00-000000.json", "notes.json", "bluetooth-server-logs.log"]
+        assert transcode_data_files(self.config_manager, elements) == {"notes.json", "bluetooth-server-logs.log"}
+        assert sorted(os.listdir(transfer_dir)) == ["notes.json"]
+
+        node_dir = os.path.join(self.config_manager.config_data["hub-columnar-dir"], "node=dev_node_columnar_01")
+        assert sorted(os.listdir(node_dir)) == ["day=2019-09-07", "day=2019-09-08", "rejects"]
+        day_row_counts = {}
+        batch_size = 0
+        for day in ["2019-09-07", "2019-09-08"]:
+            for batch_name in os.listdir(os.path.join(node_dir, "day=" + day)):
+                batch = read_columnar_batch(os.path.join(node_dir, "day=" + day, batch_name))
+                batch_size += os.path.getsize(os.path.join(node_dir, "day=" + day, batch_name))
+                assert batch["day"] == day and batch["node_id"] == "dev_node_columnar_01"
+                assert 0 < batch["row_count"] <= 50
+                assert all(len(values) == batch["row_count"] for values in batch["columns"].values())
+                assert batch["columns"]["time"] == sorted(batch["columns"]["time"])
+                day_row_counts[day] = day_row_counts.get(day, 0) + batch["row_count"]
+        assert day_row_counts == {"2019-09-07" : 70, "2019-09-08" : 51}
+        assert batch_size < raw_size
+
+        # "rms" widened to float, "label" typed by its first value, "loud" and the bad line are rejected
+        assert load_state_file(self.config_manager.get_state_file_path("hub-columnar-schema-file"), {}) == \
+            {"dev_node_columnar_01" : {"time" : "float", "rms" : "float", "peaks" : "json", "label" : "string"}}
+        rejects_name = os.listdir(os.path.join(node_dir, "rejects"))[0]
+        with gzip.open(os.path.join(node_dir, "rejects", rejects_name), "rt") as rejects_h:
+            assert rejects_h.read().splitlines() == ['{"time" : 1567900000, "rms" : "loud"}', "not a record"]
+        assert load_state_file(self.config_manager.get_state_file_path("hub-transcode-queue-file"), {}) == {}
+
+
+    def test_interrupted_pass(self):
+
+        ''' Testing that a file is transcoded once when the hub stops in the middle of a pass '''
+
+        transfer_dir = self.config_manager.config_data["hub-file-transfer-dir"]
+        columnar_dir = self.config_manager.config_data["hub-columnar-dir"]
+        file_name = "node-archived-data-2019-09-08_01-10-00-000000.json"
+        with open(os.path.join(transfer_dir, file_name), "w") as data_file_h:
+            for record_index in range(120):
+                data_file_h.write(json.dumps({"time" : 1567900000 + record_index, "rms" : record_index}) + "\n")
+        register_data_files(self.config_manager, "dev_node_columnar_01", [file_name])
+
+        # the hub stops once the pass is recorded, before the batches are published
+        with mock.patch("tremium.columnar.publish_batches", side_effect=OSError("hub stopped")):
+            with self.assertRaises(OSError):
+                transcode_data_files(self.config_manager, [file_name])
+        batch_names = [file_name for _, _, file_names in os.walk(columnar_dir) for file_name in file_names]
+        assert len(batch_names) == 3 and all(batch_name.endswith(".part") for batch_name in batch_names)
+        assert os.listdir(transfer_dir) == [file_name]
+
+        # the next pass publishes the recorded batches instead of transcoding the file again
+        assert transcode_data_files(self.config_manager, [file_name]) == set()
+        batch_paths = [os.path.join(dir_path, file_name) for dir_path, _, file_names in os.walk(columnar_dir) for file_name in file_names]
+        assert sum(read_columnar_batch(batch_path)["row_count"] for batch_path in batch_paths) == 120
+        assert os.listdir(transfer_dir) == []
+        assert load_state_file(self.config_manager.get_state_file_path("hub-transcode-queue-file"), {}) == {}
 
 
 class TestDataCollectorIntegration(unittest.TestCase):
@@ -74,11 +341,14 @@ class TestDataCollectorIntegration(unittest.TestCase):
             if os.path.isfile(element_path):
                 os.remove(element_path)
 
-        # making sure the files are written to the bucket
+        # making sure the files are written to the bucket (log files get an upload time stamp)
         # deleting the files as they are counted
         file_count = 0
+        log_file_prefixes = [file_name[ : -len(".log")] + "-" for file_name in test_file_names if file_name.endswith(".log")]
         for bucket_file in storage_bucket.list_blobs():
-            if(bucket_file.name in test_file_names):
+            is_log_file = bucket_file.name.endswith(".log") and \
+                          any(bucket_file.name.startswith(prefix) for prefix in log_file_prefixes)
+            if(bucket_file.name in test_file_names or is_log_file):
                 bucket_file.delete()
                 file_count += 1
 
@@ -1,29 +1,46 @@
 '''
-This script is the entry point for the data collector component which runs periodically
-in the "communication" container.
+This script is the entry point for the data collector component which runs in the 
+"communication" container.
 The data collector takes care of :
     - purging old data files from the hub file system
     - uploading recent data files to cloud storage
     ** data files are : log files, sensor data, ...
+In daemon mode (--daemon) the collector keeps running :
+    - completed data files are detected as they land in the transfer folder (inotify, or polling)
+      and uploaded in short time windows, over the same cloud storage client
+    - log files are uploaded on their own timer ("data-collector-log-interval")
+    - the offline purge runs on its own timer ("data-collector-purge-interval")
+    - closed partitions of the hub data index are uploaded on their own timer ("data-collector-partition-interval")
+Before they are uploaded, the node data files are transcoded into compressed columnar batches
+partitioned by node and day ("transcode-enabled", see tremium.columnar).
+Uploads go through the uplink scheduler (rate cap, daily byte budget, priority classes :
+fresh data, then logs, then backfill).
 '''
 
 import os
 import os.path
+import re
 
 import time
+import shutil
 import logging
 import datetime
 import argparse
+import tempfile
 import logging.handlers
-from google.cloud import storage
 
 from tremium.config import HubConfigurationManager
-from tremium.file_management import purge_timestamped_files
+from tremium.file_management import purge_timestamped_files, locked_file
+from tremium.data_index import HubDataIndex
+from tremium.columnar import transcode_data_files
+from tremium.file_watcher import DirectoryWatcher
+from tremium.uplink import UplinkScheduler, PRIORITY_FRESH, PRIORITY_BACKFILL
 
 # parsing script arguments
 parser = argparse.ArgumentParser()
 parser.add_argument("config_path", help="path to the .json config file")
 parser.add_argument("--offline", help="run offline purge of transfer files", action="store_true")
+parser.add_argument("--daemon", help="keep running and upload files as they are completed", action="store_true")
 args = parser.parse_args()
 
 
@@ -37,6 +54,380 @@ def delete_log_files(target_dir):
             os.remove(element_path)
 
 
+def upload_transfer_file(storage_bucket, element, config_manager, uplink_scheduler):
+
+    ''' 
+    Uploads the specified file (from the transfer folder) to the cloud bucket, then deletes it.
+    Returns the number of uploaded bytes (the upload is held to the uplink rate cap).
+
+    Parameters
+    ----------
+    storage_bucket (storage.Bucket) : destination cloud storage bucket
+    element (str) : name of the file to upload
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    uplink_scheduler (UplinkScheduler) : uplink rate cap and daily budget
+    '''
+
+    element_path = os.path.join(config_manager.config_data["hub-file-transfer-dir"], element)
+
+    # log files are appended to (shipped node logs), every upload holds the latest part
+    if element.endswith(".log"):
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        destination_name = element[ : -len(".log")] + "-" + time_str + ".log"
+        with locked_file(element_path, "rb") as log_file_h:
+            file_size = os.fstat(log_file_h.fileno()).st_size
+            blob = storage_bucket.blob(os.path.join(config_manager.config_data["gcp_data_bucket_path"], destination_name))
+            uplink_scheduler.upload(blob, log_file_h, file_size)
+            os.remove(element_path)
+        return file_size
+
+    # uploading the current file
+    destination_path = os.path.join(config_manager.config_data["gcp_data_bucket_path"], element)
+    blob = storage_bucket.blob(destination_path)
+    with open(element_path, "rb") as element_h:
+        file_size = os.fstat(element_h.fileno()).st_size
+        uplink_scheduler.upload(blob, element_h, file_size)
+
+    # deleting the current file
+    os.remove(element_path)
+    return file_size
+
+
+def upload_transfer_files(storage_bucket, elements, config_manager, uplink_scheduler, pass_time=None):
+
+    ''' 
+    Uploads the specified files (from the transfer folder) in priority order, returns the names
+    of the files that could not be uploaded (files that no longer exist are skipped, files over
+    the daily budget are deferred by the uplink scheduler)
+
+    Parameters
+    ----------
+    storage_bucket (storage.Bucket) : destination cloud storage bucket
+    elements (iterable) : names of the files to upload
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    uplink_scheduler (UplinkScheduler) : uplink rate cap, daily budget and priority classes
+    pass_time (float) : no lower priority upload (logs, backfill) is started after this many seconds,
+                        the rest is left for the next pass (None : no limit)
+    '''
+
+    failed_elements = set()
+    uploaded_elements = []
+    start_time = time.time()
+    for element in uplink_scheduler.order(elements):
+        element_path = os.path.join(config_manager.config_data["hub-file-transfer-dir"], element)
+        if not os.path.isfile(element_path):
+            continue
+
+        try :
+            priority = uplink_scheduler.get_priority(element)
+            if priority != PRIORITY_FRESH and pass_time is not None and time.time() - start_time > pass_time:
+                continue
+            if not uplink_scheduler.admit(os.path.getsize(element_path), priority, element):
+                continue
+
+            uplink_scheduler.record_upload(upload_transfer_file(storage_bucket, element, config_manager, uplink_scheduler))
+            uploaded_elements.append(element)
+
+        except Exception as e:
+            failed_elements.add(element)
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - Hub data collector failed to upload ({1}) : {2}".format(time_str, element, e))
+
+    if len(uploaded_elements) > 0:
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        logging.info("{0} - Hub data collector uploaded files : {1}".format(time_str, str(uploaded_elements)))
+
+    return failed_elements
+
+
+def upload_data_partitions(storage_bucket, config_manager, uplink_scheduler):
+
+    '''
+    Uploads the closed partitions of the hub data index (records of every node, organized by time),
+    then drops the partitions older than "hub-data-index-keep-time". Returns the number of uploaded files.
+        ** partition files are uploaded under (bucket path)/partitions/(partition start)/
+        ** partitions are backfill for the uplink scheduler, a partition over the daily budget waits
+           (unexported) for the next upload
+
+    Parameters
+    ----------
+    storage_bucket (storage.Bucket) : destination cloud storage bucket
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    uplink_scheduler (UplinkScheduler) : uplink rate cap, daily budget and priority classes
+    '''
+
+    if not config_manager.config_data["hub-data-index-enabled"]:
+        return 0
+
+    uploaded_count = 0
+    data_index = HubDataIndex(config_manager)
+    export_dir = tempfile.mkdtemp()
+
+    try :
+        for partition_start in data_index.get_export_partitions(time.time(), config_manager.config_data["hub-data-index-grace-time"]):
+
+            # the partition is only marked as exported once all its files are uploaded
+            partition_files, exported_rowid = data_index.export_partition(partition_start, export_dir)
+            partition_size = sum(os.path.getsize(partition_file) for partition_file in partition_files)
+            if not uplink_scheduler.admit(partition_size, PRIORITY_BACKFILL):
+                for partition_file in partition_files:
+                    os.remove(partition_file)
+                break
+
+            partition_str = datetime.datetime.fromtimestamp(partition_start).strftime('%Y-%m-%d_%H-%M-%S')
+            for partition_file in partition_files:
+                blob = storage_bucket.blob(os.path.join(config_manager.config_data["gcp_data_bucket_path"], "partitions",
+                                                        partition_str, os.path.basename(partition_file)))
+                with open(partition_file, "rb") as partition_h:
+                    uplink_scheduler.upload(blob, partition_h, os.path.getsize(partition_file))
+                uplink_scheduler.record_upload(os.path.getsize(partition_file))
+                os.remove(partition_file)
+
+            data_index.mark_exported(partition_start, exported_rowid)
+            uploaded_count += len(partition_files)
+
+        data_index.drop_partitions(time.time() - config_manager.config_data["hub-data-index-keep-time"])
+
+    finally:
+        data_index.close()
+        shutil.rmtree(export_dir)
+
+    if uploaded_count > 0:
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        logging.info("{0} - Hub data collector uploaded {1} data partition files".format(time_str, uploaded_count))
+
+    return uploaded_count
+
+
+def upload_columnar_batches(storage_bucket, config_manager, uplink_scheduler):
+
+    '''
+    Uploads the columnar batches of the transcoded node data (oldest day first), then deletes them.
+    Returns the number of uploaded files.
+        ** batches are uploaded under (bucket path)/columnar/node=(node id)/day=(YYYY-MM-DD)/
+        ** batches of days older than "uplink-fresh-time" are backfill for the uplink scheduler,
+           a batch over the daily budget waits for the next upload
+
+    Parameters
+    ----------
+    storage_bucket (storage.Bucket) : destination cloud storage bucket
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    uplink_scheduler (UplinkScheduler) : uplink rate cap, daily budget and priority classes
+    '''
+
+    columnar_dir = config_manager.config_data["hub-columnar-dir"]
+    if not os.path.isdir(columnar_dir):
+        return 0
+
+    # (day, relative path) of the complete batches, rejects go with the day they were written
+    batch_files = []
+    for dir_path, _, file_names in os.walk(columnar_dir):
+        for file_name in file_names:
+            if file_name.endswith(".part"):
+                continue
+            relative_path = os.path.relpath(os.path.join(dir_path, file_name), columnar_dir)
+            day_match = re.search(r"day=(\d{4}-\d{2}-\d{2})", relative_path) or re.search(r"(\d{4}-\d{2}-\d{2})", file_name)
+            batch_files.append((day_match.group(1) if day_match is not None else "", relative_path))
+
+    uploaded_count = 0
+    for day, relative_path in sorted(batch_files):
+        batch_path = os.path.join(columnar_dir, relative_path)
+        try :
+            day_time = time.mktime(datetime.datetime.strptime(day, "%Y-%m-%d").timetuple()) if day != "" else time.time()
+            priority = PRIORITY_BACKFILL if time.time() - day_time > config_manager.config_data["uplink-fresh-time"] else PRIORITY_FRESH
+            batch_size = os.path.getsize(batch_path)
+            if not uplink_scheduler.admit(batch_size, priority):
+                continue
+
+            blob = storage_bucket.blob(os.path.join(config_manager.config_data["gcp_data_bucket_path"], "columnar", relative_path))
+            with open(batch_path, "rb") as batch_h:
+                uplink_scheduler.upload(blob, batch_h, batch_size)
+            uplink_scheduler.record_upload(batch_size)
+            os.remove(batch_path)
+            uploaded_count += 1
+
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - Hub data collector failed to upload columnar batch ({1}) : {2}".format(time_str, relative_path, e))
+
+    # clearing the emptied partition folders
+    for dir_path, dir_names, file_names in os.walk(columnar_dir, topdown=False):
+        if dir_path != columnar_dir and len(os.listdir(dir_path)) == 0:
+            os.rmdir(dir_path)
+
+    if uploaded_count > 0:
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        logging.info("{0} - Hub data collector uploaded {1} columnar batch files".format(time_str, uploaded_count))
+
+    return uploaded_count
+
+
+def is_data_file(element):
+
+    ''' Data files are uploaded as soon as they are complete, (.part) files are still being written '''
+
+    return not element.endswith(".part") and not element.endswith(".log")
+
+
+def transcode_transfer_files(config_manager, elements):
+
+    '''
+    Transcodes the node data files into columnar batches (see tremium.columnar), returns the files
+    left to upload as they are (all of them if the transcoding fails)
+
+    Parameters
+    ----------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    elements (iterable) : names of the files (in the transfer folder)
+    '''
+
+    elements = set(elements)
+    try :
+        return transcode_data_files(config_manager, elements)
+    except Exception as e:
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        logging.error("{0} - Hub data collector failed to transcode data files : {1}".format(time_str, e))
+        return elements
+
+
+def get_storage_bucket(config_manager):
+
+    '''
+    Connects to cloud storage and returns the data bucket
+        ** the cloud storage library is only loaded here (the offline purge runs without it)
+
+    Parameters
+    ----------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    '''
+
+    from google.cloud import storage
+    storage_client = storage.Client()
+    return storage_client.get_bucket(config_manager.config_data["gcp_data_bucket"])
+
+
+def run_collector_daemon(config_manager):
+
+    ''' 
+    Runs the data collector as a daemon, files are uploaded as they are completed
+        - completed data files are grouped over "data-collector-upload-window" seconds, then uploaded
+        - files that fail to upload are retried with the next window
+        - the data files are transcoded into columnar batches before they are uploaded
+        - log files are uploaded every "data-collector-log-interval" seconds, along with the left over
+          data files and batches (backfill : deferred over the daily budget, or not uploaded yet)
+        - old files are purged every "data-collector-purge-interval" seconds (ex : cloud unreachable)
+        - closed data index partitions are uploaded every "data-collector-partition-interval" seconds
+
+    Parameters
+    ----------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    '''
+
+    file_transfer_dir = config_manager.config_data["hub-file-transfer-dir"]
+    upload_window = config_manager.config_data["data-collector-upload-window"]
+    log_interval = config_manager.config_data["data-collector-log-interval"]
+    purge_interval = config_manager.config_data["data-collector-purge-interval"]
+    partition_interval = config_manager.config_data["data-collector-partition-interval"]
+    uplink_scheduler = UplinkScheduler(config_manager)
+
+    # the watcher is created first, so no file is missed while the backlog is handled
+    # the storage client is kept (warm) across uploads, it is created again after a failure
+    directory_watcher = DirectoryWatcher(file_transfer_dir, config_manager.config_data["data-collector-poll-interval"])
+    storage_bucket = None
+
+    # the files present at start up are uploaded with the first window
+    pending_files = set(element for element in os.listdir(file_transfer_dir) if is_data_file(element))
+    window_start_time = time.time() if len(pending_files) > 0 else None
+    next_log_upload_time = time.time() + log_interval
+    next_purge_time = time.time() + purge_interval
+    next_partition_time = time.time() + partition_interval
+
+    time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+    logging.info("{0} - Hub data collector daemon watching ({1}), inotify : {2}".format(time_str, file_transfer_dir,
+                 directory_watcher.uses_inotify))
+
+    while True:
+
+        # a failing iteration is logged, its steps are retried with their next period (the daemon keeps running)
+        try :
+
+            # waiting for completed files, until the next timer
+            timer_times = [next_log_upload_time, next_purge_time, next_partition_time]
+            if window_start_time is not None:
+                timer_times.append(window_start_time + upload_window)
+            completed_files = directory_watcher.wait_for_files(max(0.0, min(timer_times) - time.time()))
+
+            # opening a window with the first completed file
+            completed_files = set(element for element in completed_files if is_data_file(element))
+            if len(completed_files) > 0:
+                pending_files |= completed_files
+                if window_start_time is None:
+                    window_start_time = time.time()
+
+            current_time = time.time()
+
+            upload_due = window_start_time is not None and current_time >= window_start_time + upload_window
+            partition_due = current_time >= next_partition_time
+            if (upload_due or partition_due or current_time >= next_log_upload_time) and storage_bucket is None:
+                try : storage_bucket = get_storage_bucket(config_manager)
+                except Exception as e:
+                    time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                    logging.error("{0} - Hub data collector failed to connect to cloud storage : {1}".format(time_str, e))
+
+            # transcoding, then uploading the files of the window (retried with the next window on failure)
+            if upload_due:
+                pending_files = transcode_transfer_files(config_manager, pending_files)
+                if storage_bucket is not None:
+                    upload_columnar_batches(storage_bucket, config_manager, uplink_scheduler)
+                    pending_files = upload_transfer_files(storage_bucket, pending_files, config_manager, uplink_scheduler)
+                window_start_time = current_time if len(pending_files) > 0 else None
+
+            # uploading the log files and the left over data files and batches (lower priority, limited pass)
+            if current_time >= next_log_upload_time:
+                left_over_files = transcode_transfer_files(config_manager, [element for element in os.listdir(file_transfer_dir)
+                                                                            if is_data_file(element) and element not in pending_files])
+                if storage_bucket is not None:
+                    upload_columnar_batches(storage_bucket, config_manager, uplink_scheduler)
+                    upload_transfer_files(storage_bucket, [element for element in os.listdir(file_transfer_dir) 
+                                                           if element.endswith(".log") or element in left_over_files],
+                                          config_manager, uplink_scheduler, config_manager.config_data["uplink-pass-time"])
+                next_log_upload_time = current_time + log_interval
+
+            # uploading the closed data index partitions
+            if partition_due:
+                if storage_bucket is not None:
+                    try : upload_data_partitions(storage_bucket, config_manager, uplink_scheduler)
+                    except Exception as e:
+                        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                        logging.error("{0} - Hub data collector failed to upload data partitions : {1}".format(time_str, e))
+                next_partition_time = current_time + partition_interval
+
+            # a failed upload can come from a stale client
+            if len(pending_files) > 0 and upload_due:
+                storage_bucket = None
+
+            # purging old files
+            if current_time >= next_purge_time:
+                purge_timestamped_files(file_transfer_dir, config_manager)
+                next_purge_time = current_time + purge_interval
+
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - Hub data collector daemon iteration failed : {1}".format(time_str, e))
+
+            current_time = time.time()
+            storage_bucket = None
+            if window_start_time is not None and current_time >= window_start_time + upload_window:
+                window_start_time = current_time
+            if current_time >= next_log_upload_time:
+                next_log_upload_time = current_time + log_interval
+            if current_time >= next_purge_time:
+                next_purge_time = current_time + purge_interval
+            if current_time >= next_partition_time:
+                next_partition_time = current_time + partition_interval
+            time.sleep(config_manager.config_data["data-collector-poll-interval"])
+
+
 if __name__ == "__main__":
 
     # loading configurations
@@ -46,16 +437,22 @@ if __name__ == "__main__":
     try : 
 
         # setting up logging
+        # the daemon uploads (and deletes) its own log file, only the watched handler (re-opens the file) is used
         log_file_path = os.path.join(file_transfer_dir, config_manager.config_data["data-collector-log-name"])
-        logging.basicConfig(filename=log_file_path, filemode="a", format='%(name)s - %(levelname)s - %(message)s')    
+        if not args.daemon:
+            logging.basicConfig(filename=log_file_path, filemode="a", format='%(name)s - %(levelname)s - %(message)s')    
         logger = logging.getLogger()
         logger.setLevel(logging.INFO)
         log_handler = logging.handlers.WatchedFileHandler(log_file_path)
         log_handler.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
         logger.addHandler(log_handler)
 
+        # running as a daemon (uploads files as they are completed)
+        if args.daemon :
+            run_collector_daemon(config_manager)
+
         # purging old files (without transfer)
-        if args.offline :
+        elif args.offline :
 
             purge_timestamped_files(file_transfer_dir, config_manager)
             delete_log_files(file_transfer_dir)
@@ -68,21 +465,18 @@ if __name__ == "__main__":
         else : 
 
             # creating google storage client
-            storage_client = storage.Client()
-            storage_bucket = storage_client.get_bucket(config_manager.config_data["gcp_data_bucket"])
-
-            # going through all files in the transfer directory
-            for element in os.listdir(file_transfer_dir):
-                element_path = os.path.join(file_transfer_dir, element)
-                if os.path.isfile(element_path):
+            storage_bucket = get_storage_bucket(config_manager)
 
-                    # uploading the current file
-                    destination_path = os.path.join(config_manager.config_data["gcp_data_bucket_path"], element)
-                    blob = storage_bucket.blob(destination_path)
-                    blob.upload_from_filename(element_path)
+            # going through all files in the transfer directory (in priority order), the data files are
+            # transcoded into columnar batches first ((.part) files are still being written by the bluetooth server)
+            uplink_scheduler = UplinkScheduler(config_manager)
+            transfer_files = transcode_transfer_files(config_manager, [element for element in os.listdir(file_transfer_dir)
+                                                                       if not element.endswith(".part")])
+            upload_columnar_batches(storage_bucket, config_manager, uplink_scheduler)
+            upload_transfer_files(storage_bucket, transfer_files, config_manager, uplink_scheduler)
 
-                    # deleting the current file
-                    os.remove(element_path)
+            # uploading the closed data index partitions
+            upload_data_partitions(storage_bucket, config_manager, uplink_scheduler)
 
             # logging transfer success
             time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
@@ -1,18 +1,40 @@
 import re
+import gzip
+import json
+import hashlib
 import mock
+import queue
+import shutil
+import tarfile
+import tempfile
 import unittest
+import threading
 
 import os
 import sys
 import time
 import signal
 import socket
+import importlib
 import os.path
 import subprocess
 
-from tremium.config import HubConfigurationManager
-from tremium.bluetooth import NodeBluetoothClient, launch_node_bluetooth_client
-from tremium.file_management import get_image_from_hub_archive
+from tremium.config import HubConfigurationManager, NodeConfigurationManager
+from tremium.bluetooth import NodeBluetoothClient, HubServerConnectionHandler, launch_node_bluetooth_client
+from tremium.transfer import send_file_batch, send_file_tails, receive_update_batch, receive_update_range, wait_for_socket
+from tremium.file_management import get_image_from_hub_archive, get_file_digest, get_manifest_updates, get_node_image_manifest, locked_state_file
+from tremium.relay import UpdateRelayRegistry, NodeRelayServer, fetch_from_peer
+from tremium.archive_policy import ImageArchivePolicy, acquire_download_lease, release_download_lease
+from tremium.rollout import UpdateRollout, get_rollout_bucket
+from tremium.bandwidth import FairQueue, TransferFlow, ChunkGrant, TransferScheduler
+from tremium.scheduling import LinkEstimator, TransferCarryover, get_data_file_priority, plan_transfers
+from tremium.image_install import NodeImageInstaller, iter_archive_contents, get_pending_update_entries
+from tremium.profiling import PROFILE_ENV_VAR, profiled, profile_span
+from tremium.tracing import TraceSession, trace_span, trace_connection, parse_trace_header, load_trace_files, merge_trace_files
+from tremium.spool import DataSpool
+from tremium.data_writer import DataFileWriter
+from tremium.data_index import HubDataIndex, index_data_files
+from tremium.transport import TransportSelector, HubSelector, HubLoad, create_hub_listeners, TRANSPORT_BLUETOOTH, TRANSPORT_TCP
 
 
 def mocked_listdir(path):
@@ -71,6 +93,1685 @@ class UnitTestHubBluetoothServer(unittest.TestCase):
         assert check_passed == True
 
 
+    def test_manifest_updates(self):
+
+        ''' Testing the "get_manifest_updates" function (conditional update check) '''
+
+        test_node_id = "dev-test_node_machine_5"
+        up_to_date_manifest = {
+            "acquisition-component" : "dev-test_node_machine_5_acquisition-component_2019-09-07_13-57-19.tar.gz",
+            "monitoring-component" : "dev-test_node_machine_monitoring-component_2019-06-04_13-57-19.tar.gz"
+        }
+
+        # an up to date Node gets no updates
+        assert get_manifest_updates(test_node_id, up_to_date_manifest, self.config_manager) == []
+
+        # only the outdated installed components are returned
+        outdated_manifest = dict(up_to_date_manifest)
+        outdated_manifest["acquisition-component"] = "dev-test_node_machine_5_acquisition-component_2019-09-01_13-57-19.tar.gz"
+        assert get_manifest_updates(test_node_id, outdated_manifest, self.config_manager) == \
+            ["dev-test_node_machine_5_acquisition-component_2019-09-07_13-57-19.tar.gz"]
+
+
+class UnitTestBatchTransfer(unittest.TestCase):
+
+    ''' 
+    Holds the tests for the batch transfer commands (PUT_FILE_BATCH, FETCH_UPDATE_BATCH, APPEND_FILE)
+    The Hub connection handler is connected to the client through a local socket pair
+    '''
+
+    config_file_path = os.path.join("..", "..", "..", "config", "hub-test-config.json")
+    config_manager = HubConfigurationManager(config_file_path)
+
+
+    def launch_handler(self):
+
+        ''' Handles a connection in the background, returns the client socket '''
+
+        client_s, server_s = socket.socketpair()
+        connection_handler = HubServerConnectionHandler(self.config_file_path, server_s, "local")
+        handler_thread = threading.Thread(target=connection_handler.handle_connection, daemon=True)
+        handler_thread.start()
+        return client_s
+
+
+    def test_put_file_batch(self):
+
+        ''' Testing the upload of several files in a single request '''
+
+        work_dir = tempfile.mkdtemp()
+        hub_transfer_dir = self.config_manager.config_data["hub-file-transfer-dir"]
+        file_names = ["node-archived-data-2019-09-0{}_13-57-19.json".format(i) for i in range(1, 4)]
+
+        try :
+
+            # creating the files to upload (one of them is empty)
+            for file_index, file_name in enumerate(file_names):
+                with open(os.path.join(work_dir, file_name), "w") as file_h:
+                    file_h.write("test\n" * file_index * 1000)
+
+            client_s = self.launch_handler()
+            stored_files = send_file_batch(client_s, "dev_node_testing_01", 
+                                           [os.path.join(work_dir, file_name) for file_name in file_names], 10000)
+            client_s.close()
+
+            # every file was written out, with its full content
+            assert stored_files == file_names
+            for file_index, file_name in enumerate(file_names):
+                assert os.stat(os.path.join(hub_transfer_dir, file_name)).st_size == len("test\n") * file_index * 1000
+
+        finally:
+            shutil.rmtree(work_dir)
+            for file_name in file_names:
+                if os.path.isfile(os.path.join(hub_transfer_dir, file_name)):
+                    os.remove(os.path.join(hub_transfer_dir, file_name))
+
+
+    def test_fetch_update_batch(self):
+
+        ''' Testing the download of several update files in a single request '''
+
+        work_dir = tempfile.mkdtemp()
+        archive_names = [
+            "dev_node_testing_01_acquisition-component_2019-09-07_13-57-19.tar.gz",
+            "dev_node_testing_01_missing-component_2019-09-07_13-57-19.tar.gz",
+            "dev-test_node_machine_5_cache-component_2017-09-01_13-57-19.tar.gz"
+        ]
+
+        try :
+
+            client_s = self.launch_handler()
+            received_archives = receive_update_batch(client_s, archive_names, work_dir, 10000)
+            client_s.close()
+
+            # missing files are skipped, the others are received with the Hub's digest
+            assert [archive[0] for archive in received_archives] == [archive_names[0], archive_names[2]]
+            for archive_name, archive_digest in received_archives:
+                hub_archive_path = os.path.join(self.config_manager.config_data["hub-image-archive-dir"], archive_name)
+                assert get_file_digest(os.path.join(work_dir, archive_name + ".part")) == archive_digest
+                assert get_file_digest(hub_archive_path) == archive_digest
+
+        finally:
+            shutil.rmtree(work_dir)
+
+
+    def test_append_file(self):
+
+        ''' Testing the incremental shipping of log files (APPEND_FILE) '''
+
+        work_dir = tempfile.mkdtemp()
+        log_path = os.path.join(work_dir, "acquisition-logs.log")
+        hub_log_path = os.path.join(self.config_manager.config_data["hub-file-transfer-dir"], "dev_node_testing_01_acquisition-logs.log")
+
+        def ship_tail(generation, offset, size):
+            client_s = self.launch_handler()
+            shipped_offsets = send_file_tails(client_s, "dev_node_testing_01", 
+                                              [(log_path, "acquisition-logs.log", generation, offset, size)], 10000)
+            client_s.close()
+            return shipped_offsets
+
+        try :
+
+            with open(log_path, "w") as log_h:
+                log_h.write("line 1\nline 2\n")
+            assert ship_tail(1, 0, 14) == {"acquisition-logs.log" : 14}
+
+            # only the new tail is appended, bytes received before are skipped
+            with open(log_path, "a") as log_h:
+                log_h.write("line 3\n")
+            assert ship_tail(1, 7, 14) == {"acquisition-logs.log" : 21}
+            with open(hub_log_path, "r") as hub_log_h:
+                assert hub_log_h.read() == "line 1\nline 2\nline 3\n"
+
+            # a new generation of the log (replaced file) is appended from its start
+            with open(log_path, "w") as log_h:
+                log_h.write("line 4\n")
+            assert ship_tail(2, 0, 7) == {"acquisition-logs.log" : 7}
+            with open(hub_log_path, "r") as hub_log_h:
+                assert hub_log_h.read() == "line 1\nline 2\nline 3\nline 4\n"
+
+        finally:
+            shutil.rmtree(work_dir)
+            if os.path.isfile(hub_log_path):
+                os.remove(hub_log_path)
+
+
+    def test_log_rotation(self):
+
+        ''' Testing the rotation of a log that was never shipped (rotated before the first contact) '''
+
+        work_dir = tempfile.mkdtemp()
+        with mock.patch("tremium.cache.NodeCacheModel"):
+            node_bluetooth_client = NodeBluetoothClient(self.config_file_path)
+        config_data = node_bluetooth_client.config_manager.config_data
+        config_data["node-file-transfer-dir"] = work_dir
+        config_data["node-state-dir"] = os.path.join(work_dir, ".node-state")
+        config_data["node-log-rotate-size"] = 100
+        hub_transfer_dir = self.config_manager.config_data["hub-file-transfer-dir"]
+        hub_log_names = set(os.listdir(hub_transfer_dir))
+
+        def connect_to_hub():
+            node_bluetooth_client.server_s = self.launch_handler()
+        node_bluetooth_client._connect_to_server = connect_to_hub
+
+        try :
+            with open(os.path.join(work_dir, "acquisition-logs.log"), "w") as log_h:
+                log_h.write("line\n" * 50)
+
+            # the rotated log is shipped in full, then deleted (it is not rotated again)
+            shipped_offsets = node_bluetooth_client._ship_log_files()
+            assert shipped_offsets == {} and os.listdir(work_dir) == [".node-state"]
+            shipped_logs = [element for element in os.listdir(hub_transfer_dir)
+                            if element not in hub_log_names and element.startswith(config_data["node-id"] + "_")]
+            assert len(shipped_logs) == 1 and shipped_logs[0].startswith(config_data["node-id"] + "_acquisition-logs-")
+            with open(os.path.join(hub_transfer_dir, shipped_logs[0]), "r") as hub_log_h:
+                assert hub_log_h.read() == "line\n" * 50
+
+        finally:
+            shutil.rmtree(work_dir)
+            for element in os.listdir(hub_transfer_dir):
+                if element not in hub_log_names and element.startswith(config_data["node-id"] + "_"):
+                    os.remove(os.path.join(hub_transfer_dir, element))
+
+
+    def test_fetch_update_range(self):
+
+        ''' Testing the striped download of an update file (one range per connection) '''
+
+        work_dir = tempfile.mkdtemp()
+        archive_name = "dev_node_testing_01_acquisition-component_2019-09-07_13-57-19.tar.gz"
+        hub_archive_path = os.path.join(self.config_manager.config_data["hub-image-archive-dir"], archive_name)
+        part_file_path = os.path.join(work_dir, archive_name + ".part")
+        archive_size = os.stat(hub_archive_path).st_size
+
+        try :
+
+            # fetching the file in 3 ranges, on separate connections
+            with open(part_file_path, "wb") as part_file_h:
+                part_file_h.truncate(archive_size)
+            range_size = -(-archive_size // 3)
+            for range_start in range(0, archive_size, range_size):
+                client_s = self.launch_handler()
+                receive_update_range(client_s, archive_name, range_start, min(range_start + range_size, archive_size), 
+                                     part_file_path, 10000)
+                client_s.close()
+
+            # the reassembled file matches the Hub's copy
+            assert get_file_digest(part_file_path) == get_file_digest(hub_archive_path)
+
+            # out of bounds ranges are refused
+            client_s = self.launch_handler()
+            with self.assertRaises(ValueError):
+                receive_update_range(client_s, archive_name, 0, archive_size + 1, part_file_path, 10000)
+            client_s.close()
+
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class UnitTestUpdateRelay(unittest.TestCase):
+
+    ''' 
+    Holds the tests for the update relay (Nodes fetching updates from other Nodes)
+    Several Nodes are simulated over a local (TCP) transport
+    '''
+
+    # defining the config information for all the unitests
+    config_file_path = os.path.join("..", "..", "..", "config", "hub-test-config.json")
+    config_manager = HubConfigurationManager(config_file_path)
+    test_archive = "dev_node_testing_01_acquisition-component_2019-09-07_13-57-19.tar.gz"
+
+
+    @staticmethod
+    def tcp_socket_factory():
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+
+    def create_node(self, work_dir, node_id):
+
+        ''' Creates the config file and archive folder of a simulated Node, returns its relay server '''
+
+        node_dir = os.path.join(work_dir, node_id)
+        os.makedirs(node_dir)
+
+        config_data = dict(self.config_manager.config_data)
+        config_data["node-id"] = node_id
+        config_data["node-image-archive-dir"] = node_dir
+        config_data["node-state-dir"] = os.path.join(node_dir, ".node-state")
+
+        node_config_path = os.path.join(work_dir, node_id + ".json")
+        with open(node_config_path, "w") as config_h:
+            json.dump(config_data, config_h)
+
+        return NodeRelayServer(node_config_path, socket_factory=self.tcp_socket_factory)
+
+
+    def serve_once(self, relay_server):
+
+        ''' Handles a single relay request in the background, returns the listening port '''
+
+        listener_s = self.tcp_socket_factory()
+        listener_s.bind(("127.0.0.1", 0))
+        listener_s.listen(1)
+
+        def accept_and_handle():
+            peer_s, _ = listener_s.accept()
+            relay_server.handle_peer_connection(peer_s)
+            listener_s.close()
+
+        threading.Thread(target=accept_and_handle, daemon=True).start()
+        return listener_s.getsockname()[1]
+
+
+    def test_relay_peer_selection(self):
+
+        ''' Testing the peer assignment of the "UpdateRelayRegistry" '''
+
+        registry = UpdateRelayRegistry(self.config_manager)
+        registry.remove_archive(self.test_archive)
+
+        # without peers, the Hub serves the update
+        assert registry.select_peer(self.test_archive, "digest", "dev_node_testing_02") is None
+
+        # a peer relays to a single Node at a time (see "relay-peer-max-sessions")
+        registry.register_peer(self.test_archive, "digest", "dev_node_testing_01", "127.0.0.1", 5000)
+        assert registry.select_peer(self.test_archive, "digest", "dev_node_testing_02")[0] == "dev_node_testing_01"
+        assert registry.select_peer(self.test_archive, "digest", "dev_node_testing_03") is None
+
+        # peers holding an other version of the archive are never selected
+        assert registry.select_peer(self.test_archive, "other-digest", "dev_node_testing_03") is None
+
+        # once the assigned Node registers, both peers can relay
+        registry.register_peer(self.test_archive, "digest", "dev_node_testing_02", "127.0.0.1", 5001)
+        assert registry.select_peer(self.test_archive, "digest", "dev_node_testing_03") is not None
+        assert registry.select_peer(self.test_archive, "digest", "dev_node_testing_04") is not None
+        assert registry.select_peer(self.test_archive, "digest", "dev_node_testing_05") is None
+
+        registry.remove_archive(self.test_archive)
+
+
+    def test_relay_chain(self):
+
+        ''' Testing an update spreading from a seed Node to other Nodes through relays '''
+
+        work_dir = tempfile.mkdtemp()
+        registry = UpdateRelayRegistry(self.config_manager)
+        registry.remove_archive(self.test_archive)
+
+        try :
+
+            # the seed Node holds a verified copy of the Hub's archive
+            hub_archive_path = os.path.join(self.config_manager.config_data["hub-image-archive-dir"], self.test_archive)
+            archive_digest = get_file_digest(hub_archive_path)
+            nodes = {node_id : self.create_node(work_dir, node_id) 
+                     for node_id in ["dev_node_testing_01", "dev_node_testing_02", "dev_node_testing_03"]}
+            shutil.copy(hub_archive_path, os.path.join(work_dir, "dev_node_testing_01", self.test_archive))
+            nodes["dev_node_testing_01"].add_holding(self.test_archive, archive_digest)
+            registry.register_peer(self.test_archive, archive_digest, "dev_node_testing_01", "127.0.0.1", 
+                                   self.serve_once(nodes["dev_node_testing_01"]))
+
+            # every other Node fetches the archive from the peer the Hub assigns
+            for node_id in ["dev_node_testing_02", "dev_node_testing_03"]:
+
+                peer_id, address, port = registry.select_peer(self.test_archive, archive_digest, node_id)
+                output_path = os.path.join(work_dir, node_id, self.test_archive)
+                fetch_from_peer(address, port, self.test_archive, output_path, 
+                                nodes[node_id].config_manager, socket_factory=self.tcp_socket_factory)
+                assert get_file_digest(output_path) == archive_digest
+
+                # the Node becomes a relay peer
+                nodes[node_id].add_holding(self.test_archive, archive_digest)
+                registry.register_peer(self.test_archive, archive_digest, node_id, "127.0.0.1", 
+                                       self.serve_once(nodes[node_id]))
+
+            # the last Node was served by the most recent peer
+            assert peer_id == "dev_node_testing_02"
+
+        finally:
+            registry.remove_archive(self.test_archive)
+            shutil.rmtree(work_dir)
+
+
+    def test_interrupted_fetch(self):
+
+        ''' Testing that an archive fetched from a relay peer only takes its name once complete and verified '''
+
+        work_dir = tempfile.mkdtemp()
+        try :
+
+            with mock.patch("tremium.cache.NodeCacheModel"):
+                node_bluetooth_client = NodeBluetoothClient(self.config_file_path)
+            node_bluetooth_client.config_manager.config_data["node-image-archive-dir"] = work_dir
+            node_bluetooth_client.config_manager.config_data["relay-enabled"] = False
+            archive_data = os.urandom(10000)
+            update_source = {"source" : "PEER", "address" : "127.0.0.1", "port" : 5000, "digest" : None}
+
+            # the peer drops the connection halfway through the archive
+            def interrupted_fetch(address, port, archive_name, output_path, config_manager):
+                with open(output_path, "wb") as output_h:
+                    output_h.write(archive_data[ : 5000])
+                raise ValueError("incomplete transfer")
+
+            with mock.patch("tremium.bluetooth.fetch_from_peer", side_effect=interrupted_fetch):
+                assert not node_bluetooth_client._fetch_update_from_peer(self.test_archive, update_source)
+            assert os.listdir(work_dir) == []
+
+            # a complete archive is verified against the Hub's digest before it is renamed
+            def complete_fetch(address, port, archive_name, output_path, config_manager):
+                with open(output_path, "wb") as output_h:
+                    output_h.write(archive_data)
+
+            with mock.patch("tremium.bluetooth.fetch_from_peer", side_effect=complete_fetch):
+                update_source["digest"] = "0" * 64
+                assert not node_bluetooth_client._fetch_update_from_peer(self.test_archive, update_source)
+                assert os.listdir(work_dir) == []
+                update_source["digest"] = hashlib.sha256(archive_data).hexdigest()
+                assert node_bluetooth_client._fetch_update_from_peer(self.test_archive, update_source)
+            assert os.listdir(work_dir) == [self.test_archive]
+
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class UnitTestImageArchivePolicy(unittest.TestCase):
+
+    ''' Holds the tests for the garbage collection of the Hub image archives '''
+
+    config_file_path = os.path.join("..", "..", "..", "config", "hub-test-config.json")
+    config_manager = HubConfigurationManager(config_file_path)
+
+
+    def create_archive_dir(self, work_dir, archive_sizes):
+
+        ''' Creates an image archive folder with archives of the specified sizes, returns its config '''
+
+        config_data = dict(self.config_manager.config_data)
+        config_data["hub-image-archive-dir"] = os.path.join(work_dir, "image-archives-hub")
+        config_data["hub-state-dir"] = os.path.join(work_dir, ".hub-state")
+        os.makedirs(config_data["hub-image-archive-dir"])
+
+        for archive_name, archive_size in archive_sizes.items():
+            with open(os.path.join(config_data["hub-image-archive-dir"], archive_name), "wb") as archive_h:
+                archive_h.write(b" " * archive_size)
+
+        config_path = os.path.join(work_dir, "hub-config.json")
+        with open(config_path, "w") as config_h:
+            json.dump(config_data, config_h)
+        return HubConfigurationManager(config_path)
+
+
+    def test_archive_collection(self):
+
+        '''
+        Test goals :
+            - ensure only the newest versions of every (node id pattern, component) are kept
+            - ensure the disk budget is enforced with the oldest superseded versions
+            - ensure archives being downloaded are never deleted
+        '''
+
+        work_dir = tempfile.mkdtemp()
+        archive_sizes = {
+            "dev_node_testing_acquisition-component_2019-09-01_13-57-19.tar.gz" : 100,
+            "dev_node_testing_acquisition-component_2019-09-02_13-57-19.tar.gz" : 100,
+            "dev_node_testing_acquisition-component_2019-09-03_13-57-19.tar.gz" : 100,
+            "dev_node_testing_01_acquisition-component_2019-09-01_13-57-19.tar.gz" : 100,
+            "dev_node_testing_cache-component_2019-06-01_13-57-19.tar.gz" : 100,
+            "dev_node_testing_cache-component_2019-06-02_13-57-19.tar.gz" : 100
+        }
+
+        try :
+
+            config_manager = self.create_archive_dir(work_dir, archive_sizes)
+            config_manager.config_data["hub-image-archive-keep-versions"] = 2
+            config_manager.config_data["hub-image-archive-max-bytes"] = 10000
+
+            # the oldest version of the component is being downloaded
+            acquire_download_lease(config_manager, "dev_node_testing_acquisition-component_2019-09-01_13-57-19.tar.gz")
+            assert ImageArchivePolicy(config_manager).collect() == []
+
+            # once the download is done, the oldest version goes
+            release_download_lease(config_manager, "dev_node_testing_acquisition-component_2019-09-01_13-57-19.tar.gz")
+            assert ImageArchivePolicy(config_manager).collect() == \
+                ["dev_node_testing_acquisition-component_2019-09-01_13-57-19.tar.gz"]
+
+            # the disk budget only removes superseded versions, oldest first
+            config_manager.config_data["hub-image-archive-max-bytes"] = 350
+            assert sorted(ImageArchivePolicy(config_manager).collect()) == [
+                "dev_node_testing_acquisition-component_2019-09-02_13-57-19.tar.gz",
+                "dev_node_testing_cache-component_2019-06-01_13-57-19.tar.gz"
+            ]
+            assert len(os.listdir(config_manager.config_data["hub-image-archive-dir"])) == 3
+
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class UnitTestUpdateRollout(unittest.TestCase):
+
+    ''' Holds the tests for the staged rollout of the update archives (waves, update slots, RETRY_AFTER) '''
+
+    config_file_path = os.path.join("..", "..", "..", "config", "hub-test-config.json")
+    old_archive = "dev_node_rollout_acquisition-component_2019-09-01_13-57-19.tar.gz"
+    new_archive = "dev_node_rollout_acquisition-component_2019-09-07_13-57-19.tar.gz"
+
+
+    def setUp(self):
+
+        # the new archive landed on the hub 50 seconds ago
+        self.work_dir = tempfile.mkdtemp()
+        config_data = HubConfigurationManager(self.config_file_path).config_data
+        config_data["hub-image-archive-dir"] = os.path.join(self.work_dir, "image-archives-hub")
+        config_data["hub-state-dir"] = os.path.join(self.work_dir, ".hub-state")
+        config_data["hub-rollout-waves"] = [{"pattern" : "dev_node_rollout_canary", "delay" : 0},
+                                            {"percent" : 50, "delay" : 100}, {"percent" : 100, "delay" : 200}]
+        os.makedirs(config_data["hub-image-archive-dir"])
+        for archive_name in [self.old_archive, self.new_archive]:
+            with open(os.path.join(config_data["hub-image-archive-dir"], archive_name), "wb") as archive_h:
+                archive_h.write(b" " * 100)
+        os.utime(os.path.join(config_data["hub-image-archive-dir"], self.new_archive), (time.time() - 50, time.time() - 50))
+
+        self.config_path = os.path.join(self.work_dir, "hub-config.json")
+        with open(self.config_path, "w") as config_h:
+            json.dump(config_data, config_h)
+        self.config_manager = HubConfigurationManager(self.config_path)
+
+        # nodes in the first and the second half of the rollout buckets
+        node_ids = ["dev_node_rollout_{:02d}".format(i) for i in range(100)]
+        self.early_node_id = [node_id for node_id in node_ids if get_rollout_bucket(node_id) < 50][0]
+        self.late_node_id = [node_id for node_id in node_ids if get_rollout_bucket(node_id) >= 50][0]
+
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+    def test_waves(self):
+
+        '''
+        Test goals :
+            - ensure the nodes matching the first wave get the update right away
+            - ensure the other nodes are told when their wave opens, and get the update from then on
+            - ensure nodes outside every wave never get the update
+        '''
+
+        rollout = UpdateRollout(self.config_manager)
+        assert rollout.filter_updates("dev_node_rollout_canary", [self.new_archive]) == ([self.new_archive], None)
+
+        released_images, retry_after = rollout.filter_updates(self.early_node_id, [self.new_archive])
+        assert released_images == [] and 45 < retry_after <= 50
+        released_images, retry_after = rollout.filter_updates(self.late_node_id, [self.new_archive])
+        assert released_images == [] and 145 < retry_after <= 150
+        assert rollout.filter_updates(self.late_node_id, [self.new_archive], time.time() + 151) == ([self.new_archive], None)
+
+        rollout.waves = rollout.waves[ : 2]
+        assert rollout.filter_updates(self.late_node_id, [self.new_archive], time.time() + 1000) == ([], None)
+
+
+    def test_update_slots(self):
+
+        '''
+        Test goals :
+            - ensure at most "hub-rollout-max-active" nodes are updating at the same time
+            - ensure a slot is released once its node is up to date (or when it times out)
+        '''
+
+        rollout = UpdateRollout(self.config_manager)
+        rollout.waves = []
+        rollout.max_active = 1
+        rollout.slot_timeout = 10
+
+        assert rollout.check_updates(self.early_node_id, [self.new_archive]) == ([self.new_archive], None)
+        update_images, retry_after = rollout.check_updates(self.late_node_id, [self.new_archive])
+        assert update_images == [] and rollout.retry_time <= retry_after <= rollout.retry_time * 1.5
+
+        # the first node is up to date, its slot goes to the next node
+        assert rollout.check_updates(self.early_node_id, []) == ([], None)
+        assert rollout.check_updates(self.late_node_id, [self.new_archive]) == ([self.new_archive], None)
+        assert rollout.check_updates("dev_node_rollout_canary", [self.new_archive], time.time() + 11) == ([self.new_archive], None)
+
+
+    def test_retry_after(self):
+
+        ''' Testing the RETRY_AFTER response (hub) and the skipped update checks (node) '''
+
+        def connect_to_hub():
+            client_s, server_s = socket.socketpair()
+            connection_handler = HubServerConnectionHandler(self.config_path, server_s, "local")
+            threading.Thread(target=connection_handler.handle_connection, daemon=True).start()
+            node_bluetooth_client.server_s = client_s
+
+        with mock.patch("tremium.cache.NodeCacheModel"):
+            node_bluetooth_client = NodeBluetoothClient(self.config_path)
+        node_bluetooth_client.config_manager.config_data["node-id"] = self.late_node_id
+        node_bluetooth_client._connect_to_server = connect_to_hub
+
+        assert node_bluetooth_client._check_manifest_updates({"acquisition-component" : self.old_archive}) == []
+        assert 145 < node_bluetooth_client.update_retry_time - time.time() <= 152
+
+        # no update check until then
+        node_bluetooth_client._connect_to_server = mock.Mock(side_effect=ConnectionError("no update check expected"))
+        assert node_bluetooth_client._run_update_stage()[0] == []
+        assert not node_bluetooth_client._connect_to_server.called
+
+
+class UnitTestMaintenanceScheduling(unittest.TestCase):
+
+    ''' Holds the tests for the deadline-aware scheduling of the Node maintenance transfers '''
+
+    config_file_path = os.path.join("..", "..", "..", "config", "hub-test-config.json")
+
+
+    def create_config_manager(self, work_dir):
+
+        ''' Returns a Node config manager keeping its state in the specified folder '''
+
+        config_manager = NodeConfigurationManager(self.config_file_path)
+        config_manager.config_data["node-state-dir"] = os.path.join(work_dir, ".node-state")
+        config_manager.config_data["node-image-archive-dir"] = work_dir
+        return config_manager
+
+
+    def test_transfer_planning(self):
+
+        '''
+        Test goals :
+            - ensure the window is unknown until a contact was completed
+            - ensure work is ordered by priority (newest first) and packed in the estimated window
+        '''
+
+        work_dir = tempfile.mkdtemp()
+
+        try :
+
+            config_manager = self.create_config_manager(work_dir)
+            link_estimator = LinkEstimator(config_manager)
+            link_estimator.mark_contact()
+            link_estimator.record_transfer(1000, 1.0)
+            assert link_estimator.remaining_window() is None
+
+            # simulating a completed 100s contact, followed by a new one
+            with locked_state_file(link_estimator.state_path, {}) as link_state:
+                link_state["contact_start"] -= 1000
+                link_state["last_activity"] = link_state["contact_start"] + 100
+            link_estimator.mark_contact()
+            assert 79 <= link_estimator.remaining_window() <= 80
+
+            # the window (80s at 1000 bytes/s) fits the flagged data and the newest data file
+            work_items = [
+                ("bluetooth-client-logs.log", get_data_file_priority("bluetooth-client-logs.log", config_manager), 3, 10000),
+                ("node-archived-data-01.json", get_data_file_priority("node-archived-data-01.json", config_manager), 1, 30000),
+                ("node-archived-data-02.json", get_data_file_priority("node-archived-data-02.json", config_manager), 2, 30000),
+                ("node-archived-data-flagged.json", get_data_file_priority("node-archived-data-flagged.json", config_manager), 0, 45000)
+            ]
+            scheduled_items, deferred_items = plan_transfers(work_items, link_estimator.remaining_window(), link_estimator)
+            assert [work_item[0] for work_item in scheduled_items] == ["node-archived-data-flagged.json", "node-archived-data-02.json"]
+            assert [work_item[0] for work_item in deferred_items] == ["node-archived-data-01.json", "bluetooth-client-logs.log"]
+
+        finally:
+            shutil.rmtree(work_dir)
+
+
+    def test_transfer_carryover(self):
+
+        ''' Testing the resumption of an update download interrupted at a previous contact '''
+
+        work_dir = tempfile.mkdtemp()
+        archive_name = "dev_node_testing_01_acquisition-component_2019-09-07_13-57-19.tar.gz"
+        hub_archive_path = os.path.join(UnitTestBatchTransfer.config_manager.config_data["hub-image-archive-dir"], archive_name)
+        archive_size = os.stat(hub_archive_path).st_size
+
+        try :
+
+            # simulating an interrupted download
+            carryover = TransferCarryover(self.create_config_manager(work_dir))
+            carryover.add_entry(archive_name, archive_size, get_file_digest(hub_archive_path))
+            part_file_path = carryover.get_part_file_path(archive_name)
+            with open(hub_archive_path, "rb") as archive_h, open(part_file_path, "wb") as part_file_h:
+                part_file_h.write(archive_h.read(archive_size // 2))
+
+            # resuming from the end of the partial file
+            received_size = carryover.get_entries()[archive_name][2]
+            assert received_size == archive_size // 2
+            client_s = UnitTestBatchTransfer().launch_handler()
+            receive_update_range(client_s, archive_name, received_size, archive_size, part_file_path, 10000)
+            client_s.close()
+            assert get_file_digest(part_file_path) == get_file_digest(hub_archive_path)
+
+            # entries without a partial file are dropped
+            os.remove(part_file_path)
+            assert carryover.get_entries() == {}
+
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class UnitTestTransferScheduler(unittest.TestCase):
+
+    ''' Holds the tests for the Hub fair-share scheduler of the bulk transfers '''
+
+    config_file_path = os.path.join("..", "..", "..", "config", "hub-test-config.json")
+    config_manager = HubConfigurationManager(config_file_path)
+
+
+    def test_fair_queuing(self):
+
+        '''
+        Test goals :
+            - ensure a node with a short transfer is not stuck behind a bulk transfer
+            - ensure backlogged nodes share the link according to the request type weights
+        '''
+
+        fair_queue = FairQueue({"GET_UPDATE" : 1, "STORE_FILE" : 2})
+        for _ in range(10):
+            fair_queue.push(0, "node-a", "GET_UPDATE", 10000)
+        fair_queue.push(1, "node-b", "GET_UPDATE", 100)
+        assert [fair_queue.pop()[0] for _ in range(3)] == [0, 1, 0]
+
+        fair_queue = FairQueue({"GET_UPDATE" : 1, "STORE_FILE" : 2})
+        for _ in range(12):
+            fair_queue.push(0, "node-a", "STORE_FILE", 1000)
+            fair_queue.push(1, "node-b", "GET_UPDATE", 1000)
+        granted_flows = [fair_queue.pop()[0] for _ in range(12)]
+        assert granted_flows.count(0) == 8 and granted_flows.count(1) == 4
+
+
+    def test_rate_caps(self):
+
+        ''' Testing the per node rate cap, other nodes keep using the link '''
+
+        fair_queue = FairQueue({}, node_rate_cap=1000)
+        current_time = time.time()
+        fair_queue.push(0, "node-a", "GET_UPDATE", 1000)
+        fair_queue.push(0, "node-a", "GET_UPDATE", 1000)
+        fair_queue.push(1, "node-b", "GET_UPDATE", 1000)
+
+        assert fair_queue.pop(current_time) == (0, 0.0)
+        assert fair_queue.pop(current_time) == (1, 0.0)
+        flow_id, wait_time = fair_queue.pop(current_time)
+        assert flow_id is None and 0.9 < wait_time <= 1.0
+        assert fair_queue.pop(current_time + 1.0)[0] == 0
+
+
+    def test_scheduled_transfer(self):
+
+        ''' Testing a batch download with its chunks granted by the scheduler '''
+
+        work_dir = tempfile.mkdtemp()
+        archive_name = "dev_node_testing_01_acquisition-component_2019-09-07_13-57-19.tar.gz"
+        hub_archive_path = os.path.join(self.config_manager.config_data["hub-image-archive-dir"], archive_name)
+        transfer_scheduler = TransferScheduler(self.config_manager)
+        transfer_scheduler.start()
+
+        try :
+
+            client_s, server_s = socket.socketpair()
+            connection_handler = HubServerConnectionHandler(self.config_file_path, server_s, ("local", 1), 
+                                                            transfer_scheduler.create_flow())
+            threading.Thread(target=connection_handler.handle_connection, daemon=True).start()
+            received_archives = receive_update_batch(client_s, [archive_name], work_dir, 1000)
+            client_s.close()
+
+            assert received_archives == [(archive_name, get_file_digest(hub_archive_path))]
+            assert get_file_digest(os.path.join(work_dir, archive_name + ".part")) == get_file_digest(hub_archive_path)
+
+        finally:
+            transfer_scheduler.stop()
+            shutil.rmtree(work_dir)
+
+
+    def test_chunk_grants(self):
+
+        '''
+        Test goals :
+            - ensure a grant covers several chunks (a single scheduler round trip)
+            - ensure a stream waiting for its node gives its grant back
+            - ensure a chunk fails when the scheduler does not grant it in time
+        '''
+
+        request_queue = queue.Queue()
+        grant_semaphore = threading.Semaphore(0)
+        chunk_grant = ChunkGrant(TransferFlow(request_queue, 0, grant_semaphore, 0.5, grant_chunks=4), "node-a", "STORE_FILE")
+
+        grant_semaphore.release()
+        for _ in range(4):
+            with chunk_grant(100): pass
+        assert [request_queue.get_nowait() for _ in range(2)] == [("REQUEST", 0, "node-a", "STORE_FILE", 400), ("DONE", 0)]
+        assert request_queue.empty()
+
+        client_s, server_s = socket.socketpair()
+        try :
+            grant_semaphore.release()
+            with chunk_grant(100): pass
+            request_queue.get_nowait()
+
+            # nothing to receive : the grant is given back before waiting
+            server_s.settimeout(0.2)
+            with self.assertRaises(socket.timeout):
+                wait_for_socket(server_s, chunk_grant)
+            assert request_queue.get_nowait() == ("DONE", 0)
+            client_s.sendall(b"data")
+            wait_for_socket(server_s, chunk_grant)
+            assert request_queue.empty()
+
+        finally:
+            client_s.close()
+            server_s.close()
+
+        with self.assertRaises(TimeoutError):
+            with chunk_grant(100): pass
+        assert [request_queue.get_nowait() for _ in range(2)] == [("REQUEST", 0, "node-a", "STORE_FILE", 400), ("CANCEL", 0)]
+
+
+    def test_stalled_nodes(self):
+
+        ''' Testing that nodes stalled in the middle of an upload do not hold back the other transfers '''
+
+        work_dir = tempfile.mkdtemp()
+        archive_name = "dev_node_testing_01_acquisition-component_2019-09-07_13-57-19.tar.gz"
+        hub_transfer_dir = self.config_manager.config_data["hub-file-transfer-dir"]
+        transfer_scheduler = TransferScheduler(self.config_manager)
+        transfer_scheduler.start()
+
+        def launch_handler(remote_address):
+            client_s, server_s = socket.socketpair()
+            connection_handler = HubServerConnectionHandler(self.config_file_path, server_s, remote_address,
+                                                            transfer_scheduler.create_flow())
+            threading.Thread(target=connection_handler.handle_connection, daemon=True).start()
+            return client_s
+
+        stalled_sockets = []
+        try :
+
+            # as many stalled uploads as chunks in flight
+            for node_index in range(self.config_manager.config_data["hub-scheduler-max-inflight"]):
+                client_s = launch_handler(("stalled-{}".format(node_index), 1))
+                client_s.sendall(bytes("STORE_FILE stalled-{0}.json stalled-{0}\n".format(node_index), "UTF-8"))
+                time.sleep(0.1)
+                client_s.sendall(b"data\n")
+                stalled_sockets.append(client_s)
+            time.sleep(0.2)
+
+            start_time = time.time()
+            client_s = launch_handler(("local", 1))
+            received_archives = receive_update_batch(client_s, [archive_name], work_dir, 1000)
+            client_s.close()
+            assert len(received_archives) == 1
+            assert time.time() - start_time < self.config_manager.config_data["hub-scheduler-grant-timeout"] / 2
+
+        finally:
+            for client_s in stalled_sockets:
+                client_s.close()
+            time.sleep(0.5)
+            transfer_scheduler.stop()
+            shutil.rmtree(work_dir)
+            for node_index in range(len(stalled_sockets)):
+                if os.path.isfile(os.path.join(hub_transfer_dir, "stalled-{}.json".format(node_index))):
+                    os.remove(os.path.join(hub_transfer_dir, "stalled-{}.json".format(node_index)))
+
+
+class UnitTestNodeImageInstaller(unittest.TestCase):
+
+    ''' Holds the tests for the background install of the Node updates '''
+
+    config_file_path = os.path.join("..", "..", "..", "config", "hub-test-config.json")
+
+
+    def setUp(self):
+
+        self.work_dir = tempfile.mkdtemp()
+        self.config_manager = NodeConfigurationManager(self.config_file_path)
+        self.config_manager.config_data["node-image-archive-dir"] = self.work_dir
+        self.config_manager.config_data["node-state-dir"] = os.path.join(self.work_dir, ".node-state")
+        self.config_manager.config_data["node-image-update-file"] = os.path.join(self.work_dir, "node-image-updates.txt")
+
+        # defining an update archive
+        self.archive_name = "dev_node_testing_01_acquisition-component_2019-09-07_13-57-19.tar.gz"
+        self.archive_data = os.urandom(300000)
+        with gzip.open(os.path.join(self.work_dir, self.archive_name), "wb") as archive_h:
+            archive_h.write(self.archive_data)
+        self.update_entry = "gcr.io/tremium/acquisition " + self.archive_name + " gcr.io/tremium/acquisition\n"
+
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+    def test_streamed_archive(self):
+
+        ''' Testing the on the fly decompression of an archive, and the pending update entries '''
+
+        archive_path = os.path.join(self.work_dir, self.archive_name)
+        chunks = list(iter_archive_contents(archive_path, 65536))
+        assert b"".join(chunks) == self.archive_data and max(len(chunk) for chunk in chunks) <= 65536
+
+        update_file_path = self.config_manager.config_data["node-image-update-file"]
+        assert get_pending_update_entries(update_file_path) is None
+        with open(update_file_path, "w") as update_file_h:
+            update_file_h.write(self.update_entry + "End")
+        assert get_pending_update_entries(update_file_path) == [self.update_entry]
+        with open(update_file_path, "w") as update_file_h:
+            update_file_h.write("\n")
+        assert get_pending_update_entries(update_file_path) is None
+
+
+    def test_install(self):
+
+        '''
+        Test goals :
+            - ensure the image is loaded before data collection is paused
+            - ensure data collection is restarted once the host swaps the containers
+            - ensure the manifest only records handed over updates (old archive deleted)
+            - ensure corrupted archives are never handed over (archive deleted, manifest kept)
+        '''
+
+        events = []
+        docker_client = mock.Mock()
+        docker_client.images.return_value = [{"Id" : "sha256:0123456789abcdef"}]
+        docker_client.load_image.side_effect = lambda data : events.append(("load", b"".join(data)))
+        cache = mock.Mock()
+        cache.stop_data_collection.side_effect = lambda : events.append(("stop",))
+        cache.start_data_collection.side_effect = lambda : events.append(("start",))
+
+        # the host update script applies the entries (crushes the update file)
+        update_file_path = self.config_manager.config_data["node-image-update-file"]
+        def swap_containers():
+            while get_pending_update_entries(update_file_path) is None: time.sleep(0.05)
+            with open(update_file_path, "r") as update_file_h:
+                events.append(("swap", update_file_h.read()))
+            with open(update_file_path, "w") as update_file_h:
+                update_file_h.write("\n")
+        swap_thread = threading.Thread(target=swap_containers, daemon=True)
+        swap_thread.start()
+
+        # the image being replaced
+        old_archive_name = "dev_node_testing_01_acquisition-component_2019-09-01_13-57-19.tar.gz"
+        with open(os.path.join(self.work_dir, old_archive_name), "w") as old_archive_h:
+            old_archive_h.write(" ")
+        manifest_path = self.config_manager.get_state_file_path("node-image-manifest-file")
+        with locked_state_file(manifest_path, {}) as node_manifest:
+            node_manifest["acquisition-component"] = old_archive_name
+
+        installer = NodeImageInstaller(self.config_manager, docker_client)
+        digest = get_file_digest(os.path.join(self.work_dir, self.archive_name))
+        pause_time = installer.install([self.update_entry], {self.archive_name : digest}, cache)
+        swap_thread.join()
+
+        expected_entry = "gcr.io/tremium/acquisition " + self.archive_name + " gcr.io/tremium/acquisition loaded 0123456789ab\n"
+        assert [event[0] for event in events] == ["load", "stop", "swap", "start"]
+        assert events[0][1] == self.archive_data and events[2][1] == expected_entry + "End"
+        assert pause_time is not None and pause_time < self.config_manager.config_data["node-update-swap-timeout"]
+        assert get_node_image_manifest(self.config_manager) == {"acquisition-component" : self.archive_name}
+        assert not os.path.isfile(os.path.join(self.work_dir, old_archive_name))
+
+        # a corrupted archive is dropped (and deleted), nothing is handed over nor recorded
+        events.clear()
+        with locked_state_file(manifest_path, {}) as node_manifest:
+            node_manifest["acquisition-component"] = old_archive_name
+        assert installer.install([self.update_entry], {self.archive_name : "0" * 64}, cache) is None
+        assert events == [] and get_pending_update_entries(update_file_path) is None
+        assert get_node_image_manifest(self.config_manager) == {"acquisition-component" : old_archive_name}
+        assert not os.path.isfile(os.path.join(self.work_dir, self.archive_name))
+
+
+class UnitTestProfiling(unittest.TestCase):
+
+    ''' Holds the tests for the profiling hooks '''
+
+    config_file_path = os.path.join("..", "..", "..", "config", "hub-test-config.json")
+
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.config_manager = HubConfigurationManager(self.config_file_path)
+        self.config_manager.config_data["profiling-dir"] = os.path.join(self.work_dir, "profiling")
+        self.config_manager.config_data["profiling-max-sessions"] = 2
+
+
+    def tearDown(self):
+        os.environ.pop(PROFILE_ENV_VAR, None)
+        shutil.rmtree(self.work_dir)
+
+
+    def test_profiled_sessions(self):
+
+        '''
+        Test goals :
+            - ensure nothing is recorded when profiling is off
+            - ensure a session writes its CPU profile, phase spans and memory snapshot
+            - ensure only the newest sessions are kept
+        '''
+
+        class ProfiledTask():
+            def __init__(self, config_manager):
+                self.config_manager = config_manager
+
+            @profiled("profiled_task")
+            def run(self):
+                with profile_span("busy_phase"):
+                    busy_end_time = time.time() + 0.1
+                    while time.time() < busy_end_time: pass
+                return self.load()
+
+            @profiled("load_phase")
+            def load(self):
+                return [bytearray(1000) for _ in range(100)]
+
+        profiled_task = ProfiledTask(self.config_manager)
+        profiling_dir = self.config_manager.config_data["profiling-dir"]
+
+        os.environ[PROFILE_ENV_VAR] = "0"
+        assert len(profiled_task.run()) == 100
+        assert not os.path.isdir(profiling_dir)
+
+        os.environ[PROFILE_ENV_VAR] = "1"
+        assert len(profiled_task.run()) == 100
+        output_files = sorted(os.listdir(profiling_dir))
+        assert len(output_files) == 3
+
+        session_prefix = os.path.join(profiling_dir, output_files[0].split(".")[0])
+        with open(session_prefix + ".folded", "r") as folded_h:
+            folded_lines = folded_h.read().splitlines()
+        assert any("run (test_bluetooth_interface.py" in line for line in folded_lines)
+        assert all(line.rsplit(" ", 1)[1].isdigit() for line in folded_lines)
+
+        with open(session_prefix + ".trace.json", "r") as trace_h:
+            span_names = [event["name"] for event in json.load(trace_h)["traceEvents"]]
+        assert sorted(span_names) == ["busy_phase", "load_phase", "profiled_task"]
+        with open(session_prefix + ".memory.txt", "r") as memory_h:
+            assert memory_h.readline().startswith("current : ")
+
+        # older sessions are rotated out
+        for _ in range(3):
+            time.sleep(1)
+            profiled_task.run()
+        assert len(os.listdir(profiling_dir)) == 6
+
+
+class UnitTestTracing(unittest.TestCase):
+
+    ''' Holds the tests for the request tracing (trace propagation from the node to the hub, merged timeline) '''
+
+    config_file_path = os.path.join("..", "..", "..", "config", "hub-test-config.json")
+    old_archive = "dev_node_tracing_acquisition-component_2019-09-01_13-57-19.tar.gz"
+    archive_name = "dev_node_tracing_acquisition-component_2019-09-07_13-57-19.tar.gz"
+
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        config_data = HubConfigurationManager(self.config_file_path).config_data
+        config_data["hub-image-archive-dir"] = os.path.join(self.work_dir, "image-archives-hub")
+        config_data["hub-state-dir"] = os.path.join(self.work_dir, ".hub-state")
+        config_data["tracing-enabled"] = True
+        config_data["tracing-dir"] = os.path.join(self.work_dir, "traces")
+        os.makedirs(config_data["hub-image-archive-dir"])
+        with open(os.path.join(config_data["hub-image-archive-dir"], self.archive_name), "wb") as archive_h:
+            archive_h.write(b" " * 100)
+
+        self.config_path = os.path.join(self.work_dir, "hub-config.json")
+        with open(self.config_path, "w") as config_h:
+            json.dump(config_data, config_h)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+    def test_trace_header(self):
+
+        ''' Testing the parsing of the trace header (traced and untraced requests) '''
+
+        assert parse_trace_header(b"CHECK_UPDATES_MANIFEST {}\n") == (None, b"CHECK_UPDATES_MANIFEST {}\n")
+        assert parse_trace_header(b"TRACE 5f2a0c9e81d4b7a3 81d4b7a3\nSTORE_FILE a.txt data") == \
+            (("5f2a0c9e81d4b7a3", "81d4b7a3"), b"STORE_FILE a.txt data")
+        assert parse_trace_header(b"TRACE 5f2a0c9e81d4b7a3\n") == (None, b"")
+
+
+    def test_request_trace(self):
+
+        '''
+        Test goals :
+            - ensure the hub handling of a traced request continues the node trace
+            - ensure the spans of both hosts are merged into a single timeline
+            - ensure nothing is recorded when tracing is off
+        '''
+
+        from multiprocessing import Process
+
+        def connect_to_hub():
+            client_s, server_s = socket.socketpair()
+            connection_handler = HubServerConnectionHandler(self.config_path, server_s, "local")
+            hub_handlers.append(Process(target=connection_handler.handle_connection))
+            hub_handlers[-1].start()
+            server_s.close()
+            node_bluetooth_client.server_s = trace_connection(client_s)
+
+        hub_handlers = []
+        with mock.patch("tremium.cache.NodeCacheModel"):
+            node_bluetooth_client = NodeBluetoothClient(self.config_path)
+        node_bluetooth_client.config_manager.config_data["node-id"] = "dev_node_tracing"
+        node_bluetooth_client._connect_to_server = connect_to_hub
+
+        with TraceSession(node_bluetooth_client.config_manager, "node_maintenance", "dev_node_tracing") as trace_session:
+            with trace_span("update check"):
+                assert node_bluetooth_client._check_manifest_updates({"acquisition-component" : self.old_archive}) == [self.archive_name]
+        for hub_handler in hub_handlers:
+            hub_handler.join(10)
+
+        tracing_dir = node_bluetooth_client.config_manager.config_data["tracing-dir"]
+        trace_file_paths = [os.path.join(tracing_dir, "dev_node_tracing_trace.jsonl"),
+                            os.path.join(tracing_dir, "{}_trace.jsonl".format(node_bluetooth_client.config_manager.config_data["hub-id"]))]
+        span_records = {(span_record["host"], span_record["name"]) : span_record for span_record in load_trace_files(trace_file_paths)}
+        assert all(span_record["trace"] == trace_session.trace_id for span_record in span_records.values())
+
+        # node session > update check > request > hub connection > hub request > archive scan
+        hub_id = node_bluetooth_client.config_manager.config_data["hub-id"]
+        assert span_records[("dev_node_tracing", "update check")]["parent"] == trace_session.span_id
+        request_record = span_records[("dev_node_tracing", "request CHECK_UPDATES_MANIFEST")]
+        assert request_record["parent"] == span_records[("dev_node_tracing", "update check")]["span"]
+        assert request_record["sent"] > 0 and request_record["received"] > 0
+        assert span_records[(hub_id, "hub_connection")]["parent"] == request_record["span"]
+        assert span_records[(hub_id, "receive request")]["parent"] == span_records[(hub_id, "hub_connection")]["span"]
+        assert span_records[(hub_id, "archive catalog")]["parent"] == span_records[(hub_id, "request CHECK_UPDATES_MANIFEST")]["span"]
+
+        merged_trace_path = os.path.join(self.work_dir, "merged_trace.json")
+        assert merge_trace_files(trace_file_paths, merged_trace_path, trace_session.trace_id) == len(span_records)
+        with open(merged_trace_path, "r") as merged_trace_h:
+            trace_events = json.load(merged_trace_h)["traceEvents"]
+        assert len([trace_event for trace_event in trace_events if trace_event["ph"] == "M"]) == 2
+
+        # tracing off
+        shutil.rmtree(tracing_dir)
+        node_bluetooth_client.config_manager.config_data["tracing-enabled"] = False
+        with TraceSession(node_bluetooth_client.config_manager, "node_maintenance", "dev_node_tracing"):
+            assert trace_connection(socket.socket()).__class__ is socket.socket
+        assert not os.path.isdir(tracing_dir)
+
+
+class UnitTestLazyImports(unittest.TestCase):
+
+    ''' Holds the tests for the import footprint of the tremium modules '''
+
+    def test_light_imports(self):
+
+        ''' Ensures importing the tremium modules does not load PyBluez, redis or multiprocessing '''
+
+        import_check = "import sys, tremium.config, tremium.file_management, tremium.cache, tremium.bluetooth; "
+        import_check += "print(','.join(module for module in ('bluetooth', 'redis', 'multiprocessing') if module in sys.modules))"
+        loaded_modules = subprocess.check_output([sys.executable, "-c", import_check], universal_newlines=True)
+        assert loaded_modules.strip() == ""
+
+
+class UnitTestDataSpool(unittest.TestCase):
+
+    ''' Holds the tests for the Node data spool '''
+
+    config_file_path = os.path.join("..", "..", "..", "config", "hub-test-config.json")
+
+
+    def setUp(self):
+
+        self.work_dir = tempfile.mkdtemp()
+        self.config_manager = NodeConfigurationManager(self.config_file_path)
+        self.config_manager.config_data["node-file-transfer-dir"] = self.work_dir
+        self.config_manager.config_data["node-state-dir"] = os.path.join(self.work_dir, ".node-state")
+        self.config_manager.config_data["spool-segment-age"] = 60
+        self.config_manager.config_data["spool-segment-max-bytes"] = 1000000
+
+        # spooled data files, an hour old (the flagged file is the oldest)
+        self.file_names = ["node-archived-data-2019-09-0{}_13-57-19.json".format(i) for i in range(1, 5)]
+        self.file_names.append("node-archived-data-flagged-2019-09-01_13-57-18.json")
+        for file_index, file_name in enumerate(self.file_names):
+            file_path = os.path.join(self.work_dir, file_name)
+            with open(file_path, "w") as file_h:
+                file_h.write("{}\n".format(file_index) * 20000)
+            file_time = time.time() - 3600 + file_index
+            os.utime(file_path, (file_time, file_time if "flagged" not in file_name else file_time - 100))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+    def test_index_and_segments(self):
+
+        '''
+        Test goals :
+            - ensure the spool index is built from the transfer folder once, then used alone
+            - ensure aged files are compressed into a segment (flagged files are left alone)
+        '''
+
+        data_spool = DataSpool(self.config_manager)
+        assert sorted(entry[0] for entry in data_spool.get_entries()) == sorted(self.file_names)
+
+        # files added behind the spool's back are not seen (no folder scan)
+        open(os.path.join(self.work_dir, "node-archived-data-2019-09-09_13-57-19.json"), "w").close()
+        assert len(data_spool.get_entries()) == len(self.file_names)
+
+        segments = data_spool.compress_aged_files()
+        spool_entries = [entry[0] for entry in data_spool.get_entries()]
+        assert len(segments) == 1 and sorted(spool_entries) == sorted(segments + [self.file_names[-1]])
+        with tarfile.open(os.path.join(self.work_dir, segments[0]), "r:gz") as segment_h:
+            assert sorted(segment_h.getnames()) == sorted(self.file_names[ : -1])
+
+        # a checked out file is never compressed or dropped
+        data_spool.checkout([self.file_names[-1]])
+        assert data_spool.enforce_budget(0) == segments
+        assert [entry[0] for entry in data_spool.get_entries()] == [self.file_names[-1]]
+
+
+    def test_drop_policies(self):
+
+        ''' Testing the downsampling and oldest first drop policies, and the acquisition throttle '''
+
+        cache = mock.Mock()
+        cache.check_data_collection_throttle.return_value = False
+
+        self.config_manager.config_data["spool-drop-policy"] = "downsample"
+        data_spool = DataSpool(self.config_manager)
+        segment_name = data_spool.compress_aged_files()[0]
+        spool_size = sum(entry[2] for entry in data_spool.get_entries())
+
+        # the segment is downsampled (one file out of two) before anything is dropped
+        assert data_spool.enforce_budget(spool_size - 1) == []
+        with tarfile.open(os.path.join(self.work_dir, segment_name), "r:gz") as segment_h:
+            assert len(segment_h.getnames()) == 2
+        assert data_spool.update_throttle(cache, spool_size) and cache.throttle_data_collection.called
+
+        # then the oldest files are dropped, flagged data last
+        flagged_size = [entry[2] for entry in data_spool.get_entries() if entry[0] == self.file_names[-1]][0]
+        assert data_spool.enforce_budget(flagged_size) == [segment_name]
+        assert data_spool.enforce_budget(0) == [self.file_names[-1]]
+        assert data_spool.get_entries() == [] and sorted(os.listdir(self.work_dir)) == [".node-state"]
+
+
+    def test_data_file_rotation(self):
+
+        '''
+        Test goals :
+            - ensure the main data file (active DataFileWriter segment) is left alone by default
+            - ensure it is rotated when no segment was closed, with "node-data-file-rotation" (legacy writers)
+        '''
+
+        cache = mock.Mock()
+        cache.data_file_available.return_value = True
+        self.config_manager.config_data["node-closed-segment-dir"] = os.path.join(self.work_dir, "closed-segments")
+        data_file_path = os.path.join(self.work_dir, self.config_manager.config_data["node-extracted-data-file"])
+        with open(data_file_path, "w") as data_file_h:
+            data_file_h.write("{}\n" * 100)
+
+        data_spool = DataSpool(self.config_manager)
+        assert data_spool.claim_closed_segments(cache) == [] and not cache.lock_data_file.called
+
+        self.config_manager.config_data["node-data-file-rotation"] = True
+        rotated_files = data_spool.claim_closed_segments(cache)
+        assert len(rotated_files) == 1 and rotated_files[0] in [entry[0] for entry in data_spool.get_entries()]
+        assert os.stat(os.path.join(self.work_dir, rotated_files[0])).st_size == 300 and os.stat(data_file_path).st_size == 0
+        assert cache.lock_data_file.called and cache.unlock_data_file.called
+
+        # the main data file is left alone while it is small
+        assert data_spool.claim_closed_segments(cache) == []
+
+
+class UnitTestDataFileWriter(unittest.TestCase):
+
+    ''' Holds the tests for the buffered data file writer '''
+
+    config_file_path = os.path.join("..", "..", "..", "config", "hub-test-config.json")
+
+
+    def setUp(self):
+
+        self.work_dir = tempfile.mkdtemp()
+        self.config_manager = NodeConfigurationManager(self.config_file_path)
+        self.config_manager.config_data["node-file-transfer-dir"] = self.work_dir
+        self.config_manager.config_data["node-closed-segment-dir"] = os.path.join(self.work_dir, ".closed-segments")
+        self.config_manager.config_data["node-state-dir"] = os.path.join(self.work_dir, ".node-state")
+        self.config_manager.config_data["node-data-file-max-size"] = 10000
+        self.config_manager.config_data["data-writer-group-bytes"] = 1000
+        self.config_manager.config_data["data-writer-group-time"] = 0.2
+        self.active_path = os.path.join(self.work_dir, self.config_manager.config_data["node-extracted-data-file"])
+
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+    def test_group_commit(self):
+
+        '''
+        Test goals :
+            - ensure records are committed in groups (one fsync per group)
+            - ensure a partial group is committed on time
+        '''
+
+        with mock.patch("os.fsync", wraps=os.fsync) as fsync_mock:
+            with DataFileWriter(self.config_manager) as data_writer:
+
+                for record_index in range(50):
+                    data_writer.append({"sensor" : "accel", "value" : record_index})
+                group_count = fsync_mock.call_count
+                assert group_count in (1, 2) and os.stat(self.active_path).st_size < 50 * 30
+
+                data_writer.append("partial")
+                time.sleep(0.5)
+                assert fsync_mock.call_count == group_count + 1
+
+        with open(self.active_path, "r") as active_h:
+            records = active_h.read().splitlines()
+        assert len(records) == 51 and json.loads(records[10])["value"] == 10 and records[-1] == "partial"
+
+
+    def test_rotation(self):
+
+        ''' Testing the rotation of the active segment, and the claim of the closed segments by the spool '''
+
+        # a segment left by a previous run is closed at start up
+        with open(self.active_path, "w") as active_h:
+            active_h.write("previous run\n")
+
+        with DataFileWriter(self.config_manager) as data_writer:
+            for record_index in range(1000):
+                data_writer.append({"value" : record_index})
+            data_writer.rotate()
+
+        closed_segments = sorted(os.listdir(self.config_manager.config_data["node-closed-segment-dir"]))
+        assert len(closed_segments) >= 3 and os.stat(self.active_path).st_size == 0
+
+        data_spool = DataSpool(self.config_manager)
+        assert data_spool.claim_closed_segments() == closed_segments
+        assert sorted(entry[0] for entry in data_spool.get_entries()) == closed_segments
+
+        record_count = 0
+        for segment_name in closed_segments:
+            with open(os.path.join(self.work_dir, segment_name), "r") as segment_h:
+                record_count += len(segment_h.read().splitlines())
+        assert record_count == 1001
+
+
+@unittest.skipIf(importlib.util.find_spec("numpy") is None, "numpy is only installed on the node")
+class UnitTestAudioFeatures(unittest.TestCase):
+
+    ''' Holds the tests for the streaming audio feature extraction '''
+
+    config_file_path = os.path.join("..", "..", "..", "config", "hub-test-config.json")
+
+
+    def setUp(self):
+
+        self.work_dir = tempfile.mkdtemp()
+        self.config_manager = NodeConfigurationManager(self.config_file_path)
+        self.config_manager.config_data["node-file-transfer-dir"] = self.work_dir
+        self.config_manager.config_data["node-closed-segment-dir"] = os.path.join(self.work_dir, ".closed-segments")
+        self.config_manager.config_data["node-data-file-max-size"] = 1000000
+
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+    def test_ring_buffer(self):
+
+        ''' Testing the framing of the ring buffer (overlap, wrap around, dropped samples) '''
+
+        import numpy as np
+        from tremium.audio_features import AudioRingBuffer
+
+        ring_buffer = AudioRingBuffer(10)
+        ring_buffer.write(np.arange(7, dtype=np.float32))
+        frames = ring_buffer.read_frames(4, 2)
+        assert frames.tolist() == [[0, 1, 2, 3], [2, 3, 4, 5]] and ring_buffer.available() == 3
+
+        # writing around the end of the buffer
+        ring_buffer.write(np.arange(7, 12, dtype=np.float32))
+        assert ring_buffer.read_frames(4, 2).tolist() == [[4, 5, 6, 7], [6, 7, 8, 9], [8, 9, 10, 11]]
+
+        # the reader fell behind, the oldest samples are dropped
+        assert ring_buffer.write(np.arange(12, 24, dtype=np.float32)) == 4
+        assert ring_buffer.read_frames(10, 10).tolist() == [list(range(14, 24))]
+
+
+    def test_features(self):
+
+        ''' Testing the features of a pure tone, and the records written out by the engine '''
+
+        import numpy as np
+        from tremium.audio_features import AudioFeatureEngine
+
+        sample_rate = self.config_manager.config_data["audio-sample-rate"]
+        time_axis = np.arange(sample_rate * 3) / sample_rate
+        pcm_data = (0.5 * np.sin(2 * np.pi * 1000 * time_axis) * 32767).astype("<i2").tobytes()
+
+        with DataFileWriter(self.config_manager) as data_writer:
+            engine = AudioFeatureEngine(self.config_manager, data_writer)
+
+            # odd sized reads, as returned by the audio source pipe
+            record_count = 0
+            for chunk_start in range(0, len(pcm_data), 3001):
+                record_count += engine.process(pcm_data[chunk_start : chunk_start + 3001], read_time=100)
+
+        data_file_path = os.path.join(self.work_dir, self.config_manager.config_data["node-extracted-data-file"])
+        with open(data_file_path, "r") as data_file_h:
+            records = [json.loads(line) for line in data_file_h.read().splitlines()]
+
+        assert record_count == len(records) == 2
+        assert abs(records[0]["peak"] - 1000) < sample_rate / self.config_manager.config_data["audio-frame-size"]
+        assert abs(records[0]["rms"] - 0.5 / np.sqrt(2)) < 0.01 and records[0]["flatness"] < 0.01
+        assert abs(records[1]["time"] - records[0]["time"] - records[0]["duration"]) < 0.002
+        assert len(records[0]["bands"]) == self.config_manager.config_data["audio-band-count"]
+
+
+    def test_dropped_samples(self):
+
+        ''' Testing that the records written after the ring buffer dropped samples keep the time of their audio '''
+
+        import numpy as np
+        from tremium.audio_features import AudioFeatureEngine
+
+        sample_rate = self.config_manager.config_data["audio-sample-rate"]
+        hop_size = self.config_manager.config_data["audio-hop-size"]
+        buffer_size = self.config_manager.config_data["audio-ring-buffer-time"] * sample_rate
+        pcm_data = (0.1 * np.random.randn(sample_rate * 14) * 32767).astype("<i2").tobytes()
+
+        with DataFileWriter(self.config_manager) as data_writer:
+            engine = AudioFeatureEngine(self.config_manager, data_writer)
+
+            # a first second of audio, then a read larger than the ring buffer (the reader fell behind)
+            engine.process(pcm_data[ : sample_rate * 2], read_time=101)
+            engine.process(pcm_data[sample_rate * 2 : ], read_time=114)
+
+        data_file_path = os.path.join(self.work_dir, self.config_manager.config_data["node-extracted-data-file"])
+        with open(data_file_path, "r") as data_file_h:
+            records = [json.loads(line) for line in data_file_h.read().splitlines()]
+
+        # the first record ends with the first frame read after the drop (oldest sample the buffer kept),
+        # the second record starts one hop later
+        kept_start = sample_rate * 14 - buffer_size
+        assert engine.dropped_samples > 0 and abs(records[0]["time"] - 100) < 0.002
+        assert abs(records[1]["time"] - (100 + (kept_start + hop_size) / sample_rate)) < 0.002
+        assert abs(records[-1]["time"] + records[-1]["duration"] - 114) < 1
+
+
+class UnitTestHubDataIndex(unittest.TestCase):
+
+    ''' Holds the tests for the time series index of the data received by the hub '''
+
+    config_file_path = os.path.join("..", "..", "..", "config", "hub-test-config.json")
+
+
+    def setUp(self):
+
+        self.work_dir = tempfile.mkdtemp()
+        self.config_manager = HubConfigurationManager(self.config_file_path)
+        self.config_manager.config_data["hub-file-transfer-dir"] = self.work_dir
+        self.config_manager.config_data["hub-state-dir"] = os.path.join(self.work_dir, ".hub-state")
+        self.config_manager.config_data["hub-data-index-batch-size"] = 7
+
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+    def write_data_file(self, file_name, start_time, count):
+
+        ''' Writes a data file with a record every 60 seconds from start_time '''
+
+        with open(os.path.join(self.work_dir, file_name), "w") as data_file_h:
+            for record_index in range(count):
+                data_file_h.write(json.dumps({"time" : start_time + record_index * 60, "value" : record_index}) + "\n")
+
+
+    def test_ingest_and_query(self):
+
+        ''' Testing the ingestion of data files and segments, and the range queries '''
+
+        self.write_data_file("node-archived-data-1.json", 36000, 150)
+        self.write_data_file("node-archived-data-2.json", 36000 + 150 * 60, 10)
+        with tarfile.open(os.path.join(self.work_dir, "node-archived-data-segment-1.tar.gz"), "w:gz") as segment_h:
+            segment_h.add(os.path.join(self.work_dir, "node-archived-data-2.json"), arcname="node-archived-data-2.json")
+        with open(os.path.join(self.work_dir, "node-archived-data-3.json"), "w") as data_file_h:
+            data_file_h.write("test\n\ntest\n")
+
+        assert index_data_files(self.config_manager, "node_a", ["node-archived-data-1.json", "bluetooth-client-logs.log"]) == 150
+        assert index_data_files(self.config_manager, "node_b", ["node-archived-data-segment-1.tar.gz", "node-archived-data-3.json"]) == 12
+
+        # files are only ingested once (retried uploads)
+        assert index_data_files(self.config_manager, "node_a", ["node-archived-data-1.json"]) == 0
+
+        data_index = HubDataIndex(self.config_manager)
+        try :
+            records = data_index.query("node_a", 36000 + 30 * 60, 36000 + 90 * 60)
+            assert [record["value"] for _, record in records] == list(range(30, 90))
+            assert len(data_index.query("node_a", 0, 10 ** 10)) == 150 and len(data_index.query("node_c", 0, 10 ** 10)) == 0
+
+            node_b_records = data_index.query("node_b", 0, 10 ** 10)
+            assert len(node_b_records) == 12 and node_b_records[-1][1] == "test"
+            assert data_index.connection.execute("SELECT COUNT(*) FROM partitions").fetchone()[0] == 4
+
+        finally:
+            data_index.close()
+
+
+    def test_partition_export(self):
+
+        ''' Testing the export of closed partitions, with late records and partition retention '''
+
+        export_dir = os.path.join(self.work_dir, "export")
+        os.makedirs(export_dir)
+
+        self.write_data_file("node-archived-data-1.json", 36000, 90)
+        index_data_files(self.config_manager, "node_a", ["node-archived-data-1.json"])
+        index_data_files(self.config_manager, "node_b", ["node-archived-data-1.json"])
+
+        data_index = HubDataIndex(self.config_manager)
+        try :
+
+            # only the closed partitions are exported
+            assert data_index.get_export_partitions(36000 + 7200, 3600) == [36000]
+            export_files, exported_rowid = data_index.export_partition(36000, export_dir)
+            assert len(export_files) == 2 and os.path.basename(export_files[0]).startswith("node_a_")
+            with gzip.open(export_files[0], "rt") as export_h:
+                assert [json.loads(line)["value"] for line in export_h] == list(range(60))
+            data_index.mark_exported(36000, exported_rowid)
+            assert data_index.get_export_partitions(36000 + 7200, 3600) == []
+
+            # late records are exported on their own
+            self.write_data_file("node-archived-data-2.json", 36000 + 30, 2)
+            index_data_files(self.config_manager, "node_a", ["node-archived-data-2.json"])
+            assert data_index.get_export_partitions(36000 + 7200, 3600) == [36000]
+            assert data_index.drop_partitions(36000 + 7200) == []
+
+            export_files, exported_rowid = data_index.export_partition(36000, export_dir)
+            with gzip.open(export_files[-1], "rt") as export_h:
+                assert len(export_h.read().splitlines()) == 2
+            data_index.mark_exported(36000, exported_rowid)
+
+            # exported partitions are dropped once they are old enough
+            assert data_index.drop_partitions(36000 + 7200) == [36000]
+            assert len(data_index.query("node_a", 0, 10 ** 10)) == 30
+
+        finally:
+            data_index.close()
+
+
+class UnitTestTcpTransport(unittest.TestCase):
+
+    '''
+    Holds the tests for the IP network transport (node and hub on the same machine)
+    The Hub connection handlers run in the background, behind a local TCP listener
+    '''
+
+    config_file_path = os.path.join("..", "..", "..", "config", "hub-test-config.json")
+
+
+    def setUp(self):
+
+        # listening on any free local port
+        hub_config_manager = HubConfigurationManager(self.config_file_path)
+        hub_config_manager.config_data["hub-transports"] = [TRANSPORT_TCP]
+        hub_config_manager.config_data["hub-tcp-port"] = 0
+        self.listener_s = create_hub_listeners(hub_config_manager)[0][1]
+        self.hub_port = self.listener_s.getsockname()[1]
+
+        self.hub_thread = threading.Thread(target=self.run_hub, args=(self.listener_s,), daemon=True)
+        self.hub_thread.start()
+
+        with mock.patch("tremium.cache.NodeCacheModel"):
+            self.node_bluetooth_client = NodeBluetoothClient(self.config_file_path)
+        self.node_bluetooth_client.config_manager.config_data["hub-tcp-port"] = self.hub_port
+
+
+    def tearDown(self):
+        self.listener_s.close()
+
+
+    def run_hub(self, listener_s, hub_load=None):
+
+        ''' Handles the incoming connections (until the listener is closed) '''
+
+        while True:
+            try : client_s, remote_address = listener_s.accept()
+            except OSError:
+                return
+            client_s.settimeout(1)
+            connection_handler = HubServerConnectionHandler(self.config_file_path, client_s, remote_address, hub_load=hub_load)
+            threading.Thread(target=connection_handler.handle_connection, daemon=True).start()
+
+
+    def test_requests(self):
+
+        ''' Testing CHECK_AVAILABLE_UPDATES, GET_UPDATE and STORE_FILE over the IP network '''
+
+        config_data = self.node_bluetooth_client.config_manager.config_data
+        expected_response = "dev-test_node_machine_5_acquisition-component_2019-09-07_13-57-19.tar.gz,dev-test_node_machine_monitoring-component_2019-06-04_13-57-19.tar.gz,dev-test_node_machine_5_cache-component_2017-09-01_13-57-19.tar.gz"
+        assert sorted(self.node_bluetooth_client._check_available_updates("dev-test_node_machine_5")) == sorted(expected_response.split(","))
+        assert self.node_bluetooth_client.hub_selector.current_transport == TRANSPORT_TCP
+
+        # the update is downloaded, then verified against the hub's digest
+        target_image_file = "dev_node_testing_01_acquisition-component_2019-09-07_13-57-19.tar.gz"
+        target_image_path_node = os.path.join(config_data["node-image-archive-dir"], target_image_file)
+        try :
+            assert self.node_bluetooth_client._get_update_file(target_image_file)
+            assert get_file_digest(target_image_path_node) == get_file_digest(os.path.join(config_data["hub-image-archive-dir"], target_image_file))
+        finally:
+            if os.path.isfile(target_image_path_node):
+                os.remove(target_image_path_node)
+
+        # the file data follows the request line on the same stream
+        target_file_path_hub = os.path.join(config_data["hub-file-transfer-dir"], "test_data.json")
+        try :
+            self.node_bluetooth_client._upload_file("test_data.json")
+            for _ in range(20):
+                if os.path.isfile(target_file_path_hub) and os.path.getsize(target_file_path_hub) == \
+                   os.path.getsize(os.path.join(config_data["node-file-transfer-dir"], "test_data.json")):
+                    break
+                time.sleep(0.1)
+            assert get_file_digest(target_file_path_hub) == get_file_digest(os.path.join(config_data["node-file-transfer-dir"], "test_data.json"))
+
+            # the file was indexed under the node id before it was renamed
+            data_index = HubDataIndex(HubConfigurationManager(self.config_file_path))
+            try :
+                assert data_index._is_ingested(config_data["node-id"], "test_data.json")
+            finally:
+                data_index.close()
+        finally:
+            time.sleep(0.5)
+            if os.path.isfile(target_file_path_hub):
+                os.remove(target_file_path_hub)
+
+
+    def test_fallback(self):
+
+        ''' Testing the fallback to bluetooth when the hub can not be reached over the IP network '''
+
+        # local port nothing listens on
+        unused_s = socket.socket()
+        unused_s.bind(("127.0.0.1", 0))
+        config_manager = NodeConfigurationManager(self.config_file_path)
+        config_manager.config_data["hub-tcp-port"] = unused_s.getsockname()[1]
+        transport_selector = TransportSelector(config_manager)
+
+        bluetooth_s, other_s = socket.socketpair()
+        with mock.patch("tremium.transport.connect_bluetooth", return_value=bluetooth_s) as bluetooth_mock:
+            assert transport_selector.connect() is bluetooth_s
+            assert transport_selector.current_transport == TRANSPORT_BLUETOOTH
+
+            # the IP network is skipped until "transport-fallback-time" is over
+            with mock.patch("tremium.transport.connect_tcp") as tcp_mock:
+                transport_selector.connect()
+                assert tcp_mock.call_count == 0 and bluetooth_mock.call_count == 2
+
+                transport_selector.skipped_until[TRANSPORT_TCP] = 0
+                transport_selector.connect()
+                assert tcp_mock.call_count == 1 and transport_selector.current_transport == TRANSPORT_TCP
+
+        bluetooth_s.close()
+        other_s.close()
+        unused_s.close()
+
+
+    def test_bind_address(self):
+
+        ''' Testing that the hub only listens on all the interfaces when it is allowed explicitly '''
+
+        hub_config_manager = HubConfigurationManager(self.config_file_path)
+        hub_config_manager.config_data["hub-transports"] = [TRANSPORT_TCP]
+        hub_config_manager.config_data["hub-tcp-port"] = 0
+        hub_config_manager.config_data["hub-tcp-bind-address"] = "0.0.0.0"
+        self.assertRaises(Exception, create_hub_listeners, hub_config_manager)
+
+        hub_config_manager.config_data["hub-tcp-allow-all-interfaces"] = True
+        listener_s = create_hub_listeners(hub_config_manager)[0][1]
+        assert listener_s.getsockname()[0] == "0.0.0.0"
+        listener_s.close()
+
+
+    def test_hub_selection(self):
+
+        '''
+        Test goals :
+            - ensure the node picks the least loaded hub in reach (HUB_STATUS)
+            - ensure the node fails over to the next hub when its hub can no longer be reached
+        '''
+
+        # second hub, busier than the first one
+        busy_hub_load = HubLoad()
+        busy_hub_load.set_active_sessions(5)
+        busy_hub_load.set_queue_depth(12)
+        busy_listener_s = socket.socket()
+        busy_listener_s.bind(("127.0.0.1", 0))
+        busy_listener_s.listen(5)
+        threading.Thread(target=self.run_hub, args=(busy_listener_s, busy_hub_load), daemon=True).start()
+
+        # hub nothing listens for
+        unused_s = socket.socket()
+        unused_s.bind(("127.0.0.1", 0))
+
+        config_manager = NodeConfigurationManager(self.config_file_path)
+        config_manager.config_data["transport-mode"] = TRANSPORT_TCP
+        config_manager.config_data["hub-list"] = [
+            {"hub-id" : "dev_hub_busy", "tcp-address" : "127.0.0.1", "tcp-port" : busy_listener_s.getsockname()[1]},
+            {"hub-id" : "dev_hub_down", "tcp-address" : "127.0.0.1", "tcp-port" : unused_s.getsockname()[1]},
+            {"hub-id" : "dev_hub_idle", "tcp-address" : "127.0.0.1", "tcp-port" : self.hub_port}]
+        hub_selector = HubSelector(config_manager)
+
+        try :
+            assert hub_selector.select_hub()["hub-id"] == "dev_hub_idle"
+            assert hub_selector.hub_loads == {"dev_hub_busy" : (5, 12), "dev_hub_idle" : (0, 0)}
+            hub_selector.connect().close()
+            assert hub_selector.current_hub["hub-id"] == "dev_hub_idle"
+
+            # the idle hub goes out of reach
+            self.listener_s.shutdown(socket.SHUT_RDWR)
+            self.listener_s.close()
+            hub_selector.connect().close()
+            assert hub_selector.current_hub["hub-id"] == "dev_hub_busy"
+
+        finally:
+            busy_listener_s.shutdown(socket.SHUT_RDWR)
+            busy_listener_s.close()
+            unused_s.close()
+
+
 class IntegrationTestHubBluetoothServer(unittest.TestCase):
 
     ''' 
@@ -142,11 +1843,10 @@ class IntegrationTestHubBluetoothServer(unittest.TestCase):
 
         def create_data_file(lines):
             
-            ''' Generates a data file with the specified amount of lines '''
+            ''' Writes the specified amount of lines with the data writer (acquisition) '''
 
-            data_file_path = os.path.join(node_transfer_dir, data_file_name)
-            with open(data_file_path, "w") as data_f:
-                for _ in range(lines): data_f.write("test\n")
+            with DataFileWriter(NodeConfigurationManager(self.config_file_path)) as data_writer:
+                for _ in range(lines): data_writer.append("test")
 
         def check_hub_for_files(file_names):
             
@@ -179,6 +1879,7 @@ class IntegrationTestHubBluetoothServer(unittest.TestCase):
 
         # final clean up
         os.remove(os.path.join(node_transfer_dir, data_file_name))
+        shutil.rmtree(self.config_manager.config_data["node-closed-segment-dir"])
 
 
     def test_node_maintenance(self):
@@ -206,9 +1907,14 @@ class IntegrationTestHubBluetoothServer(unittest.TestCase):
         expected_listing += update_image_zip + " "
         expected_listing += docker_registry_prefix + "dev_node_testing_01_acquisition-component\nEnd" 
 
+        # the installed images manifest is rebuilt from the archive folder
+        manifest_path = NodeConfigurationManager(self.config_file_path).get_state_file_path("node-image-manifest-file")
+        if os.path.isfile(manifest_path): os.remove(manifest_path)
+
         # launching hub maintenance and checking update listing (1)
         node_bluetooth_client = NodeBluetoothClient(self.config_file_path)
         node_bluetooth_client.launch_maintenance()
+        node_bluetooth_client.install_process.join()
         with open(update_listing_path, "r") as update_listing_h:
             assert expected_listing.rstrip() == update_listing_h.read().rstrip()
 
@@ -6,9 +6,193 @@ import subprocess
 import shutil
 
 import re
+import time
 import docker
+import tempfile
+import threading
 from google.cloud import pubsub_v1
 from tremium.config import HubConfigurationManager
+from tremium.image_updates import ImagePullScheduler, ImageLayerCache, archive_node_image, get_image_repository
+
+
+class FakeMessage():
+
+    ''' Stand-in for a pub/sub message (fake subscriber) '''
+
+    def __init__(self, image_path, publish_time):
+        self.data = image_path.encode("utf-8")
+        self.publish_time = publish_time
+        self.acked = False
+
+    def ack(self):
+        self.acked = True
+
+
+class UnitTestImagePullScheduler(unittest.TestCase):
+
+    ''' Holds the tests for the update manager's pull job scheduler (no registry or pub/sub needed) '''
+
+    def test_image_repository(self):
+
+        ''' Testing the component (image repository) extraction from image paths '''
+
+        assert get_image_repository("gcr.io/tremium/dev_node_test:latest") == "gcr.io/tremium/dev_node_test"
+        assert get_image_repository("gcr.io/tremium/dev_node_test@sha256:1a2b") == "gcr.io/tremium/dev_node_test"
+        assert get_image_repository("localhost:5000/dev_node_test") == "localhost:5000/dev_node_test"
+
+
+    def test_notification_coalescing(self):
+
+        '''
+        Test goals :
+            - ensure a burst of notifications for a component only pulls the newest image
+            - ensure all the notifications are acknowledged
+            - ensure different components are pulled concurrently
+        '''
+
+        pulled_images = []
+        release_first_pull = threading.Event()
+
+        def process_image(image_path):
+            pulled_images.append(image_path)
+            if image_path.endswith("v1"):
+                release_first_pull.wait(5)
+
+        pull_scheduler = ImagePullScheduler(process_image, max_workers=2)
+
+        # burst of notifications while the first pull of the component is running
+        messages = [FakeMessage("gcr.io/tremium/dev_node_acquisition:v{}".format(i), i) for i in range(1, 6)]
+        pull_scheduler.submit("gcr.io/tremium/dev_node_acquisition:v1", messages[0])
+        time.sleep(0.2)
+        for message in messages[1 : ][::-1]:
+            pull_scheduler.submit(message.data.decode("utf-8"), message)
+
+        # an other component is not blocked by the running pull
+        other_message = FakeMessage("gcr.io/tremium/dev_node_monitoring:v1", 1)
+        pull_scheduler.submit("gcr.io/tremium/dev_node_monitoring:v1", other_message)
+        time.sleep(0.2)
+        assert "gcr.io/tremium/dev_node_monitoring:v1" in pulled_images
+
+        release_first_pull.set()
+        pull_scheduler.shutdown(wait=True)
+
+        assert pulled_images.count("gcr.io/tremium/dev_node_acquisition:v1") == 1
+        assert "gcr.io/tremium/dev_node_acquisition:v5" in pulled_images
+        assert len(pulled_images) == 3
+        assert all([message.acked for message in messages + [other_message]])
+
+
+class FakeDockerClient():
+
+    ''' Stand-in for the docker client (docker.Client 1.10 calls) : images are (digest, layers), pulls only fetch the missing layers '''
+
+    def __init__(self, registry, resolve_digests=True):
+        self.registry = registry
+        self.resolve_digests = resolve_digests
+        self.local_images = {}
+        self.pull_count = 0
+        self.pulled_layers = []
+        self.removed_images = []
+
+    def _get_image_id(self, digest):
+        return "id-" + digest.split(":")[1]
+
+    def _url(self, pathfmt, *args, **kwargs):
+        return "http+docker://localunixsocket" + pathfmt.format(*args)
+
+    def _get(self, url, **kwargs):
+        image_path = re.match("http\\+docker://localunixsocket/distribution/(.+)/json$", url).group(1)
+        if not self.resolve_digests:
+            return (404, {"message" : "distribution inspection unavailable"})
+        return (200, {"Descriptor" : {"digest" : self.registry[image_path][0]}})
+
+    def _result(self, response, json=False):
+        if response[0] != 200:
+            raise RuntimeError(response[1]["message"])
+        return response[1]
+
+    def pull(self, image_path):
+        self.pull_count += 1
+        digest, layers = self.registry[image_path]
+        local_layers = set(layer for _, image_layers in self.local_images.values() for layer in image_layers)
+        self.pulled_layers.extend([layer for layer in layers if layer not in local_layers])
+        self.local_images[self._get_image_id(digest)] = (image_path, layers)
+        return '{"status" : "Pull complete", "id" : "latest"}'
+
+    def inspect_image(self, image_path):
+        digest, layers = self.registry[image_path]
+        return {"Id" : self._get_image_id(digest), "Size" : 100 * len(layers),
+                "RepoDigests" : [get_image_repository(image_path) + "@" + digest]}
+
+    def get_image(self, image_path):
+        for layer in self.registry[image_path][1]:
+            yield layer.encode("utf-8") * 100
+
+    def remove_image(self, image):
+        self.removed_images.append(image)
+        self.local_images.pop(image, None)
+
+
+class UnitTestImageArchiveDedupe(unittest.TestCase):
+
+    ''' Holds the tests for the digest based dedupe of the image pulls and the layer cache (fake docker client) '''
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.config_manager = HubConfigurationManager(os.environ['TREMIUM_CONFIG_FILE'])
+        self.config_manager.config_data["hub-image-archive-dir"] = self.work_dir
+        self.config_manager.config_data["hub-state-dir"] = os.path.join(self.work_dir, ".hub-state")
+        self.config_manager.config_data["update-manager-layer-cache-images"] = 2
+        self.registry = {"gcr.io/tremium/dev_node_acquisition:latest" : ("sha256:aa01", ["base", "libs", "app-1"])}
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+    def test_digest_dedupe(self):
+
+        '''
+        Test goals :
+            - ensure a re-sent notification for an archived digest is neither pulled nor exported
+            - ensure the digest is also resolved after the pull when the registry cannot be asked
+            - ensure an image is pulled again once its archive was deleted
+        '''
+
+        image_path = "gcr.io/tremium/dev_node_acquisition:latest"
+        for resolve_digests in (True, False):
+            docker_client = FakeDockerClient(self.registry, resolve_digests)
+            shutil.rmtree(self.work_dir)
+            os.makedirs(self.work_dir)
+
+            archive_name = archive_node_image(docker_client, image_path, self.config_manager)
+            assert archive_name is not None and archive_name.startswith("dev_node_acquisition_")
+            assert archive_node_image(docker_client, image_path, self.config_manager) is None
+            assert sorted(os.listdir(self.work_dir)) == sorted([archive_name, ".hub-state"])
+            assert docker_client.pull_count == (1 if resolve_digests else 2)
+
+            os.remove(os.path.join(self.work_dir, archive_name))
+            assert archive_node_image(docker_client, image_path, self.config_manager) is not None
+
+
+    def test_layer_cache(self):
+
+        '''
+        Test goals :
+            - ensure a new version only pulls the layers that changed
+            - ensure the least recently pulled images are removed past the cache bounds
+        '''
+
+        image_path = "gcr.io/tremium/dev_node_acquisition:latest"
+        docker_client = FakeDockerClient(self.registry)
+        layer_cache = ImageLayerCache(docker_client, self.config_manager)
+
+        for version in range(1, 4):
+            self.registry[image_path] = ("sha256:aa0{}".format(version), ["base", "libs", "app-{}".format(version)])
+            assert archive_node_image(docker_client, image_path, self.config_manager, layer_cache) is not None
+
+        assert docker_client.pulled_layers == ["base", "libs", "app-1", "app-2", "app-3"]
+        assert docker_client.removed_images == ["id-aa01"]
+        assert sorted(docker_client.local_images.keys()) == ["id-aa02", "id-aa03"]
 
 
 class TestUpdateManagerIntegration(unittest.TestCase):
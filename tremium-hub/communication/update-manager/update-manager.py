@@ -4,7 +4,11 @@ This script runs as a service in the "communication" container.
     - The service listens to a dedicated "update" pub/sub topic that publishes 
       available update notifications for Tremium Node images. 
     - When the service is alerted that a new image is available, it dowloads said image 
-      from Tremium's private registry and exports it to a .tar file. 
+      from Tremium's private registry and exports it to a .tar.gz file. 
+    - Notifications are coalesced per component and pulls run on a bounded pool of workers.
+    - Images whose registry digest was already archived are skipped, the pulled images are kept
+      in a bounded local layer cache (new versions only pull the layers that changed).
+      Setting PUBSUB_EMULATOR_HOST runs the service against a local pub/sub emulator.
     - Further down the line the image will be transfered to the Tremium Nodes connected
       to the Hub.
 '''
@@ -17,10 +21,9 @@ import datetime
 import logging.handlers
 
 import re
-import docker
-import gzip
-from google.cloud import pubsub_v1
 from tremium.config import HubConfigurationManager
+from tremium.image_updates import ImagePullScheduler, ImageLayerCache, archive_node_image
+from tremium.archive_policy import ImageArchivePolicy
 
 # parsing script arguments
 parser = argparse.ArgumentParser()
@@ -43,64 +46,58 @@ if __name__ == "__main__" :
         log_handler.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
         logger.addHandler(log_handler)
 
-        # creating necessary API clients 
+        # creating necessary API clients (loaded once the configurations are parsed)
+        import docker
+        from google.cloud import pubsub_v1
         docker_client = docker.Client(base_url=config_manager.config_data["docker-socket-path"])
         pubsub_subscriber = pubsub_v1.SubscriberClient()
         subscription_path = pubsub_subscriber.subscription_path(
                                         config_manager.config_data["gcp_project_id"], 
                                         config_manager.config_data["update_subscription_name"])
 
-        # defining call back for pub/sub messages
-        def update_callback(message):
-
-            message.ack()
-            new_image_path = message.data.decode("utf-8")
+        # pulled images are kept for their layers (bounded cache)
+        layer_cache = ImageLayerCache(docker_client, config_manager)
 
-            # checking if hub's organisation is concerned
-            image_name_pattern = config_manager.config_data["node-container-image-pattern"]
-            if re.match(image_name_pattern, new_image_path) is not None :
+        # applying the archive retention policy to the existing archives
+        ImageArchivePolicy(config_manager).collect()
 
-                try : 
-                  
-                    pull_response = docker_client.pull(new_image_path)
-                
-                    # cheking if image was properly pulled
-                    if "id" in pull_response :
+        # defining the pull job scheduler (coalesces notifications per component)
+        def process_image(new_image_path):
+            archive_name = archive_node_image(docker_client, new_image_path, config_manager, layer_cache)
+            if archive_name is not None:
 
-                        # loading the pulled image
-                        new_image_data = docker_client.get_image(new_image_path)
+                # logging successful image pull
+                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                logging.info("{0} - Node update manager successfuly pulled docker image : {1}".format(time_str, new_image_path))
 
-                        # defining the path of the archived image
-                        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
-                        archive_name = new_image_path.split("/")[-1].split(":")[0] + "_" + time_str + ".tar"
-                        archive_path = os.path.join(config_manager.config_data["hub-image-archive-dir"], archive_name)
+                # deleting the archives superseded by the new image
+                ImageArchivePolicy(config_manager).collect()
 
-                        # saving the pulled image to disk (.tar file)
-                        with open(archive_path, 'wb') as archive_f: 
-                            for chunk in new_image_data:
-                                archive_f.write(chunk)
+        pull_scheduler = ImagePullScheduler(process_image, config_manager.config_data["update-manager-max-workers"])
 
-                        # compressing the archive file
-                        archive_f = open(archive_path, 'rb')
-                        with gzip.open(archive_path + ".gz", 'wb') as ziped_f:
-                            archive_data = archive_f.read()
-                            ziped_f.write(archive_data)
-                        archive_f.close()                       
+        # defining call back for pub/sub messages
+        def update_callback(message):
 
-                        # clean up
-                        os.remove(archive_path)
-                        docker_client.remove_image(new_image_path)
+            new_image_path = message.data.decode("utf-8")
 
-                        # logging successful image pull
-                        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
-                        logging.info("{0} - Node update manager successfuly pulled docker image : {1}".format(time_str, new_image_path))
+            # checking if hub's organisation is concerned
+            # the message is acknowledged by the scheduler once the image is handled
+            image_name_pattern = config_manager.config_data["node-container-image-pattern"]
+            if re.match(image_name_pattern, new_image_path) is not None :
+                pull_scheduler.submit(new_image_path, message)
+            else :
+                message.ack()
 
-                except Exception as e:
-                    time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
-                    logging.error("{0} - Node update manager failed : {1}".format(time_str, e))
+        # limiting the outstanding (not acknowledged) messages during bursts
+        flow_control = pubsub_v1.types.FlowControl(
+                            max_messages=config_manager.config_data["update-manager-max-pending-messages"],
+                            max_bytes=config_manager.config_data["update-manager-max-pending-bytes"])
 
-        pubsub_subscriber.subscribe(subscription_path, callback=update_callback)
+        pubsub_subscriber.subscribe(subscription_path, callback=update_callback, flow_control=flow_control)
 
         while True :
             time.sleep(config_manager.config_data["node-update-check-delay"])
-            if args.oneshot: break
\ No newline at end of file
+            if args.oneshot: break
+
+        # letting the scheduled pulls complete
+        pull_scheduler.shutdown(wait=True)
\ No newline at end of file
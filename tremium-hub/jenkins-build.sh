@@ -19,8 +19,6 @@ cp ./config/hub-config.json ./$build_folder/
 cp ./config/TremiumDevEditor.json ./$build_folder/
 cp ./communication/update-manager/update-manager.py ./$build_folder/
 cp ./communication/data-collector/data-collector.py ./$build_folder/
-cp ./communication/data-collector/data-collector-cron ./$build_folder/
-cp ./communication/data-collector/launch-data-collector.sh ./$build_folder/
 cp ./communication/iot-communication-interface/bluetooth-interface.py ./$build_folder/
 
 # moving into the build folder
@@ -9,8 +9,9 @@ $bluetooth_cmd &
 update_manager_cmd="python update-manager.py $TREMIUM_CONFIG_FILE"
 $update_manager_cmd &
 
-# launching cron
-cron
+# launching the data collector daemon (in background)
+data_collector_cmd="python data-collector.py $TREMIUM_CONFIG_FILE --daemon"
+$data_collector_cmd &
 
 # preventing the docker "CMD" from ending
 tail -f /dev/null
\ No newline at end of file
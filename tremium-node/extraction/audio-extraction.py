@@ -0,0 +1,19 @@
+'''
+This script is the entry point to launch the Node audio feature extraction.
+Should run for as long as the Node container runs (launched by launch-node-services.sh)
+The extraction routine enables the node to :
+    - read the machine's audio (microphone), in real time
+    - extract spectral features from the audio
+    - write the features to the extracted data file (transfered to the hub by the maintenance routine)
+'''
+
+import argparse
+from tremium.audio_features import run_audio_extraction
+
+# parsing script arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("config_path", help="path to the .json config file")
+args = parser.parse_args()
+
+if __name__ == "__main__" :
+    run_audio_extraction(args.config_path)
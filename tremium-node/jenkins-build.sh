@@ -17,6 +17,7 @@ cp ./launch-node-services.sh ./$build_folder/
 cp -r ../tremium-py/ ./$build_folder/
 cp ./config/node-config.json ./$build_folder/
 cp ./maintenance/maintenance.py ./$build_folder/
+cp ./extraction/audio-extraction.py ./$build_folder/
 
 # moving into the build folder
 cd $build_folder
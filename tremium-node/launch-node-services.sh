@@ -5,5 +5,9 @@
 maintenance_cmd="python maintenance.py $TREMIUM_CONFIG_FILE"
 $maintenance_cmd &
 
+# launching the audio feature extraction (in background)
+extraction_cmd="python audio-extraction.py $TREMIUM_CONFIG_FILE"
+$extraction_cmd &
+
 # preventing the docker "CMD" from ending
 tail -f /dev/null
\ No newline at end of file
@@ -75,10 +75,10 @@ cat $registry_credentials_path | docker login -u _json_key --password-stdin $ima
 docker pull gcr.io/tremium/dev_node_testing_01_acquisition-component:latest
 
 # scheduling the node start up script on host device power up
-# setting update checks every 5 minutes
+# setting update checks every minute (data collection is paused until the containers are swapped)
 crontab -l > new_cron
 echo "@reboot $HOME/launch-node-container.sh" >> new_cron
-echo "*/5 * * * * $HOME/update-node.sh $HOME/tremium-mounted-volumes/image-archives-node/node-image-updates.txt" >> new_cron
+echo "* * * * * $HOME/update-node.sh $HOME/tremium-mounted-volumes/image-archives-node/node-image-updates.txt" >> new_cron
 crontab new_cron
 rm new_cron
 
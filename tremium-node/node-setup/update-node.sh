@@ -1,5 +1,6 @@
 #!/bin/bash
 # parses the node update file and performs the indicated docker container updates
+# entries flagged "loaded" were already loaded by the node (only the containers are swapped)
 #
 # Usage: 
 #   ./update-node.sh
@@ -29,9 +30,15 @@ do
         old_image_name=$(echo $line | cut -f1 -d ' ')
         new_image_archive=$(echo $line | cut -f2 -d ' ')
         new_image_name=$(echo $line | cut -f3 -d ' ')
+        load_status=$(echo $line | cut -f4 -d ' ')
 
-        # getting old ids
-        old_image_id=$(docker images $old_image_name --format "{{.ID}}")
+        # getting old ids (the node records the old image id, the new image already holds its tag)
+        if [ "$load_status" == "loaded" ]
+            then
+                old_image_id=$(echo $line | cut -f5 -d ' ')
+            else
+                old_image_id=$(docker images $old_image_name --format "{{.ID}}")
+        fi
         old_container_id=$(docker container ps --filter "ancestor=$old_image_id" --format "{{.ID}}")
 
         # stopping and deleting old container
@@ -41,9 +48,12 @@ do
         # deleting old image
         docker image rm -f $old_image_id
 
-        # loading new image from archive file
-        new_archive_path="${archive_dir}${new_image_archive}"
-        docker load -i $new_archive_path
+        # loading new image from archive file (when the node could not load it)
+        if [ "$load_status" != "loaded" ]
+            then
+                new_archive_path="${archive_dir}${new_image_archive}"
+                docker load -i $new_archive_path
+        fi
 
         # launching new container
         new_image_id=$(docker images $new_image_name --format "{{.ID}}")
@@ -0,0 +1,106 @@
+'''
+Real time benchmark of the Node audio feature extraction.
+
+Synthetic machine audio (harmonics + noise, 16 bit PCM) is fed to the AudioFeatureEngine in
+chunks of "audio-read-chunk-size" bytes, as it would be read from the audio source. The
+records are written to a throw away data file. Reported :
+    - real time factor : seconds of audio processed per second of wall time (must stay > 1)
+    - cpu load : CPU time used per second of audio (share of one core left to the other services)
+    - chunk latency : p50 / p99 processing time of a single chunk
+The run fails (exit code 1) when the cpu load goes over --max-cpu-load, run it on the Pi 4
+the node is deployed on.
+
+Usage :
+    python audio_features.py
+    python audio_features.py --duration 600 --max-cpu-load 0.25
+    python audio_features.py --config ../../tremium-node/config/node-config.json
+'''
+
+import os
+import os.path
+import sys
+
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+
+import numpy as np
+
+
+# repository layout
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(REPO_DIR, "tremium-py", "tremium"))
+
+from tremium.config import NodeConfigurationManager
+from tremium.data_writer import DataFileWriter
+from tremium.audio_features import AudioFeatureEngine
+
+
+def get_machine_audio(duration, sample_rate):
+
+    ''' Returns synthetic machine audio (16 bit PCM bytes) : rotating harmonics with amplitude modulation + noise '''
+
+    time_axis = np.arange(int(duration * sample_rate)) / sample_rate
+    signal = np.zeros(len(time_axis))
+    for harmonic, amplitude in ((1, 0.3), (2, 0.15), (3, 0.08), (7, 0.04)):
+        signal += amplitude * np.sin(2 * np.pi * 120 * harmonic * time_axis)
+    signal *= 1 + 0.2 * np.sin(2 * np.pi * 0.5 * time_axis)
+    signal += 0.05 * np.random.RandomState(0).standard_normal(len(time_axis))
+    return (np.clip(signal, -1, 1) * 32767).astype("<i2").tobytes()
+
+
+def run_benchmark(args):
+
+    config_manager = NodeConfigurationManager(args.config)
+    work_dir = tempfile.mkdtemp()
+    config_manager.config_data["node-file-transfer-dir"] = work_dir
+    config_manager.config_data["node-closed-segment-dir"] = os.path.join(work_dir, ".closed-segments")
+
+    sample_rate = config_manager.config_data["audio-sample-rate"]
+    chunk_size = config_manager.config_data["audio-read-chunk-size"]
+    pcm_data = get_machine_audio(args.duration, sample_rate)
+
+    chunk_times = []
+    record_count = 0
+    try :
+        with DataFileWriter(config_manager) as data_writer:
+            engine = AudioFeatureEngine(config_manager, data_writer)
+
+            start_time = time.perf_counter()
+            start_cpu_time = time.process_time()
+            for chunk_start in range(0, len(pcm_data), chunk_size):
+                chunk_start_time = time.perf_counter()
+                record_count += engine.process(pcm_data[chunk_start : chunk_start + chunk_size], read_time=0)
+                chunk_times.append(time.perf_counter() - chunk_start_time)
+            wall_time = time.perf_counter() - start_time
+            cpu_time = time.process_time() - start_cpu_time
+
+    finally:
+        shutil.rmtree(work_dir)
+
+    chunk_times.sort()
+    cpu_load = cpu_time / args.duration
+    print("audio : {0:.0f} s at {1} Hz, frame {2} / hop {3}, {4} records".format(
+        args.duration, sample_rate, config_manager.config_data["audio-frame-size"],
+        config_manager.config_data["audio-hop-size"], record_count))
+    print("real time factor : {0:.1f}x".format(args.duration / wall_time))
+    print("cpu load : {0:.1%} of one core (limit {1:.0%})".format(cpu_load, args.max_cpu_load))
+    print("chunk latency : p50 {0:.2f} ms, p99 {1:.2f} ms (chunk : {2:.0f} ms of audio)".format(
+        statistics.median(chunk_times) * 1e3, chunk_times[int(len(chunk_times) * 0.99)] * 1e3,
+        chunk_size / 2 / sample_rate * 1e3))
+
+    return cpu_load <= args.max_cpu_load
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="node configuration file",
+                        default=os.path.join(REPO_DIR, "tremium-node", "config", "node-config.json"))
+    parser.add_argument("--duration", help="seconds of audio processed", type=float, default=120)
+    parser.add_argument("--max-cpu-load", help="highest cpu load (share of one core) accepted", type=float, default=0.25)
+    args = parser.parse_args()
+
+    sys.exit(0 if run_benchmark(args) else 1)
@@ -0,0 +1,131 @@
+'''
+Write path benchmark of the Node's extracted data file.
+
+Compares, for the same stream of sensor records :
+    - naive : every record is appended by opening, writing and closing the data file
+              (with an fsync, so a record is durable once appended)
+    - writer : tremium.data_writer.DataFileWriter (group commit, one write + fsync per group)
+Reports the throughput (records/s, MB/s) and the p50 / p99 latency of a single append.
+
+Usage :
+    python data_writer.py
+    python data_writer.py --records 50000 --record-size 256 --group-bytes 65536
+'''
+
+import os
+import os.path
+import sys
+import json
+
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+
+
+# repository layout
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(REPO_DIR, "tremium-py", "tremium"))
+
+from tremium.data_writer import DataFileWriter
+
+
+class BenchmarkConfigManager():
+
+    ''' Minimal stand in for NodeConfigurationManager (only the data writer configurations) '''
+
+    def __init__(self, work_dir, group_bytes, group_time, max_segment_size):
+        self.config_data = {
+            "node-file-transfer-dir" : work_dir,
+            "node-closed-segment-dir" : os.path.join(work_dir, ".closed-segments"),
+            "node-extracted-data-file" : "node-extracted-data.json",
+            "node-archived-data-file" : "node-archived-data.json",
+            "node-data-file-max-size" : max_segment_size,
+            "data-writer-group-bytes" : group_bytes,
+            "data-writer-group-time" : group_time,
+            "data-writer-rotate-time" : 3600
+        }
+
+
+def get_records(record_count, record_size):
+
+    ''' Returns sensor records, serialized to about record_size bytes '''
+
+    padding = "x" * max(0, record_size - 60)
+    return [{"sensor" : "accel", "time" : 1500000000 + index, "value" : index, "pad" : padding}
+            for index in range(record_count)]
+
+
+def run_naive(work_dir, records):
+
+    ''' Appends every record by opening the data file (returns the append latencies) '''
+
+    data_file_path = os.path.join(work_dir, "node-extracted-data.json")
+    latencies = []
+    for record in records:
+        start_time = time.perf_counter()
+        with open(data_file_path, "a") as data_file_h:
+            data_file_h.write(json.dumps(record) + "\n")
+            data_file_h.flush()
+            os.fsync(data_file_h.fileno())
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def run_writer(work_dir, records, args):
+
+    ''' Appends every record with the data file writer (returns the append latencies) '''
+
+    config_manager = BenchmarkConfigManager(work_dir, args.group_bytes, args.group_time, args.max_segment_size)
+    latencies = []
+    with DataFileWriter(config_manager) as data_writer:
+        for record in records:
+            start_time = time.perf_counter()
+            data_writer.append(record)
+            latencies.append(time.perf_counter() - start_time)
+        data_writer.commit()
+    return latencies
+
+
+def get_written_size(work_dir):
+
+    written_size = 0
+    for dir_path, _, file_names in os.walk(work_dir):
+        written_size += sum(os.path.getsize(os.path.join(dir_path, file_name)) for file_name in file_names)
+    return written_size
+
+
+def run_benchmark(args):
+
+    records = get_records(args.records, args.record_size)
+
+    print("{0:<10} {1:>12} {2:>10} {3:>14} {4:>14}".format("mode", "records/s", "MB/s", "p50 (us)", "p99 (us)"))
+    for mode_name, run in (("naive", run_naive), ("writer", lambda work_dir, records : run_writer(work_dir, records, args))):
+
+        work_dir = tempfile.mkdtemp()
+        try :
+            start_time = time.perf_counter()
+            latencies = run(work_dir, records)
+            total_time = time.perf_counter() - start_time
+            written_size = get_written_size(work_dir)
+        finally:
+            shutil.rmtree(work_dir)
+
+        latencies.sort()
+        print("{0:<10} {1:>12.0f} {2:>10.2f} {3:>14.1f} {4:>14.1f}".format(
+            mode_name, len(records) / total_time, written_size / total_time / 1e6,
+            statistics.median(latencies) * 1e6, latencies[int(len(latencies) * 0.99)] * 1e6))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", help="number of records appended", type=int, default=20000)
+    parser.add_argument("--record-size", help="approximate size of a record (bytes)", type=int, default=200)
+    parser.add_argument("--group-bytes", help="writer group commit size (bytes)", type=int, default=65536)
+    parser.add_argument("--group-time", help="writer group commit time (seconds)", type=float, default=1.0)
+    parser.add_argument("--max-segment-size", help="writer segment rotation size (bytes)", type=int, default=20000000)
+    args = parser.parse_args()
+
+    run_benchmark(args)
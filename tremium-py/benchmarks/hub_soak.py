@@ -0,0 +1,457 @@
+'''
+Fleet scale soak test of the Tremium Hub server.
+
+A hub server (bluetooth-interface.py) is launched over the IP network transport (the local
+stand-in for RFCOMM), then hundreds of simulated nodes run maintenance cycles against it :
+    - CHECK_UPDATES_MANIFEST, then FETCH_UPDATE_BATCH when an update was rolled out
+    - PUT_FILE_BATCH of freshly written data files (JSON records, indexed by the hub)
+Update rollouts are simulated by adding a newer image archive to the hub archive folder.
+Every --sample-interval seconds the hub process tree is sampled (cpu, memory, open file
+descriptors, connection handler processes) along with the request latency percentiles and
+failure rates of the interval. Samples can be written out as JSON lines (--output).
+The run fails (exit code 1) when the failure rate goes over --max-failure-rate.
+
+Usage :
+    python hub_soak.py --nodes 200 --duration 600
+    python hub_soak.py --nodes 500 --cycle-interval 30 --rollout-interval 120 --output soak.jsonl
+'''
+
+import os
+import os.path
+import sys
+import json
+
+import time
+import heapq
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+# repository layout
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+TREMIUM_PACKAGE_DIR = os.path.join(REPO_DIR, "tremium-py", "tremium")
+HUB_SCRIPT_PATH = os.path.join(REPO_DIR, "tremium-hub", "communication", "iot-communication-interface", "bluetooth-interface.py")
+HUB_CONFIG_PATH = os.path.join(REPO_DIR, "tremium-hub", "config", "hub-test-config.json")
+sys.path.insert(0, TREMIUM_PACKAGE_DIR)
+
+from tremium.transfer import send_file_batch, receive_update_batch
+
+# simulated fleet naming (matches the hub "image-archive-pattern")
+NODE_ID_PATTERN = "soak_node_sim"
+COMPONENT_NAME = "acquisition-component"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def percentile(sorted_values, ratio):
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * ratio))]
+
+
+class RequestStats():
+
+    ''' Latencies and failures of the requests sent by the simulated nodes (reset every sample) '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.failures = {}
+        self.total_requests = 0
+        self.total_failures = 0
+
+
+    def record(self, request_name, latency, failed):
+        with self.lock:
+            self.total_requests += 1
+            if failed:
+                self.total_failures += 1
+                self.failures[request_name] = self.failures.get(request_name, 0) + 1
+            else :
+                self.latencies.setdefault(request_name, []).append(latency)
+
+
+    def collect(self):
+
+        ''' Returns {request name : (count, failures, p50, p95, p99)} of the interval, then resets it '''
+
+        with self.lock:
+            latencies, failures = self.latencies, self.failures
+            self.latencies, self.failures = {}, {}
+
+        interval_stats = {}
+        for request_name in set(latencies.keys()) | set(failures.keys()):
+            request_latencies = sorted(latencies.get(request_name, []))
+            interval_stats[request_name] = (len(request_latencies) + failures.get(request_name, 0), failures.get(request_name, 0),
+                                            percentile(request_latencies, 0.5), percentile(request_latencies, 0.95),
+                                            percentile(request_latencies, 0.99))
+        return interval_stats
+
+
+class HubProcessMonitor():
+
+    ''' Samples the resource usage of the hub process and of its connection handler processes (/proc) '''
+
+    def __init__(self, hub_pid):
+        self.hub_pid = hub_pid
+        self.last_cpu_time = None
+        self.last_sample_time = None
+
+
+    def _read_stat(self, pid):
+        with open("/proc/{}/stat".format(pid), "r") as stat_h:
+            stat_segs = stat_h.read().rsplit(")", 1)[1].split()
+        return int(stat_segs[1]), stat_segs[0], [int(value) for value in stat_segs[11 : 15]]
+
+
+    def _get_process_tree(self):
+
+        ''' Returns the pids of the hub and of all its descendants '''
+
+        children = {}
+        for pid_str in os.listdir("/proc"):
+            if pid_str.isdigit():
+                try : children.setdefault(self._read_stat(pid_str)[0], []).append(int(pid_str))
+                except (OSError, IndexError):
+                    pass
+
+        process_tree = [self.hub_pid]
+        for pid in process_tree:
+            process_tree.extend(children.get(pid, []))
+        return process_tree
+
+
+    def sample(self):
+
+        ''' Returns the resource usage of the hub process tree (cpu ratio since the last sample, rss, fds, processes) '''
+
+        cpu_ticks = 0
+        rss_bytes = 0
+        open_fds = 0
+        zombies = 0
+        process_tree = self._get_process_tree()
+        for pid in process_tree:
+            try :
+                _, state, cpu_times = self._read_stat(pid)
+
+                # the hub also accounts the cpu time of the handlers it reaped
+                cpu_ticks += sum(cpu_times) if pid == self.hub_pid else sum(cpu_times[ : 2])
+                if state == "Z":
+                    zombies += 1
+                    continue
+
+                with open("/proc/{}/status".format(pid), "r") as status_h:
+                    for line in status_h:
+                        if line.startswith("VmRSS:"):
+                            rss_bytes += int(line.split()[1]) * 1024
+                open_fds += len(os.listdir("/proc/{}/fd".format(pid)))
+
+            except (OSError, IndexError):
+                pass
+
+        sample_time = time.time()
+        cpu_time = cpu_ticks / CLOCK_TICKS
+        cpu_ratio = None
+        if self.last_cpu_time is not None:
+            cpu_ratio = (cpu_time - self.last_cpu_time) / (sample_time - self.last_sample_time)
+        self.last_cpu_time, self.last_sample_time = cpu_time, sample_time
+
+        return {"cpu" : cpu_ratio, "rss" : rss_bytes, "fds" : open_fds, "processes" : len(process_tree), "zombies" : zombies}
+
+
+class SimulatedNode():
+
+    ''' Node running maintenance cycles against the hub (one connection per request, as the real node) '''
+
+    def __init__(self, node_index, simulation):
+        self.node_id = "{0}_{1:04d}".format(NODE_ID_PATTERN, node_index)
+        self.simulation = simulation
+        self.work_dir = os.path.join(simulation.work_dir, "nodes", self.node_id)
+        self.installed_image = simulation.initial_image
+        self.cycle_count = 0
+        os.makedirs(self.work_dir)
+
+
+    def _request(self, request_name, request_func):
+
+        ''' Runs a request on a new connection to the hub, records its latency (returns None on failure) '''
+
+        start_time = time.perf_counter()
+        try :
+            with socket.create_connection(("127.0.0.1", self.simulation.hub_port), timeout=self.simulation.args.timeout) as hub_s:
+                result = request_func(hub_s)
+            self.simulation.stats.record(request_name, time.perf_counter() - start_time, False)
+            return result
+
+        except Exception:
+            self.simulation.stats.record(request_name, time.perf_counter() - start_time, True)
+            return None
+
+
+    def _check_manifest(self, hub_s):
+        hub_s.sendall(bytes("CHECK_UPDATES_MANIFEST {0} {1}".format(self.node_id, self.installed_image), "UTF-8"))
+        response_segs = hub_s.recv(self.simulation.buffer_size).decode("utf-8").split()
+        if response_segs == ["NOT_MODIFIED"]:
+            return []
+        if len(response_segs) == 2 and response_segs[0] == "UPDATES":
+            return response_segs[1].split(",")
+        raise ValueError("unexpected manifest response : {}".format(response_segs))
+
+
+    def _write_data_files(self):
+
+        ''' Writes the data files of the cycle (JSON records, as the node writer does) '''
+
+        data_file_paths = []
+        record_line = json.dumps({"type" : "audio-features", "time" : time.time(), "rms" : 0.01, "bands" : [-40.0] * 16})
+        record_count = max(1, self.simulation.args.data_file_size // (len(record_line) + 1))
+        for file_index in range(self.simulation.args.data_files):
+            data_file_path = os.path.join(self.work_dir, "node-archived-data-{0}-{1}-{2}.json".format(
+                                          self.node_id, self.cycle_count, file_index))
+            with open(data_file_path, "w") as data_file_h:
+                data_file_h.write((record_line + "\n") * record_count)
+            data_file_paths.append(data_file_path)
+        return data_file_paths
+
+
+    def run_cycle(self):
+
+        ''' Runs a maintenance cycle : update check (and download), data upload '''
+
+        self.cycle_count += 1
+        buffer_size = self.simulation.buffer_size
+
+        update_names = self._request("CHECK_UPDATES_MANIFEST", self._check_manifest)
+        if update_names:
+            received = self._request("FETCH_UPDATE_BATCH", lambda hub_s : receive_update_batch(hub_s, update_names, self.work_dir, buffer_size))
+            if received:
+                self.installed_image = update_names[0]
+            for element in os.listdir(self.work_dir):
+                if element.endswith(".part"):
+                    os.remove(os.path.join(self.work_dir, element))
+
+        data_file_paths = self._write_data_files()
+        self._request("PUT_FILE_BATCH", lambda hub_s : send_file_batch(hub_s, self.node_id, data_file_paths, buffer_size))
+        for data_file_path in data_file_paths:
+            os.remove(data_file_path)
+
+
+class SoakSimulation():
+
+    def __init__(self, args):
+
+        self.args = args
+        self.work_dir = tempfile.mkdtemp(prefix="tremium-soak-")
+        self.stats = RequestStats()
+        self.stop_event = threading.Event()
+
+        # hub configuration : test configuration, served over the IP network from the work folder
+        with open(HUB_CONFIG_PATH, "r") as config_h:
+            config_data = json.load(config_h)
+        self.hub_port = self._get_free_port()
+        config_data.update({
+            "hub-transports" : ["tcp"],
+            "hub-tcp-bind-address" : "127.0.0.1",
+            "hub-tcp-port" : self.hub_port,
+            "hub-image-archive-dir" : os.path.join(self.work_dir, "image-archives-hub"),
+            "hub-file-transfer-dir" : os.path.join(self.work_dir, "file-transfer-hub"),
+            "hub-state-dir" : os.path.join(self.work_dir, "image-archives-hub", ".hub-state"),
+            "relay-enabled" : False,
+            "profiling-enabled" : False
+        })
+        config_data.update(json.loads(args.config_overrides))
+        self.buffer_size = config_data["bluetooth-message-max-size"]
+        self.archive_dir = config_data["hub-image-archive-dir"]
+        self.transfer_dir = config_data["hub-file-transfer-dir"]
+        os.makedirs(self.archive_dir)
+        os.makedirs(self.transfer_dir)
+
+        self.config_path = os.path.join(self.work_dir, "soak-config.json")
+        with open(self.config_path, "w") as config_h:
+            json.dump(config_data, config_h, indent=4)
+
+        self.rollout_count = 0
+        self.initial_image = self.roll_out_update()
+        self.hub_process = None
+
+
+    def _get_free_port(self):
+        with socket.socket() as port_s:
+            port_s.bind(("127.0.0.1", 0))
+            return port_s.getsockname()[1]
+
+
+    def roll_out_update(self):
+
+        ''' Adds a newer image archive to the hub (every node will fetch it), returns its name '''
+
+        self.rollout_count += 1
+        archive_time = time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime(1500000000 + self.rollout_count * 3600))
+        archive_name = "{0}_{1}_{2}.tar.gz".format(NODE_ID_PATTERN, COMPONENT_NAME, archive_time)
+        with open(os.path.join(self.archive_dir, archive_name + ".part"), "wb") as archive_h:
+            archive_h.write(os.urandom(self.args.update_size))
+        os.rename(os.path.join(self.archive_dir, archive_name + ".part"), os.path.join(self.archive_dir, archive_name))
+        return archive_name
+
+
+    def start_hub(self):
+
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([TREMIUM_PACKAGE_DIR] + [path for path in [env.get("PYTHONPATH")] if path])
+        self.hub_process = subprocess.Popen([sys.executable, HUB_SCRIPT_PATH, self.config_path], env=env, cwd=self.work_dir,
+                                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+        # waiting for the hub to listen
+        for _ in range(100):
+            try :
+                socket.create_connection(("127.0.0.1", self.hub_port), timeout=1).close()
+                return
+            except OSError:
+                if self.hub_process.poll() is not None:
+                    raise RuntimeError("the hub server exited with code {}".format(self.hub_process.returncode))
+                time.sleep(0.1)
+        raise RuntimeError("the hub server is not listening")
+
+
+    def stop_hub(self):
+        if self.hub_process is not None and self.hub_process.poll() is None:
+            os.killpg(self.hub_process.pid, 9)
+            self.hub_process.wait()
+
+
+    def purge_hub_files(self, max_age):
+
+        ''' Deletes the received data files older than max_age (stand-in for the data collector) '''
+
+        for element in os.listdir(self.transfer_dir):
+            element_path = os.path.join(self.transfer_dir, element)
+            try :
+                if element.endswith(".json") and time.time() - os.stat(element_path).st_mtime > max_age:
+                    os.remove(element_path)
+            except OSError:
+                pass
+
+
+    def run_nodes(self):
+
+        ''' Schedules the maintenance cycles of the nodes (spread over the first cycle interval) '''
+
+        nodes = [SimulatedNode(node_index, self) for node_index in range(self.args.nodes)]
+        start_time = time.time()
+        schedule = [(start_time + random.uniform(0, self.args.cycle_interval), node_index) for node_index in range(len(nodes))]
+        heapq.heapify(schedule)
+
+        # a node only runs one cycle at a time
+        running_nodes = set()
+        running_lock = threading.Lock()
+
+        def run_node_cycle(node_index):
+            try : nodes[node_index].run_cycle()
+            finally:
+                with running_lock:
+                    running_nodes.discard(node_index)
+
+        with ThreadPoolExecutor(max_workers=self.args.max_concurrency) as executor:
+            while not self.stop_event.is_set():
+                cycle_time, node_index = heapq.heappop(schedule)
+                if self.stop_event.wait(max(0.0, cycle_time - time.time())):
+                    break
+
+                with running_lock:
+                    node_busy = node_index in running_nodes
+                    running_nodes.add(node_index)
+                if not node_busy:
+                    executor.submit(run_node_cycle, node_index)
+
+                next_cycle_time = time.time() + self.args.cycle_interval * random.uniform(0.8, 1.2)
+                heapq.heappush(schedule, (next_cycle_time, node_index))
+
+
+    def run(self):
+
+        self.start_hub()
+        monitor = HubProcessMonitor(self.hub_process.pid)
+        monitor.sample()
+
+        node_thread = threading.Thread(target=self.run_nodes, daemon=True)
+        node_thread.start()
+
+        samples = []
+        output_h = open(self.args.output, "w") if self.args.output else None
+        start_time = time.time()
+        next_rollout_time = start_time + self.args.rollout_interval if self.args.rollout_interval > 0 else None
+
+        print("{0:>7} {1:>6} {2:>9} {3:>5} {4:>6} {5:>7} {6:>7} {7:>9} {8:>9} {9:>9}".format(
+              "time", "cpu", "rss (MB)", "fds", "procs", "reqs", "failed", "p50 (ms)", "p95 (ms)", "p99 (ms)"))
+
+        try :
+            while time.time() - start_time < self.args.duration:
+                time.sleep(self.args.sample_interval)
+
+                if next_rollout_time is not None and time.time() >= next_rollout_time:
+                    self.roll_out_update()
+                    next_rollout_time += self.args.rollout_interval
+                self.purge_hub_files(self.args.sample_interval * 2)
+
+                if self.hub_process.poll() is not None:
+                    print("the hub server exited with code {}".format(self.hub_process.returncode))
+                    break
+
+                resources = monitor.sample()
+                request_stats = self.stats.collect()
+                sample = {"time" : round(time.time() - start_time, 1), "rollouts" : self.rollout_count}
+                sample.update(resources)
+                sample["requests"] = {request_name : dict(zip(("count", "failures", "p50", "p95", "p99"), values))
+                                      for request_name, values in request_stats.items()}
+                samples.append(sample)
+                if output_h is not None:
+                    output_h.write(json.dumps(sample) + "\n")
+                    output_h.flush()
+
+                request_count = sum(values[0] for values in request_stats.values())
+                failure_count = sum(values[1] for values in request_stats.values())
+                worst_latencies = [max((values[index] for values in request_stats.values() if values[index] is not None), default=0)
+                                   for index in (2, 3, 4)]
+                print("{0:>7.0f} {1:>6.0%} {2:>9.1f} {3:>5} {4:>6} {5:>7} {6:>7} {7:>9.1f} {8:>9.1f} {9:>9.1f}".format(
+                      sample["time"], resources["cpu"] or 0, resources["rss"] / 1e6, resources["fds"], resources["processes"],
+                      request_count, failure_count, *[latency * 1e3 for latency in worst_latencies]))
+
+        finally:
+            self.stop_event.set()
+            node_thread.join()
+            self.stop_hub()
+            if output_h is not None:
+                output_h.close()
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+        failure_rate = self.stats.total_failures / max(1, self.stats.total_requests)
+        print("nodes : {0}, requests : {1}, failure rate : {2:.2%}, peak rss : {3:.1f} MB, peak fds : {4}, peak processes : {5}".format(
+              self.args.nodes, self.stats.total_requests, failure_rate, max((sample["rss"] for sample in samples), default=0) / 1e6,
+              max((sample["fds"] for sample in samples), default=0), max((sample["processes"] for sample in samples), default=0)))
+        return failure_rate <= self.args.max_failure_rate
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", help="number of simulated nodes", type=int, default=200)
+    parser.add_argument("--duration", help="length of the soak (seconds)", type=float, default=300)
+    parser.add_argument("--cycle-interval", help="mean time between two maintenance cycles of a node (seconds)", type=float, default=60)
+    parser.add_argument("--data-files", help="data files uploaded per cycle", type=int, default=2)
+    parser.add_argument("--data-file-size", help="size of a data file (bytes)", type=int, default=50000)
+    parser.add_argument("--update-size", help="size of a rolled out update archive (bytes)", type=int, default=1000000)
+    parser.add_argument("--rollout-interval", help="time between two update rollouts (seconds, 0 : none)", type=float, default=120)
+    parser.add_argument("--max-concurrency", help="simulated nodes running a cycle at the same time", type=int, default=64)
+    parser.add_argument("--timeout", help="socket timeout of the simulated nodes (seconds)", type=float, default=30)
+    parser.add_argument("--sample-interval", help="time between two samples (seconds)", type=float, default=5)
+    parser.add_argument("--max-failure-rate", help="highest failure rate accepted", type=float, default=0.01)
+    parser.add_argument("--config-overrides", help="JSON object of hub configurations to override", default="{}")
+    parser.add_argument("--output", help="JSON lines file the samples are written to", default=None)
+    args = parser.parse_args()
+
+    sys.exit(0 if SoakSimulation(args).run() else 1)
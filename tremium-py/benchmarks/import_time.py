@@ -0,0 +1,108 @@
+'''
+Import time benchmark of the Tremium entry points.
+
+Every target is loaded in a fresh interpreter with "python -X importtime", the reported
+import time excludes the interpreter start up imports (measured with an empty run).
+    - tremium modules : "import tremium.(module)"
+    - entry scripts : "(script) --help", which loads the script imports then exits
+The heavy dependencies loaded by every target are listed (they should only be loaded
+by the code paths that need them).
+
+Usage :
+    python import_time.py
+    python import_time.py --runs 10
+'''
+
+import os
+import os.path
+import sys
+
+import argparse
+import statistics
+import subprocess
+
+
+# repository layout
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+TREMIUM_PACKAGE_DIR = os.path.join(REPO_DIR, "tremium-py", "tremium")
+
+MODULE_TARGETS = ["tremium.config", "tremium.file_management", "tremium.cache", "tremium.relay",
+                  "tremium.archive_policy", "tremium.image_updates", "tremium.bluetooth"]
+
+SCRIPT_TARGETS = [
+    os.path.join("tremium-node", "maintenance", "maintenance.py"),
+    os.path.join("tremium-hub", "communication", "iot-communication-interface", "bluetooth-interface.py"),
+    os.path.join("tremium-hub", "communication", "data-collector", "data-collector.py"),
+    os.path.join("tremium-hub", "communication", "update-manager", "update-manager.py")
+]
+
+HEAVY_MODULES = ["bluetooth", "redis", "docker", "google.cloud.storage", "google.cloud.pubsub_v1", "multiprocessing"]
+
+
+def parse_import_times(importtime_output):
+
+    '''
+    Returns ({module : cumulative import time (us)} of the top level imports, set of all imported modules)
+
+    Parameters
+    ----------
+    importtime_output (str) : stderr of a "python -X importtime" run
+    '''
+
+    top_level_times = {}
+    imported_modules = set()
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+
+        line_segs = line[len("import time:") : ].split("|")
+        if len(line_segs) != 3 or not line_segs[1].strip().isdigit():
+            continue
+
+        module_name = line_segs[2].rstrip()
+        imported_modules.add(module_name.strip())
+
+        # nested imports are indented (two spaces per level, after the leading space)
+        if not module_name.startswith("  "):
+            top_level_times[module_name.strip()] = int(line_segs[1])
+
+    return top_level_times, imported_modules
+
+
+def measure_target(command, env):
+
+    ''' Returns (total import time (ms), heavy modules loaded) of a single run of the command '''
+
+    run = subprocess.run([sys.executable, "-X", "importtime"] + command, env=env, cwd=REPO_DIR,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    top_level_times, imported_modules = parse_import_times(run.stderr)
+
+    heavy_modules = [module for module in HEAVY_MODULES if module in imported_modules]
+    return sum(top_level_times.values()) / 1000, heavy_modules
+
+
+def run_benchmark(runs):
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([TREMIUM_PACKAGE_DIR] + [path for path in [env.get("PYTHONPATH")] if path])
+
+    # interpreter start up imports (site, encodings, ...)
+    baseline_time = statistics.median(measure_target(["-c", "pass"], env)[0] for _ in range(runs))
+
+    targets = [(module, ["-c", "import " + module]) for module in MODULE_TARGETS]
+    targets += [(script, [script, "--help"]) for script in SCRIPT_TARGETS]
+
+    print("{0:<75} {1:>12}   {2}".format("target", "import (ms)", "heavy modules loaded"))
+    for target_name, command in targets:
+        measures = [measure_target(command, env) for _ in range(runs)]
+        import_time = statistics.median(measure[0] for measure in measures) - baseline_time
+        print("{0:<75} {1:>12.1f}   {2}".format(target_name, import_time, ", ".join(measures[-1][1]) or "-"))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", help="number of runs per target (the median is reported)", type=int, default=5)
+    args = parser.parse_args()
+
+    run_benchmark(args.runs)
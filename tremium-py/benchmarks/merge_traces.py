@@ -0,0 +1,37 @@
+'''
+Merges the request traces of the nodes and of the hub into a single timeline.
+
+The trace files ((host id)_trace.jsonl, in the "tracing-dir" of every host) are collected from
+the nodes and the hub, the merged timeline is written in the Chrome trace event format : open it
+in chrome://tracing or https://ui.perfetto.dev (one process row per host, the hub clock is aligned
+on the node clocks). A maintenance cycle is a single trace, its id is in the node maintenance report.
+
+Usage :
+    python merge_traces.py node_1_trace.jsonl hub_1_trace.jsonl -o maintenance.json
+    python merge_traces.py traces/*_trace.jsonl -o maintenance.json --trace 5f2a0c9e81d4b7a3
+'''
+
+import os
+import os.path
+import sys
+
+import argparse
+
+
+# repository layout
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(REPO_DIR, "tremium-py", "tremium"))
+
+from tremium.tracing import merge_trace_files
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace_files", help="trace files of the nodes and of the hub", nargs="+")
+    parser.add_argument("-o", "--output", help="path of the merged trace", default="merged_trace.json")
+    parser.add_argument("--trace", help="only merges the spans of this trace id", default=None)
+    args = parser.parse_args()
+
+    span_count = merge_trace_files(args.trace_files, args.output, args.trace)
+    print("merged {0} spans into {1}".format(span_count, args.output))
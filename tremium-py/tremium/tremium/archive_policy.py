@@ -0,0 +1,198 @@
+import os
+import os.path
+
+import time
+import logging
+import datetime
+
+from .relay import UpdateRelayRegistry
+from .file_management import parse_image_archive_name, load_state_file, locked_state_file
+
+
+def acquire_download_lease(config_manager, archive_name):
+
+    '''
+    Marks the specified archive as being downloaded by the current process (connection handler)
+    Archives with a valid lease are never deleted by the archive policy.
+
+    Parameters
+    ----------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    archive_name (str) : name of the image archive being downloaded
+    '''
+
+    lease_file_path = config_manager.get_state_file_path("hub-image-lease-file")
+    with locked_state_file(lease_file_path, {}) as leases:
+        leases.setdefault(archive_name, {})[str(os.getpid())] = time.time()
+
+
+def release_download_lease(config_manager, archive_name):
+
+    '''
+    Releases the download lease held by the current process on the specified archive
+
+    Parameters
+    ----------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    archive_name (str) : name of the downloaded image archive
+    '''
+
+    lease_file_path = config_manager.get_state_file_path("hub-image-lease-file")
+    with locked_state_file(lease_file_path, {}) as leases:
+        archive_leases = leases.get(archive_name, {})
+        archive_leases.pop(str(os.getpid()), None)
+        if len(archive_leases) == 0:
+            leases.pop(archive_name, None)
+
+
+def get_leased_archives(config_manager):
+
+    '''
+    Returns the set of archive names currently being downloaded.
+    A lease is valid while its process is alive and it is younger than the lease timeout.
+
+    Parameters
+    ----------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    '''
+
+    leased_archives = set()
+    current_time = time.time()
+    lease_timeout = config_manager.config_data["hub-image-lease-timeout"]
+    leases = load_state_file(config_manager.get_state_file_path("hub-image-lease-file"), {})
+
+    for archive_name, archive_leases in leases.items():
+        for pid, lease_time in archive_leases.items():
+
+            if current_time - lease_time > lease_timeout:
+                continue
+
+            # leases of dead processes are ignored
+            try : os.kill(int(pid), 0)
+            except ProcessLookupError: continue
+            except PermissionError: pass
+
+            leased_archives.add(archive_name)
+            break
+
+    return leased_archives
+
+
+class ImageArchivePolicy():
+
+    '''
+    Garbage collector for the Hub image archive folder
+        - keeps the newest N versions of every (node id pattern, component) pair
+        - deletes older versions (oldest first) while the archives exceed the disk budget
+        - never deletes the newest version of a component, or an archive being downloaded
+    '''
+
+    def __init__(self, config_manager):
+
+        '''
+        Parameters
+        ----------
+        config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+        '''
+
+        self.config_manager = config_manager
+        self.archive_dir = config_manager.config_data["hub-image-archive-dir"]
+
+
+    def _list_archive_groups(self):
+
+        '''
+        Returns the archives grouped by (node id pattern, component), each group sorted from
+        newest to oldest, as lists of (archive name, timestamp, size)
+        '''
+
+        archive_groups = {}
+        for archive_element in os.listdir(self.archive_dir):
+            archive_element_path = os.path.join(self.archive_dir, archive_element)
+            if os.path.isfile(archive_element_path) and archive_element.endswith(".tar.gz"):
+
+                archive_info = parse_image_archive_name(archive_element, self.config_manager)
+                if archive_info is not None:
+                    id_pattern, component_name, archive_timestamp = archive_info
+                    archive_groups.setdefault((id_pattern, component_name), []).append(
+                        (archive_element, archive_timestamp, os.stat(archive_element_path).st_size))
+
+        for group_archives in archive_groups.values():
+            group_archives.sort(key=lambda archive: archive[1], reverse=True)
+
+        return archive_groups
+
+
+    def select_archives(self, archive_groups, leased_archives):
+
+        '''
+        Returns the names of the archives to delete according to the policy
+
+        Parameters
+        ----------
+        archive_groups (dict) : archives grouped by (node id pattern, component), newest first
+        leased_archives (set) : names of the archives currently being downloaded
+        '''
+
+        keep_versions = max(1, self.config_manager.config_data["hub-image-archive-keep-versions"])
+        max_bytes = self.config_manager.config_data["hub-image-archive-max-bytes"]
+
+        selected_archives = []
+        superseded_archives = []
+        total_size = 0
+
+        for group_archives in archive_groups.values():
+            for archive_index, (archive_name, archive_timestamp, archive_size) in enumerate(group_archives):
+
+                # versions beyond the retention count are deleted
+                if archive_index >= keep_versions and archive_name not in leased_archives:
+                    selected_archives.append(archive_name)
+                    continue
+
+                total_size += archive_size
+                if archive_index > 0:
+                    superseded_archives.append((archive_timestamp, archive_name, archive_size))
+
+        # enforcing the disk budget with the oldest superseded versions
+        superseded_archives.sort()
+        for _, archive_name, archive_size in superseded_archives:
+            if total_size <= max_bytes: break
+            if archive_name not in leased_archives:
+                selected_archives.append(archive_name)
+                total_size -= archive_size
+
+        return selected_archives
+
+
+    def collect(self):
+
+        ''' Applies the policy to the image archive folder, returns the names of the deleted archives '''
+
+        deleted_archives = []
+        relay_registry = UpdateRelayRegistry(self.config_manager)
+        selected_archives = self.select_archives(self._list_archive_groups(),
+                                                 get_leased_archives(self.config_manager))
+
+        for archive_name in selected_archives:
+
+            # a download could have started since the selection
+            if archive_name in get_leased_archives(self.config_manager):
+                continue
+
+            try :
+                archive_path = os.path.join(self.archive_dir, archive_name)
+                os.remove(archive_path)
+                if os.path.isfile(archive_path + ".sha256"):
+                    os.remove(archive_path + ".sha256")
+                relay_registry.remove_archive(archive_name)
+                deleted_archives.append(archive_name)
+
+            except Exception as e:
+                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                logging.error("{0} - Image archive policy failed to delete ({1}) : {2}".format(time_str, archive_name, e))
+
+        if len(deleted_archives) > 0:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - Image archive policy deleted superseded archives : {1}".format(time_str, deleted_archives))
+
+        return deleted_archives
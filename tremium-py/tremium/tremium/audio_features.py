@@ -0,0 +1,421 @@
+import shlex
+
+import time
+import logging
+import datetime
+import subprocess
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from .config import NodeConfigurationManager
+from .data_writer import DataFileWriter
+
+
+# smallest power considered by the logarithmic features (avoids log(0))
+POWER_FLOOR = 1e-12
+
+
+def decode_pcm(pcm_data):
+
+    '''
+    Returns the samples (float32 array, in [-1, 1[) of raw mono PCM audio (signed 16 bit, little endian)
+
+    Parameters
+    ----------
+    pcm_data (bytes) : raw audio, as read from the audio source
+    '''
+
+    sample_count = len(pcm_data) // 2
+    return np.frombuffer(pcm_data, dtype="<i2", count=sample_count).astype(np.float32) / 32768.0
+
+
+class AudioRingBuffer():
+
+    '''
+    Fixed size buffer holding the audio samples not yet framed
+        - samples are written and read in blocks (no per sample / per frame python operations)
+        - when the reader falls behind by more than the buffer size, the oldest samples are dropped
+    '''
+
+    def __init__(self, capacity):
+
+        '''
+        Parameters
+        ----------
+        capacity (int) : number of samples the buffer can hold
+        '''
+
+        self.capacity = capacity
+        self.samples = np.zeros(capacity, dtype=np.float32)
+
+        # total number of samples written / consumed since the buffer was created
+        self.write_count = 0
+        self.read_count = 0
+
+
+    def available(self):
+        return self.write_count - self.read_count
+
+
+    def clear(self):
+        self.read_count = self.write_count
+
+
+    def write(self, samples):
+
+        '''
+        Writes samples to the buffer, returns the number of unread samples that were dropped
+
+        Parameters
+        ----------
+        samples (np.array) : samples to add to the buffer
+        '''
+
+        sample_count = len(samples)
+        samples = samples[-self.capacity : ]
+
+        # copying the samples in (at most) two blocks, around the end of the buffer
+        write_start = (self.write_count + sample_count - len(samples)) % self.capacity
+        first_block = min(len(samples), self.capacity - write_start)
+        self.samples[write_start : write_start + first_block] = samples[ : first_block]
+        self.samples[ : len(samples) - first_block] = samples[first_block : ]
+        self.write_count += sample_count
+
+        dropped_count = max(0, self.available() - self.capacity)
+        self.read_count += dropped_count
+        return dropped_count
+
+
+    def read_frames(self, frame_size, hop_size):
+
+        '''
+        Returns all the complete frames held by the buffer, as a (frame count, frame_size) array.
+        The frames are consumed : the next read starts at the first frame that was not returned
+        (the overlap between frames is kept).
+            ** the returned array is a view over a copy of the buffer, it is not affected by later writes
+
+        Parameters
+        ----------
+        frame_size (int) : number of samples per frame
+        hop_size (int) : number of samples between the start of two consecutive frames
+        '''
+
+        if self.available() < frame_size:
+            return np.zeros((0, frame_size), dtype=np.float32)
+
+        frame_count = (self.available() - frame_size) // hop_size + 1
+        span = (frame_count - 1) * hop_size + frame_size
+
+        # contiguous copy of the framed samples, then an overlapping (strided) view of the frames
+        read_start = self.read_count % self.capacity
+        if read_start + span <= self.capacity:
+            framed_samples = self.samples[read_start : read_start + span].copy()
+        else :
+            framed_samples = np.concatenate((self.samples[read_start : ],
+                                             self.samples[ : read_start + span - self.capacity]))
+
+        item_size = framed_samples.itemsize
+        frames = as_strided(framed_samples, shape=(frame_count, frame_size), strides=(hop_size * item_size, item_size),
+                            writeable=False)
+
+        self.read_count += frame_count * hop_size
+        return frames
+
+
+class AudioFeatureExtractor():
+
+    '''
+    Computes the spectral features of batches of audio frames (every feature is computed for
+    the whole batch at once, by numpy array operations)
+        - rms : root mean square amplitude
+        - zcr : zero crossing rate
+        - centroid, bandwidth : mean and spread of the magnitude spectrum (Hz)
+        - rolloff : frequency under which "rolloff ratio" of the spectral power lies (Hz)
+        - flatness : geometric / arithmetic mean of the power spectrum (1 : noise, 0 : tone)
+        - peak : frequency of the strongest spectral bin (Hz)
+        - bands : power in logarithmically spaced frequency bands
+    '''
+
+    def __init__(self, sample_rate, frame_size, band_count, band_min_freq, rolloff_ratio):
+
+        '''
+        Parameters
+        ----------
+        sample_rate (int) : sampling rate of the audio (Hz)
+        frame_size (int) : number of samples per frame
+        band_count (int) : number of frequency bands
+        band_min_freq (float) : lower bound of the first frequency band (Hz)
+        rolloff_ratio (float) : ratio of the spectral power used for the rolloff frequency
+        '''
+
+        self.rolloff_ratio = rolloff_ratio
+        self.window = np.hanning(frame_size).astype(np.float32)
+        self.freqs = np.fft.rfftfreq(frame_size, 1.0 / sample_rate).astype(np.float32)
+
+        # bin to band assignment matrix (band powers are a single matrix product)
+        band_edges = np.geomspace(band_min_freq, sample_rate / 2, band_count + 1)
+        band_index = np.clip(np.searchsorted(band_edges, self.freqs, side="right") - 1, -1, band_count - 1)
+        self.band_matrix = np.zeros((len(self.freqs), band_count), dtype=np.float32)
+        in_band = band_index >= 0
+        self.band_matrix[np.nonzero(in_band)[0], band_index[in_band]] = 1.0
+
+
+    def compute(self, frames):
+
+        '''
+        Returns the features of every frame of the batch ({feature name : array}, one value
+        (row for "bands") per frame)
+
+        Parameters
+        ----------
+        frames (np.array) : (frame count, frame size) array of audio frames
+        '''
+
+        rms = np.sqrt(np.mean(np.square(frames), axis=1))
+        signs = np.signbit(frames)
+        zcr = np.mean(signs[:, 1 : ] != signs[:, : -1], axis=1)
+
+        magnitude = np.abs(np.fft.rfft(frames * self.window, axis=1)).astype(np.float32)
+        power = np.square(magnitude)
+
+        magnitude_total = magnitude.sum(axis=1) + POWER_FLOOR
+        centroid = magnitude @ self.freqs / magnitude_total
+        spread = magnitude @ np.square(self.freqs) / magnitude_total - np.square(centroid)
+        bandwidth = np.sqrt(np.maximum(spread, 0.0))
+
+        power_total = power.sum(axis=1)
+        cumulative_power = np.cumsum(power, axis=1)
+        rolloff = self.freqs[np.argmax(cumulative_power >= (self.rolloff_ratio * power_total)[:, None], axis=1)]
+
+        log_power = np.log(power + POWER_FLOOR)
+        flatness = np.exp(np.mean(log_power, axis=1)) / (np.mean(power, axis=1) + POWER_FLOOR)
+        peak = self.freqs[np.argmax(power, axis=1)]
+
+        return {
+            "rms" : rms,
+            "zcr" : zcr,
+            "centroid" : centroid,
+            "bandwidth" : bandwidth,
+            "rolloff" : rolloff,
+            "flatness" : flatness,
+            "peak" : peak,
+            "bands" : power @ self.band_matrix
+        }
+
+
+def summarize_features(features, record_time, duration):
+
+    '''
+    Returns the compact data file record of a block of frames (mean of every feature, band powers in dB)
+
+    Parameters
+    ----------
+    features (dict) : features of the frames of the block (see AudioFeatureExtractor.compute)
+    record_time (float) : time of the first frame of the block
+    duration (float) : duration of the block (seconds)
+    '''
+
+    band_db = 10 * np.log10(features["bands"].mean(axis=0) + POWER_FLOOR)
+    return {
+        "type" : "audio-features",
+        "time" : round(record_time, 3),
+        "duration" : round(duration, 3),
+        "frames" : len(features["rms"]),
+        "rms" : round(float(features["rms"].mean()), 5),
+        "rms_max" : round(float(features["rms"].max()), 5),
+        "zcr" : round(float(features["zcr"].mean()), 4),
+        "centroid" : round(float(features["centroid"].mean()), 1),
+        "bandwidth" : round(float(features["bandwidth"].mean()), 1),
+        "rolloff" : round(float(features["rolloff"].mean()), 1),
+        "flatness" : round(float(features["flatness"].mean()), 4),
+        "peak" : round(float(np.median(features["peak"])), 1),
+        "bands" : [round(float(value), 1) for value in band_db]
+    }
+
+
+class AudioFeatureEngine():
+
+    '''
+    Streaming feature extraction : raw audio is buffered (ring buffer), framed and analysed in
+    batches, one record is written to the extracted data file every "audio-record-time" seconds
+    of audio (every "audio-throttle-factor" times that while data collection is throttled).
+    '''
+
+    def __init__(self, config_manager, data_writer):
+
+        '''
+        Parameters
+        ----------
+        config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+        data_writer (DataFileWriter) : writer of the extracted data file
+        '''
+
+        self.config_manager = config_manager
+        self.data_writer = data_writer
+
+        self.sample_rate = config_manager.config_data["audio-sample-rate"]
+        self.frame_size = config_manager.config_data["audio-frame-size"]
+        self.hop_size = config_manager.config_data["audio-hop-size"]
+        self.frames_per_record = max(1, int(round(config_manager.config_data["audio-record-time"] *
+                                                  self.sample_rate / self.hop_size)))
+        self.record_factor = 1
+
+        self.ring_buffer = AudioRingBuffer(int(config_manager.config_data["audio-ring-buffer-time"] * self.sample_rate))
+        self.extractor = AudioFeatureExtractor(self.sample_rate, self.frame_size,
+                                               config_manager.config_data["audio-band-count"],
+                                               config_manager.config_data["audio-band-min-freq"],
+                                               config_manager.config_data["audio-rolloff-ratio"])
+
+        # features and ring buffer positions (first sample) of the frames not yet written out
+        self.pending_features = []
+        self.pending_positions = []
+        self.pending_frames = 0
+
+        # time and ring buffer position of the first sample of the stream
+        # (frames are timed from their position, samples dropped by the ring buffer are accounted for)
+        self.stream_start_time = None
+        self.stream_start_count = 0
+        self.dropped_samples = 0
+
+        # trailing byte of the last read (reads are not aligned on samples)
+        self.pcm_remainder = b""
+
+
+    def set_throttle(self, throttled):
+
+        ''' Lowers the record rate while data collection is throttled (data spool nearly full) '''
+
+        self.record_factor = self.config_manager.config_data["audio-throttle-factor"] if throttled else 1
+
+
+    def reset(self):
+
+        ''' Drops the buffered audio and pending features (data collection paused), the next audio starts a new stream '''
+
+        self.ring_buffer.clear()
+        self.pending_features = []
+        self.pending_positions = []
+        self.pending_frames = 0
+        self.stream_start_time = None
+        self.pcm_remainder = b""
+
+
+    def process(self, pcm_data, read_time=None):
+
+        '''
+        Adds audio to the stream and writes the records that are complete, returns the number of records written
+
+        Parameters
+        ----------
+        pcm_data (bytes) : raw audio (see decode_pcm)
+        read_time (float) : time the audio was read at (defaults to now)
+        '''
+
+        pcm_data = self.pcm_remainder + pcm_data
+        aligned_size = len(pcm_data) - len(pcm_data) % 2
+        self.pcm_remainder = pcm_data[aligned_size : ]
+        samples = decode_pcm(pcm_data[ : aligned_size])
+        if self.stream_start_time is None:
+            read_time = time.time() if read_time is None else read_time
+            self.stream_start_time = read_time - len(samples) / self.sample_rate
+            self.stream_start_count = self.ring_buffer.write_count
+
+        dropped_count = self.ring_buffer.write(samples)
+        if dropped_count > 0:
+            self.dropped_samples += dropped_count
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.warning("{0} - AudioFeatureEngine fell behind, dropped {1} samples".format(time_str, dropped_count))
+
+        frames_start = self.ring_buffer.read_count
+        frames = self.ring_buffer.read_frames(self.frame_size, self.hop_size)
+        if len(frames) == 0:
+            return 0
+
+        self.pending_features.append(self.extractor.compute(frames))
+        self.pending_positions.append(frames_start + np.arange(len(frames)) * self.hop_size)
+        self.pending_frames += len(frames)
+
+        record_frames = self.frames_per_record * self.record_factor
+        if self.pending_frames < record_frames:
+            return 0
+
+        # merging the pending batches, then writing out every complete record
+        features = {name : np.concatenate([batch[name] for batch in self.pending_features])
+                    for name in self.pending_features[0]}
+        frame_positions = np.concatenate(self.pending_positions)
+
+        record_count = self.pending_frames // record_frames
+        for record_index in range(record_count):
+            record_slice = slice(record_index * record_frames, (record_index + 1) * record_frames)
+            record_time = self.stream_start_time + float(frame_positions[record_slice.start] - self.stream_start_count) / self.sample_rate
+            self.data_writer.append(summarize_features({name : values[record_slice] for name, values in features.items()},
+                                                       record_time, record_frames * self.hop_size / self.sample_rate))
+
+        remaining_slice = slice(record_count * record_frames, None)
+        self.pending_features = [{name : values[remaining_slice] for name, values in features.items()}]
+        self.pending_positions = [frame_positions[remaining_slice]]
+        self.pending_frames -= record_count * record_frames
+        return record_count
+
+
+def run_audio_extraction(config_file_path):
+
+    '''
+    Reads the audio source ("audio-source-command" output) and writes the audio features to the
+    extracted data file, for as long as the source runs
+        - audio read while data collection is stopped (node update) is discarded
+        - the record rate is lowered while data collection is throttled
+
+    Parameters
+    ----------
+    config_file_path (str) : path to the node configuration file
+    '''
+
+    from .cache import NodeCacheModel
+
+    config_manager = NodeConfigurationManager(config_file_path)
+    cache = NodeCacheModel(config_file_path)
+    chunk_size = config_manager.config_data["audio-read-chunk-size"]
+    cache_check_time = config_manager.config_data["audio-cache-check-time"]
+
+    source_command = shlex.split(config_manager.config_data["audio-source-command"])
+    source_process = subprocess.Popen(source_command, stdout=subprocess.PIPE, bufsize=0)
+
+    time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+    logging.info("{0} - Audio extraction started, source : {1}".format(time_str, " ".join(source_command)))
+
+    with DataFileWriter(config_manager) as data_writer:
+
+        engine = AudioFeatureEngine(config_manager, data_writer)
+        collecting = True
+        last_check_time = 0
+
+        try :
+            while True:
+
+                pcm_data = source_process.stdout.read(chunk_size)
+                if not pcm_data:
+                    break
+
+                # the collection flags are only read every "audio-cache-check-time" seconds
+                if time.time() - last_check_time >= cache_check_time:
+                    last_check_time = time.time()
+                    try :
+                        collecting = cache.check_data_collection()
+                        engine.set_throttle(cache.check_data_collection_throttle())
+                    except Exception as e:
+                        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                        logging.error("{0} - Audio extraction could not read the node cache : {1}".format(time_str, e))
+
+                if collecting:
+                    engine.process(pcm_data)
+                else :
+                    engine.reset()
+
+        finally:
+            source_process.kill()
+            source_process.wait()
+
+    time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+    logging.warning("{0} - Audio extraction stopped, the audio source ended (code {1})".format(time_str, source_process.returncode))
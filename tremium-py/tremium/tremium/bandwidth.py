@@ -0,0 +1,386 @@
+import time
+import logging
+import datetime
+import threading
+import contextlib
+import multiprocessing
+from queue import Empty
+
+
+class TokenBucket():
+
+    ''' Rate limiter, holds up to one second worth of tokens (bytes) '''
+
+    def __init__(self, rate):
+
+        '''
+        Parameters
+        ----------
+        rate (float) : refill rate (bytes per second), 0 for no limit
+        '''
+
+        self.rate = rate
+        self.tokens = rate
+        self.update_time = None
+
+
+    def _refill(self, current_time):
+        if self.update_time is not None:
+            self.tokens = min(self.rate, self.tokens + max(0.0, current_time - self.update_time) * self.rate)
+        self.update_time = current_time if self.update_time is None else max(self.update_time, current_time)
+
+
+    def wait_time(self, size, current_time):
+
+        '''
+        Returns the time to wait before (size) bytes can be consumed (0 if they can be consumed now)
+            ** requests larger than the bucket only need a full bucket
+        '''
+
+        if self.rate <= 0:
+            return 0.0
+        self._refill(current_time)
+        needed_tokens = min(size, self.rate)
+        return max(0.0, (needed_tokens - self.tokens) / self.rate)
+
+
+    def consume(self, size, current_time):
+        if self.rate > 0:
+            self._refill(current_time)
+            self.tokens -= size
+
+
+class FairQueue():
+
+    '''
+    Start-time fair queue of transfer chunk requests
+        - every node is a flow, a chunk costs (size / weight of the request type) of virtual time
+        - the pending request with the smallest start tag is granted first, so every node gets its
+          weighted share of the link whatever the number of streams it has open
+        - optional global and per node rate caps (token buckets)
+    '''
+
+    def __init__(self, weights, rate_cap=0, node_rate_cap=0):
+
+        '''
+        Parameters
+        ----------
+        weights (dict) : weight of every request type (default weight is 1)
+        rate_cap (float) : global rate cap (bytes per second), 0 for no limit
+        node_rate_cap (float) : per node rate cap (bytes per second), 0 for no limit
+        '''
+
+        self.weights = weights
+        self.virtual_time = 0.0
+        self.node_finish_tags = {}
+        self.pending_requests = []
+
+        self.global_bucket = TokenBucket(rate_cap)
+        self.node_rate_cap = node_rate_cap
+        self.node_buckets = {}
+
+
+    def push(self, flow_id, node_key, request_type, size):
+
+        '''
+        Queues a chunk request
+
+        Parameters
+        ----------
+        flow_id (int) : id of the requesting stream
+        node_key (str) : node the stream belongs to
+        request_type (str) : type of request (ex : GET_UPDATE)
+        size (int) : size of the chunk (bytes)
+        '''
+
+        start_tag = max(self.virtual_time, self.node_finish_tags.get(node_key, 0.0))
+        self.node_finish_tags[node_key] = start_tag + size / self.weights.get(request_type, 1)
+        self.pending_requests.append((start_tag, flow_id, node_key, size))
+
+
+    def discard(self, flow_id):
+
+        ''' Drops the pending requests of the specified stream '''
+
+        self.pending_requests = [request for request in self.pending_requests if request[1] != flow_id]
+
+
+    def pop(self, current_time=None):
+
+        '''
+        Returns the next request to grant as (flow id, wait time). When the rate caps hold back
+        every pending request the flow id is None and the wait time is the time until one can go,
+        when there are no pending requests both are None.
+        '''
+
+        if current_time is None:
+            current_time = time.time()
+
+        if len(self.pending_requests) == 0:
+            return None, None
+
+        # requests of nodes above their cap are skipped (other nodes can use the link)
+        min_wait = None
+        for request in sorted(self.pending_requests):
+            start_tag, flow_id, node_key, size = request
+            node_bucket = self.node_buckets.setdefault(node_key, TokenBucket(self.node_rate_cap))
+            node_wait = max(node_bucket.wait_time(size, current_time), self.global_bucket.wait_time(size, current_time))
+
+            if node_wait == 0:
+                self.pending_requests.remove(request)
+                self.virtual_time = max(self.virtual_time, start_tag)
+                node_bucket.consume(size, current_time)
+                self.global_bucket.consume(size, current_time)
+                return flow_id, 0.0
+
+            min_wait = node_wait if min_wait is None else min(min_wait, node_wait)
+
+        return None, min_wait
+
+
+class TransferFlow():
+
+    '''
+    Connection handler side handle on the transfer scheduler.
+    Every chunk of a bulk stream is sent (or received) once the scheduler grants it. A grant covers
+    "hub-scheduler-grant-chunks" chunks (one scheduler round trip for several chunks), it is given
+    back once used up, or as soon as the stream has to wait for its node (see ChunkGrant).
+    '''
+
+    def __init__(self, request_queue, flow_id, grant_semaphore, grant_timeout, grant_chunks=1):
+
+        '''
+        Parameters
+        ----------
+        request_queue (multiprocessing.Queue) : queue of the scheduler
+        flow_id (int) : id of the stream
+        grant_semaphore (multiprocessing.Semaphore) : released by the scheduler on every grant
+        grant_timeout (float) : time to wait for a grant, the transfer fails past it (scheduler not responding)
+        grant_chunks (int) : number of chunks covered by a grant
+        '''
+
+        self.request_queue = request_queue
+        self.flow_id = flow_id
+        self.grant_semaphore = grant_semaphore
+        self.grant_timeout = grant_timeout
+        self.grant_chunks = grant_chunks
+
+        # bytes left in the held grant (None : no grant held)
+        self.granted_size = None
+
+
+    @contextlib.contextmanager
+    def grant(self, node_key, request_type, size):
+
+        '''
+        Context manager holding a grant for the transfer of a chunk
+
+        Parameters
+        ----------
+        node_key (str) : node the stream belongs to
+        request_type (str) : type of request (ex : GET_UPDATE)
+        size (int) : size of the chunk (bytes)
+        '''
+
+        if self.granted_size is None or self.granted_size < size:
+            self.release()
+            self.request_queue.put(("REQUEST", self.flow_id, node_key, request_type, size * self.grant_chunks))
+            if not self.grant_semaphore.acquire(timeout=self.grant_timeout):
+                # the request is withdrawn, the stream fails (a late grant only reaches a failed stream)
+                self.request_queue.put(("CANCEL", self.flow_id))
+                raise TimeoutError("no transfer grant within {} seconds".format(self.grant_timeout))
+            self.granted_size = size * self.grant_chunks
+
+        try :
+            yield
+        except :
+            self.release()
+            raise
+
+        self.granted_size -= size
+        if self.granted_size <= 0:
+            self.release()
+
+
+    def release(self):
+
+        ''' Gives back the held grant (if any) '''
+
+        if self.granted_size is not None:
+            self.granted_size = None
+            self.request_queue.put(("DONE", self.flow_id))
+
+
+    def close(self):
+        self.granted_size = None
+        self.request_queue.put(("CLOSE", self.flow_id))
+
+
+class ChunkGrant():
+
+    '''
+    Grant function of a bulk stream (see tremium.transfer.get_chunk_grant) : grant(size) is held
+    while a chunk is transfered, release() gives back the held grant while the stream waits for its node
+    '''
+
+    def __init__(self, transfer_flow, node_key, request_type):
+
+        '''
+        Parameters
+        ----------
+        transfer_flow (TransferFlow) : handle on the hub transfer scheduler
+        node_key (str) : node the stream belongs to
+        request_type (str) : type of request (ex : GET_UPDATE)
+        '''
+
+        self.transfer_flow = transfer_flow
+        self.node_key = node_key
+        self.request_type = request_type
+
+
+    def __call__(self, size):
+        return self.transfer_flow.grant(self.node_key, self.request_type, size)
+
+
+    def release(self):
+        self.transfer_flow.release()
+
+
+class TransferScheduler():
+
+    '''
+    Hub side scheduler of the bulk transfer streams (GET_UPDATE and STORE_FILE style requests).
+    Connection handlers run in separate processes, they request grants through a queue and the
+    scheduler thread (in the server process) grants chunks in fair queuing order, with at most
+    "hub-scheduler-max-inflight" chunks in flight. Short requests are not scheduled.
+    '''
+
+    def __init__(self, config_manager, hub_load=None):
+
+        '''
+        Parameters
+        ----------
+        config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+        hub_load (HubLoad) : load indicators of the hub, the scheduler keeps its queue depth up to date
+        '''
+
+        self.config_manager = config_manager
+        self.hub_load = hub_load
+        self.request_queue = multiprocessing.Queue()
+        self.fair_queue = FairQueue(config_manager.config_data["hub-scheduler-weights"],
+                                    config_manager.config_data["hub-rate-cap"],
+                                    config_manager.config_data["hub-node-rate-cap"])
+
+        self.lock = threading.Lock()
+        self.next_flow_id = 0
+        self.grant_semaphores = {}
+        self.inflight_grants = {}
+
+
+    def create_flow(self):
+
+        ''' Returns a new TransferFlow, to be handed to a connection handler before it is started '''
+
+        grant_semaphore = multiprocessing.Semaphore(0)
+        with self.lock:
+            flow_id = self.next_flow_id
+            self.next_flow_id += 1
+            self.grant_semaphores[flow_id] = grant_semaphore
+
+        return TransferFlow(self.request_queue, flow_id, grant_semaphore,
+                            self.config_manager.config_data["hub-scheduler-grant-timeout"],
+                            self.config_manager.config_data["hub-scheduler-grant-chunks"])
+
+
+    def _handle_message(self, message):
+
+        ''' Applies a message from a connection handler to the scheduler state, returns False on STOP '''
+
+        if message[0] == "STOP":
+            return False
+
+        elif message[0] == "REQUEST":
+            _, flow_id, node_key, request_type, size = message
+            self.fair_queue.push(flow_id, node_key, request_type, size)
+
+        elif message[0] == "DONE":
+            self.inflight_grants.pop(message[1], None)
+
+        elif message[0] == "CANCEL":
+            self.fair_queue.discard(message[1])
+            self.inflight_grants.pop(message[1], None)
+
+        elif message[0] == "CLOSE":
+            self.fair_queue.discard(message[1])
+            self.inflight_grants.pop(message[1], None)
+            with self.lock:
+                self.grant_semaphores.pop(message[1], None)
+
+        return True
+
+
+    def run(self):
+
+        ''' Scheduling loop (runs in the server process) '''
+
+        max_inflight = self.config_manager.config_data["hub-scheduler-max-inflight"]
+        grant_timeout = self.config_manager.config_data["hub-scheduler-grant-timeout"]
+        wait_time = None
+
+        while True:
+
+            # waiting for a message, or until a capped request can go
+            try :
+                if not self._handle_message(self.request_queue.get(timeout=wait_time)):
+                    return
+                while True:
+                    if not self._handle_message(self.request_queue.get_nowait()):
+                        return
+            except Empty: pass
+
+            # grants of handlers that died (no DONE message) expire
+            current_time = time.time()
+            for flow_id, grant_time in list(self.inflight_grants.items()):
+                if current_time - grant_time > grant_timeout:
+                    del self.inflight_grants[flow_id]
+
+            # granting chunks, in fair queuing order
+            wait_time = None
+            while len(self.inflight_grants) < max_inflight:
+                flow_id, capped_wait_time = self.fair_queue.pop(current_time)
+                if flow_id is None:
+                    wait_time = capped_wait_time
+                    break
+
+                with self.lock:
+                    grant_semaphore = self.grant_semaphores.get(flow_id)
+                if grant_semaphore is not None:
+                    self.inflight_grants[flow_id] = current_time
+                    grant_semaphore.release()
+
+            # chunk requests still waiting for a grant (reported to the nodes)
+            if self.hub_load is not None:
+                self.hub_load.set_queue_depth(len(self.fair_queue.pending_requests))
+
+            # in flight grants are checked regularly for expiration
+            if wait_time is None and len(self.inflight_grants) > 0:
+                wait_time = grant_timeout
+
+
+    def start(self):
+
+        ''' Launches the scheduling loop in a background thread '''
+
+        scheduler_thread = threading.Thread(target=self.run, daemon=True)
+        scheduler_thread.start()
+
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        logging.info("{0} - Hub transfer scheduler started".format(time_str))
+        return scheduler_thread
+
+
+    def stop(self):
+
+        ''' Stops the scheduling loop '''
+
+        self.request_queue.put(("STOP",))
@@ -1,5 +1,6 @@
 import os
 import os.path
+import json
 
 import time
 import logging
@@ -10,29 +11,47 @@ import gzip
 
 import re
 import select
-from bluetooth import BluetoothSocket, BluetoothError, advertise_service, find_service
-from multiprocessing import Process
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from .cache import NodeCacheModel
+# PyBluez, redis and multiprocessing are imported where they are used, so the module loads quickly
+# (and without them) for the components that only need its helpers
 from .config import HubConfigurationManager, NodeConfigurationManager
-from .file_management import get_image_from_hub_archive, get_matching_image
+from .file_management import get_image_from_hub_archive, get_matching_image, get_file_digest, get_archive_digest
+from .file_management import get_manifest_updates, get_node_image_manifest, parse_image_archive_name
+from .file_management import locked_file, locked_state_file
+from .relay import UpdateRelayRegistry, NodeRelayServer, fetch_from_peer, launch_node_relay_server
+from .archive_policy import acquire_download_lease, release_download_lease
+from .transfer import SocketReader, get_chunk_grant, wait_for_socket, send_file, send_file_batch, send_file_tails, receive_update_batch, receive_update_range
+from .scheduling import LinkEstimator, TransferCarryover, get_data_file_priority, plan_transfers
+from .image_install import install_node_updates
+from .spool import DataSpool, run_spool_manager
+from .data_index import index_data_files
+from .columnar import register_data_files
+from .rollout import UpdateRollout
+from .profiling import profiled, profile_span
+from .tracing import TraceSession, trace_span, trace_connection, parse_trace_header, new_span_id
+from .transport import HubSelector, HubLoad, get_timeout_errors
+from .transport import create_hub_listeners
 
 
 class NodeBluetoothClient():
 
     ''' Tremium Node side bluetooth client which connects to the Tremium Hub '''
 
-    def __init__(self, config_file_path):
+    def __init__(self, config_file_path, hub_selector=None):
 
         '''
         Parameters
         ------
         config_file_path (str) : path to the hub configuration file
+        hub_selector (HubSelector) : selector of the hub to connect to (ex : from the hub discovery)
         '''
 
         super().__init__()
 
         # loading configurations
+        self.config_file_path = config_file_path
         self.config_manager = NodeConfigurationManager(config_file_path)
         log_file_path = os.path.join(self.config_manager.config_data["node-file-transfer-dir"], 
                                      self.config_manager.config_data["bluetooth-client-log-name"])
@@ -44,11 +63,32 @@ class NodeBluetoothClient():
         log_handler.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
         logger.addHandler(log_handler)
 
-        # defining connection to server
+        # defining connection to server (one per thread, see "transfer-channels")
+        self.channel_state = threading.local()
         self.server_s = None
+        self.transfer_channels = max(1, self.config_manager.config_data["transfer-channels"])
+        self.hub_selector = hub_selector if hub_selector is not None else HubSelector(self.config_manager)
+        self.striped_downloads = []
+
+        # defining the contact window estimator, the record of interrupted downloads and the data spool
+        self.link_estimator = LinkEstimator(self.config_manager)
+        self.carryover = TransferCarryover(self.config_manager)
+        self.spool = DataSpool(self.config_manager)
+
+        # digests of the verified update files, the updates are installed in a background process
+        self.update_digests = {}
+        self.install_process = None
+
+        # the hub can ask the node to check back later for updates (staged rollout)
+        self.update_retry_time = 0.0
+
+        # defining the local relay server (holds the archives this node can relay)
+        self.relay_server = NodeRelayServer(config_file_path)
 
         # connecting to local cache
-        try : self.cache = NodeCacheModel(config_file_path)
+        try :
+            from .cache import NodeCacheModel
+            self.cache = NodeCacheModel(config_file_path)
         except Exception as e:
             time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
             logging.error("{0} - NodeBluetoothClient failed to connect to cache {1}".format(time_str, e))
@@ -61,27 +101,38 @@ class NodeBluetoothClient():
             self.server_s.close()
 
 
+    @property
+    def server_s(self):
+
+        ''' Connection to the server, every thread (transfer channel) has its own connection '''
+
+        return getattr(self.channel_state, "server_s", None)
+
+
+    @server_s.setter
+    def server_s(self, server_s):
+        self.channel_state.server_s = server_s
+
+
     def _connect_to_server(self):
 
-        ''' Establishes a connection with the Tremium Hub Bluetooth server '''
+        ''' Establishes a connection with the Tremium Hub server (least loaded hub in reach, IP network or Bluetooth, see HubSelector) '''
 
-        bluetooth_port = self.config_manager.config_data["bluetooth-port"]
+        # concurrent channels can not share the local port
+        local_port = self.config_manager.config_data["bluetooth-port"] if self.transfer_channels == 1 else 0
 
         try : 
 
-            # creating a new socket
-            self.server_s = BluetoothSocket()
-            self.server_s.bind((self.config_manager.config_data["bluetooth-adapter-mac-client"], bluetooth_port))
+            # connecting to the hub (the connection carries the trace of the maintenance session)
+            with trace_span("connect") as connect_span:
+                self.server_s = trace_connection(self.hub_selector.connect(local_port))
+                connect_span.set(hub=self.hub_selector.current_hub["hub-id"], transport=self.hub_selector.current_transport)
 
-            # connecting to the hub
-            time.sleep(0.25)    
-            self.server_s.connect((self.config_manager.config_data["bluetooth-adapter-mac-server"], bluetooth_port))
-            self.server_s.settimeout(self.config_manager.config_data["bluetooth-comm-timeout"])
-            time.sleep(0.25)
+            # the hub is in range
+            self.link_estimator.mark_contact()
 
         # handling server connection failure
         except Exception as e:
-            self.server_s.close()
             time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
             logging.error("{0} - NodeBluetoothClient failed to connect to server : {1}".format(time_str, e))
             raise      
@@ -126,33 +177,467 @@ class NodeBluetoothClient():
         return update_image_names
 
 
+    def _check_manifest_updates(self, node_manifest):
+
+        '''
+        Sends the manifest of the installed images to the Hub, which only responds with the
+        update images that differ from the installed ones ("NOT_MODIFIED" when there are none).
+        Returns the list of update image names, None if the Hub could not handle the request.
+            ** "RETRY_AFTER (seconds)" : the updates are not rolled out to the node yet (or every
+               update slot of the hub is taken), the node checks back after the given time
+
+        Parameters
+        ----------
+        node_manifest (dict) : installed images (component name --> archive name)
+        '''
+
+        update_image_names = None
+        node_id = self.config_manager.config_data["node-id"]
+
+        try :
+
+            self._connect_to_server()
+            self.server_s.send(bytes("CHECK_UPDATES_MANIFEST {0} {1}".format(node_id, ",".join(node_manifest.values())), 'UTF-8'))
+            response_segs = self.server_s.recv(self.config_manager.config_data["bluetooth-message-max-size"]).\
+                            decode("utf-8").split()
+
+            if response_segs == ["NOT_MODIFIED"]:
+                update_image_names = []
+            elif len(response_segs) == 2 and response_segs[0] == "UPDATES":
+                update_image_names = response_segs[1].split(",")
+            elif len(response_segs) == 2 and response_segs[0] == "RETRY_AFTER":
+                update_image_names = []
+                self.update_retry_time = time.time() + float(response_segs[1])
+
+            # logging completion
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - NodeBluetoothClient checked manifest updates : {1}".\
+                         format(time_str, str(update_image_names)))
+
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - NodeBluetoothClient failed to check Hub for manifest updates : {1}".format(time_str, e))
+
+        self.server_s.close()
+        return update_image_names
+
+
+    def _locate_update(self, update_file):
+
+        '''
+        Asks the Hub where the specified update file should be fetched from (Hub or relay peer)
+        Returns a dict describing the update source, None if the Hub could not locate the file.
+            - "source" : "HUB" or "PEER"
+            - "address", "port" : relay peer address (only for "PEER")
+            - "size", "digest" : size and sha256 digest of the Hub's copy of the file
+
+        Parameters
+        ----------
+        update_file (str) : name of update file to locate
+        '''
+
+        update_source = None
+        node_id = self.config_manager.config_data["node-id"]
+
+        try :
+
+            self._connect_to_server()
+            self.server_s.send(bytes("LOCATE_UPDATE {0} {1}".format(node_id, update_file), 'UTF-8'))
+            response_segs = self.server_s.recv(self.config_manager.config_data["bluetooth-message-max-size"]).\
+                            decode("utf-8").split()
+
+            if len(response_segs) == 3 and response_segs[0] == "HUB":
+                update_source = {"source" : "HUB", "size" : int(response_segs[1]), "digest" : response_segs[2]}
+
+            elif len(response_segs) == 5 and response_segs[0] == "PEER":
+                update_source = {"source" : "PEER", "address" : response_segs[1], "port" : int(response_segs[2]),
+                                 "size" : int(response_segs[3]), "digest" : response_segs[4]}
+
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - NodeBluetoothClient failed to locate update file ({1}) : {2}".format(time_str, update_file, e))
+
+        self.server_s.close()
+        return update_source
+
+
+    def _register_update_peer(self, update_file, digest):
+
+        '''
+        Tells the Hub this Node holds a verified copy of the specified update file
+        and can relay it to other Nodes.
+
+        Parameters
+        ----------
+        update_file (str) : name of the verified update file
+        digest (str) : sha256 digest of the verified update file
+        '''
+
+        try :
+
+            # making the file available to the local relay server
+            self.relay_server.add_holding(update_file, digest)
+
+            # registering with the Hub
+            self._connect_to_server()
+            self.server_s.send(bytes("REGISTER_UPDATE_PEER {0} {1} {2} {3} {4}".format(
+                self.config_manager.config_data["node-id"],
+                self.config_manager.config_data["bluetooth-adapter-mac-client"],
+                self.config_manager.config_data["relay-port"], update_file, digest), 'UTF-8'))
+            response_str = self.server_s.recv(self.config_manager.config_data["bluetooth-message-max-size"]).decode("utf-8")
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - NodeBluetoothClient registered as relay peer for ({1}) : {2}".\
+                         format(time_str, update_file, response_str))
+
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - NodeBluetoothClient failed to register as relay peer : {1}".format(time_str, e))
+
+        self.server_s.close()
+
+
+    def _fetch_update_from_peer(self, update_file, update_source):
+
+        '''
+        Pulls the specified update file from the relay peer assigned by the Hub.
+        The file is written as .part, it only takes its name once verified against the Hub's digest.
+        Returns True if the file was downloaded (and verified), False otherwise.
+
+        Parameters
+        ----------
+        update_file (str) : name of update file to fetch
+        update_source (dict) : update source, as returned by "_locate_update"
+        '''
+
+        part_file_path = os.path.join(self.config_manager.config_data["node-image-archive-dir"], update_file) + ".part"
+
+        try :
+            fetch_from_peer(update_source["address"], update_source["port"], update_file, 
+                            part_file_path, self.config_manager)
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - NodeBluetoothClient successfully pulled update file ({1}) from relay peer : {2}\
+                         ".format(time_str, update_file, update_source["address"]))
+            return self._verify_update_file(update_file, update_source["digest"], part_file_path)
+
+        except Exception as e:
+            try : os.remove(part_file_path)
+            except : pass
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - NodeBluetoothClient failed to pull update from relay peer, falling back to Hub : {1}\
+                          ".format(time_str, e))
+            return False
+
+
+    def _verify_update_file(self, update_file, digest, file_path=None):
+
+        '''
+        Checks the downloaded update file against the Hub's digest. Verified files are registered
+        as relayable (relay peer), others are deleted. Returns True if the file was verified.
+
+        Parameters
+        ----------
+        update_file (str) : name of the downloaded update file
+        digest (str) : sha256 digest of the Hub's copy of the file
+        file_path (str) : path of the downloaded file (defaults to the file in the archive folder)
+        '''
+
+        update_file_path = os.path.join(self.config_manager.config_data["node-image-archive-dir"], update_file)
+        if file_path is None:
+            file_path = update_file_path
+
+        self.carryover.remove_entry(update_file)
+        with trace_span("verify file", file=update_file):
+            file_digest = get_file_digest(file_path)
+        if file_digest != digest:
+            os.remove(file_path)
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - NodeBluetoothClient discarded update file ({1}), digest mismatch\
+                          ".format(time_str, update_file))
+            return False
+
+        os.replace(file_path, update_file_path)
+        self.update_digests[update_file] = digest
+        if self.config_manager.config_data["relay-enabled"]:
+            self._register_update_peer(update_file, digest)
+        return True
+
+
     def _get_update_file(self, update_file):
 
         '''
-        Pulls the specified udate file from the Hub
+        Pulls the specified udate file from a relay peer (when the Hub assigns one) or from the Hub.
+        When the Hub provides the file's digest, the downloaded file is verified, then this Node
+        registers as a relay peer for it.
+        Returns True if the file was downloaded (and verified), False otherwise.
         
         Parameters
         ----------
         update_file (str) : name of update file to fetch
         '''
+
+        # asking the Hub where to fetch the update from
+        update_source = None
+        if self.config_manager.config_data["relay-enabled"]:
+            update_source = self._locate_update(update_file)
+
+        # downloading from the assigned relay peer, falling back to the Hub
+        downloaded = False
+        if update_source is not None and update_source["source"] == "PEER":
+            downloaded = self._fetch_update_from_peer(update_file, update_source)
        
-        try : 
+        if not downloaded:
+
+            try : 
+
+                # downloading file from hub
+                self._connect_to_server()
+                self.server_s.send(bytes("GET_UPDATE {}".format(update_file), 'UTF-8'))
+                self._download_file(update_file)
+                downloaded = True
+
+                # logging completion
+                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                logging.info("{0} - NodeBluetoothClient successfully pulled update file ({1}) from Hub\
+                             ".format(time_str, update_file))
+
+            except Exception as e:    
+                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                logging.error("{0} - NodeBluetoothClient failed to pull update from Hub : {1}".format(time_str, e))
+            
+            self.server_s.close()
+
+            # verifying the downloaded file against the Hub's digest (peer files are verified on arrival)
+            if downloaded and update_source is not None:
+                downloaded = self._verify_update_file(update_file, update_source["digest"])
+
+        return downloaded
+
+
+    def _get_update_range(self, update_file, start, end, part_file_path):
 
-            # downloading file from hub
+        '''
+        Pulls a byte range of the specified update file from the Hub, on its own connection.
+        Returns the time spent on the transfer.
+
+        Parameters
+        ----------
+        update_file (str) : name of update file to fetch
+        start (int) : position of the first byte of the range
+        end (int) : position following the last byte of the range
+        part_file_path (str) : path of the (preallocated) output file
+        '''
+
+        range_start_time = time.time()
+        try :
             self._connect_to_server()
-            self.server_s.send(bytes("GET_UPDATE {}".format(update_file), 'UTF-8'))
-            self._download_file(update_file)
+            receive_update_range(self.server_s, update_file, start, end, part_file_path, 
+                                 self.config_manager.config_data["bluetooth-message-max-size"])
+        finally:
+            self.server_s.close()
+
+        return time.time() - range_start_time
+
+
+    def _get_update_file_striped(self, update_file, update_source):
+
+        '''
+        Pulls the specified update file from the Hub, striped by byte range across 
+        "transfer-channels" parallel connections. The file is verified once complete.
+        Returns True if the file was downloaded (and verified), False otherwise.
+
+        Parameters
+        ----------
+        update_file (str) : name of update file to fetch
+        update_source (dict) : update source (Hub), as returned by "_locate_update"
+        '''
+
+        file_size = update_source["size"]
+        part_file_path = os.path.join(self.config_manager.config_data["node-image-archive-dir"], update_file + ".part")
+
+        # splitting the file in one range per channel
+        range_size = -(-file_size // self.transfer_channels)
+        file_ranges = [(range_start, min(range_start + range_size, file_size)) 
+                       for range_start in range(0, file_size, range_size)]
+
+        try :
+
+            # preallocating the output file, then fetching the ranges concurrently
+            with open(part_file_path, "wb") as part_file_h:
+                part_file_h.truncate(file_size)
+
+            striping_start_time = time.time()
+            with ThreadPoolExecutor(max_workers=len(file_ranges)) as executor:
+                range_times = list(executor.map(lambda file_range : self._get_update_range(update_file, file_range[0], 
+                                                file_range[1], part_file_path), file_ranges))
+            striping_time = time.time() - striping_start_time
+            self.striped_downloads.append({"file" : update_file, "channels" : len(file_ranges), "wall_time" : striping_time})
 
-            # logging completion
             time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
-            logging.info("{0} - NodeBluetoothClient successfully pulled update file ({1}) from Hub\
-                         ".format(time_str, update_file))
+            logging.info("{0} - NodeBluetoothClient pulled update file ({1}) from Hub over {2} channels in {3:.2f}s (ranges : {4})\
+                         ".format(time_str, update_file, len(file_ranges), striping_time,
+                                  ", ".join("{:.2f}s".format(range_time) for range_time in range_times)))
 
-        except Exception as e:    
+        except Exception as e:
+            if os.path.isfile(part_file_path):
+                os.remove(part_file_path)
             time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
-            logging.error("{0} - NodeBluetoothClient failed to pull update from Hub : {1}".format(time_str, e))
-        
+            logging.error("{0} - NodeBluetoothClient failed to pull striped update file ({1}) : {2}".format(time_str, update_file, e))
+            return False
+
+        return self._verify_update_file(update_file, update_source["digest"], part_file_path)
+
+
+    def _resume_update_file(self, update_file, carryover_entry):
+
+        '''
+        Resumes an update download interrupted at a previous contact (FETCH_UPDATE_RANGE from the
+        end of the partial file). The partial file is dropped if the Hub's copy changed.
+        Returns True if the file was downloaded (and verified), False otherwise.
+
+        Parameters
+        ----------
+        update_file (str) : name of update file to fetch
+        carryover_entry (tuple) : (size, digest, received size) of the interrupted download
+        '''
+
+        file_size, file_digest, received_size = carryover_entry
+        part_file_path = self.carryover.get_part_file_path(update_file)
+
+        # the partial file is only valid for the same copy of the archive
+        update_source = self._locate_update(update_file)
+        if update_source is not None and (update_source["size"], update_source["digest"]) != (file_size, file_digest):
+            self.carryover.remove_entry(update_file)
+            os.remove(part_file_path)
+            return False
+
+        try :
+
+            transfer_start_time = time.time()
+            self._connect_to_server()
+            receive_update_range(self.server_s, update_file, received_size, file_size, part_file_path, 
+                                 self.config_manager.config_data["bluetooth-message-max-size"])
+            self.link_estimator.record_transfer(file_size - received_size, time.time() - transfer_start_time)
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - NodeBluetoothClient resumed update file ({1}) from byte {2}\
+                         ".format(time_str, update_file, received_size))
+
+        # the partial file is kept for the next contact
+        except Exception as e:
+            self.server_s.close()
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - NodeBluetoothClient failed to resume update file ({1}) : {2}".format(time_str, update_file, e))
+            return False
+
+        self.server_s.close()
+        return self._verify_update_file(update_file, file_digest, part_file_path)
+
+
+    def _get_update_files(self, update_files):
+
+        '''
+        Pulls several update files. Downloads interrupted at a previous contact are resumed,
+        files assigned to a relay peer are fetched from the peer, large files are striped across
+        parallel channels (when "transfer-channels" > 1), the others are fetched from the Hub in
+        a single batch request (FETCH_UPDATE_BATCH). A batch interrupted by the end of the contact
+        is carried over to the next contact.
+        Returns the names of the downloaded (and verified) files.
+
+        Parameters
+        ----------
+        update_files (list) : names of update files to fetch
+        '''
+
+        downloaded_files = []
+        hub_files = []
+        archive_dir = self.config_manager.config_data["node-image-archive-dir"]
+
+        # resuming the downloads interrupted at a previous contact
+        carryover_entries = self.carryover.get_entries()
+        for update_file in [update_file for update_file in update_files if update_file in carryover_entries]:
+            if self._resume_update_file(update_file, carryover_entries[update_file]):
+                downloaded_files.append(update_file)
+
+        # fetching the files assigned to relay peers, and the striped files
+        for update_file in update_files:
+
+            # skipping resumed files (and those still carried over)
+            if update_file in downloaded_files or (update_file in carryover_entries and \
+               os.path.isfile(self.carryover.get_part_file_path(update_file))):
+                continue
+
+            update_source = None
+            if self.config_manager.config_data["relay-enabled"] or self.transfer_channels > 1:
+                update_source = self._locate_update(update_file)
+
+            if update_source is not None and update_source["source"] == "PEER" and \
+               self._fetch_update_from_peer(update_file, update_source):
+                downloaded_files.append(update_file)
+
+            elif update_source is not None and self.transfer_channels > 1 and \
+                 update_source["size"] >= self.config_manager.config_data["transfer-stripe-min-size"] and \
+                 self._get_update_file_striped(update_file, update_source):
+                downloaded_files.append(update_file)
+
+            else :
+                hub_files.append(update_file)
+
+        if len(hub_files) == 0:
+            return downloaded_files
+
+        # fetching the remaining files from the Hub in one request
+        # every announced file is recorded, so an interrupted transfer can be resumed
+        batch_entries = {}
+        def record_batch_entry(archive_name, archive_size, archive_digest):
+            batch_entries[archive_name] = (archive_size, archive_digest)
+            self.carryover.add_entry(archive_name, archive_size, archive_digest)
+
+        try :
+
+            transfer_start_time = time.time()
+            self._connect_to_server()
+            received_archives = receive_update_batch(self.server_s, hub_files, archive_dir, 
+                                                     self.config_manager.config_data["bluetooth-message-max-size"],
+                                                     entry_callback=record_batch_entry)
+            self.link_estimator.record_transfer(sum(entry[0] for entry in batch_entries.values()), 
+                                                time.time() - transfer_start_time)
+            for archive_name, archive_digest in received_archives:
+                if self._verify_update_file(archive_name, archive_digest, os.path.join(archive_dir, archive_name + ".part")):
+                    downloaded_files.append(archive_name)
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - NodeBluetoothClient pulled update batch from Hub : {1}".format(time_str, str(received_archives)))
+
+        # the batch was interrupted (ex : end of contact), the complete files are kept, 
+        # the others are carried over to the next contact
+        except Exception as e:
+            self.server_s.close()
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - NodeBluetoothClient failed to pull update batch from Hub : {1}".format(time_str, e))
+
+            if len(batch_entries) > 0:
+                for archive_name, (archive_size, archive_digest) in batch_entries.items():
+                    part_file_path = self.carryover.get_part_file_path(archive_name)
+                    if os.path.isfile(part_file_path) and os.stat(part_file_path).st_size == archive_size and \
+                       self._verify_update_file(archive_name, archive_digest, part_file_path):
+                        downloaded_files.append(archive_name)
+
+                logging.info("{0} - NodeBluetoothClient carried over interrupted update files : {1}".\
+                             format(time_str, str([name for name in batch_entries if name not in downloaded_files])))
+                return downloaded_files
+
+            # falling back on single file requests (ex : Hub without batch support)
+            for update_file in hub_files:
+                part_file_path = os.path.join(archive_dir, update_file + ".part")
+                if os.path.isfile(part_file_path):
+                    os.remove(part_file_path)
+                if update_file not in downloaded_files and self._get_update_file(update_file):
+                    downloaded_files.append(update_file)
+
         self.server_s.close()
+        return downloaded_files
     
 
     def _download_file(self, file_name):
@@ -187,7 +672,7 @@ class NodeBluetoothClient():
 
         # consider time out as : (no more available data)
         # this is the worst way of checking download is complete
-        except BluetoothError: pass
+        except get_timeout_errors(): pass
     
 
     def _upload_file(self, file_name):
@@ -206,13 +691,13 @@ class NodeBluetoothClient():
         try :
 
             self._connect_to_server()
-            self.server_s.send(bytes("STORE_FILE {}".format(file_name), 'UTF-8'))
+            self.server_s.sendall(bytes("STORE_FILE {0} {1}\n".format(file_name, self.config_manager.config_data["node-id"]), 'UTF-8'))
 
             # uploading specified file to the hub            
             with open(upload_file_path, "rb") as image_file_h:
                 data = image_file_h.read(self.config_manager.config_data["bluetooth-message-max-size"])
                 while data:
-                    self.server_s.send(data)
+                    self.server_s.sendall(data)
                     data = image_file_h.read(self.config_manager.config_data["bluetooth-message-max-size"])
             self.server_s.close()
 
@@ -226,61 +711,177 @@ class NodeBluetoothClient():
             raise
 
 
-    def _transfer_data_files(self):
+    def _upload_files(self, file_names):
 
         ''' 
-        Transfers the contents of the data-transfer folder to the hub
-            1) copy the contents of the extracted data file (sensor data) to a temp file
-            2) create a new extracted data file (blank) for new data extraction (sensor data)
-            3) transfer/delete all data/log files to the Tremium Hub
+        Sends the specified files (from the node transfer folder) to the Hub, in batch requests
+        (PUT_FILE_BATCH) of at most "batch-max-files" files.
+        Returns the names of the files the Hub confirmed as stored.
+            ** lets exceptions bubble up 
+
+        Parameters
+        ----------
+        file_names (list) : names of upload files (must be in transfer folder)
         '''
-        
-        transfer_files = []
+
+        stored_files = []
+        batch_max_files = self.config_manager.config_data["batch-max-files"]
         transfer_dir = self.config_manager.config_data["node-file-transfer-dir"]
-        transfer_file_name = self.config_manager.config_data["node-extracted-data-file"]
-        data_file_max_size = self.config_manager.config_data["node-data-file-max-size"]
 
-        archived_data_pattern_segs = self.config_manager.config_data["node-archived-data-file"].split(".")
+        for batch_start in range(0, len(file_names), batch_max_files):
+            batch_files = file_names[batch_start : batch_start + batch_max_files]
 
-        # when the main data file is big enough transfer the contents to an other file
-        data_file_path = os.path.join(transfer_dir, transfer_file_name)
-        if os.path.isfile(data_file_path):
-            if os.stat(data_file_path).st_size > data_file_max_size :
+            try :
+                transfer_start_time = time.time()
+                self._connect_to_server()
+                stored_files += send_file_batch(self.server_s, self.config_manager.config_data["node-id"], 
+                                                [os.path.join(transfer_dir, file_name) for file_name in batch_files],
+                                                self.config_manager.config_data["bluetooth-message-max-size"])
+                self.server_s.close()
+                self.link_estimator.record_transfer(sum(os.stat(os.path.join(transfer_dir, file_name)).st_size 
+                                                        for file_name in batch_files), time.time() - transfer_start_time)
 
-                # waiting for data file availability and locking it
-                while not self.cache.data_file_available(): time.sleep(0.1)
-                self.cache.lock_data_file()
+            except :
+                self.server_s.close()
+                raise
 
-                # renaming the filled / main data file
-                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
-                archive_file_name = archived_data_pattern_segs[0] + "-{}".format(time_str) + "." + archived_data_pattern_segs[1]
-                archive_file_path = os.path.join(transfer_dir, archive_file_name)
-                os.rename(data_file_path, archive_file_path)            
+        # logging completion
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        logging.info("{0} - NodeBluetoothClient successfully uploaded files ({1}) to Hub\
+                     ".format(time_str, str(stored_files)))
+
+        return stored_files
+
+
+    def _ship_log_files(self):
+
+        '''
+        Ships the new tail of every log file in the node transfer folder (APPEND_FILE), the Hub
+        appends the tails to its copy. The shipped offset of every log is kept in a state file.
+            - logs bigger than "node-log-rotate-size" are renamed (rotated), the logger creates a new file,
+              rotated logs are deleted once fully shipped
+            - a truncated or replaced log is shipped from the start
+        Returns {log name : shipped offset}.
+            ** lets exceptions bubble up
+        '''
+
+        transfer_dir = self.config_manager.config_data["node-file-transfer-dir"]
+        rotate_size = self.config_manager.config_data["node-log-rotate-size"]
+        offsets_path = self.config_manager.get_state_file_path("node-log-offsets-file")
+
+        with locked_state_file(offsets_path, {}) as log_offsets:
+
+            # forgetting the logs that no longer exist
+            for log_name in list(log_offsets.keys()):
+                if not os.path.isfile(os.path.join(transfer_dir, log_name)):
+                    del log_offsets[log_name]
+
+            # rotating the big logs (the rotated file keeps the shipped offset, a never shipped log starts at 0)
+            for element in os.listdir(transfer_dir):
+                element_path = os.path.join(transfer_dir, element)
+                if element.endswith(".log") and os.path.isfile(element_path) and \
+                   not log_offsets.get(element, {}).get("rotated", False) and os.stat(element_path).st_size >= rotate_size:
+
+                    log_offset = log_offsets.pop(element, None) or {"offset" : 0, "inode" : os.stat(element_path).st_ino}
+                    time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                    rotated_log_name = element[ : -len(".log")] + "-" + time_str + ".log"
+                    os.rename(element_path, os.path.join(transfer_dir, rotated_log_name))
+                    log_offsets[rotated_log_name] = dict(log_offset, rotated=True)
+
+            # collecting the new tails
+            log_tails = []
+            for element in os.listdir(transfer_dir):
+                element_path = os.path.join(transfer_dir, element)
+                if element.endswith(".log") and os.path.isfile(element_path):
+
+                    log_stat = os.stat(element_path)
+                    log_offset = log_offsets.setdefault(element, {"offset" : 0, "inode" : log_stat.st_ino})
+                    if log_offset["inode"] != log_stat.st_ino or log_stat.st_size < log_offset["offset"]:
+                        log_offset.update({"offset" : 0, "inode" : log_stat.st_ino})
+
+                    if log_stat.st_size > log_offset["offset"]:
+                        log_tails.append((element_path, element, log_offset["inode"], log_offset["offset"], 
+                                          log_stat.st_size - log_offset["offset"]))
+
+            # shipping the tails in a single request
+            if len(log_tails) > 0:
+                try :
+                    transfer_start_time = time.time()
+                    self._connect_to_server()
+                    shipped_offsets = send_file_tails(self.server_s, self.config_manager.config_data["node-id"], log_tails,
+                                                      self.config_manager.config_data["bluetooth-message-max-size"])
+                    self.server_s.close()
+                    self.link_estimator.record_transfer(sum(log_tail[4] for log_tail in log_tails), time.time() - transfer_start_time)
+
+                except :
+                    self.server_s.close()
+                    raise
+
+                for _, element, _, log_start, log_size in log_tails:
+                    if shipped_offsets.get(element) == log_start + log_size:
+                        log_offsets[element]["offset"] = log_start + log_size
+
+            # deleting the fully shipped rotated logs
+            for log_name in list(log_offsets.keys()):
+                log_path = os.path.join(transfer_dir, log_name)
+                if log_offsets[log_name].get("rotated", False) and log_offsets[log_name]["offset"] == os.stat(log_path).st_size:
+                    os.remove(log_path)
+                    del log_offsets[log_name]
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - NodeBluetoothClient shipped log tails : {1}".format(time_str, 
+                         str([(log_tail[1], log_tail[4]) for log_tail in log_tails])))
+
+            return {log_name : log_offset["offset"] for log_name, log_offset in log_offsets.items()}
 
-                # creating new main data file
-                open(data_file_path, "w").close()
 
-                # unlocking the data file
-                self.cache.unlock_data_file()
+    def _transfer_data_files(self):
 
-        # collecting all (archived / ready for transfer) data files + log files
-        for element in os.listdir(transfer_dir):
-            element_path = os.path.join(transfer_dir, element)
-            if os.path.isfile(element_path):
+        ''' 
+        Transfers the contents of the data spool to the hub
+            1) claim the data segments closed by the acquisition writer (DataFileWriter), or move the
+               main (extracted) data file to the spool for the writers that append to it
+            2) transfer/delete the spooled files to the Tremium Hub, by priority (flagged data, newest data)
+               files that do not fit in the estimated contact window are carried over to the next contact
+            ** the spooled files are taken from the spool index (the transfer folder is not scanned)
+            ** log files are shipped incrementally (_ship_log_files)
+        '''
+        
+        transfer_dir = self.config_manager.config_data["node-file-transfer-dir"]
+        self.spool.claim_closed_segments(self.cache)
+
+        # ordering the spooled files by priority, keeping those that fit in the contact window
+        work_items = [(file_name, get_data_file_priority(file_name, self.config_manager), file_time, file_size)
+                      for file_name, file_time, file_size in self.spool.get_entries()]
+        scheduled_items, deferred_items = plan_transfers(work_items, self.link_estimator.remaining_window(), self.link_estimator)
+        transfer_files = [(work_item[0], os.path.join(transfer_dir, work_item[0])) for work_item in scheduled_items]
+        if len(deferred_items) > 0:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - NodeBluetoothClient carried over data files to the next contact : {1}\
+                         ".format(time_str, str([work_item[0] for work_item in deferred_items])))
 
-                is_log_file = element.endswith(".log")
-                is_archived_data = re.search(archived_data_pattern_segs[0], element) is not None
-                is_full = os.stat(element_path).st_size > data_file_max_size
-                if (is_log_file or is_archived_data) and is_full:
-                    transfer_files.append((element, element_path))
+        # the spool leaves the files alone while they are transfered
+        self.spool.checkout([file_info[0] for file_info in transfer_files])
+
+        # uploading transfer files to the Hub (batch requests)
+        transfered_files = []
+        if len(transfer_files) > 0:
+            try :
+                transfered_files = self._upload_files([file_info[0] for file_info in transfer_files])
+            except Exception as e:
+                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                logging.error("{0} - NodeBluetoothClient failed to upload data file batch, uploading files one by one : {1}\
+                              ".format(time_str, e))
 
         try :
-            # uploading transfer files to the Hub and deleting them from local storage
+            # uploading the remaining transfer files to the Hub and deleting them from local storage
             for file_info in transfer_files:
-                self._upload_file(file_info[0])
-                os.remove(file_info[1])
+                if file_info[0] not in transfered_files:
+                    self._upload_file(file_info[0])
+                self.spool.remove([file_info[0]])
 
         except Exception as e:
+            self.spool.release([file_info[0] for file_info in transfer_files])
             time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
             logging.error("{0} - NodeBluetoothClient failed while transfering data files : {1}".format(time_str, e))
             raise
@@ -289,72 +890,155 @@ class NodeBluetoothClient():
         return [file_info[0] for file_info in transfer_files]
             
 
-    def launch_maintenance(self):
+    @profiled("upload_stage")
+    def _run_upload_stage(self):
+
+        ''' Maintenance stage transfering the data/log files to the hub, returns its duration '''
+
+        stage_start_time = time.time()
+        self._transfer_data_files()
+
+        # logs are shipped last (lowest priority)
+        try : self._ship_log_files()
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - NodeBluetoothClient failed to ship log files : {1}".format(time_str, e))
+
+        return time.time() - stage_start_time
+
+
+    @profiled("update_stage")
+    def _run_update_stage(self):
 
-        ''' 
-        Launches the hub - node maintenance sequence
-            - transfers/purges data files (acquisition and logs)
-            - fetches available updates
-            - adds necessary entries in the image update file
+        '''
+        Maintenance stage fetching the available updates from the hub
+        Returns the update file entries and the duration of the stage.
         '''
 
+        stage_start_time = time.time()
         update_entries = []
-        archive_dir = self.config_manager.config_data["node-image-archive-dir"]
         time_stp_pattern = self.config_manager.config_data["image-archive-pattern"]
         docker_registry_prefix = self.config_manager.config_data["docker_registry_prefix"]
 
-        try :
+        # the hub asked to check back later (staged rollout)
+        if time.time() < self.update_retry_time:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - NodeBluetoothClient skipped the update check, the hub rolls updates out in {1:.0f} seconds\
+                         ".format(time_str, self.update_retry_time - time.time()))
+            return update_entries, time.time() - stage_start_time
+
+        # checking for updates of the installed images (manifest)
+        node_manifest = get_node_image_manifest(self.config_manager)
+        update_files = self._check_manifest_updates(node_manifest)
+        if update_files is not None:
+            update_pairs = [(update_file, node_manifest.get(parse_image_archive_name(update_file, self.config_manager)[1]))
+                            for update_file in update_files]
+
+        # falling back on the full listing of available updates (Hub without manifest support)
+        else :
+            update_pairs = [(update_file, get_matching_image(update_file, self.config_manager))
+                            for update_file in self._check_available_updates()]
+
+        # pulling available updates from the hub (or relay peers)
+        # only updates replacing an old image are pulled
+        update_pairs = [update_pair for update_pair in update_pairs if update_pair[1] is not None]
+        downloaded_files = self._get_update_files([update_pair[0] for update_pair in update_pairs])
+        for update_file, old_image_file in update_pairs:
+                
+            # handling the downloaded updates
+            # the manifest is updated (and the old archive deleted) once the update is handed over (NodeImageInstaller)
+            if update_file in downloaded_files:
 
-            # transfering data/log files to the hub
-            self._transfer_data_files()
+                # adding update file entry
+                old_image_time_stp = re.search(time_stp_pattern, old_image_file).group(3)
+                old_image_reg_path = docker_registry_prefix + old_image_file.split(old_image_time_stp)[0][ : -1]
+                update_image_time_stp = re.search(time_stp_pattern, update_file).group(3)
+                update_image_reg_path = docker_registry_prefix + update_file.split(update_image_time_stp)[0][ : -1]
+                update_entries.append(old_image_reg_path + " " + update_file + " " + update_image_reg_path + "\n")
 
-            # pulling available updates from the hub
-            update_files = self._check_available_updates()
-            for update_file in update_files:
-                
-                # getting old image to be updated, if any
-                old_image_file = get_matching_image(update_file, self.config_manager)
-                if old_image_file is not None:
-                    
-                    # downloading update image from the Hub
-                    self._get_update_file(update_file)
-
-                    # deleting old image archive files (.tar and .tar.gz)
-                    old_image_path = os.path.join(archive_dir, old_image_file)
-                    try : os.remove(old_image_path)
-                    except: pass
-
-                    # adding update file entry
-                    old_image_time_stp = re.search(time_stp_pattern, old_image_file).group(3)
-                    old_image_reg_path = docker_registry_prefix + old_image_file.split(old_image_time_stp)[0][ : -1]
-                    update_image_time_stp = re.search(time_stp_pattern, update_file).group(3)
-                    update_image_reg_path = docker_registry_prefix + update_file.split(update_image_time_stp)[0][ : -1]
-                    update_entries.append(old_image_reg_path + " " + update_file + " " + update_image_reg_path + "\n")
-
-            # if updates were pulled from the hub
-            if len(update_entries) > 0:
-
-                # halting the data collection
-                self.cache.stop_data_collection()
-
-                # logging the update entries
-                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
-                logging.info("{0} - NodeBluetoothClient writting out update entries : {1}".\
-                             format(time_str, str(update_entries)))
+        return update_entries, time.time() - stage_start_time
 
-                # writing out the update entries
-                with open(self.config_manager.config_data["node-image-update-file"], "w") as update_file_h:
-                    for entry in update_entries:
-                        update_file_h.write(entry)
-                    update_file_h.write("End")
 
-            # logging maintenance success
-            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
-            logging.info("{0} - Node Bluetooth client successfully performed maintenance".format(time_str))
+    @profiled("node_maintenance")
+    def launch_maintenance(self, discovery_window=None):
 
-        except Exception as e:
-            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
-            logging.error("{0} - Node Bluetooth client failed : {1}".format(time_str, e))
+        ''' 
+        Launches the hub - node maintenance sequence
+            - fetches available updates
+            - transfers/purges data files (acquisition and logs)
+            - installs the updates in the background (see NodeImageInstaller), data collection
+              is only paused for the container swap
+        When "transfer-channels" > 1, the data upload and the update download run at the same 
+        time, the measured wall-clock times of the maintenance, of its stages and of the striped
+        downloads are reported.
+        The session is traced (see TraceSession) : its requests carry the trace id to the hub.
+        Returns the maintenance report (measured durations).
+
+        Parameters
+        ----------
+        discovery_window (tuple) : (start, end) time of the hub discovery that led to the maintenance
+        '''
+
+        maintenance_report = {"channels" : self.transfer_channels}
+        trace_start_time = discovery_window[0] if discovery_window is not None else None
+        with TraceSession(self.config_manager, "node_maintenance", self.config_manager.config_data["node-id"],
+                          start_time=trace_start_time) as trace_session:
+
+            # the trace id is logged with the report (shared with the hub logs)
+            if trace_session.settings is not None:
+                maintenance_report["trace"] = trace_session.trace_id
+            if discovery_window is not None:
+                trace_session.record("discovery", new_span_id(), trace_session.span_id, *discovery_window)
+
+            maintenance_start_time = time.time()
+            self.striped_downloads = []
+
+            try :
+
+                # running the transfer stages concurrently (parallel channels)
+                if self.transfer_channels > 1:
+                    with ThreadPoolExecutor(max_workers=2) as executor:
+                        upload_future = executor.submit(self._run_upload_stage)
+                        update_future = executor.submit(self._run_update_stage)
+                        update_entries, update_time = update_future.result()
+                        upload_time = upload_future.result()
+
+                # pulling updates (critical) first, then transfering data/log files to the hub
+                else :
+                    update_entries, update_time = self._run_update_stage()
+                    upload_time = self._run_upload_stage()
+
+                # if updates were pulled from the hub, they are loaded while data collection keeps running
+                if len(update_entries) > 0:
+
+                    time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                    logging.info("{0} - NodeBluetoothClient installing update entries : {1}".\
+                                 format(time_str, str(update_entries)))
+
+                    from multiprocessing import Process
+                    self.install_process = Process(target=install_node_updates,
+                                                   args=(self.config_file_path, update_entries, dict(self.update_digests)))
+                    self.install_process.start()
+
+                # logging maintenance success
+                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                logging.info("{0} - Node Bluetooth client successfully performed maintenance".format(time_str))
+
+                # reporting the measured durations (stages run concurrently with parallel channels)
+                maintenance_report.update({
+                    "wall_time" : time.time() - maintenance_start_time,
+                    "upload_time" : upload_time,
+                    "update_time" : update_time,
+                    "striped_downloads" : self.striped_downloads
+                })
+                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                logging.info("{0} - Node Bluetooth client maintenance report : {1}".format(time_str, json.dumps(maintenance_report)))
+
+            except Exception as e:
+                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                logging.error("{0} - Node Bluetooth client failed : {1}".format(time_str, e))
+
+        return maintenance_report
 
 
 
@@ -362,6 +1046,8 @@ def launch_node_bluetooth_client(config_file_path, testing=False):
 
     '''
     Launches the Tremium Node bluetooth client for communication with the Hub.
+    The Hubs are looked for over the IP network first ("transport-mode" : "auto" or "tcp"), then over Bluetooth,
+    the maintenance runs against the least loaded Hub in reach (see HubSelector).
 
     Parameters
     ----------
@@ -371,24 +1057,40 @@ def launch_node_bluetooth_client(config_file_path, testing=False):
         False : continuously tries to find the server and runs maintenance
     '''
 
+    from multiprocessing import Process
+
     # loading Node configurations
     config_manager = NodeConfigurationManager(config_file_path)
-    server_address = config_manager.config_data["bluetooth-adapter-mac-server"]
+    hub_selector = HubSelector(config_manager)
+
+    # launching the relay server (serves verified updates to other nodes) in a seperate process
+    if config_manager.config_data["relay-enabled"] and not testing:
+        relay_process_h = Process(target=launch_node_relay_server, args=(config_file_path,))
+        relay_process_h.daemon = True
+        relay_process_h.start()
+
+    # keeping the data spool under its disk budget (even when the hub is out of reach)
+    if not testing:
+        spool_process_h = Process(target=run_spool_manager, args=(config_file_path,))
+        spool_process_h.daemon = True
+        spool_process_h.start()
+
+    # completing the update swap handed over by the previous container (restarts data collection)
+    if not testing:
+        install_process_h = Process(target=install_node_updates, args=(config_file_path, [], {}))
+        install_process_h.start()
 
     # continuously checking for server device
     while True:
 
-        # looking for the server device
-        server_found = False
-        for service in find_service(address=server_address):
-            if service["host"] == server_address:
-                server_found = True
-                break
+        # looking for the server devices (load probe of every hub, IP network then bluetooth)
+        discovery_start_time = time.time()
+        server_found = hub_selector.select_hub() is not None
 
-        # when server device is found, launch maintenance
+        # when a server device is found, launch maintenance (against the least loaded hub)
         if server_found and not testing:
-            node_bluetooth_client = NodeBluetoothClient(config_file_path)
-            node_bluetooth_client.launch_maintenance()
+            node_bluetooth_client = NodeBluetoothClient(config_file_path, hub_selector)
+            node_bluetooth_client.launch_maintenance(discovery_window=(discovery_start_time, time.time()))
 
         # single run exits here
         if testing : return server_found
@@ -402,7 +1104,7 @@ class HubServerConnectionHandler():
 
     ''' Server side handler of new client connections '''
 
-    def __init__(self, config_file_path, client_s, remote_address):
+    def __init__(self, config_file_path, client_s, remote_address, transfer_flow=None, hub_load=None):
 
         '''
         Parameters
@@ -410,28 +1112,55 @@ class HubServerConnectionHandler():
         config_file_path (str) : path to the hub configuration file
         client_s (socket.Socket) : socket corresponding to client connection
         remote_address (str) : client's mac adddress
+        transfer_flow (TransferFlow) : handle on the hub transfer scheduler (None : bulk transfers are not scheduled)
+        hub_load (HubLoad) : load indicators of the hub, reported to the nodes (None : no load is reported)
         '''
 
         self.client_s = client_s
         self.remote_address = remote_address
+        self.transfer_flow = transfer_flow
+        self.hub_load = hub_load
+
+        # data received after the request line (start of a batch stream)
+        self.pending_data = b""
 
         # loading tremium hub configurations
         self.config_manager = HubConfigurationManager(config_file_path)
         log_file_path = os.path.join(self.config_manager.config_data["hub-file-transfer-dir"], 
                                      self.config_manager.config_data["bluetooth-server-log-name"])
 
-        # setting up logging    
+        # setting up logging (handlers are created by the server process, the log file is only opened once)
         logger = logging.getLogger()
         logger.setLevel(logging.INFO)
-        log_handler = logging.handlers.WatchedFileHandler(log_file_path)
-        log_handler.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
-        logger.addHandler(log_handler)
+        if not any(getattr(handler, "baseFilename", None) == os.path.abspath(log_file_path) for handler in logger.handlers):
+            log_handler = logging.handlers.WatchedFileHandler(log_file_path)
+            log_handler.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
+            logger.addHandler(log_handler)
 
 
     def __del__(self):
         self.client_s.close()
 
 
+    def _get_chunk_grant(self, request_type):
+
+        '''
+        Returns the grant function used for the chunks of a bulk transfer (None without scheduler)
+        Chunks are scheduled per node (remote address), weighted by request type, see ChunkGrant.
+
+        Parameters
+        ----------
+        request_type (str) : type of request (ex : GET_UPDATE)
+        '''
+
+        if self.transfer_flow is None:
+            return None
+
+        from .bandwidth import ChunkGrant
+        node_key = self.remote_address[0] if isinstance(self.remote_address, tuple) else str(self.remote_address)
+        return ChunkGrant(self.transfer_flow, node_key, request_type)
+
+
     def _check_available_updates(self, message_str):
 
         '''
@@ -451,6 +1180,9 @@ class HubServerConnectionHandler():
             node_id = re.search(self.config_manager.config_data["id-pattern"], message_str).group(1)
             image_archives = get_image_from_hub_archive(node_id, self.config_manager)
 
+            # archives not rolled out to the node yet are left out
+            image_archives, _ = UpdateRollout(self.config_manager).filter_updates(node_id, image_archives)
+
             list_str = " "
             if len(image_archives) > 0:
                 list_str = ",".join(image_archives)
@@ -470,6 +1202,160 @@ class HubServerConnectionHandler():
             return ""
 
 
+    def _check_manifest_updates(self, message_str):
+
+        '''
+        Responds with "UPDATES (comma seperated image names)" containing only the images that 
+        differ from the ones installed on the Node (manifest), or "NOT_MODIFIED".
+        The image archives come from the cached Hub catalog (no scan of the archive folder).
+        Updates are rolled out in waves (see UpdateRollout), a Node outside the open waves or
+        over the update slot cap gets "RETRY_AFTER (seconds)".
+        
+        Params
+        ------
+        message_str (str) : incoming message from client
+        '''
+
+        try :
+
+            # parsing the request : CHECK_UPDATES_MANIFEST (node id) (comma seperated installed image names)
+            message_segs = message_str.split()
+            node_id = message_segs[1]
+            node_manifest = {}
+            if len(message_segs) > 2:
+                for image_name in message_segs[2].split(","):
+                    archive_info = parse_image_archive_name(image_name, self.config_manager)
+                    if archive_info is not None:
+                        node_manifest[archive_info[1]] = image_name
+
+            with profile_span("archive catalog"):
+                update_images = get_manifest_updates(node_id, node_manifest, self.config_manager)
+            update_images, retry_after = UpdateRollout(self.config_manager).check_updates(node_id, update_images)
+            response_str = "NOT_MODIFIED"
+            if len(update_images) > 0:
+                response_str = "UPDATES " + ",".join(update_images)
+            elif retry_after is not None:
+                response_str = "RETRY_AFTER {}".format(int(retry_after) + 1)
+            self.client_s.sendall(response_str.encode())
+
+            # logging exchange
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')                
+            logging.info("{0} - Hub Bluetooth server thread handled (CHECK_UPDATES_MANIFEST) request from Node with id : {1}, {2}\
+                         ".format(time_str, node_id, response_str))
+
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - Hub Bluetooth server failed while handling (CHECK_UPDATES_MANIFEST) request from peer : {1}, {2}\
+                        ".format(time_str, self.remote_address, e))
+
+
+    def _locate_update(self, message_str):
+
+        '''
+        Responds with the source the Node should fetch the specified update file from.
+            - "HUB (size) (digest)" : the Hub serves the file
+            - "PEER (address) (port) (size) (digest)" : a relay peer (an other Node) serves the file
+            - "NONE" : the file is not available
+        
+        Parameters
+        ------
+        message_str (str) : incoming message from client
+        '''
+
+        try :
+
+            # parsing the request : LOCATE_UPDATE (node id) (image file name)
+            _, node_id, image_file_name = message_str.split()
+            image_file_path = os.path.join(self.config_manager.config_data["hub-image-archive-dir"], image_file_name)
+
+            response_str = "NONE"
+            if os.path.isfile(image_file_path):
+
+                image_file_size = os.stat(image_file_path).st_size
+                image_file_digest = get_archive_digest(image_file_path)
+                response_str = "HUB {0} {1}".format(image_file_size, image_file_digest)
+
+                # assigning a relay peer to the node, if one is available
+                if self.config_manager.config_data["relay-enabled"]:
+                    relay_peer = UpdateRelayRegistry(self.config_manager).\
+                                 select_peer(image_file_name, image_file_digest, node_id)
+                    if relay_peer is not None:
+                        response_str = "PEER {0} {1} {2} {3}".format(relay_peer[1], relay_peer[2], 
+                                                                     image_file_size, image_file_digest)
+
+            self.client_s.sendall(response_str.encode())
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - Hub Bluetooth server thread handled (LOCATE_UPDATE) request from Node with id : {1}, {2}\
+                         ".format(time_str, node_id, response_str))
+
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - Hub Bluetooth server failed while handling (LOCATE_UPDATE) request from peer : {1}, {2}\
+                        ".format(time_str, self.remote_address, e))
+
+
+    def _report_hub_status(self, message_str):
+
+        '''
+        Responds with the load of the Hub, the Nodes connect to the least loaded Hub in reach
+            - "HUB_STATUS (hub id) (active sessions) (transfer queue depth)"
+
+        Parameters
+        ------
+        message_str (str) : incoming message from client
+        '''
+
+        try :
+
+            active_sessions, queue_depth = self.hub_load.get() if self.hub_load is not None else (0, 0)
+            response_str = "HUB_STATUS {0} {1} {2}\n".format(self.config_manager.config_data["hub-id"], active_sessions, queue_depth)
+            self.client_s.sendall(response_str.encode())
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - Hub Bluetooth server thread handled (HUB_STATUS) request from peer : {1}, {2}\
+                         ".format(time_str, self.remote_address, response_str.strip()))
+
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - Hub Bluetooth server failed while handling (HUB_STATUS) request from peer : {1}, {2}\
+                        ".format(time_str, self.remote_address, e))
+
+
+    def _register_update_peer(self, message_str):
+
+        '''
+        Registers the Node as a relay peer for an update file it verified.
+        Responds with "OK", or "REJECTED" if the Node's digest does not match the Hub's copy.
+        
+        Parameters
+        ------
+        message_str (str) : incoming message from client
+        '''
+
+        try :
+
+            # parsing the request : REGISTER_UPDATE_PEER (node id) (address) (port) (image file name) (digest)
+            _, node_id, address, port, image_file_name, digest = message_str.split()
+            image_file_path = os.path.join(self.config_manager.config_data["hub-image-archive-dir"], image_file_name)
+
+            response_str = "REJECTED"
+            if os.path.isfile(image_file_path) and get_archive_digest(image_file_path) == digest:
+                UpdateRelayRegistry(self.config_manager).register_peer(image_file_name, digest, node_id, address, int(port))
+                response_str = "OK"
+
+            self.client_s.sendall(response_str.encode())
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - Hub Bluetooth server thread handled (REGISTER_UPDATE_PEER) request from Node with id : {1}, {2}\
+                         ".format(time_str, node_id, response_str))
+
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - Hub Bluetooth server failed while handling (REGISTER_UPDATE_PEER) request from peer : {1}, {2}\
+                        ".format(time_str, self.remote_address, e))
+
+
     def _get_update(self, message_str):
 
         ''' 
@@ -487,12 +1373,23 @@ class HubServerConnectionHandler():
             image_file_path = os.path.join(self.config_manager.config_data["hub-image-archive-dir"], image_file_name)
             if os.path.isfile(image_file_path):
 
-                # transfering the target file
-                with open(image_file_path, "rb") as image_f:
-                    data = image_f.read(self.config_manager.config_data["bluetooth-message-max-size"])
-                    while data : 
-                        self.client_s.send(data)
+                # the archive can not be garbage collected while it is being transfered
+                acquire_download_lease(self.config_manager, image_file_name)
+                try :
+
+                    # transfering the target file (chunks are granted by the transfer scheduler)
+                    chunk_grant = self._get_chunk_grant("GET_UPDATE")
+                    with trace_span("send file", file=image_file_name, bytes=os.stat(image_file_path).st_size), \
+                         open(image_file_path, "rb") as image_f:
                         data = image_f.read(self.config_manager.config_data["bluetooth-message-max-size"])
+                        while data : 
+                            wait_for_socket(self.client_s, chunk_grant, write=True)
+                            with get_chunk_grant(chunk_grant, len(data)):
+                                self.client_s.send(data)
+                            data = image_f.read(self.config_manager.config_data["bluetooth-message-max-size"])
+
+                finally:
+                    release_download_lease(self.config_manager, image_file_name)
 
             time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
             logging.info("{0} - Hub Bluetooth server thread handled (GET_UPDATE) request from peer : {1}\
@@ -504,35 +1401,258 @@ class HubServerConnectionHandler():
                         ".format(time_str, self.client_s.getpeername(), e))
 
 
+    def _store_file_batch(self, message_str):
+
+        ''' 
+        Writes out the stream of file entries sent by the client (PUT_FILE_BATCH).
+        Every entry is written to a (.part) file, indexed, queued for the columnar transcoding and
+        renamed once complete (the data collector only sees indexed and queued files), then its
+        status is sent back to the client ("OK (file name)" or "ERROR (file name)").
+        
+        Parameters
+        ----------
+        message_str (str) : incoming message from client
+        '''
+
+        stored_files = []
+
+        try :
+
+            # parsing the request : PUT_FILE_BATCH (node id) (file count)
+            _, node_id, file_count = message_str.split()
+            reader = SocketReader(self.client_s, self.config_manager.config_data["bluetooth-message-max-size"], self.pending_data)
+            transfer_dir = self.config_manager.config_data["hub-file-transfer-dir"]
+
+            for _ in range(int(file_count)):
+
+                # reading the entry header : (file name) (size)
+                target_file_name, target_file_size = reader.read_line().split()
+                target_file_path = os.path.join(transfer_dir, target_file_name)
+                valid_name = os.path.basename(target_file_name) == target_file_name and target_file_name not in (".", "..")
+
+                # writing out the entry (invalid entries are consumed and discarded)
+                with trace_span("receive file", file=target_file_name, bytes=int(target_file_size)), \
+                     open(target_file_path + ".part" if valid_name else os.devnull, "wb") as target_file_h:
+                    reader.read_to_file(target_file_h, int(target_file_size), grant=self._get_chunk_grant("PUT_FILE_BATCH"))
+
+                if valid_name:
+                    with profile_span("index data files"):
+                        index_data_files(self.config_manager, node_id, [target_file_name], file_suffix=".part")
+                    register_data_files(self.config_manager, node_id, [target_file_name])
+                    os.replace(target_file_path + ".part", target_file_path)
+                    stored_files.append(target_file_name)
+                    self.client_s.sendall(bytes("OK {}\n".format(target_file_name), "UTF-8"))
+                else :
+                    self.client_s.sendall(bytes("ERROR {}\n".format(target_file_name), "UTF-8"))
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - Hub Bluetooth server thread handled (PUT_FILE_BATCH) request from Node with id : {1}, {2}\
+                         ".format(time_str, node_id, str(stored_files)))
+
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - Hub Bluetooth server failed while handling (PUT_FILE_BATCH) request from peer : {1}, {2}\
+                        ".format(time_str, self.remote_address, e))
+
+        return stored_files
+
+
+    def _fetch_update_batch(self, message_str):
+
+        ''' 
+        Transfers the specified files (in the message) to the client, as a stream of entries
+        ("OK (file name) (size) (digest)" followed by the file data, or "MISSING (file name)")
+        terminated by "END".
+        
+        Parameters
+        ------
+        message_str (str) : incoming message from client
+        '''
+
+        try :
+
+            # parsing the request : FETCH_UPDATE_BATCH (comma seperated image file names)
+            image_file_names = message_str.split()[1].split(",")
+            archive_dir = self.config_manager.config_data["hub-image-archive-dir"]
+
+            for image_file_name in image_file_names:
+                image_file_path = os.path.join(archive_dir, image_file_name)
+                if os.path.basename(image_file_name) != image_file_name or not os.path.isfile(image_file_path):
+                    self.client_s.sendall(bytes("MISSING {}\n".format(image_file_name), "UTF-8"))
+                    continue
+
+                # the archive can not be garbage collected while it is being transfered
+                acquire_download_lease(self.config_manager, image_file_name)
+                try :
+                    image_file_size = os.stat(image_file_path).st_size
+                    self.client_s.sendall(bytes("OK {0} {1} {2}\n".format(image_file_name, image_file_size, 
+                                          get_archive_digest(image_file_path)), "UTF-8"))
+                    with trace_span("send file", file=image_file_name, bytes=image_file_size):
+                        send_file(self.client_s, image_file_path, self.config_manager.config_data["bluetooth-message-max-size"],
+                                  size=image_file_size, grant=self._get_chunk_grant("FETCH_UPDATE_BATCH"))
+                finally:
+                    release_download_lease(self.config_manager, image_file_name)
+
+            self.client_s.sendall(b"END\n")
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - Hub Bluetooth server thread handled (FETCH_UPDATE_BATCH) request from peer : {1}\
+                        ".format(time_str, self.remote_address))
+
+        except Exception as e: 
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')                
+            logging.error("{0} - Hub Bluetooth server failed while handling (FETCH_UPDATE_BATCH) request from peer : {1}, {2}\
+                        ".format(time_str, self.remote_address, e))
+
+
+    def _fetch_update_range(self, message_str):
+
+        ''' 
+        Transfers a byte range of the specified file (in the message) to the client
+        ("OK (size)" followed by the range data, or "MISSING (file name)")
+        
+        Parameters
+        ------
+        message_str (str) : incoming message from client
+        '''
+
+        try :
+
+            # parsing the request : FETCH_UPDATE_RANGE (image file name) (start) (end)
+            _, image_file_name, range_start, range_end = message_str.split()
+            image_file_path = os.path.join(self.config_manager.config_data["hub-image-archive-dir"], image_file_name)
+            range_start, range_end = int(range_start), int(range_end)
+
+            if os.path.basename(image_file_name) != image_file_name or not os.path.isfile(image_file_path) or \
+               not 0 <= range_start <= range_end <= os.stat(image_file_path).st_size:
+                self.client_s.sendall(bytes("MISSING {}\n".format(image_file_name), "UTF-8"))
+                return
+
+            # the archive can not be garbage collected while it is being transfered
+            acquire_download_lease(self.config_manager, image_file_name)
+            try :
+                self.client_s.sendall(bytes("OK {}\n".format(range_end - range_start), "UTF-8"))
+                with trace_span("send file", file=image_file_name, bytes=range_end - range_start):
+                    send_file(self.client_s, image_file_path, self.config_manager.config_data["bluetooth-message-max-size"],
+                              offset=range_start, size=range_end - range_start, grant=self._get_chunk_grant("FETCH_UPDATE_RANGE"))
+            finally:
+                release_download_lease(self.config_manager, image_file_name)
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - Hub Bluetooth server thread handled (FETCH_UPDATE_RANGE) request from peer : {1}, {2}\
+                        ".format(time_str, self.remote_address, message_str))
+
+        except Exception as e: 
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')                
+            logging.error("{0} - Hub Bluetooth server failed while handling (FETCH_UPDATE_RANGE) request from peer : {1}, {2}\
+                        ".format(time_str, self.remote_address, e))
+
+
+    def _append_files(self, message_str):
+
+        ''' 
+        Appends the stream of log tails sent by the client (APPEND_FILE) to the Hub's copy of the logs
+        ("(node id)_(file name)" in the transfer folder), then sends back the offset every log reached
+        ("OK (file name) (offset)" or "ERROR (file name)"). The offset received for every log is kept
+        in a state file, bytes the Hub already received (same log generation) are skipped.
+        
+        Parameters
+        ----------
+        message_str (str) : incoming message from client
+        '''
+
+        appended_files = []
+
+        try :
+
+            # parsing the request : APPEND_FILE (node id) (entry count)
+            _, node_id, entry_count = message_str.split()
+            reader = SocketReader(self.client_s, self.config_manager.config_data["bluetooth-message-max-size"], self.pending_data)
+            transfer_dir = self.config_manager.config_data["hub-file-transfer-dir"]
+            offsets_path = self.config_manager.get_state_file_path("hub-log-offsets-file")
+
+            for _ in range(int(entry_count)):
+
+                # reading the entry header : (file name) (generation) (offset) (size)
+                log_name, log_generation, log_start, log_size = reader.read_line().split()
+                log_start, log_size = int(log_start), int(log_size)
+                log_key = node_id + "_" + log_name
+                if os.path.basename(log_key) != log_key or not log_name.endswith(".log"):
+                    with open(os.devnull, "wb") as discard_h:
+                        reader.read_to_file(discard_h, log_size)
+                    self.client_s.sendall(bytes("ERROR {}\n".format(log_name), "UTF-8"))
+                    continue
+
+                # skipping the bytes that were already received (ex : the client missed the response)
+                with locked_state_file(offsets_path, {}) as log_offsets:
+                    log_offset = log_offsets.get(log_key, {})
+                    received_offset = log_offset["offset"] if log_offset.get("generation") == log_generation else log_start
+                    skip_size = min(log_size, max(0, received_offset - log_start))
+                    with open(os.devnull, "wb") as discard_h:
+                        reader.read_to_file(discard_h, skip_size)
+
+                    # appending the new bytes to the Hub's copy (shared with the data collector)
+                    with locked_file(os.path.join(transfer_dir, log_key), "ab") as log_file_h:
+                        reader.read_to_file(log_file_h, log_size - skip_size, grant=self._get_chunk_grant("APPEND_FILE"))
+                    log_offsets[log_key] = {"generation" : log_generation, "offset" : log_start + log_size}
+
+                appended_files.append(log_name)
+                self.client_s.sendall(bytes("OK {0} {1}\n".format(log_name, log_start + log_size), "UTF-8"))
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - Hub Bluetooth server thread handled (APPEND_FILE) request from Node with id : {1}, {2}\
+                         ".format(time_str, node_id, str(appended_files)))
+
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - Hub Bluetooth server failed while handling (APPEND_FILE) request from peer : {1}, {2}\
+                        ".format(time_str, self.remote_address, e))
+
+        return appended_files
+
+
     def _store_file(self, message_str):
 
         ''' 
         Creates the specified file (in message) and writes the incoming client data in it. 
+        The data is written to a (.part) file, indexed, queued for the transcoding and renamed once the client is done.
         
         Parameters
         ----------
         message_str (str) : incoming message from client
         '''
-    
+
+        file_received = False
         try :
 
             client_address = self.client_s.getpeername()
 
-            # creating target image file
-            target_file_name = message_str.split("STORE_FILE ")[1]
+            # parsing the request : STORE_FILE (file name) (node id), older nodes do not send their id
+            request_fields = message_str.split(" ")
+            target_file_name = request_fields[1]
+            node_id = request_fields[2] if len(request_fields) > 2 else str(client_address[0])
             target_file_path = os.path.join(self.config_manager.config_data["hub-file-transfer-dir"], target_file_name)
             
-            with open(target_file_path, "wb") as target_file_h:
-
-                file_data = self.client_s.recv(self.config_manager.config_data["bluetooth-message-max-size"])
+            # receiving the file (chunks are granted by the transfer scheduler once the data is there)
+            chunk_grant = self._get_chunk_grant("STORE_FILE")
+            buffer_size = self.config_manager.config_data["bluetooth-message-max-size"]
+            with trace_span("receive file", file=target_file_name), open(target_file_path + ".part", "wb") as target_file_h:
+
+                # the file data can arrive with the request line (stream transports)
+                target_file_h.write(self.pending_data)
+                file_data = True
                 while file_data:
+                    wait_for_socket(self.client_s, chunk_grant)
+                    with get_chunk_grant(chunk_grant, buffer_size):
+                        file_data = self.client_s.recv(buffer_size)
                     target_file_h.write(file_data)
-                    file_data = self.client_s.recv(self.config_manager.config_data["bluetooth-message-max-size"])
 
             self.client_s.close()
+            file_received = True
             
         # client closes connection when all data is transfered      
         except ConnectionResetError :
+            file_received = True
             time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
             logging.info("{0} - Hub Bluetooth server thread handled (STORE_FILE) ({1}) request from peer : {2}\
                          ".format(time_str, target_file_name, client_address))
@@ -542,12 +1662,24 @@ class HubServerConnectionHandler():
             logging.error("{0} - Hub Bluetooth server failed while handling (STORE_FILE) request from peer : {1}, {2}\
                         ".format(time_str, client_address, e))
 
+        # the file is indexed and queued for the transcoding before it is visible to the data collector
+        if file_received:
+            index_data_files(self.config_manager, node_id, [target_file_name], file_suffix=".part")
+            register_data_files(self.config_manager, node_id, [target_file_name])
+            os.replace(target_file_path + ".part", target_file_path)
 
+
+    @profiled("hub_connection")
     def handle_connection(self):
 
-        ''' Handles interactions with the client connection '''
+        '''
+        Handles interactions with the client connection
+        The handling is traced (see TraceSession), as part of the node trace when the request carries one.
+        '''
 
         # setting up monitoring for the socket
+        connection_start_time = time.time()
+        trace_context = None
         s_data_ready = select.select([self.client_s], [], [], self.config_manager.config_data["bluetooth-comm-timeout"])
 
         # waiting to receive data (subject to timeout)
@@ -556,22 +1688,67 @@ class HubServerConnectionHandler():
             try : 
 
                 # waiting and reading incoming message (blocking and subject to timeout)
-                message_str = self.client_s.recv(self.config_manager.config_data["bluetooth-message-max-size"]).decode("utf-8")
-
-                if not message_str.find("CHECK_AVAILABLE_UPDATES") == -1:
-                    self._check_available_updates(message_str)
-
-                elif not message_str.find("GET_UPDATE") == -1:
-                    self._get_update(message_str)
-
-                elif not message_str.find("STORE_FILE") == -1:
-                    self._store_file(message_str)
-
-                # handling unrecognized incoming message
-                else :
-                    time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
-                    logging.error("{0} - Hub Bluetooth server thread connected to peer : {1}, received unrecognized message : {2}\
-                                ".format(time_str, self.remote_address, message_str))
+                # batch requests are newline terminated, the data following the request line is kept
+                # the request line can follow a trace header (traced node session)
+                with profile_span("receive_request"):
+                    message_data = self.client_s.recv(self.config_manager.config_data["bluetooth-message-max-size"])
+                    trace_context, message_data = parse_trace_header(message_data)
+                    if trace_context is not None and len(message_data) == 0:
+                        message_data = self.client_s.recv(self.config_manager.config_data["bluetooth-message-max-size"])
+                    message_data, _, self.pending_data = message_data.partition(b"\n")
+                    message_str = message_data.decode("utf-8")
+                request_time = time.time()
+
+                # every request is a phase of the connection profile (and a span of the trace)
+                trace_id, parent_span_id = trace_context if trace_context is not None else (None, None)
+                with TraceSession(self.config_manager, "hub_connection", self.config_manager.config_data["hub-id"], trace_id,
+                                  parent_span_id, connection_start_time) as trace_session, \
+                     profile_span("request " + message_str.split(" ")[0]):
+                    if trace_session.settings is not None:
+                        trace_session.record("receive request", new_span_id(), trace_session.span_id, connection_start_time,
+                                             request_time, remote=str(self.remote_address))
+                    if not message_str.find("PUT_FILE_BATCH") == -1:
+                        self._store_file_batch(message_str)
+
+                    elif not message_str.find("FETCH_UPDATE_BATCH") == -1:
+                        self._fetch_update_batch(message_str)
+
+                    elif not message_str.find("FETCH_UPDATE_RANGE") == -1:
+                        self._fetch_update_range(message_str)
+
+                    elif not message_str.find("APPEND_FILE") == -1:
+                        self._append_files(message_str)
+
+                    elif not message_str.find("CHECK_AVAILABLE_UPDATES") == -1:
+                        self._check_available_updates(message_str)
+
+                    elif not message_str.find("GET_UPDATE") == -1:
+                        self._get_update(message_str)
+
+                    elif not message_str.find("STORE_FILE") == -1:
+                        self._store_file(message_str)
+
+                    elif not message_str.find("CHECK_UPDATES_MANIFEST") == -1:
+                        self._check_manifest_updates(message_str)
+
+                    elif not message_str.find("LOCATE_UPDATE") == -1:
+                        self._locate_update(message_str)
+
+                    elif not message_str.find("REGISTER_UPDATE_PEER") == -1:
+                        self._register_update_peer(message_str)
+
+                    elif not message_str.find("HUB_STATUS") == -1:
+                        self._report_hub_status(message_str)
+
+                    # connection closed without a request (reachability probe)
+                    elif message_str.strip() == "":
+                        pass
+
+                    # handling unrecognized incoming message
+                    else :
+                        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                        logging.error("{0} - Hub Bluetooth server thread connected to peer : {1}, received unrecognized message : {2}\
+                                    ".format(time_str, self.remote_address, message_str))
     
             except Exception as e:
                 self.client_s.close()
@@ -581,9 +1758,11 @@ class HubServerConnectionHandler():
     
         # closing connection with the client
         self.client_s.close()
+        if self.transfer_flow is not None:
+            self.transfer_flow.close()
         time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
-        logging.info("{0} - Hub Bluetooth server thread connected to peer : {1}, closed connection\
-                        ".format(time_str, self.remote_address))
+        logging.info("{0} - Hub Bluetooth server thread connected to peer : {1}, closed connection, trace : {2}\
+                        ".format(time_str, self.remote_address, trace_context[0] if trace_context is not None else None))
 
 
 
@@ -591,12 +1770,15 @@ def launch_hub_bluetooth_server(config_file_path):
 
     ''' 
     Launches the Tremium Hub bluetooth server which the Tremium Nodes connect to.
+    The server accepts connections over every transport in "hub-transports" (Bluetooth, IP network).
 
     Parameters
     ----------
     config_file_path (str) : path to the hub configuration file
     '''
 
+    from multiprocessing import Process
+
     # loading Tremium Hub configurations
     config_manager = HubConfigurationManager(config_file_path)
     log_file_path = os.path.join(config_manager.config_data["hub-file-transfer-dir"], 
@@ -612,35 +1794,35 @@ def launch_hub_bluetooth_server(config_file_path):
     # defining container for connection handler handles
     connection_handlers_h = []
 
-    try :
+    # launching the scheduler of the bulk transfers (shared by the connection handlers)
+    # load indicators of the hub (active sessions, transfer queue depth), reported to the nodes
+    hub_load = HubLoad()
 
-        # creating socket to listen for new connections
-        listener_s = BluetoothSocket()
-        listener_s.bind((config_manager.config_data["bluetooth-adapter-mac-server"], 
-                        config_manager.config_data["bluetooth-port"]))
-        listener_s.listen(1)
-    
-        # advertising the listenning connection
-        advertise_service(listener_s, config_manager.config_data["hub-id"])
+    transfer_scheduler = None
+    if config_manager.config_data["hub-scheduler-enabled"]:
+        from .bandwidth import TransferScheduler
+        transfer_scheduler = TransferScheduler(config_manager, hub_load)
+        transfer_scheduler.start()
 
-        bind_address = listener_s.getsockname()
-        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
-        logging.info("{0} - Hub Bluetooth server listening on address : {1}".format(time_str, bind_address))
-
-    except Exception as e:
-        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
-        logging.error("{0} - Hub Bluetooth server failed to create listener socket : {1}".format(time_str, e))
-        raise
+    # creating the sockets listening for new connections (one per transport)
+    listeners = dict((listener_s.fileno(), listener_s) for _, listener_s in create_hub_listeners(config_manager))
 
     while True:
         
         try : 
 
-            # blocking until a new connection occurs, then create connection handler
-            client_s, remote_address = listener_s.accept()
+            # blocking until a new connection occurs (on any transport), then create connection handler
+            ready_fds, _, _ = select.select(list(listeners.keys()), [], [])
+            client_s, remote_address = listeners[ready_fds[0]].accept()
             client_s.settimeout(config_manager.config_data["bluetooth-comm-timeout"])
-            connection_handler = HubServerConnectionHandler(config_file_path, client_s, remote_address)
-            
+            transfer_flow = transfer_scheduler.create_flow() if transfer_scheduler is not None else None
+            connection_handler = HubServerConnectionHandler(config_file_path, client_s, remote_address, transfer_flow, hub_load)
+
+            # clearing the handles of finished handlers, the running handlers are the active sessions
+            # (reported without the new connection, a HUB_STATUS probe does not count itself)
+            connection_handlers_h = [handler_h for handler_h in connection_handlers_h if handler_h.is_alive()]
+            hub_load.set_active_sessions(len(connection_handlers_h))
+
             # launching connection handler in a seperate process
             process_h = Process(target=connection_handler.handle_connection, args=())
             process_h.start()
@@ -649,11 +1831,6 @@ def launch_hub_bluetooth_server(config_file_path):
             time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
             logging.info("{0} - Hub Bluetooth server accepted and is handling connection from remote : {1}\
                          ".format(time_str, remote_address))
-
-            #regular check to clear dead handles
-            for handler_h in connection_handlers_h:
-                if handler_h is not None:
-                    connection_handlers_h.remove(handler_h)
         
         except Exception as e: 
 
@@ -1,4 +1,3 @@
-import redis
 import logging
 from .config import NodeConfigurationManager
 
@@ -25,7 +24,8 @@ class NodeCacheModel():
             # first instance creates the connection pool, then connects
             if self.conn_pool is None: 
                 
-                # creating class level connection pool
+                # creating class level connection pool (redis is only loaded by the processes using the cache)
+                import redis
                 redis_config = self.config_manager.config_data["node-redis-server-config"]
                 NodeCacheModel.conn_pool = redis.ConnectionPool(**redis_config)
                 self.r_server = redis.StrictRedis(connection_pool=self.conn_pool)
@@ -36,6 +36,7 @@ class NodeCacheModel():
             
             # create connection from existing connection pool
             else :
+                import redis
                 self.r_server = redis.StrictRedis(connection_pool=self.conn_pool)
 
         except Exception as e:
@@ -59,6 +60,9 @@ class NodeCacheModel():
         # locking flag for extracted data file
         self.r_server.set("data_file_lock", "0")
 
+        # throttling flag, set by the data spool when the node storage is nearly full
+        self.r_server.set("data_collection_throttle", "0")
+
 
     def start_data_collection(self):
         self.r_server.set("data_collection", "1")
@@ -69,6 +73,15 @@ class NodeCacheModel():
     def check_data_collection(self):
         return int(self.r_server.get("data_collection")) == 1
 
+    def throttle_data_collection(self):
+        self.r_server.set("data_collection_throttle", "1")
+
+    def release_data_collection_throttle(self):
+        self.r_server.set("data_collection_throttle", "0")
+
+    def check_data_collection_throttle(self):
+        return int(self.r_server.get("data_collection_throttle") or 0) == 1
+
     def lock_data_file(self):
         self.r_server.set("data_file_lock", "1")
 
@@ -0,0 +1,414 @@
+import os
+import os.path
+import re
+import gzip
+import json
+import shutil
+
+import time
+import logging
+import datetime
+
+from .data_index import iter_data_file_lines, is_indexed_data_file
+from .file_management import load_state_file, locked_state_file
+
+
+# column types of the batch schemas (a column can widen from int to float)
+TYPE_BOOL = "bool"
+TYPE_INT = "int"
+TYPE_FLOAT = "float"
+TYPE_STRING = "string"
+TYPE_JSON = "json"
+
+# node of the data files received without a node id (not registered)
+UNKNOWN_NODE_ID = "unknown"
+
+
+def get_value_type(value):
+
+    ''' Returns the column type of a record value, None for null values '''
+
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return TYPE_BOOL
+    if isinstance(value, int):
+        return TYPE_INT
+    if isinstance(value, float):
+        return TYPE_FLOAT
+    if isinstance(value, str):
+        return TYPE_STRING
+    return TYPE_JSON
+
+
+def merge_column_type(column_type, value_type):
+
+    '''
+    Returns the column type once a value of value_type is added to the column, None if the
+    value does not fit the column (the record is rejected)
+
+    Parameters
+    ----------
+    column_type (str) : current type of the column (None : new column)
+    value_type (str) : type of the value (None : null value)
+    '''
+
+    if column_type is None:
+        return value_type
+    if value_type is None or value_type == column_type:
+        return column_type
+    if {column_type, value_type} == {TYPE_INT, TYPE_FLOAT}:
+        return TYPE_FLOAT
+    return None
+
+
+def get_columnar_format(config_manager):
+
+    '''
+    Returns the format of the columnar batches ("transcode-format")
+        - "parquet" : Apache Parquet files (needs pyarrow)
+        - "json" : gzip JSON files holding the columns (no extra dependency)
+        - "auto" : parquet when pyarrow is installed, json otherwise
+
+    Parameters
+    ----------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    '''
+
+    columnar_format = config_manager.config_data["transcode-format"]
+    if columnar_format == "auto":
+        try :
+            import pyarrow
+            return "parquet"
+        except ImportError:
+            return "json"
+    if columnar_format in ("parquet", "json"):
+        return columnar_format
+    raise ValueError("unknown columnar format : {}".format(columnar_format))
+
+
+def read_columnar_batch(batch_path):
+
+    ''' Returns the columns of a gzip JSON batch, as {"schema" : {column : type}, "columns" : {column : values}, ...} '''
+
+    with gzip.open(batch_path, "rt") as batch_h:
+        return json.load(batch_h)
+
+
+class ColumnarTranscoder():
+
+    '''
+    Transcodes the JSON lines data files received from the nodes into compressed columnar batches
+        - data files are streamed (a line at a time), records are buffered by partition (node, day)
+          and a partition is written out every "transcode-batch-rows" records (bounded memory)
+        - batches are written to "hub-columnar-dir"/node=(node id)/day=(YYYY-MM-DD)/, in the
+          "transcode-format" format (see get_columnar_format), records ordered by time
+        - the schema of every node (column types) is inferred from its records and kept in
+          "hub-columnar-schema-file", new columns are added, int columns widen to float
+        - records that are not JSON objects, or whose values do not fit the schema, are written
+          as is to the rejects file of the node (node=(node id)/rejects/), no record is dropped
+    A data file without a single valid record (ex : not JSON lines) is left untouched.
+    Batches are written as (.part) files, they are only published once the pass is recorded (see transcode_data_files).
+    '''
+
+    def __init__(self, config_manager):
+
+        '''
+        Parameters
+        ----------
+        config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+        '''
+
+        self.config_manager = config_manager
+        self.columnar_dir = config_manager.config_data["hub-columnar-dir"]
+        self.batch_rows = config_manager.config_data["transcode-batch-rows"]
+        self.columnar_format = get_columnar_format(config_manager)
+        self.schema_file_path = config_manager.get_state_file_path("hub-columnar-schema-file")
+
+        # {node id : {column : type}}, {(node id, day) : [(time, record)]}, paths of the written batches
+        self.schemas = load_state_file(self.schema_file_path, {})
+        self.partitions = {}
+        self.batch_paths = []
+        self.batch_count = 0
+        self.file_valid_count = 0
+
+
+    def _get_partition_dir(self, node_id, *sub_dirs):
+
+        ''' Returns (creates) the folder of a node partition '''
+
+        partition_dir = os.path.join(self.columnar_dir, "node=" + re.sub("[^A-Za-z0-9_.-]", "-", node_id), *sub_dirs)
+        if not os.path.isdir(partition_dir):
+            os.makedirs(partition_dir, exist_ok=True)
+        return partition_dir
+
+
+    def _get_batch_name(self, extension):
+        current_time = time.time()
+        time_str = datetime.datetime.fromtimestamp(current_time).strftime('%Y-%m-%d_%H-%M-%S')
+        self.batch_count += 1
+        return "batch-{0}-{1:06d}-{2}.{3}".format(time_str, int((current_time % 1) * 1e6), self.batch_count, extension)
+
+
+    def _validate_record(self, node_id, record):
+
+        ''' Adds the record to the schema of the node, returns False (schema untouched) if it does not fit '''
+
+        if not isinstance(record, dict):
+            return False
+
+        schema = self.schemas.setdefault(node_id, {})
+        column_types = {}
+        for column, value in record.items():
+            column_type = merge_column_type(schema.get(column), get_value_type(value))
+            if column_type is None and value is not None:
+                return False
+            column_types[column] = column_type
+
+        schema.update((column, column_type) for column, column_type in column_types.items() if column_type is not None)
+        return True
+
+
+    def transcode_file(self, node_id, file_path):
+
+        '''
+        Buffers the records of a data file (written out by the batches), returns (valid records, rejected records)
+
+        Parameters
+        ----------
+        node_id (str) : id of the node the file comes from
+        file_path (str) : path to the data file
+        '''
+
+        self.file_valid_count = 0
+        received_time = os.stat(file_path).st_mtime
+        valid_count = 0
+        rejected_count = 0
+        rejects_path = None
+        rejects_h = None
+
+        try :
+            for line in iter_data_file_lines(file_path):
+                record_line = line.strip()
+                if record_line == "":
+                    continue
+
+                try : record = json.loads(record_line)
+                except ValueError:
+                    record = None
+
+                # rejected records are streamed to the rejects file of the node
+                if record is None or not self._validate_record(node_id, record):
+                    if rejects_h is None:
+                        rejects_path = os.path.join(self._get_partition_dir(node_id, "rejects"), self._get_batch_name("jsonl.gz"))
+                        rejects_h = gzip.open(rejects_path + ".part", "wt")
+                    rejects_h.write(record_line + "\n")
+                    rejected_count += 1
+                    continue
+
+                valid_count += 1
+                record_time = float(record["time"]) if isinstance(record.get("time"), (int, float)) else received_time
+                record_day = datetime.datetime.fromtimestamp(record_time).strftime('%Y-%m-%d')
+                partition_records = self.partitions.setdefault((node_id, record_day), [])
+                partition_records.append((record_time, record))
+                if len(partition_records) >= self.batch_rows:
+                    self._write_batch(node_id, record_day)
+
+        finally:
+            self.file_valid_count = valid_count
+            if rejects_h is not None:
+                rejects_h.close()
+
+                # the file is left as is when nothing in it could be transcoded
+                if valid_count > 0:
+                    self.batch_paths.append(rejects_path)
+                else :
+                    os.remove(rejects_path + ".part")
+
+        return valid_count, rejected_count
+
+
+    def _write_batch(self, node_id, day):
+
+        ''' Writes out the buffered records of a partition as a (.part) columnar batch, returns the batch path '''
+
+        records = [record for _, record in sorted(self.partitions.pop((node_id, day)), key=lambda entry : entry[0])]
+        schema = self.schemas[node_id]
+        columns = dict((column, [record.get(column) for record in records]) for column in sorted(schema))
+
+        partition_dir = self._get_partition_dir(node_id, "day=" + day)
+        if self.columnar_format == "parquet":
+            batch_path = os.path.join(partition_dir, self._get_batch_name("parquet"))
+            self._write_parquet(batch_path + ".part", schema, columns)
+        else :
+            batch_path = os.path.join(partition_dir, self._get_batch_name("json.gz"))
+            with gzip.open(batch_path + ".part", "wt") as batch_h:
+                json.dump({"node_id" : node_id, "day" : day, "row_count" : len(records),
+                           "schema" : dict((column, schema[column]) for column in columns), "columns" : columns},
+                          batch_h, separators=(",", ":"))
+
+        self.batch_paths.append(batch_path)
+        return batch_path
+
+
+    @staticmethod
+    def _write_parquet(batch_path, schema, columns):
+
+        ''' Writes the columns as a parquet file (nested values are stored as JSON strings) '''
+
+        import pyarrow
+        import pyarrow.parquet
+
+        column_types = {TYPE_BOOL : pyarrow.bool_(), TYPE_INT : pyarrow.int64(), TYPE_FLOAT : pyarrow.float64(),
+                        TYPE_STRING : pyarrow.string(), TYPE_JSON : pyarrow.string()}
+        arrays = []
+        for column, values in columns.items():
+            if schema[column] == TYPE_JSON:
+                values = [json.dumps(value) if value is not None else None for value in values]
+            arrays.append(pyarrow.array(values, type=column_types[schema[column]]))
+
+        pyarrow.parquet.write_table(pyarrow.Table.from_arrays(arrays, names=list(columns.keys())), batch_path, compression="zstd")
+
+
+    def flush(self):
+
+        ''' Writes out every buffered partition, saves the node schemas, returns the paths of the written batches (not published) '''
+
+        for node_id, day in list(self.partitions.keys()):
+            self._write_batch(node_id, day)
+        with locked_state_file(self.schema_file_path, {}) as schemas:
+            for node_id, schema in self.schemas.items():
+                node_schema = schemas.setdefault(node_id, {})
+                for column, column_type in schema.items():
+                    node_schema[column] = merge_column_type(node_schema.get(column), column_type) or TYPE_STRING
+        return list(self.batch_paths)
+
+
+def publish_batches(batch_paths):
+
+    ''' Makes the written batches visible to the uploads (batches already published are skipped) '''
+
+    for batch_path in batch_paths:
+        if os.path.isfile(batch_path + ".part"):
+            os.replace(batch_path + ".part", batch_path)
+
+
+def register_data_files(config_manager, node_id, file_names):
+
+    '''
+    Records the node the received data files come from (the data file names do not hold it),
+    the data collector transcodes them by node (see transcode_data_files)
+        ** files are registered before they are renamed out of .part (the collector could pick them up)
+
+    Parameters
+    ----------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    node_id (str) : id of the node the files come from
+    file_names (list) : names of the received files (in the hub transfer folder)
+    '''
+
+    if not config_manager.config_data["transcode-enabled"]:
+        return
+
+    with locked_state_file(config_manager.get_state_file_path("hub-transcode-queue-file"), {}) as transcode_queue:
+        for file_name in file_names:
+            if is_indexed_data_file(file_name):
+                transcode_queue[file_name] = {"node-id" : node_id}
+
+
+def complete_transcoded_files(config_manager):
+
+    '''
+    Completes the pass interrupted after its files were transcoded (hub restart) : publishes the
+    recorded batches and deletes the transcoded files, leftover batches of a pass that was not
+    recorded are removed (the files are transcoded again). Returns the names of the completed files.
+
+    Parameters
+    ----------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    '''
+
+    file_transfer_dir = config_manager.config_data["hub-file-transfer-dir"]
+    with locked_state_file(config_manager.get_state_file_path("hub-transcode-queue-file"), {}) as transcode_queue:
+        completed_elements = [element for element, entry in transcode_queue.items() if "batches" in entry]
+        for element in completed_elements:
+            publish_batches(transcode_queue[element]["batches"])
+            if os.path.isfile(os.path.join(file_transfer_dir, element)):
+                os.remove(os.path.join(file_transfer_dir, element))
+            del transcode_queue[element]
+
+    columnar_dir = config_manager.config_data["hub-columnar-dir"]
+    for dir_path, _, file_names in os.walk(columnar_dir):
+        for file_name in file_names:
+            if file_name.endswith(".part"):
+                os.remove(os.path.join(dir_path, file_name))
+
+    return completed_elements
+
+
+def transcode_data_files(config_manager, elements):
+
+    '''
+    Transcodes the specified data files (from the transfer folder) into columnar batches, returns the
+    elements that were not transcoded (log files, files without valid records, files that failed to transcode).
+    A file is only transcoded once :
+        1) the records of the files are written as (.part) batches
+        2) the transcoded files and their batches are recorded in the transcode queue
+        3) the batches are published, the transcoded files are deleted, then dropped from the queue
+    A pass interrupted after 2) is completed by the next one (see complete_transcoded_files).
+    A file failing once some of its records were read is kept as is in the rejects of its node.
+
+    Parameters
+    ----------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    elements (iterable) : names of the files (in the transfer folder)
+    '''
+
+    elements = set(elements)
+    if not config_manager.config_data["transcode-enabled"]:
+        return elements
+
+    file_transfer_dir = config_manager.config_data["hub-file-transfer-dir"]
+    queue_file_path = config_manager.get_state_file_path("hub-transcode-queue-file")
+    completed_elements = complete_transcoded_files(config_manager)
+    transcode_queue = load_state_file(queue_file_path, {})
+    transcoder = ColumnarTranscoder(config_manager)
+
+    transcoded_elements = []
+    record_count = 0
+    for element in sorted(elements):
+        element_path = os.path.join(file_transfer_dir, element)
+        if not is_indexed_data_file(element) or not os.path.isfile(element_path):
+            continue
+
+        try :
+            node_id = transcode_queue.get(element, {}).get("node-id", UNKNOWN_NODE_ID)
+            valid_count, rejected_count = transcoder.transcode_file(node_id, element_path)
+            if valid_count > 0:
+                transcoded_elements.append(element)
+                record_count += valid_count + rejected_count
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - Hub data transcoder failed to transcode ({1}) : {2}".format(time_str, element, e))
+
+            # the records read before the failure are in the batches, the file is kept in the rejects as is
+            if transcoder.file_valid_count > 0:
+                rejects_path = os.path.join(transcoder._get_partition_dir(node_id, "rejects"), element)
+                shutil.copyfile(element_path, rejects_path + ".part")
+                transcoder.batch_paths.append(rejects_path)
+                transcoded_elements.append(element)
+
+    # the pass is recorded before anything is published or deleted
+    batch_paths = transcoder.flush()
+    with locked_state_file(queue_file_path, {}) as transcode_queue:
+        for element in transcoded_elements:
+            transcode_queue[element] = dict(transcode_queue.get(element, {}), batches=batch_paths)
+
+    complete_transcoded_files(config_manager)
+
+    if len(transcoded_elements) > 0:
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        logging.info("{0} - Hub data transcoder wrote {1} {2} batches ({3} records) from : {4}".format(time_str,
+                     len(batch_paths), transcoder.columnar_format, record_count, str(transcoded_elements)))
+
+    return elements - set(transcoded_elements) - set(completed_elements)
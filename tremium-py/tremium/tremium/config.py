@@ -1,3 +1,4 @@
+import os
 import json
 
 
@@ -27,6 +28,24 @@ class ConfigurationManager():
             config_f.close()
 
 
+    def _get_state_file_path(self, state_dir_key, file_name_key):
+
+        '''
+        Returns the path of a state file (kept in the specified state directory)
+        The state directory is created if it does not exist yet.
+
+        Params
+        ------
+        state_dir_key (str) : config key of the state directory
+        file_name_key (str) : config key of the state file name
+        '''
+
+        state_dir = self.config_data[state_dir_key]
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir, exist_ok=True)
+        return os.path.join(state_dir, self.config_data[file_name_key])
+
+
 class HubConfigurationManager(ConfigurationManager):
     
     ''' Config manager specific to the hub '''
@@ -34,6 +53,9 @@ class HubConfigurationManager(ConfigurationManager):
     def __init__(self, config_path):
         super().__init__(config_path)
 
+    def get_state_file_path(self, file_name_key):
+        return self._get_state_file_path("hub-state-dir", file_name_key)
+
 
 class NodeConfigurationManager(ConfigurationManager):
     
@@ -41,3 +63,6 @@ class NodeConfigurationManager(ConfigurationManager):
 
     def __init__(self, config_path):
         super().__init__(config_path)
+
+    def get_state_file_path(self, file_name_key):
+        return self._get_state_file_path("node-state-dir", file_name_key)
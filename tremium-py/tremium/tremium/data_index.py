@@ -0,0 +1,334 @@
+import os
+import os.path
+import re
+import gzip
+import json
+
+import time
+import logging
+import datetime
+import tarfile
+import sqlite3
+
+
+def iter_data_file_lines(file_path):
+
+    '''
+    Generator over the lines of a data file received from a node (read as a stream)
+        - extracted data files (JSON lines)
+        - compressed data spool segments (.tar.gz of data files)
+
+    Parameters
+    ----------
+    file_path (str) : path to the data file
+    '''
+
+    if file_path.endswith(".tar.gz"):
+        with tarfile.open(file_path, "r:gz") as segment_h:
+            for member in segment_h:
+                if not member.isfile():
+                    continue
+                for line in segment_h.extractfile(member):
+                    yield line.decode("utf-8", errors="replace")
+
+    else :
+        with open(file_path, "r", errors="replace") as data_file_h:
+            for line in data_file_h:
+                yield line
+
+
+def get_record_time(record_line, default_time):
+
+    ''' Returns the time of a data record (its "time" field), default_time if it has none '''
+
+    try :
+        record_time = json.loads(record_line).get("time")
+        if isinstance(record_time, (int, float)):
+            return float(record_time)
+    except (ValueError, AttributeError):
+        pass
+    return default_time
+
+
+class HubDataIndex():
+
+    '''
+    Time series index of the data received from the nodes (embedded SQLite database)
+        - records are stored in time partitions (one table per "hub-data-index-partition-time"
+          seconds), indexed by node id and time : range queries only read the partitions they overlap
+        - data files are ingested once (read before the write lock is taken, inserted in batches of
+          "hub-data-index-batch-size") : the lock is only held for the inserts
+        - partitions are exported (one gzip JSON lines file per node) once they are closed,
+          records arriving late are exported with the next export of their partition
+    The database is shared by the connection handler processes (WAL journal, busy timeout).
+    '''
+
+    def __init__(self, config_manager):
+
+        '''
+        Parameters
+        ----------
+        config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+        '''
+
+        self.config_manager = config_manager
+        self.partition_time = config_manager.config_data["hub-data-index-partition-time"]
+        self.batch_size = config_manager.config_data["hub-data-index-batch-size"]
+
+        self.connection = sqlite3.connect(config_manager.get_state_file_path("hub-data-index-file"),
+                                          timeout=config_manager.config_data["hub-data-index-timeout"])
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS partitions (start INTEGER PRIMARY KEY, table_name TEXT, \
+                                     record_count INTEGER, last_rowid INTEGER, exported_rowid INTEGER, exported_at REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS ingested_files (node_id TEXT, file_name TEXT, \
+                                     record_count INTEGER, ingested_at REAL, PRIMARY KEY (node_id, file_name))")
+
+
+    def close(self):
+        self.connection.close()
+
+
+    def _get_partition_start(self, record_time):
+        return int(record_time // self.partition_time * self.partition_time)
+
+
+    def _get_partition_table(self, partition_start):
+
+        ''' Returns the name of the table of a partition, creates the partition if needed (transaction held) '''
+
+        table_name = "records_{}".format(partition_start)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS {} (node_id TEXT, time REAL, file_name TEXT, record TEXT)\
+                                ".format(table_name))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS {0}_node_time ON {0} (node_id, time)".format(table_name))
+        self.connection.execute("INSERT OR IGNORE INTO partitions VALUES (?, ?, 0, 0, 0, NULL)", (partition_start, table_name))
+        return table_name
+
+
+    def _insert_records(self, node_id, file_name, records):
+
+        ''' Inserts (time, record line) records, grouped by partition (transaction held) '''
+
+        partition_records = {}
+        for record_time, record_line in records:
+            partition_records.setdefault(self._get_partition_start(record_time), []).append(
+                (node_id, record_time, file_name, record_line))
+
+        for partition_start, rows in partition_records.items():
+            table_name = self._get_partition_table(partition_start)
+            cursor = self.connection.executemany("INSERT INTO {} VALUES (?, ?, ?, ?)".format(table_name), rows)
+            self.connection.execute("UPDATE partitions SET record_count = record_count + ?, last_rowid = \
+                                     (SELECT MAX(rowid) FROM {}) WHERE start = ?".format(table_name), (cursor.rowcount, partition_start))
+
+
+    def _is_ingested(self, node_id, file_name):
+        return self.connection.execute("SELECT 1 FROM ingested_files WHERE node_id = ? AND file_name = ?",
+                                       (node_id, file_name)).fetchone() is not None
+
+
+    def ingest_file(self, node_id, file_path, file_name=None):
+
+        '''
+        Indexes the records of a data file received from a node, returns the number of records
+        indexed (0 if the file was already ingested). Records without a "time" field are indexed
+        at the time the file was received.
+
+        Parameters
+        ----------
+        node_id (str) : id of the node the file comes from
+        file_path (str) : path to the data file
+        file_name (str) : name the file is indexed under (default : name of file_path)
+        '''
+
+        file_name = file_name or os.path.basename(file_path)
+        received_time = os.stat(file_path).st_mtime
+        if self._is_ingested(node_id, file_name):
+            return 0
+
+        with self.connection:
+
+            # the write lock is taken up front (other connection handlers could be ingesting)
+            self.connection.execute("BEGIN IMMEDIATE")
+            if self._is_ingested(node_id, file_name):
+                return 0
+
+            # the file is streamed, only a batch of records is held at a time
+            record_count = 0
+            records = []
+            for line in iter_data_file_lines(file_path):
+                record_line = line.strip()
+                if record_line != "":
+                    records.append((get_record_time(record_line, received_time), record_line))
+                if len(records) >= self.batch_size:
+                    self._insert_records(node_id, file_name, records)
+                    record_count += len(records)
+                    records = []
+
+            self._insert_records(node_id, file_name, records)
+            record_count += len(records)
+            self.connection.execute("INSERT INTO ingested_files VALUES (?, ?, ?, ?)", (node_id, file_name, record_count, time.time()))
+
+        return record_count
+
+
+    def query(self, node_id, start_time, end_time):
+
+        '''
+        Returns the records a node reported between start_time and end_time, as a time ordered
+        list of (time, record) (records are decoded when they are JSON)
+
+        Parameters
+        ----------
+        node_id (str) : id of the node
+        start_time (float) : start of the time range (included)
+        end_time (float) : end of the time range (excluded)
+        '''
+
+        partition_tables = self.connection.execute("SELECT table_name FROM partitions WHERE start >= ? AND start < ? \
+                                                    ORDER BY start", (self._get_partition_start(start_time), end_time)).fetchall()
+
+        records = []
+        for (table_name,) in partition_tables:
+            for record_time, record_line in self.connection.execute("SELECT time, record FROM {} WHERE node_id = ? AND \
+                                                                     time >= ? AND time < ? ORDER BY time".format(table_name),
+                                                                    (node_id, start_time, end_time)):
+                try : records.append((record_time, json.loads(record_line)))
+                except ValueError:
+                    records.append((record_time, record_line))
+
+        return records
+
+
+    def get_export_partitions(self, current_time, grace_time):
+
+        '''
+        Returns the start of the closed partitions holding records that were not exported yet
+
+        Parameters
+        ----------
+        current_time (float) : current time
+        grace_time (float) : time a partition is left open after it ends (late node uploads)
+        '''
+
+        return [row[0] for row in self.connection.execute("SELECT start FROM partitions WHERE start + ? <= ? AND \
+                                                           last_rowid > exported_rowid ORDER BY start",
+                                                          (self.partition_time + grace_time, current_time))]
+
+
+    def export_partition(self, partition_start, output_dir):
+
+        '''
+        Writes the records of a partition that were not exported yet, one gzip JSON lines file
+        per node ("(node id)_(partition start)_(export time).jsonl.gz", records ordered by time).
+        Returns (paths of the written files, last exported rowid), see mark_exported.
+
+        Parameters
+        ----------
+        partition_start (int) : start time of the partition
+        output_dir (str) : folder the partition files are written to
+        '''
+
+        table_name, exported_rowid = self.connection.execute("SELECT table_name, exported_rowid FROM partitions \
+                                                              WHERE start = ?", (partition_start,)).fetchone()
+        last_rowid = self.connection.execute("SELECT MAX(rowid) FROM {}".format(table_name)).fetchone()[0] or 0
+
+        partition_str = datetime.datetime.fromtimestamp(partition_start).strftime('%Y-%m-%d_%H-%M-%S')
+        export_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+
+        output_paths = []
+        node_ids = [row[0] for row in self.connection.execute("SELECT DISTINCT node_id FROM {} WHERE rowid > ? AND rowid <= ? ORDER BY node_id\
+                                                               ".format(table_name), (exported_rowid, last_rowid))]
+        for node_id in node_ids:
+            output_path = os.path.join(output_dir, "{0}_{1}_{2}.jsonl.gz".format(re.sub("[^A-Za-z0-9_.-]", "-", node_id),
+                                                                                  partition_str, export_str))
+            with gzip.open(output_path, "wt") as output_h:
+                for (record_line,) in self.connection.execute("SELECT record FROM {} WHERE node_id = ? AND rowid > ? AND \
+                                                               rowid <= ? ORDER BY time".format(table_name),
+                                                              (node_id, exported_rowid, last_rowid)):
+                    output_h.write(record_line + "\n")
+            output_paths.append(output_path)
+
+        return output_paths, last_rowid
+
+
+    def mark_exported(self, partition_start, exported_rowid):
+
+        ''' Records that the records of a partition were exported, up to exported_rowid (see export_partition) '''
+
+        with self.connection:
+            self.connection.execute("UPDATE partitions SET exported_rowid = ?, exported_at = ? WHERE start = ?",
+                                    (exported_rowid, time.time(), partition_start))
+
+
+    def drop_partitions(self, before_time):
+
+        '''
+        Deletes the exported partitions that ended before before_time, returns their start
+
+        Parameters
+        ----------
+        before_time (float) : partitions ending before this time are deleted (once exported)
+        '''
+
+        with self.connection:
+            dropped_partitions = self.connection.execute("SELECT start, table_name FROM partitions WHERE start + ? <= ? AND \
+                                                          last_rowid <= exported_rowid", (self.partition_time, before_time)).fetchall()
+            for partition_start, table_name in dropped_partitions:
+                self.connection.execute("DROP TABLE {}".format(table_name))
+                self.connection.execute("DELETE FROM partitions WHERE start = ?", (partition_start,))
+            self.connection.execute("DELETE FROM ingested_files WHERE ingested_at < ?", (before_time,))
+
+        if len(dropped_partitions) > 0:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - HubDataIndex dropped partitions : {1}".format(time_str, str([row[0] for row in dropped_partitions])))
+
+        return [row[0] for row in dropped_partitions]
+
+
+def is_indexed_data_file(file_name):
+
+    ''' Data files (extracted data, spool segments) are indexed, log files and partial files are not '''
+
+    return not file_name.endswith(".log") and not file_name.endswith(".part")
+
+
+def index_data_files(config_manager, node_id, file_names, file_suffix=""):
+
+    '''
+    Indexes the data files received from a node (files that fail to index are logged and left alone),
+    returns the number of records indexed
+
+    Parameters
+    ----------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    node_id (str) : id of the node the files come from
+    file_names (list) : names of the received files (in the hub transfer folder)
+    file_suffix (str) : suffix of the files on disk (".part" : files not renamed yet, indexed under their final name)
+    '''
+
+    if not config_manager.config_data["hub-data-index-enabled"]:
+        return 0
+
+    record_count = 0
+    data_index = None
+    try :
+        data_index = HubDataIndex(config_manager)
+        for file_name in file_names:
+            if not is_indexed_data_file(file_name):
+                continue
+            try :
+                file_path = os.path.join(config_manager.config_data["hub-file-transfer-dir"], file_name + file_suffix)
+                record_count += data_index.ingest_file(node_id, file_path, file_name)
+            except Exception as e:
+                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                logging.error("{0} - HubDataIndex failed to index ({1}) from node {2} : {3}".format(time_str, file_name, node_id, e))
+
+    except Exception as e:
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        logging.error("{0} - HubDataIndex could not be opened : {1}".format(time_str, e))
+
+    finally:
+        if data_index is not None:
+            data_index.close()
+
+    return record_count
@@ -0,0 +1,187 @@
+import os
+import os.path
+import json
+
+import time
+import logging
+import datetime
+import threading
+
+
+class DataFileWriter():
+
+    '''
+    Writer of the Node's extracted data file (used by the acquisition component)
+        - records are buffered and committed in groups (one write and one fsync per group), once
+          "data-writer-group-bytes" are buffered or the oldest buffered record is "data-writer-group-time" old
+        - the active segment (extracted data file) is closed once it reaches "node-data-file-max-size"
+          or is "data-writer-rotate-time" old : it is atomically renamed into the closed segment
+          folder ("node-closed-segment-dir") and a new active segment is started
+        - the transfer side only claims closed segments (DataSpool.claim_closed_segments), no lock is
+          shared with the writer
+    A segment left active by a previous run is closed when the writer starts.
+    '''
+
+    def __init__(self, config_manager):
+
+        '''
+        Parameters
+        ----------
+        config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+        '''
+
+        self.config_manager = config_manager
+        self.active_path = os.path.join(config_manager.config_data["node-file-transfer-dir"],
+                                        config_manager.config_data["node-extracted-data-file"])
+        self.closed_segment_dir = config_manager.config_data["node-closed-segment-dir"]
+        self.archived_data_pattern_segs = config_manager.config_data["node-archived-data-file"].split(".")
+
+        self.group_bytes = config_manager.config_data["data-writer-group-bytes"]
+        self.group_time = config_manager.config_data["data-writer-group-time"]
+        self.max_segment_size = config_manager.config_data["node-data-file-max-size"]
+        self.rotate_time = config_manager.config_data["data-writer-rotate-time"]
+
+        if not os.path.isdir(self.closed_segment_dir):
+            os.makedirs(self.closed_segment_dir, exist_ok=True)
+
+        # buffered records (committed as a group)
+        self.lock = threading.Lock()
+        self.buffered_records = []
+        self.buffered_size = 0
+        self.buffer_start_time = None
+
+        # closing the segment left by a previous run, then opening the active segment
+        if os.path.isfile(self.active_path) and os.stat(self.active_path).st_size > 0:
+            os.rename(self.active_path, self._get_closed_segment_path())
+        self._open_active_segment()
+
+        # committing the buffered records on time (writers with a low record rate)
+        self.stop_event = threading.Event()
+        self.flush_thread = threading.Thread(target=self._flush_on_time, daemon=True)
+        self.flush_thread.start()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+    def _open_active_segment(self):
+        self.active_fd = os.open(self.active_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.active_size = os.fstat(self.active_fd).st_size
+        self.active_start_time = time.time()
+
+
+    def _get_closed_segment_path(self):
+
+        ''' Returns the path of the next closed segment (archived data file name, made unique) '''
+
+        current_time = time.time()
+        time_str = datetime.datetime.fromtimestamp(current_time).strftime('%Y-%m-%d_%H-%M-%S')
+        segment_name = "{0}-{1}-{2:06d}.{3}".format(self.archived_data_pattern_segs[0], time_str, 
+                                                    int((current_time % 1) * 1e6), self.archived_data_pattern_segs[1])
+        return os.path.join(self.closed_segment_dir, segment_name)
+
+
+    def append(self, record):
+
+        '''
+        Buffers a record (JSON line), the buffered records are committed once the group is full
+
+        Parameters
+        ----------
+        record (object) : JSON serializable record, or str (written as is, newline added)
+        '''
+
+        record_line = record if isinstance(record, str) else json.dumps(record)
+        record_data = (record_line + "\n").encode("utf-8")
+
+        with self.lock:
+            self.buffered_records.append(record_data)
+            self.buffered_size += len(record_data)
+            if self.buffer_start_time is None:
+                self.buffer_start_time = time.time()
+
+            if self.buffered_size >= self.group_bytes:
+                self._commit()
+
+
+    def _commit(self):
+
+        ''' Writes out the buffered records (one write + fsync), rotates the active segment when due (lock held) '''
+
+        if len(self.buffered_records) > 0:
+            group_data = b"".join(self.buffered_records)
+            written_size = 0
+            while written_size < len(group_data):
+                written_size += os.write(self.active_fd, group_data[written_size : ])
+            os.fsync(self.active_fd)
+
+            self.active_size += len(group_data)
+            self.buffered_records = []
+            self.buffered_size = 0
+            self.buffer_start_time = None
+
+        if self.active_size >= self.max_segment_size or \
+           (self.active_size > 0 and time.time() - self.active_start_time >= self.rotate_time):
+            self._rotate()
+
+
+    def _rotate(self):
+
+        ''' Closes the active segment (atomic rename to the closed segment folder) and starts a new one (lock held) '''
+
+        os.close(self.active_fd)
+        closed_segment_path = self._get_closed_segment_path()
+        os.rename(self.active_path, closed_segment_path)
+        self._open_active_segment()
+
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        logging.info("{0} - DataFileWriter closed segment : {1}".format(time_str, os.path.basename(closed_segment_path)))
+
+
+    def commit(self):
+
+        ''' Commits the buffered records now '''
+
+        with self.lock:
+            self._commit()
+
+
+    def rotate(self):
+
+        ''' Commits the buffered records and closes the active segment now (if it holds data) '''
+
+        with self.lock:
+            self._commit()
+            if self.active_size > 0:
+                self._rotate()
+
+
+    def _flush_on_time(self):
+
+        ''' Commits the buffered records once the oldest one is "data-writer-group-time" old '''
+
+        while not self.stop_event.wait(self.group_time / 2):
+            with self.lock:
+                buffer_due = self.buffer_start_time is not None and time.time() - self.buffer_start_time >= self.group_time
+                rotation_due = self.active_size > 0 and time.time() - self.active_start_time >= self.rotate_time
+                if buffer_due or rotation_due:
+                    self._commit()
+
+
+    def close(self):
+
+        ''' Commits the buffered records and releases the active segment (it is closed by the next writer) '''
+
+        self.stop_event.set()
+        self.flush_thread.join()
+        with self.lock:
+            if self.active_fd is not None:
+                self._commit()
+                os.close(self.active_fd)
+                self.active_fd = None
@@ -5,7 +5,95 @@ import os.path
 import time
 import datetime
 
+import json
+import fcntl
+import hashlib
+import contextlib
 
+from .profiling import profiled
+
+
+def parse_image_archive_name(archive_name, config_manager):
+
+    '''
+    Extracts the naming convention fields from an image archive file name.
+    Returns a tuple (node id pattern, component name, archive timestamp), or None if the 
+    name does not respect the naming convention.
+
+    Parameters
+    ----------
+    archive_name (str) : name of the image archive file
+    config_manager (ConfigurationManager) : holds the "image-archive-pattern" configuration
+    '''
+
+    match_object = re.search(config_manager.config_data["image-archive-pattern"], archive_name)
+    if match_object is None:
+        return None
+
+    # extracting information from the image archive file name
+    archive_timestamp = time.mktime(datetime.datetime.strptime(match_object.group(3), '%Y-%m-%d_%H-%M-%S').timetuple())
+    archive_component_name = match_object.group(2)
+    id_pattern = archive_name.split(archive_component_name)[0][:-1]
+
+    return (id_pattern, archive_component_name, archive_timestamp)
+
+
+def list_image_archives(config_manager):
+
+    '''
+    Returns the image archives stored in the Hub image archive folder, as a list of
+    (archive name, node id pattern, component name, archive timestamp)
+
+    Params
+    ------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub 
+    '''
+
+    image_archives = []
+    image_archive_dir = config_manager.config_data["hub-image-archive-dir"]
+
+    # going through all archived image files
+    for archive_element in os.listdir(image_archive_dir):
+        archive_element_path = os.path.join(image_archive_dir, archive_element)
+        if os.path.isfile(archive_element_path) and archive_element.endswith(".tar.gz"):
+
+            archive_info = parse_image_archive_name(archive_element, config_manager)
+            if archive_info is not None:
+                image_archives.append((archive_element, ) + archive_info)
+
+    return image_archives
+
+
+def select_newest_images(node_id, image_archives):
+
+    '''
+    Returns a dict (component name --> archive name) holding the most recent archive
+    of every component relevant to the specified node id
+
+    Params
+    ------
+    node_id (str) : id of the Tremium Node asking for an update.
+    image_archives (list) : image archives, as returned by "list_image_archives"
+    '''
+
+    matched_image_files = {}
+    for archive_element, id_pattern, archive_component_name, archive_timestamp in image_archives:
+
+        # checking if image name is related to the provided Node id
+        if re.match(id_pattern, node_id) is not None:
+            
+            # making sure the most recent images are selected
+            if archive_component_name in matched_image_files:
+                if archive_timestamp > matched_image_files[archive_component_name][0]:
+                    matched_image_files[archive_component_name] = (archive_timestamp, archive_element)
+            else:
+                matched_image_files[archive_component_name] = (archive_timestamp, archive_element)
+
+    return {component_name : matched_image_files[component_name][1] 
+            for component_name in matched_image_files.keys()}
+
+
+@profiled("get_image_from_hub_archive", lambda node_id, config_manager : config_manager)
 def get_image_from_hub_archive(node_id, config_manager):
     
     '''
@@ -19,35 +107,102 @@ def get_image_from_hub_archive(node_id, config_manager):
     config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub 
     '''
 
-    matched_image_files = {}
-    image_archive_dir = config_manager.config_data["hub-image-archive-dir"]
+    # returning list of most recent and relevant image archive file names
+    return list(select_newest_images(node_id, list_image_archives(config_manager)).values())
 
-    # going through all archived image files
-    for archive_element in os.listdir(image_archive_dir):
-        archive_element_path = os.path.join(image_archive_dir, archive_element)
-        if os.path.isfile(archive_element_path) and archive_element.endswith(".tar.gz"):
 
-            match_object = re.search(config_manager.config_data["image-archive-pattern"], archive_element)
-            if match_object is not None:
+def get_hub_image_catalog(config_manager):
+
+    '''
+    Returns the image archives stored on the Hub (see "list_image_archives").
+    The listing is cached in a state file, and only rebuilt when the modification time
+    of the image archive folder changes (ie : an archive was added or removed).
+
+    Params
+    ------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub 
+    '''
 
-                # extracting information from the image archive file name
-                archive_timestamp = time.mktime(datetime.datetime.strptime(match_object.group(3), '%Y-%m-%d_%H-%M-%S').timetuple())
-                archive_component_name = match_object.group(2)
+    catalog_path = config_manager.get_state_file_path("hub-image-catalog-file")
+    catalog_version = os.stat(config_manager.config_data["hub-image-archive-dir"]).st_mtime_ns
 
-                # checking if image name is related to the provided Node id
-                id_pattern = archive_element.split(archive_component_name)[0][:-1]
-                if re.match(id_pattern, node_id) is not None:
-                    
-                    # making sure the most recent images are selected
-                    if archive_component_name in matched_image_files:
-                        if archive_timestamp > matched_image_files[archive_component_name][0]:
-                            matched_image_files[archive_component_name] = (archive_timestamp, archive_element)
-                    else:
-                        matched_image_files[archive_component_name] = (archive_timestamp, archive_element)
+    # using the cached catalog when the archive folder did not change
+    catalog = load_state_file(catalog_path, {})
+    if catalog.get("version") == catalog_version:
+        return [tuple(archive_entry) for archive_entry in catalog["archives"]]
 
-    # returning list of most recent and relevant image archive file names
-    return [matched_image_files[component_name][1] 
-            for component_name in matched_image_files.keys()]
+    image_archives = list_image_archives(config_manager)
+    write_state_file(catalog_path, {"version" : catalog_version, "archives" : image_archives})
+    return image_archives
+
+
+def get_manifest_updates(node_id, node_manifest, config_manager):
+
+    '''
+    Returns the names of the update archives a Node should fetch, given the manifest of the
+    images installed on the Node. Only the installed components are updated (same rule
+    as "get_matching_image").
+
+    Params
+    ------
+    node_id (str) : id of the Tremium Node asking for an update.
+    node_manifest (dict) : installed images on the Node (component name --> archive name)
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub 
+    '''
+
+    newest_images = select_newest_images(node_id, get_hub_image_catalog(config_manager))
+    return [newest_images[component_name] for component_name in sorted(node_manifest.keys())
+            if component_name in newest_images and newest_images[component_name] != node_manifest[component_name]]
+
+
+def get_node_image_manifest(config_manager):
+
+    '''
+    Returns the manifest of the images installed on the Node (component name --> archive name)
+    The manifest is kept in a state file, the Node image archive folder is only scanned 
+    when the manifest does not exist yet.
+    *** assumes that all images in the node archive folder are currently running.
+
+    Parameters
+    ----------   
+    config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+    '''
+
+    manifest_path = config_manager.get_state_file_path("node-image-manifest-file")
+    node_manifest = load_state_file(manifest_path)
+
+    if node_manifest is None:
+
+        # building the manifest from the compressed image archives
+        node_manifest = {}
+        archive_dir = config_manager.config_data["node-image-archive-dir"]
+        for image_file_name in sorted(os.listdir(archive_dir)):
+            if image_file_name.endswith(".gz"):
+                archive_info = parse_image_archive_name(image_file_name, config_manager)
+                if archive_info is not None:
+                    node_manifest[archive_info[1]] = image_file_name
+
+        write_state_file(manifest_path, node_manifest)
+
+    return node_manifest
+
+
+def update_node_image_manifest(config_manager, archive_name):
+
+    '''
+    Records the specified archive as the installed image of its component
+
+    Parameters
+    ----------   
+    config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+    archive_name (str) : name of the installed image archive
+    '''
+
+    archive_info = parse_image_archive_name(archive_name, config_manager)
+    if archive_info is not None:
+        manifest_path = config_manager.get_state_file_path("node-image-manifest-file")
+        with locked_state_file(manifest_path, {}) as node_manifest:
+            node_manifest[archive_info[1]] = archive_name
 
 
 def get_matching_image(update_image_name, config_manager):
@@ -130,4 +285,144 @@ def purge_timestamped_files(target_folder, config_manager):
 
                 # deleting .log files, not the data-collector logs
                 if element.endswith(".log") and (not element == config_manager.config_data["data-collector-log-name"]):
-                    os.remove(element_path)
\ No newline at end of file
+                    os.remove(element_path)
+
+
+def get_file_digest(file_path, chunk_size=65536):
+
+    '''
+    Returns the sha256 digest (hex string) of the specified file
+    The file is read in chunks, so large image archives never sit in memory.
+
+    Parameters
+    ----------
+    file_path (str) : path to the target file
+    chunk_size (int) : size of the chunks read from the file
+    '''
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as target_file_h:
+        data = target_file_h.read(chunk_size)
+        while data:
+            digest.update(data)
+            data = target_file_h.read(chunk_size)
+
+    return digest.hexdigest()
+
+
+def get_archive_digest(archive_path):
+
+    '''
+    Returns the sha256 digest of an image archive file.
+    The digest is cached in a (.sha256) file next to the archive, the cache is refreshed
+    when the archive is more recent than the cached digest.
+
+    Parameters
+    ----------
+    archive_path (str) : path to the image archive file
+    '''
+
+    digest_path = archive_path + ".sha256"
+
+    # using the cached digest when it is still valid
+    if os.path.isfile(digest_path):
+        if os.stat(digest_path).st_mtime >= os.stat(archive_path).st_mtime:
+            with open(digest_path, "r") as digest_file_h:
+                cached_digest = digest_file_h.read().strip()
+            if cached_digest:
+                return cached_digest
+
+    # computing and caching the digest
+    digest = get_file_digest(archive_path)
+    with open(digest_path, "w") as digest_file_h:
+        digest_file_h.write(digest)
+
+    return digest
+
+
+def load_state_file(state_file_path, default=None):
+
+    '''
+    Returns the contents of a .json state file, or the default value if the file
+    does not exist (or is unreadable).
+
+    Parameters
+    ----------
+    state_file_path (str) : path to the state file
+    default (object) : value returned when there is no usable state
+    '''
+
+    try :
+        with open(state_file_path, "r") as state_file_h:
+            return json.load(state_file_h)
+    except (OSError, ValueError):
+        return default
+
+
+def write_state_file(state_file_path, state):
+
+    '''
+    Atomically writes out the specified state to a .json state file
+    (the state is written to a temporary file which then replaces the state file)
+
+    Parameters
+    ----------
+    state_file_path (str) : path to the state file
+    state (object) : json serializable state
+    '''
+
+    temp_file_path = "{0}.{1}.tmp".format(state_file_path, os.getpid())
+    with open(temp_file_path, "w") as state_file_h:
+        json.dump(state, state_file_h)
+    os.replace(temp_file_path, state_file_path)
+
+
+@contextlib.contextmanager
+def locked_state_file(state_file_path, default=None):
+
+    '''
+    Context manager giving exclusive (read-modify-write) access to a .json state file.
+    The state is locked across processes (the hub handles every connection in its own process),
+    the yielded state is written back when the context exits without error.
+
+    Parameters
+    ----------
+    state_file_path (str) : path to the state file
+    default (object) : initial state when the file does not exist
+    '''
+
+    with open(state_file_path + ".lock", "a") as lock_file_h:
+        fcntl.flock(lock_file_h, fcntl.LOCK_EX)
+        try :
+            state = load_state_file(state_file_path, default)
+            yield state
+            write_state_file(state_file_path, state)
+        finally:
+            fcntl.flock(lock_file_h, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def locked_file(file_path, mode):
+
+    '''
+    Context manager opening a file with an exclusive lock. Used for the shipped log copies
+    the hub bluetooth server appends to and the data collector uploads (then deletes).
+    The file is opened again if it was deleted while waiting for the lock.
+
+    Parameters
+    ----------
+    file_path (str) : path to the file
+    mode (str) : mode the file is opened in
+    '''
+
+    while True:
+        file_h = open(file_path, mode)
+        fcntl.flock(file_h, fcntl.LOCK_EX)
+        if os.fstat(file_h.fileno()).st_nlink > 0: break
+        file_h.close()
+
+    try :
+        yield file_h
+    finally:
+        fcntl.flock(file_h, fcntl.LOCK_UN)
+        file_h.close()
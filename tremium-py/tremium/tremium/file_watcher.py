@@ -0,0 +1,159 @@
+import os
+import os.path
+
+import time
+import select
+import struct
+import logging
+import datetime
+import ctypes
+import ctypes.util
+
+
+# inotify event masks (see "man inotify")
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+# inotify event header : watch descriptor, mask, cookie, name length
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+
+class DirectoryWatcher():
+
+    '''
+    Reports the files completed in a folder (closed after being written, or moved in)
+        - uses inotify (through ctypes) when it is available
+        - falls back on polling, a file is reported once its size and modification time
+          did not change over a poll interval
+    '''
+
+    def __init__(self, target_dir, poll_interval):
+
+        '''
+        Parameters
+        ----------
+        target_dir (str) : folder to watch
+        poll_interval (float) : time between two scans of the folder (polling fallback)
+        '''
+
+        self.target_dir = target_dir
+        self.poll_interval = poll_interval
+        self.inotify_fd = None
+
+        # states of the files (polling fallback)
+        self.scanned_states = {}
+        self.reported_states = {}
+
+        try :
+            self._init_inotify()
+
+        except (OSError, AttributeError) as e:
+            self.scanned_states = self._scan()
+            self.reported_states = dict(self.scanned_states)
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - DirectoryWatcher falling back on polling for ({1}) : {2}".format(time_str, target_dir, e))
+
+
+    def __del__(self):
+        self.close()
+
+
+    def _init_inotify(self):
+
+        ''' Creates the inotify instance watching the target folder '''
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+        inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if inotify_fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        watch_descriptor = libc.inotify_add_watch(inotify_fd, os.fsencode(self.target_dir), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if watch_descriptor < 0:
+            os.close(inotify_fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+        self.inotify_fd = inotify_fd
+
+
+    @property
+    def uses_inotify(self):
+        return self.inotify_fd is not None
+
+
+    def _read_events(self):
+
+        ''' Returns the names of the files in the pending inotify events '''
+
+        file_names = set()
+        while True:
+
+            try : event_data = os.read(self.inotify_fd, 65536)
+            except BlockingIOError: break
+
+            event_offset = 0
+            while event_offset + INOTIFY_EVENT_HEADER.size <= len(event_data):
+                _, _, _, name_length = INOTIFY_EVENT_HEADER.unpack_from(event_data, event_offset)
+                name_start = event_offset + INOTIFY_EVENT_HEADER.size
+                file_name = event_data[name_start : name_start + name_length].rstrip(b"\0")
+                if file_name:
+                    file_names.add(os.fsdecode(file_name))
+                event_offset = name_start + name_length
+
+        return file_names
+
+
+    def _scan(self):
+
+        ''' Returns the (size, modification time) of every file in the target folder '''
+
+        file_states = {}
+        for element in os.listdir(self.target_dir):
+            try :
+                element_stat = os.stat(os.path.join(self.target_dir, element))
+                file_states[element] = (element_stat.st_size, element_stat.st_mtime_ns)
+            except FileNotFoundError: pass
+
+        return file_states
+
+
+    def wait_for_files(self, timeout=None):
+
+        '''
+        Waits for files to be completed in the target folder, returns the set of their names
+        (empty if none were completed before the timeout)
+
+        Parameters
+        ----------
+        timeout (float) : maximum time to wait (None : wait for one event or poll interval)
+        '''
+
+        if self.uses_inotify:
+            ready_fds, _, _ = select.select([self.inotify_fd], [], [], timeout)
+            if len(ready_fds) == 0:
+                return set()
+            return self._read_events()
+
+        # polling : files that did not change since the previous scan are complete
+        time.sleep(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+        file_states = self._scan()
+        completed_files = set(file_name for file_name, file_state in file_states.items()
+                              if self.scanned_states.get(file_name) == file_state and
+                              self.reported_states.get(file_name) != file_state)
+
+        for file_name in completed_files:
+            self.reported_states[file_name] = file_states[file_name]
+        self.reported_states = {file_name : file_state for file_name, file_state in self.reported_states.items()
+                                if file_name in file_states}
+        self.scanned_states = file_states
+
+        return completed_files
+
+
+    def close(self):
+
+        ''' Releases the inotify instance '''
+
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
@@ -0,0 +1,329 @@
+import os
+import os.path
+
+import time
+import logging
+import datetime
+
+import gzip
+
+from .cache import NodeCacheModel
+from .config import NodeConfigurationManager
+from .file_management import get_file_digest, load_state_file, locked_file, locked_state_file
+from .file_management import get_node_image_manifest, update_node_image_manifest, parse_image_archive_name
+
+
+def iter_archive_contents(archive_path, chunk_size):
+
+    '''
+    Generator over the decompressed contents of an image archive (.tar.gz)
+        ** the archive is decompressed on the fly, no intermediate .tar is written
+
+    Parameters
+    ----------
+    archive_path (str) : path to the image archive
+    chunk_size (int) : size of the decompressed chunks
+    '''
+
+    with gzip.open(archive_path, "rb") as archive_h:
+        data = archive_h.read(chunk_size)
+        while data:
+            yield data
+            data = archive_h.read(chunk_size)
+
+
+def get_short_image_id(image_id):
+
+    '''
+    Returns the short form of a docker image id (as listed by "docker images")
+        ex : sha256:4f1c2b3a5d6e7f... --> 4f1c2b3a5d6e
+    '''
+
+    return image_id.split(":")[-1][ : 12]
+
+
+def get_pending_update_entries(update_file_path):
+
+    '''
+    Returns the entries of the image update file the host update script did not apply yet,
+    None if there are none (the host script crushes the file once it is applied).
+    A file is pending once its last line is the "End" tag.
+
+    Parameters
+    ----------
+    update_file_path (str) : path to the image update file
+    '''
+
+    try :
+        with open(update_file_path, "r") as update_file_h:
+            update_lines = [line for line in update_file_h.read().splitlines() if line.strip() != ""]
+    except FileNotFoundError:
+        return None
+
+    if len(update_lines) == 0 or update_lines[-1].strip() != "End":
+        return None
+    return [line + "\n" for line in update_lines[ : -1]]
+
+
+def resume_data_collection(config_manager, cache, force=False):
+
+    '''
+    Restarts the data collection once the host update script swapped the containers,
+    and records how long acquisition was paused. Returns the pause duration (seconds),
+    None if no swap was waiting to complete.
+
+    Parameters
+    ----------
+    config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+    cache (NodeCacheModel) : connection to the Node's cache
+    force (bool) : restarts the collection even if the swap is still pending
+    '''
+
+    swap_file_path = config_manager.get_state_file_path("node-update-swap-file")
+    update_pending = get_pending_update_entries(config_manager.config_data["node-image-update-file"]) is not None
+
+    with locked_state_file(swap_file_path, {}) as swap_record:
+
+        if swap_record.get("paused_at") is None or swap_record.get("resumed_at") is not None:
+            return None
+        if update_pending and not force:
+            return None
+
+        cache.start_data_collection()
+        swap_record["resumed_at"] = time.time()
+        swap_record["pause_time"] = swap_record["resumed_at"] - swap_record["paused_at"]
+        swap_record["swapped"] = not update_pending
+
+    time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+    if update_pending:
+        logging.warning("{0} - Node update swap timed out, data collection resumed after {1:.1f} seconds\
+                        ".format(time_str, swap_record["pause_time"]))
+    else :
+        logging.info("{0} - Node update swap completed, data collection was paused for {1:.1f} seconds\
+                     ".format(time_str, swap_record["pause_time"]))
+
+    return swap_record["pause_time"]
+
+
+class NodeImageInstaller():
+
+    '''
+    Installs the update images downloaded by the Node, while data collection keeps running
+        - every archive is verified, then streamed (decompressed on the fly) into the docker daemon
+        - once the images are loaded, data collection is paused and the entries are handed to the
+          host update script, which only has to swap the containers (entries flagged "loaded")
+        - data collection is restarted as soon as the swap is done, the pause is recorded
+    Archives that could not be loaded are handed over unflagged, the host script loads them.
+    '''
+
+    def __init__(self, config_manager, docker_client=None):
+
+        '''
+        Parameters
+        ----------
+        config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+        docker_client (docker.Client) : client connected to the docker daemon (None : connects to
+                                        "docker-socket-path" if possible)
+        '''
+
+        self.config_manager = config_manager
+        self.archive_dir = config_manager.config_data["node-image-archive-dir"]
+        self.swap_file_path = config_manager.get_state_file_path("node-update-swap-file")
+
+        self.docker_client = docker_client
+        if self.docker_client is None:
+            try :
+                import docker
+                self.docker_client = docker.Client(base_url=config_manager.config_data["docker-socket-path"])
+                self.docker_client.ping()
+            except Exception as e:
+                self.docker_client = None
+                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                logging.warning("{0} - NodeImageInstaller can not reach the docker daemon, images will be loaded by the host : {1}\
+                                ".format(time_str, e))
+
+
+    def load_update(self, update_entry, digest=None):
+
+        '''
+        Verifies and loads the image archive of an update entry into the docker daemon.
+        Returns the entry to hand to the host update script, flagged "loaded" (with the id of
+        the image it replaces) if the image was loaded, None if the archive is corrupted (the
+        archive is deleted, the update is offered again by the hub).
+
+        Parameters
+        ----------
+        update_entry (str) : "(old image) (update archive) (new image)" update entry
+        digest (str) : sha256 digest of the update archive (None : not verified)
+        '''
+
+        old_image, update_file, new_image = update_entry.split()[ : 3]
+        archive_path = os.path.join(self.archive_dir, update_file)
+
+        # the archive could have been damaged since it was downloaded
+        if digest is not None and get_file_digest(archive_path) != digest:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - NodeImageInstaller discarded update ({1}), digest mismatch".format(time_str, update_file))
+            try : os.remove(archive_path)
+            except : pass
+            return None
+
+        if self.docker_client is None:
+            return update_entry
+
+        try :
+
+            # the loaded image takes the tag of the old one, which has to be located first
+            old_image_ids = [image["Id"] for image in self.docker_client.images(name=old_image)]
+            load_start_time = time.time()
+            self.docker_client.load_image(iter_archive_contents(archive_path,
+                                                                self.config_manager.config_data["node-image-load-chunk-size"]))
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - NodeImageInstaller loaded update ({1}) in {2:.1f} seconds\
+                         ".format(time_str, update_file, time.time() - load_start_time))
+
+            old_image_id = get_short_image_id(old_image_ids[0]) if len(old_image_ids) > 0 else "none"
+            return "{0} {1} {2} loaded {3}\n".format(old_image, update_file, new_image, old_image_id)
+
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - NodeImageInstaller failed to load update ({1}), the host will load it : {2}\
+                          ".format(time_str, update_file, e))
+            return update_entry
+
+
+    def hand_over(self, update_entries, cache):
+
+        '''
+        Pauses data collection and writes the update entries for the host update script
+        (entries still pending from a previous hand over are kept)
+
+        Parameters
+        ----------
+        update_entries (list) : update entries to hand to the host update script
+        cache (NodeCacheModel) : connection to the Node's cache
+        '''
+
+        update_file_path = self.config_manager.config_data["node-image-update-file"]
+        pending_entries = get_pending_update_entries(update_file_path) or []
+
+        # halting the data collection for the container swap only
+        with locked_state_file(self.swap_file_path, {}) as swap_record:
+            if swap_record.get("paused_at") is None or swap_record.get("resumed_at") is not None:
+                swap_record.clear()
+                swap_record["paused_at"] = time.time()
+            swap_record["entries"] = pending_entries + update_entries
+            cache.stop_data_collection()
+
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        logging.info("{0} - NodeImageInstaller writting out update entries : {1}".format(time_str, str(update_entries)))
+
+        with open(update_file_path, "w") as update_file_h:
+            for entry in pending_entries + update_entries:
+                update_file_h.write(entry)
+            update_file_h.write("End")
+
+
+    def record_update(self, update_entry):
+
+        '''
+        Records the archive of a handed over update as the installed image of its component
+        (image manifest), the archive of the image it replaces is deleted.
+
+        Parameters
+        ----------
+        update_entry (str) : "(old image) (update archive) (new image)" update entry
+        '''
+
+        update_file = update_entry.split()[1]
+        archive_info = parse_image_archive_name(update_file, self.config_manager)
+        if archive_info is None:
+            return
+
+        old_image_file = get_node_image_manifest(self.config_manager).get(archive_info[1])
+        update_node_image_manifest(self.config_manager, update_file)
+        if old_image_file is not None and old_image_file != update_file:
+            try : os.remove(os.path.join(self.archive_dir, old_image_file))
+            except : pass
+
+
+    def wait_for_swap(self, cache):
+
+        '''
+        Waits for the host update script to apply the update entries, then restarts the data
+        collection. Collection is restarted anyway after "node-update-swap-timeout" seconds.
+        Returns the pause duration (seconds), None if no swap is in progress.
+
+        Parameters
+        ----------
+        cache (NodeCacheModel) : connection to the Node's cache
+        '''
+
+        swap_record = load_state_file(self.swap_file_path, {})
+        if swap_record.get("paused_at") is None or swap_record.get("resumed_at") is not None:
+            return None
+
+        wait_start_time = time.time()
+        while time.time() - wait_start_time < self.config_manager.config_data["node-update-swap-timeout"]:
+            pause_time = resume_data_collection(self.config_manager, cache)
+            if pause_time is not None:
+                return pause_time
+            time.sleep(self.config_manager.config_data["node-update-swap-poll"])
+
+        return resume_data_collection(self.config_manager, cache, force=True)
+
+
+    def install(self, update_entries, digests, cache):
+
+        '''
+        Loads the updates, then hands them over to the host update script for the container swap.
+        The image manifest only records the updates once they are handed over.
+        Returns the time data collection was paused (None if no swap was in progress).
+            ** installs are serialized, a new install waits for the previous swap to complete
+
+        Parameters
+        ----------
+        update_entries (list) : "(old image) (update archive) (new image)" update entries
+        digests (dict) : sha256 digest of the update archives
+        cache (NodeCacheModel) : connection to the Node's cache
+        '''
+
+        with locked_file(self.swap_file_path + ".install", "a"):
+
+            # loading the images while the data collection keeps running
+            loaded_entries = []
+            for update_entry in update_entries:
+                loaded_entry = self.load_update(update_entry, digests.get(update_entry.split()[1]))
+                if loaded_entry is not None:
+                    loaded_entries.append(loaded_entry)
+
+            if len(loaded_entries) > 0:
+                self.hand_over(loaded_entries, cache)
+                for loaded_entry in loaded_entries:
+                    self.record_update(loaded_entry)
+
+            # also completes a swap handed over by a previous container
+            return self.wait_for_swap(cache)
+
+
+def install_node_updates(config_file_path, update_entries, digests):
+
+    '''
+    Installs the downloaded updates (meant to run in a background process)
+
+    Parameters
+    ----------
+    config_file_path (str) : path to the node configuration file
+    update_entries (list) : "(old image) (update archive) (new image)" update entries
+    digests (dict) : sha256 digest of the update archives
+    '''
+
+    config_manager = NodeConfigurationManager(config_file_path)
+    try :
+        cache = NodeCacheModel(config_file_path)
+        NodeImageInstaller(config_manager).install(update_entries, digests, cache)
+
+    except Exception as e:
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        logging.error("{0} - Node update install failed : {1}".format(time_str, e))
@@ -0,0 +1,401 @@
+import os
+import os.path
+
+import time
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import gzip
+from .file_management import load_state_file, locked_state_file
+
+
+def get_image_repository(image_path):
+
+    '''
+    Returns the repository part of a docker image path (without tag or digest)
+        ex : gcr.io/tremium/dev_node_test:latest --> gcr.io/tremium/dev_node_test
+
+    Parameters
+    ----------
+    image_path (str) : full docker image path
+    '''
+
+    image_path = image_path.split("@")[0]
+    path_segs = image_path.rsplit("/", 1)
+    if ":" in path_segs[-1]:
+        path_segs[-1] = path_segs[-1].split(":")[0]
+    return "/".join(path_segs)
+
+
+def get_registry_auth_headers(image_path):
+
+    '''
+    Returns the headers holding the registry credentials of an image (docker config file), as the
+    docker client sends them with its pulls, no header when there are none
+
+    Parameters
+    ----------
+    image_path (str) : full path of the image
+    '''
+
+    try :
+        from docker import auth
+        registry, _ = auth.resolve_repository_name(get_image_repository(image_path))
+        auth_config = auth.resolve_authconfig(auth.load_config(), registry)
+        if auth_config:
+            return {"X-Registry-Auth" : auth.encode_header(auth_config)}
+    except Exception:
+        pass
+    return {}
+
+
+def get_registry_digest(docker_client, image_path):
+
+    '''
+    Returns the registry digest (manifest digest) of an image without pulling it,
+    None if the registry (or the docker daemon) cannot tell
+        ** the daemon is asked directly (GET /distribution/(image)/json), the docker client (docker-py 1.10) has no call for it
+
+    Parameters
+    ----------
+    docker_client (docker.Client) : client connected to the docker daemon
+    image_path (str) : full path of the image
+    '''
+
+    if "@" in image_path:
+        return image_path.split("@")[1]
+
+    try :
+        distribution_url = docker_client._url("/distribution/{0}/json", image_path, versioned_api=False)
+        response = docker_client._get(distribution_url, headers=get_registry_auth_headers(image_path))
+        return docker_client._result(response, json=True)["Descriptor"]["digest"]
+    except Exception:
+        return None
+
+
+def get_pulled_digest(docker_client, image_path):
+
+    '''
+    Returns the registry digest of a pulled image (from its repo digests), None if it has none
+
+    Parameters
+    ----------
+    docker_client (docker.Client) : client connected to the docker daemon
+    image_path (str) : full path of the pulled image
+    '''
+
+    repository = get_image_repository(image_path)
+    for repo_digest in docker_client.inspect_image(image_path).get("RepoDigests") or []:
+        if repo_digest.split("@")[0] == repository:
+            return repo_digest.split("@")[1]
+    return None
+
+
+def get_archived_digest(config_manager, digest):
+
+    '''
+    Returns the name of the archive exported from the image with the specified registry digest,
+    None if there is none (or if it was deleted by the archive policy)
+
+    Parameters
+    ----------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    digest (str) : registry digest of the image
+    '''
+
+    if digest is None:
+        return None
+
+    archive_name = load_state_file(config_manager.get_state_file_path("hub-image-digest-file"), {}).get(digest)
+    if archive_name is not None and os.path.isfile(os.path.join(config_manager.config_data["hub-image-archive-dir"], archive_name)):
+        return archive_name
+    return None
+
+
+def record_archived_digest(config_manager, digest, archive_name):
+
+    '''
+    Records the archive exported from the image with the specified registry digest
+    (entries of archives that no longer exist are dropped)
+
+    Parameters
+    ----------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    digest (str) : registry digest of the image
+    archive_name (str) : name of the exported archive
+    '''
+
+    archive_dir = config_manager.config_data["hub-image-archive-dir"]
+    with locked_state_file(config_manager.get_state_file_path("hub-image-digest-file"), {}) as archived_digests:
+        for known_digest, known_archive_name in list(archived_digests.items()):
+            if not os.path.isfile(os.path.join(archive_dir, known_archive_name)):
+                del archived_digests[known_digest]
+        archived_digests[digest] = archive_name
+
+
+class ImageLayerCache():
+
+    '''
+    Keeps the pulled images in the local docker storage, so that the next version of a component
+    only pulls the layers that changed (instead of every layer after remove_image).
+        - bounded by "update-manager-layer-cache-images" images and "update-manager-layer-cache-bytes"
+          (sum of the image sizes, layers shared by images are counted for each of them)
+        - the least recently pulled images are removed first, the images are tracked in "hub-layer-cache-file"
+    '''
+
+    def __init__(self, docker_client, config_manager):
+
+        '''
+        Parameters
+        ----------
+        docker_client (docker.Client) : client connected to the docker daemon
+        config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+        '''
+
+        self.docker_client = docker_client
+        self.max_images = config_manager.config_data["update-manager-layer-cache-images"]
+        self.max_bytes = config_manager.config_data["update-manager-layer-cache-bytes"]
+        self.cache_file_path = config_manager.get_state_file_path("hub-layer-cache-file")
+
+        # pull jobs of different components add images concurrently
+        self.lock = threading.Lock()
+
+
+    def add(self, image_path):
+
+        '''
+        Adds a pulled image to the cache, then removes the least recently pulled images over the bounds
+
+        Parameters
+        ----------
+        image_path (str) : full path of the pulled image
+        '''
+
+        image_info = self.docker_client.inspect_image(image_path)
+        with self.lock:
+            with locked_state_file(self.cache_file_path, {}) as cached_images:
+                cached_images[image_info["Id"]] = {"image" : image_path, "size" : image_info.get("Size", 0), "time" : time.time()}
+                self._evict(cached_images, keep_image_id=image_info["Id"])
+
+
+    def _evict(self, cached_images, keep_image_id):
+
+        '''
+        Removes the least recently pulled images until the cache is within its bounds (state lock held)
+
+        Parameters
+        ----------
+        cached_images (dict) : {image id : {"image", "size", "time"}}
+        keep_image_id (str) : id of the image that was just pulled (never removed)
+        '''
+
+        eviction_order = sorted([image_id for image_id in cached_images if image_id != keep_image_id],
+                                key=lambda image_id : cached_images[image_id]["time"])
+        for image_id in eviction_order:
+            if len(cached_images) <= self.max_images and sum(entry["size"] for entry in cached_images.values()) <= self.max_bytes:
+                break
+
+            try : self.docker_client.remove_image(image_id)
+            except Exception as e:
+
+                # images still in use (or already removed) are forgotten, not retried
+                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                logging.warning("{0} - Node update manager could not remove cached image {1} : {2}".format(
+                                time_str, cached_images[image_id]["image"], e))
+            del cached_images[image_id]
+
+
+def archive_node_image(docker_client, image_path, config_manager, layer_cache=None):
+
+    '''
+    Pulls the specified image from the registry and exports it to a compressed archive
+    (.tar.gz) in the hub image archive folder. Returns the name of the created archive,
+    None if the image could not be pulled or if it was already archived.
+        ** the registry digest is resolved first, an image already archived is not pulled again
+        ** the image is streamed straight into the compressed archive (no intermediate .tar)
+        ** the archive is written under a temporary name and renamed once complete
+        ** the pulled image is kept in the layer cache (removed right away without one)
+
+    Parameters
+    ----------
+    docker_client (docker.Client) : client connected to the docker daemon
+    image_path (str) : full path of the image to pull
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    layer_cache (ImageLayerCache) : local cache of the pulled images (None : no cache)
+    '''
+
+    # skipping images that were already archived (re-sent or duplicate notifications)
+    digest = get_registry_digest(docker_client, image_path)
+    archived_name = get_archived_digest(config_manager, digest)
+    if archived_name is not None:
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        logging.info("{0} - Node update manager skipped image {1}, digest {2} is archived as : {3}".format(
+                     time_str, image_path, digest, archived_name))
+        return None
+
+    pull_response = docker_client.pull(image_path)
+
+    # cheking if image was properly pulled
+    if not "id" in pull_response :
+        return None
+
+    # defining the path of the archived image
+    time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+    archive_name = get_image_repository(image_path).split("/")[-1] + "_" + time_str + ".tar.gz"
+    archive_path = os.path.join(config_manager.config_data["hub-image-archive-dir"], archive_name)
+    temp_archive_path = archive_path + ".part"
+
+    try :
+
+        # the digest is only known once pulled when the registry could not be asked
+        if digest is None:
+            digest = get_pulled_digest(docker_client, image_path)
+            archived_name = get_archived_digest(config_manager, digest)
+            if archived_name is not None:
+                logging.info("{0} - Node update manager skipped image {1}, digest {2} is archived as : {3}".format(
+                             time_str, image_path, digest, archived_name))
+                return None
+
+        # saving the pulled image to disk (compressed on the fly)
+        with gzip.open(temp_archive_path, 'wb') as ziped_f:
+            for chunk in docker_client.get_image(image_path):
+                ziped_f.write(chunk)
+        os.rename(temp_archive_path, archive_path)
+        if digest is not None:
+            record_archived_digest(config_manager, digest, archive_name)
+
+    finally:
+
+        # clean up
+        if os.path.isfile(temp_archive_path):
+            os.remove(temp_archive_path)
+        if layer_cache is not None:
+            layer_cache.add(image_path)
+        else :
+            docker_client.remove_image(image_path)
+
+    return archive_name
+
+
+class ImagePullScheduler():
+
+    '''
+    Schedules image pull jobs for the update manager.
+        - notifications are coalesced per component (image repository), while a component
+          job is pending only the newest notified image is kept
+        - jobs of different components run concurrently on a bounded pool of workers
+        - messages are acknowledged once their job is done (or superseded), so the subscriber
+          flow control limits the amount of outstanding work
+    '''
+
+    def __init__(self, process_image, max_workers):
+
+        '''
+        Parameters
+        ----------
+        process_image (callable) : job function, takes the image path as argument
+        max_workers (int) : maximum number of concurrent jobs
+        '''
+
+        self.process_image = process_image
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        self.lock = threading.Lock()
+        self.pending_jobs = {}
+        self.running_components = set()
+
+
+    @staticmethod
+    def _ack_message(message):
+        if message is not None:
+            message.ack()
+
+
+    def submit(self, image_path, message=None):
+
+        '''
+        Schedules a pull job for the specified image
+
+        Parameters
+        ----------
+        image_path (str) : full path of the notified image
+        message (pubsub_v1.subscriber.message.Message) : notification to acknowledge once handled
+        '''
+
+        component = get_image_repository(image_path)
+        superseded_message = None
+
+        with self.lock:
+
+            # only the newest notification is kept for a component
+            if component in self.pending_jobs:
+                pending_image_path, pending_message = self.pending_jobs[component]
+                pending_time = getattr(pending_message, "publish_time", None)
+                message_time = getattr(message, "publish_time", None)
+                if pending_time is not None and message_time is not None and message_time < pending_time:
+                    image_path, message, pending_message = pending_image_path, pending_message, message
+                superseded_message = pending_message
+
+            self.pending_jobs[component] = (image_path, message)
+
+            # one worker at a time handles a given component
+            if component not in self.running_components:
+                self.running_components.add(component)
+                self.executor.submit(self._run_component_jobs, component)
+
+        # superseded notifications are dropped
+        if superseded_message is not None:
+            self._ack_message(superseded_message)
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - Node update manager coalesced notification for component : {1}".format(time_str, component))
+
+
+    def _run_component_jobs(self, component):
+
+        '''
+        Runs the pending jobs of a component until there are none left
+
+        Parameters
+        ----------
+        component (str) : image repository of the component
+        '''
+
+        while True:
+
+            with self.lock:
+                job = self.pending_jobs.pop(component, None)
+                if job is None:
+                    self.running_components.discard(component)
+                    return
+
+            image_path, message = job
+            try :
+                self.process_image(image_path)
+
+            except Exception as e:
+                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                logging.error("{0} - Node update manager failed : {1}".format(time_str, e))
+
+            finally:
+                self._ack_message(message)
+
+
+    def shutdown(self, wait=True):
+
+        '''
+        Stops the scheduler
+
+        Parameters
+        ----------
+        wait (bool) : wait for the pending jobs to complete
+        '''
+
+        if wait:
+            while True:
+                with self.lock:
+                    if len(self.running_components) == 0: break
+                time.sleep(0.1)
+
+        self.executor.shutdown(wait=wait)
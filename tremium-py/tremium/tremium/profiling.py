@@ -0,0 +1,289 @@
+import os
+import os.path
+import sys
+import json
+
+import time
+import logging
+import datetime
+import threading
+import functools
+import tracemalloc
+
+from .tracing import trace_span
+
+
+# profiling can be forced on ("1") or off ("0") without editing the configuration file
+PROFILE_ENV_VAR = "TREMIUM_PROFILE"
+
+# session being profiled in the current process (hub connections and node maintenance each run in their own process)
+_current_session = None
+
+
+def get_profiling_settings(config_manager):
+
+    '''
+    Returns the profiling settings (dict) if profiling is enabled, None otherwise
+        - the "TREMIUM_PROFILE" environment variable overrides the "profiling-enabled" configuration
+
+    Parameters
+    ----------
+    config_manager (ConfigurationManager) : holds the Hub or Node configurations
+    '''
+
+    profile_env = os.environ.get(PROFILE_ENV_VAR)
+    if profile_env is not None:
+        enabled = profile_env.strip().lower() not in ("", "0", "false", "no", "off")
+    else :
+        enabled = config_manager.config_data.get("profiling-enabled", False)
+
+    if not enabled:
+        return None
+
+    return {
+        "output_dir" : config_manager.config_data["profiling-dir"],
+        "sample_interval" : config_manager.config_data["profiling-sample-interval"],
+        "max_sessions" : config_manager.config_data["profiling-max-sessions"],
+        "memory_top" : config_manager.config_data["profiling-memory-top"]
+    }
+
+
+class ProfilingSession():
+
+    '''
+    Profile of a single session (hub connection, node maintenance, ...), written out when it ends
+        - sampled CPU profile, in folded stack format ("(thread);(frame);(frame) (count)" lines,
+          the input of flamegraph.pl, speedscope, ...)
+        - wall-time spans of the session phases, in the Chrome trace event format
+          (chrome://tracing, Perfetto)
+        - memory snapshot (tracemalloc), top allocation sites and peak traced memory
+    Only the newest "profiling-max-sessions" sessions of every name are kept.
+    '''
+
+    def __init__(self, name, settings):
+
+        '''
+        Parameters
+        ----------
+        name (str) : name of the profiled entry point
+        settings (dict) : profiling settings (see get_profiling_settings)
+        '''
+
+        self.name = name
+        self.settings = settings
+        self.stack_counts = {}
+        self.spans = []
+        self.start_time = None
+
+        self.sampling_stop = threading.Event()
+        self.sampling_thread = None
+        self.started_tracemalloc = False
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+
+    def start(self):
+
+        global _current_session
+
+        self.start_time = time.time()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+        self.sampling_thread = threading.Thread(target=self._sample, daemon=True)
+        self.sampling_thread.start()
+        _current_session = self
+
+
+    def stop(self):
+
+        global _current_session
+
+        _current_session = None
+        end_time = time.time()
+        self.sampling_stop.set()
+        self.sampling_thread.join()
+
+        try :
+            self._write_outputs(end_time)
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - ProfilingSession failed to write the profile of ({1}) : {2}".format(time_str, self.name, e))
+
+        finally:
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+
+
+    def span(self, name):
+
+        '''
+        Context manager recording the wall-time of a phase of the session
+
+        Parameters
+        ----------
+        name (str) : name of the phase
+        '''
+
+        return _Span(self, name)
+
+
+    def _sample(self):
+
+        ''' Sampling loop, records the stack of every other thread of the process '''
+
+        sampling_thread_id = threading.get_ident()
+        while not self.sampling_stop.wait(self.settings["sample_interval"]):
+
+            thread_names = {thread.ident : thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampling_thread_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append("{0} ({1}:{2})".format(frame.f_code.co_name, os.path.basename(frame.f_code.co_filename),
+                                                       frame.f_code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+
+                folded_stack = ";".join(reversed(stack))
+                self.stack_counts[folded_stack] = self.stack_counts.get(folded_stack, 0) + 1
+
+
+    def _write_outputs(self, end_time):
+
+        ''' Writes the profile files of the session, then deletes the oldest sessions '''
+
+        output_dir = self.settings["output_dir"]
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+
+        time_str = datetime.datetime.fromtimestamp(self.start_time).strftime('%Y-%m-%d_%H-%M-%S')
+        output_prefix = os.path.join(output_dir, "{0}_{1}_{2}".format(self.name, time_str, os.getpid()))
+
+        # sampled CPU profile
+        with open(output_prefix + ".folded", "w") as folded_h:
+            for folded_stack, count in sorted(self.stack_counts.items()):
+                folded_h.write("{0} {1}\n".format(folded_stack, count))
+
+        # wall-time spans (the session itself is the outer span)
+        trace_events = [{"name" : self.name, "ph" : "X", "pid" : os.getpid(), "tid" : 0,
+                         "ts" : int(self.start_time * 1e6), "dur" : int((end_time - self.start_time) * 1e6)}]
+        for span_name, thread_id, span_start, span_end in self.spans:
+            trace_events.append({"name" : span_name, "ph" : "X", "pid" : os.getpid(), "tid" : thread_id,
+                                 "ts" : int(span_start * 1e6), "dur" : int((span_end - span_start) * 1e6)})
+        with open(output_prefix + ".trace.json", "w") as trace_h:
+            json.dump({"traceEvents" : trace_events, "displayTimeUnit" : "ms"}, trace_h)
+
+        # memory snapshot
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        top_stats = tracemalloc.take_snapshot().statistics("lineno")[ : self.settings["memory_top"]]
+        with open(output_prefix + ".memory.txt", "w") as memory_h:
+            memory_h.write("current : {0} B, peak : {1} B\n".format(current_memory, peak_memory))
+            for stat in top_stats:
+                memory_h.write("{}\n".format(stat))
+
+        self._rotate_outputs(output_dir)
+
+
+    def _rotate_outputs(self, output_dir):
+
+        ''' Keeps the newest "profiling-max-sessions" sessions of this session name '''
+
+        session_prefixes = set()
+        for output_file in os.listdir(output_dir):
+            if output_file.startswith(self.name + "_") and output_file.endswith(".folded"):
+                session_prefixes.add(output_file[ : -len(".folded")])
+
+        for session_prefix in sorted(session_prefixes)[ : -self.settings["max_sessions"]]:
+            for extension in (".folded", ".trace.json", ".memory.txt"):
+                try : os.remove(os.path.join(output_dir, session_prefix + extension))
+                except FileNotFoundError: pass
+
+
+class _Span():
+
+    ''' Wall-time span of a phase of a profiling session (also a span of the current trace, if any) '''
+
+    def __init__(self, session, name):
+        self.session = session
+        self.name = name
+        self.start_time = None
+        self.trace_span = trace_span(name)
+
+    def __enter__(self):
+        self.trace_span.__enter__()
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.session.spans.append((self.name, threading.get_ident(), self.start_time, time.time()))
+        return self.trace_span.__exit__(*exc_info)
+
+
+def profile_span(name):
+
+    '''
+    Returns a context manager recording a phase of the current profiling session, and a span
+    of the current trace session (does nothing when neither is active)
+
+    Parameters
+    ----------
+    name (str) : name of the phase
+    '''
+
+    if _current_session is None:
+        return trace_span(name)
+    return _current_session.span(name)
+
+
+def profiled(session_name, get_config_manager=None):
+
+    '''
+    Decorator profiling an entry point, when profiling is enabled
+        - a call made outside of a profiling session runs in its own session
+        - a call made inside a session is recorded as a phase (span) of that session
+        - the call is a span of the current trace session, if any (see tracing.trace_span)
+
+    Parameters
+    ----------
+    session_name (str) : name of the entry point
+    get_config_manager (callable) : returns the configuration manager from the call arguments
+                                    (defaults to the "config_manager" attribute of the instance)
+    '''
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def profiled_func(*args, **kwargs):
+
+            if _current_session is not None:
+                with _current_session.span(session_name):
+                    return func(*args, **kwargs)
+
+            if get_config_manager is None:
+                config_manager = args[0].config_manager
+            else :
+                config_manager = get_config_manager(*args, **kwargs)
+
+            settings = get_profiling_settings(config_manager)
+            if settings is None:
+                with trace_span(session_name):
+                    return func(*args, **kwargs)
+
+            with ProfilingSession(session_name, settings), trace_span(session_name):
+                return func(*args, **kwargs)
+
+        return profiled_func
+
+    return decorator
@@ -0,0 +1,353 @@
+import os
+import os.path
+
+import time
+import logging
+import datetime
+
+from .config import NodeConfigurationManager
+from .file_management import load_state_file, locked_state_file
+
+
+def create_bluetooth_socket():
+
+    ''' Default socket factory for the relay components (RFCOMM bluetooth socket) '''
+
+    from bluetooth import BluetoothSocket
+    return BluetoothSocket()
+
+
+def read_response_header(peer_s, buffer_size):
+
+    '''
+    Reads a newline terminated response header from the specified socket.
+    Returns the decoded header and the bytes received after the header (start of the payload).
+
+    Parameters
+    ----------
+    peer_s (socket) : connected socket
+    buffer_size (int) : maximum size of a single socket read
+    '''
+
+    received_data = b""
+    while b"\n" not in received_data:
+        data = peer_s.recv(buffer_size)
+        if not data:
+            raise ConnectionError("connection closed before the response header was received")
+        received_data += data
+
+    header, payload = received_data.split(b"\n", 1)
+    return header.decode("utf-8"), payload
+
+
+def fetch_from_peer(address, port, archive_name, output_path, config_manager, socket_factory=create_bluetooth_socket):
+
+    '''
+    Downloads an update archive from a relay peer (an other Tremium Node).
+    Returns the number of bytes written to the output file.
+        ** raises an exception when the peer refuses the request or the transfer is incomplete
+
+    Parameters
+    ----------
+    address (str) : address of the relay peer
+    port (int) : port the relay peer listens on
+    archive_name (str) : name of the update archive to fetch
+    output_path (str) : path of the output file (temporary file, left incomplete when the transfer fails)
+    config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+    socket_factory (callable) : creates the socket used to connect to the peer
+    '''
+
+    buffer_size = config_manager.config_data["bluetooth-message-max-size"]
+    peer_s = socket_factory()
+
+    try :
+
+        # requesting the archive from the peer
+        peer_s.connect((address, port))
+        peer_s.settimeout(config_manager.config_data["bluetooth-comm-timeout"])
+        peer_s.send(bytes("GET_UPDATE {}\n".format(archive_name), "UTF-8"))
+
+        # the peer announces the size of the archive before sending it
+        header, file_data = read_response_header(peer_s, buffer_size)
+        header_segs = header.split()
+        if len(header_segs) != 2 or header_segs[0] != "OK":
+            raise ValueError("relay peer refused request for ({0}) : {1}".format(archive_name, header))
+        archive_size = int(header_segs[1])
+
+        # writing incoming data to file, until the announced size is reached
+        received_size = 0
+        with open(output_path, "wb") as archive_file_h:
+            while True:
+                archive_file_h.write(file_data)
+                received_size += len(file_data)
+                if received_size >= archive_size: break
+                file_data = peer_s.recv(buffer_size)
+                if not file_data: break
+
+        if received_size != archive_size:
+            raise ValueError("incomplete transfer of ({0}) from relay peer : {1}/{2} bytes".\
+                             format(archive_name, received_size, archive_size))
+
+        return received_size
+
+    finally:
+        peer_s.close()
+
+
+class UpdateRelayRegistry():
+
+    '''
+    Hub side registry of the Nodes holding verified update archives (relay peers).
+    The Hub uses the registry to decide which peer a Node should fetch an update from,
+    so the Hub is not the only source of update archives.
+        ** the registry is a state file, Hub connection handlers run in separate processes
+    '''
+
+    def __init__(self, config_manager):
+
+        '''
+        Parameters
+        ----------
+        config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+        '''
+
+        self.config_manager = config_manager
+        self.registry_path = config_manager.get_state_file_path("hub-relay-registry-file")
+
+
+    def _expire_entries(self, archive_entry, current_time):
+
+        '''
+        Drops peers that have not registered in a while and assignments that timed out
+
+        Parameters
+        ----------
+        archive_entry (dict) : registry entry of an update archive
+        current_time (float) : current time stamp
+        '''
+
+        peer_ttl = self.config_manager.config_data["relay-peer-ttl"]
+        assignment_timeout = self.config_manager.config_data["relay-assignment-timeout"]
+
+        for peer_id in list(archive_entry["peers"].keys()):
+            peer = archive_entry["peers"][peer_id]
+            if current_time - peer["time"] > peer_ttl:
+                del archive_entry["peers"][peer_id]
+                continue
+
+            for requester_id in list(peer["assignments"].keys()):
+                if current_time - peer["assignments"][requester_id] > assignment_timeout:
+                    del peer["assignments"][requester_id]
+
+
+    def register_peer(self, archive_name, digest, node_id, address, port):
+
+        '''
+        Registers a Node as holder of a verified update archive
+
+        Parameters
+        ----------
+        archive_name (str) : name of the update archive
+        digest (str) : sha256 digest of the archive (as verified by the Node)
+        node_id (str) : id of the Node holding the archive
+        address (str) : address of the Node's relay server
+        port (int) : port of the Node's relay server
+        '''
+
+        with locked_state_file(self.registry_path, {}) as registry:
+
+            # a new digest means the archive was replaced, older peers are dropped
+            archive_entry = registry.get(archive_name)
+            if archive_entry is None or archive_entry["digest"] != digest:
+                archive_entry = {"digest" : digest, "peers" : {}}
+                registry[archive_name] = archive_entry
+
+            archive_entry["peers"][node_id] = {
+                "address" : address,
+                "port" : port,
+                "time" : time.time(),
+                "assignments" : {}
+            }
+
+            # the registering Node is done fetching the archive
+            for peer in archive_entry["peers"].values():
+                peer["assignments"].pop(node_id, None)
+
+
+    def select_peer(self, archive_name, digest, node_id):
+
+        '''
+        Returns the (peer id, address, port) of the least loaded peer able to relay
+        the specified archive to the requesting Node, None if the Hub should serve it.
+        The requesting Node is assigned to the selected peer.
+
+        Parameters
+        ----------
+        archive_name (str) : name of the requested update archive
+        digest (str) : sha256 digest of the Hub's copy of the archive
+        node_id (str) : id of the requesting Node
+        '''
+
+        max_sessions = self.config_manager.config_data["relay-peer-max-sessions"]
+
+        with locked_state_file(self.registry_path, {}) as registry:
+
+            archive_entry = registry.get(archive_name)
+            if archive_entry is None or archive_entry["digest"] != digest:
+                return None
+
+            current_time = time.time()
+            self._expire_entries(archive_entry, current_time)
+
+            # selecting the peer with the fewest assigned Nodes (most recent peer on ties)
+            candidates = [(len(peer["assignments"]), -peer["time"], peer_id)
+                          for peer_id, peer in archive_entry["peers"].items()
+                          if peer_id != node_id and len(peer["assignments"]) < max_sessions]
+            if len(candidates) == 0:
+                return None
+
+            peer_id = min(candidates)[2]
+            peer = archive_entry["peers"][peer_id]
+            peer["assignments"][node_id] = current_time
+            return (peer_id, peer["address"], peer["port"])
+
+
+    def remove_archive(self, archive_name):
+
+        '''
+        Removes all the peers of the specified archive from the registry
+
+        Parameters
+        ----------
+        archive_name (str) : name of the update archive
+        '''
+
+        with locked_state_file(self.registry_path, {}) as registry:
+            registry.pop(archive_name, None)
+
+
+class NodeRelayServer():
+
+    ''' Node side server relaying verified update archives to other Tremium Nodes '''
+
+    def __init__(self, config_file_path, socket_factory=create_bluetooth_socket):
+
+        '''
+        Parameters
+        ----------
+        config_file_path (str) : path to the node configuration file
+        socket_factory (callable) : creates the listening socket
+        '''
+
+        self.socket_factory = socket_factory
+        self.config_manager = NodeConfigurationManager(config_file_path)
+        self.holdings_path = self.config_manager.get_state_file_path("node-relay-holdings-file")
+
+
+    def add_holding(self, archive_name, digest):
+
+        '''
+        Marks the specified (verified) archive as available for relaying
+
+        Parameters
+        ----------
+        archive_name (str) : name of the update archive
+        digest (str) : sha256 digest of the verified archive
+        '''
+
+        archive_dir = self.config_manager.config_data["node-image-archive-dir"]
+
+        with locked_state_file(self.holdings_path, {}) as holdings:
+            holdings[archive_name] = digest
+
+            # forgetting archives that were deleted (replaced by updates)
+            for held_archive in list(holdings.keys()):
+                if not os.path.isfile(os.path.join(archive_dir, held_archive)):
+                    del holdings[held_archive]
+
+
+    def handle_peer_connection(self, peer_s):
+
+        '''
+        Handles a single relay request from an other Node
+            - GET_UPDATE (image file name) : responds with (OK size) followed by the archive data
+
+        Parameters
+        ----------
+        peer_s (socket) : socket connected to the requesting Node
+        '''
+
+        buffer_size = self.config_manager.config_data["bluetooth-message-max-size"]
+
+        try :
+
+            peer_s.settimeout(self.config_manager.config_data["bluetooth-comm-timeout"])
+            message_str, _ = read_response_header(peer_s, buffer_size)
+            message_segs = message_str.split()
+
+            # only verified archives are relayed
+            holdings = load_state_file(self.holdings_path, {})
+            archive_name = message_segs[1] if len(message_segs) == 2 else ""
+            archive_path = os.path.join(self.config_manager.config_data["node-image-archive-dir"], archive_name)
+            if message_segs[ : 1] != ["GET_UPDATE"] or archive_name not in holdings or not os.path.isfile(archive_path):
+                peer_s.sendall(b"ERROR\n")
+                raise ValueError("refused relay request : {}".format(message_str))
+
+            # transfering the archive
+            peer_s.sendall(bytes("OK {}\n".format(os.stat(archive_path).st_size), "UTF-8"))
+            with open(archive_path, "rb") as archive_file_h:
+                data = archive_file_h.read(buffer_size)
+                while data:
+                    peer_s.sendall(data)
+                    data = archive_file_h.read(buffer_size)
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - NodeRelayServer relayed update file ({1}) to peer".format(time_str, archive_name))
+
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - NodeRelayServer failed to handle relay request : {1}".format(time_str, e))
+
+        peer_s.close()
+
+
+    def serve_forever(self, listener_s):
+
+        '''
+        Handles relay requests one at a time (the Hub limits the Nodes assigned to a peer)
+
+        Parameters
+        ----------
+        listener_s (socket) : bound and listening socket
+        '''
+
+        while True:
+            peer_s, _ = listener_s.accept()
+            self.handle_peer_connection(peer_s)
+
+
+def launch_node_relay_server(config_file_path):
+
+    '''
+    Launches the Tremium Node relay server which other Nodes fetch updates from.
+
+    Parameters
+    ----------
+    config_file_path (str) : path to the node configuration file
+    '''
+
+    relay_server = NodeRelayServer(config_file_path)
+    config_data = relay_server.config_manager.config_data
+
+    try :
+
+        listener_s = relay_server.socket_factory()
+        listener_s.bind((config_data["bluetooth-adapter-mac-client"], config_data["relay-port"]))
+        listener_s.listen(1)
+
+    except Exception as e:
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        logging.error("{0} - NodeRelayServer failed to create listener socket : {1}".format(time_str, e))
+        raise
+
+    relay_server.serve_forever(listener_s)
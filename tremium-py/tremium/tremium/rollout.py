@@ -0,0 +1,174 @@
+import os
+import os.path
+import re
+
+import time
+import random
+import hashlib
+import logging
+import datetime
+
+from .file_management import locked_state_file
+
+
+def get_rollout_bucket(node_id):
+
+    ''' Returns the rollout bucket (0 - 99) of a node, stable across releases (same nodes go first) '''
+
+    return int(hashlib.sha1(node_id.encode("utf-8")).hexdigest(), 16) % 100
+
+
+class UpdateRollout():
+
+    '''
+    Rolls the update archives out to the nodes in waves ("hub-rollout-waves")
+        - a wave is {"pattern" : node id regex, "percent" : share of the nodes, "delay" : seconds},
+          it includes the nodes matching its pattern (when given) whose rollout bucket is under its
+          percent (when given), and opens (delay) seconds after the archive landed on the hub
+        - without waves every archive is released to every node at once
+        - at most "hub-rollout-max-active" nodes are updating at the same time (0 : no limit), a node
+          holds its slot until it reports no more updates (or for "hub-rollout-slot-timeout" seconds)
+    Nodes outside the open waves (or over the cap) are told to check back later (RETRY_AFTER).
+    '''
+
+    def __init__(self, config_manager):
+
+        '''
+        Parameters
+        ----------
+        config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+        '''
+
+        self.config_manager = config_manager
+        self.archive_dir = config_manager.config_data["hub-image-archive-dir"]
+        self.waves = config_manager.config_data["hub-rollout-waves"]
+        self.max_active = config_manager.config_data["hub-rollout-max-active"]
+        self.slot_timeout = config_manager.config_data["hub-rollout-slot-timeout"]
+        self.retry_time = config_manager.config_data["hub-rollout-retry-time"]
+        self.state_file_path = config_manager.get_state_file_path("hub-rollout-state-file")
+
+
+    def get_release_time(self, node_id, archive_name):
+
+        '''
+        Returns the time an archive is released to a node (opening of the first wave including the node),
+        None if no wave includes the node
+
+        Parameters
+        ----------
+        node_id (str) : id of the node
+        archive_name (str) : name of the update archive (in the hub archive folder)
+        '''
+
+        landed_time = os.stat(os.path.join(self.archive_dir, archive_name)).st_mtime
+        if len(self.waves) == 0:
+            return landed_time
+
+        wave_delays = [wave.get("delay", 0) for wave in self.waves
+                       if (wave.get("pattern") is None or re.match(wave["pattern"], node_id) is not None) and
+                          get_rollout_bucket(node_id) < wave.get("percent", 100)]
+        if len(wave_delays) == 0:
+            return None
+        return landed_time + min(wave_delays)
+
+
+    def filter_updates(self, node_id, update_images, current_time=None):
+
+        '''
+        Returns (update images released to the node, seconds until the next withheld image is released),
+        the second value is None when no image is withheld (or when the withheld images are never released)
+
+        Parameters
+        ----------
+        node_id (str) : id of the node
+        update_images (list) : names of the update archives the node would fetch
+        current_time (float) : current time (defaults to now)
+        '''
+
+        current_time = time.time() if current_time is None else current_time
+
+        released_images = []
+        retry_after = None
+        for update_image in update_images:
+            release_time = self.get_release_time(node_id, update_image)
+            if release_time is not None and release_time <= current_time:
+                released_images.append(update_image)
+            elif release_time is not None:
+                retry_after = release_time - current_time if retry_after is None else min(retry_after, release_time - current_time)
+
+        return released_images, retry_after
+
+
+    def acquire_slot(self, node_id, current_time=None):
+
+        '''
+        Takes (or renews) an update slot for the node, returns False when every slot is taken
+
+        Parameters
+        ----------
+        node_id (str) : id of the node
+        current_time (float) : current time (defaults to now)
+        '''
+
+        if self.max_active <= 0:
+            return True
+
+        current_time = time.time() if current_time is None else current_time
+        with locked_state_file(self.state_file_path, {}) as active_slots:
+
+            # slots of nodes that went silent expire
+            for slot_node_id, slot_time in list(active_slots.items()):
+                if current_time - slot_time > self.slot_timeout:
+                    del active_slots[slot_node_id]
+
+            if node_id not in active_slots and len(active_slots) >= self.max_active:
+                return False
+            active_slots[node_id] = current_time
+            return True
+
+
+    def release_slot(self, node_id):
+
+        '''
+        Releases the update slot of the node (it is up to date)
+
+        Parameters
+        ----------
+        node_id (str) : id of the node
+        '''
+
+        if self.max_active <= 0:
+            return
+
+        with locked_state_file(self.state_file_path, {}) as active_slots:
+            active_slots.pop(node_id, None)
+
+
+    def check_updates(self, node_id, update_images, current_time=None):
+
+        '''
+        Returns (update images the node should fetch now, seconds after which the node should check back),
+        the second value is None when the node has nothing to wait for
+
+        Parameters
+        ----------
+        node_id (str) : id of the node
+        update_images (list) : names of the update archives that differ from the node manifest
+        current_time (float) : current time (defaults to now)
+        '''
+
+        if len(update_images) == 0:
+            self.release_slot(node_id)
+            return [], None
+
+        released_images, retry_after = self.filter_updates(node_id, update_images, current_time)
+        if len(released_images) == 0:
+            return [], retry_after
+
+        # over the cap, the check backs are spread out (retry time + up to 50 %)
+        if not self.acquire_slot(node_id, current_time):
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - UpdateRollout deferred node {1}, every update slot is taken".format(time_str, node_id))
+            return [], self.retry_time * random.uniform(1.0, 1.5)
+
+        return released_images, None
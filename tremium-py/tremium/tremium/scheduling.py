@@ -0,0 +1,243 @@
+import os
+import os.path
+
+import re
+import time
+
+from .file_management import load_state_file, locked_state_file
+
+
+# work priorities (lowest value is transfered first)
+PRIORITY_UPDATE = 0
+PRIORITY_FLAGGED_DATA = 1
+PRIORITY_DATA = 2
+PRIORITY_LOG = 3
+
+
+class LinkEstimator():
+
+    '''
+    Node side estimator of the contact window with the Hub and of the link rate.
+    A contact is a sequence of successful Hub connections, separated from the previous one
+    by more than "contact-gap" seconds.
+        - the contact duration and link rate are exponentially weighted averages
+        - the estimates are kept in a state file, so they survive across maintenance runs
+    '''
+
+    def __init__(self, config_manager):
+
+        '''
+        Parameters
+        ----------
+        config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+        '''
+
+        self.config_manager = config_manager
+        self.state_path = config_manager.get_state_file_path("node-link-state-file")
+
+
+    def _update_average(self, average, value):
+
+        ''' Returns the weighted average updated with the new value '''
+
+        if average is None:
+            return value
+        weight = self.config_manager.config_data["link-estimate-weight"]
+        return (1 - weight) * average + weight * value
+
+
+    def mark_contact(self):
+
+        ''' Records a successful connection with the Hub, starts a new contact after a gap '''
+
+        current_time = time.time()
+        with locked_state_file(self.state_path, {}) as link_state:
+
+            last_activity = link_state.get("last_activity")
+            if last_activity is None or current_time - last_activity > self.config_manager.config_data["contact-gap"]:
+
+                # the previous contact is over
+                if last_activity is not None:
+                    link_state["contact_duration"] = self._update_average(link_state.get("contact_duration"),
+                                                                          last_activity - link_state["contact_start"])
+                link_state["contact_start"] = current_time
+
+            link_state["last_activity"] = current_time
+
+
+    def record_transfer(self, size, duration):
+
+        '''
+        Records a completed transfer, used to estimate the link rate
+
+        Parameters
+        ----------
+        size (int) : number of bytes transfered
+        duration (float) : duration of the transfer (seconds)
+        '''
+
+        if size <= 0 or duration <= 0:
+            return
+
+        with locked_state_file(self.state_path, {}) as link_state:
+            link_state["link_rate"] = self._update_average(link_state.get("link_rate"), size / duration)
+            link_state["last_activity"] = time.time()
+
+
+    def remaining_window(self):
+
+        '''
+        Returns the estimated time left in the current contact (seconds), None if no contact
+        was completed yet (unknown window). Never less than "contact-min-window", so some
+        work always gets done.
+        '''
+
+        link_state = load_state_file(self.state_path, {})
+        if link_state.get("contact_duration") is None or link_state.get("contact_start") is None:
+            return None
+
+        expected_duration = link_state["contact_duration"] * self.config_manager.config_data["contact-window-safety"]
+        remaining_time = expected_duration - (time.time() - link_state["contact_start"])
+        return max(self.config_manager.config_data["contact-min-window"], remaining_time)
+
+
+    def estimate_transfer_time(self, size):
+
+        '''
+        Returns the estimated duration of a transfer (seconds), 0 if the link rate is unknown
+
+        Parameters
+        ----------
+        size (int) : number of bytes to transfer
+        '''
+
+        link_rate = load_state_file(self.state_path, {}).get("link_rate")
+        if not link_rate:
+            return 0.0
+        return size / link_rate
+
+
+def get_data_file_priority(file_name, config_manager):
+
+    '''
+    Returns the transfer priority of a file from the node transfer folder
+        - flagged data files (matching "node-flagged-data-pattern"), then data files, then logs
+
+    Parameters
+    ----------
+    file_name (str) : name of the data/log file
+    config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+    '''
+
+    if file_name.endswith(".log"):
+        return PRIORITY_LOG
+    if re.search(config_manager.config_data["node-flagged-data-pattern"], file_name) is not None:
+        return PRIORITY_FLAGGED_DATA
+    return PRIORITY_DATA
+
+
+def plan_transfers(work_items, remaining_window, link_estimator):
+
+    '''
+    Orders the work items by priority (newest first within a priority) and packs the ones
+    that fit in the remaining contact window. Returns the (scheduled, deferred) item lists,
+    deferred items are carried over to the next contact.
+
+    Parameters
+    ----------
+    work_items (list) : (name, priority, time stamp, size) of every work item
+    remaining_window (float) : estimated time left in the contact, None if unknown
+    link_estimator (LinkEstimator) : estimates the transfer durations
+    '''
+
+    ordered_items = sorted(work_items, key=lambda work_item : (work_item[1], -work_item[2]))
+    if remaining_window is None:
+        return ordered_items, []
+
+    scheduled_items = []
+    deferred_items = []
+    for work_item in ordered_items:
+
+        # smaller items of lower priority can still fill the window
+        transfer_time = link_estimator.estimate_transfer_time(work_item[3])
+        if transfer_time <= remaining_window:
+            scheduled_items.append(work_item)
+            remaining_window -= transfer_time
+        else :
+            deferred_items.append(work_item)
+
+    return scheduled_items, deferred_items
+
+
+class TransferCarryover():
+
+    '''
+    Node side record of the update downloads interrupted by the end of a contact.
+    The partial (.part) files are kept and resumed (by byte range) at the next contact.
+    '''
+
+    def __init__(self, config_manager):
+
+        '''
+        Parameters
+        ----------
+        config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+        '''
+
+        self.config_manager = config_manager
+        self.archive_dir = config_manager.config_data["node-image-archive-dir"]
+        self.state_path = config_manager.get_state_file_path("node-transfer-carryover-file")
+
+
+    def get_part_file_path(self, archive_name):
+        return os.path.join(self.archive_dir, archive_name + ".part")
+
+
+    def add_entry(self, archive_name, size, digest):
+
+        '''
+        Records an update download in progress
+
+        Parameters
+        ----------
+        archive_name (str) : name of the update archive
+        size (int) : size of the Hub's copy of the archive
+        digest (str) : sha256 digest of the Hub's copy of the archive
+        '''
+
+        with locked_state_file(self.state_path, {}) as carryover:
+            carryover[archive_name] = {"size" : size, "digest" : digest}
+
+
+    def remove_entry(self, archive_name):
+
+        '''
+        Forgets an update download (completed or abandoned)
+
+        Parameters
+        ----------
+        archive_name (str) : name of the update archive
+        '''
+
+        with locked_state_file(self.state_path, {}) as carryover:
+            carryover.pop(archive_name, None)
+
+
+    def get_entries(self):
+
+        ''' Returns the interrupted downloads that can be resumed : {archive name : (size, digest, received size)} '''
+
+        entries = {}
+        with locked_state_file(self.state_path, {}) as carryover:
+            for archive_name in list(carryover.keys()):
+
+                # entries without a partial file can not be resumed
+                part_file_path = self.get_part_file_path(archive_name)
+                if not os.path.isfile(part_file_path) or os.stat(part_file_path).st_size > carryover[archive_name]["size"]:
+                    del carryover[archive_name]
+                    continue
+
+                entries[archive_name] = (carryover[archive_name]["size"], carryover[archive_name]["digest"],
+                                         os.stat(part_file_path).st_size)
+
+        return entries
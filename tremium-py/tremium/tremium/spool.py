@@ -0,0 +1,426 @@
+import os
+import os.path
+
+import re
+import time
+import logging
+import datetime
+import tarfile
+
+from .config import NodeConfigurationManager
+from .file_management import locked_state_file
+
+
+# drop policies applied when the spool exceeds its disk budget
+DROP_OLDEST = "oldest"
+DROP_DOWNSAMPLE = "downsample"
+
+
+class DataSpool():
+
+    '''
+    Node side spool of the archived data files waiting for a Hub contact
+        - the spooled files are kept in an index (state file), so a transfer never has to list,
+          stat and pattern match the whole transfer folder
+        - files older than "spool-segment-age" are compressed into larger segments (.tar.gz)
+        - the spool is kept under its disk budget ("spool-max-bytes", and "spool-min-free-bytes"
+          left on the file system) with the "spool-drop-policy" : drop the oldest files, or
+          downsample the oldest segments (keep one file out of "spool-downsample-factor") first
+        - acquisition is asked to throttle (NodeCacheModel) while the spool is nearly full
+    Flagged data files are never compressed or downsampled, and are dropped last.
+    Entries checked out by a transfer are left untouched until they are removed or released.
+    '''
+
+    def __init__(self, config_manager):
+
+        '''
+        Parameters
+        ----------
+        config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+        '''
+
+        self.config_manager = config_manager
+        self.transfer_dir = config_manager.config_data["node-file-transfer-dir"]
+        self.index_path = config_manager.get_state_file_path("node-spool-index-file")
+        self.archived_data_pattern_segs = config_manager.config_data["node-archived-data-file"].split(".")
+
+
+    def _is_flagged(self, file_name):
+        return re.search(self.config_manager.config_data["node-flagged-data-pattern"], file_name) is not None
+
+
+    def _scan_transfer_dir(self):
+
+        ''' Builds the index from the transfer folder (first use of the spool only) '''
+
+        spool_index = {}
+        for element in os.listdir(self.transfer_dir):
+            element_path = os.path.join(self.transfer_dir, element)
+            if os.path.isfile(element_path) and re.search(self.archived_data_pattern_segs[0], element) is not None:
+                element_stat = os.stat(element_path)
+                spool_index[element] = {"size" : element_stat.st_size, "time" : element_stat.st_mtime,
+                                        "segment" : element.endswith(".tar.gz"), "downsampled" : False}
+
+        return spool_index
+
+
+    def _locked_index(self):
+
+        ''' Context manager giving exclusive access to the spool index (built on first use) '''
+
+        if not os.path.isfile(self.index_path):
+            with locked_state_file(self.index_path, {}) as spool_index:
+                if not os.path.isfile(self.index_path):
+                    spool_index.update(self._scan_transfer_dir())
+
+        return locked_state_file(self.index_path, {})
+
+
+    def add_file(self, file_name):
+
+        '''
+        Adds a data file of the transfer folder to the spool
+
+        Parameters
+        ----------
+        file_name (str) : name of the data file
+        '''
+
+        file_stat = os.stat(os.path.join(self.transfer_dir, file_name))
+        with self._locked_index() as spool_index:
+            spool_index[file_name] = {"size" : file_stat.st_size, "time" : file_stat.st_mtime,
+                                      "segment" : file_name.endswith(".tar.gz"), "downsampled" : False}
+
+
+    def rotate_data_file(self, cache):
+
+        '''
+        Moves the main (extracted) data file to the spool once it reached "node-data-file-max-size",
+        returns the name of the spooled file (None if the data file was not rotated)
+            ** only used for the writers that append to the main data file (not using DataFileWriter)
+
+        Parameters
+        ----------
+        cache (NodeCacheModel) : connection to the Node's cache (data file lock)
+        '''
+
+        data_file_path = os.path.join(self.transfer_dir, self.config_manager.config_data["node-extracted-data-file"])
+        if not os.path.isfile(data_file_path) or os.stat(data_file_path).st_size <= self.config_manager.config_data["node-data-file-max-size"]:
+            return None
+
+        # waiting for data file availability and locking it
+        while not cache.data_file_available(): time.sleep(0.1)
+        cache.lock_data_file()
+
+        try :
+
+            # renaming the filled / main data file
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            archive_file_name = self.archived_data_pattern_segs[0] + "-{}".format(time_str) + "." + self.archived_data_pattern_segs[1]
+            os.rename(data_file_path, os.path.join(self.transfer_dir, archive_file_name))
+
+            # creating new main data file
+            open(data_file_path, "w").close()
+
+        finally:
+            cache.unlock_data_file()
+
+        self.add_file(archive_file_name)
+        return archive_file_name
+
+
+    def claim_closed_segments(self, cache=None):
+
+        '''
+        Moves the segments closed by the data writer (DataFileWriter) to the spool, returns their names
+            ** segments are claimed by an atomic rename, no lock is shared with the writer
+            ** with "node-data-file-rotation", the main data file of the writers that do not use
+               DataFileWriter is rotated when there is no closed segment (see rotate_data_file), it
+               has to stay off with DataFileWriter (the main data file is its active segment)
+
+        Parameters
+        ----------
+        cache (NodeCacheModel) : connection to the Node's cache (None : the main data file is not rotated)
+        '''
+
+        closed_segment_dir = self.config_manager.config_data["node-closed-segment-dir"]
+        claimed_segments = []
+        if os.path.isdir(closed_segment_dir):
+            for segment_name in sorted(os.listdir(closed_segment_dir)):
+                try : os.rename(os.path.join(closed_segment_dir, segment_name), os.path.join(self.transfer_dir, segment_name))
+                except FileNotFoundError: continue
+                self.add_file(segment_name)
+                claimed_segments.append(segment_name)
+
+        if len(claimed_segments) == 0 and cache is not None and self.config_manager.config_data["node-data-file-rotation"]:
+            rotated_file = self.rotate_data_file(cache)
+            if rotated_file is not None:
+                claimed_segments.append(rotated_file)
+
+        return claimed_segments
+
+
+    def get_entries(self):
+
+        ''' Returns the spooled files (name, modification time, size), without touching the transfer folder '''
+
+        with self._locked_index() as spool_index:
+            return [(file_name, entry["time"], entry["size"]) for file_name, entry in spool_index.items()]
+
+
+    def checkout(self, file_names):
+
+        '''
+        Marks spooled files as being transfered (they are not compressed or dropped meanwhile)
+
+        Parameters
+        ----------
+        file_names (list) : names of the spooled files
+        '''
+
+        with self._locked_index() as spool_index:
+            for file_name in file_names:
+                if file_name in spool_index:
+                    spool_index[file_name]["checkout"] = time.time()
+
+
+    def release(self, file_names):
+
+        '''
+        Returns spooled files to the spool (transfer failed)
+
+        Parameters
+        ----------
+        file_names (list) : names of the spooled files
+        '''
+
+        with self._locked_index() as spool_index:
+            for file_name in file_names:
+                if file_name in spool_index:
+                    spool_index[file_name].pop("checkout", None)
+
+
+    def remove(self, file_names):
+
+        '''
+        Deletes spooled files (transfered or dropped)
+
+        Parameters
+        ----------
+        file_names (list) : names of the spooled files
+        '''
+
+        with self._locked_index() as spool_index:
+            for file_name in file_names:
+                spool_index.pop(file_name, None)
+                try : os.remove(os.path.join(self.transfer_dir, file_name))
+                except FileNotFoundError: pass
+
+
+    def _is_available(self, entry, current_time):
+
+        ''' Entries checked out by a transfer are available again after "spool-checkout-timeout" '''
+
+        checkout_time = entry.get("checkout")
+        return checkout_time is None or current_time - checkout_time > self.config_manager.config_data["spool-checkout-timeout"]
+
+
+    def compress_aged_files(self):
+
+        ''' Compresses the (unflagged) files older than "spool-segment-age" into segments, returns the created segments '''
+
+        current_time = time.time()
+        segment_age = self.config_manager.config_data["spool-segment-age"]
+        segment_max_bytes = self.config_manager.config_data["spool-segment-max-bytes"]
+        created_segments = []
+
+        with self._locked_index() as spool_index:
+
+            # grouping the aged files (oldest first) into segments of bounded size
+            aged_files = sorted((entry["time"], file_name) for file_name, entry in spool_index.items()
+                                if not entry["segment"] and not self._is_flagged(file_name) and
+                                current_time - entry["time"] > segment_age and self._is_available(entry, current_time))
+            segment_groups = []
+            for _, file_name in aged_files:
+                if len(segment_groups) == 0 or sum(spool_index[grouped_file]["size"] for grouped_file in segment_groups[-1]) + \
+                                               spool_index[file_name]["size"] > segment_max_bytes:
+                    segment_groups.append([])
+                segment_groups[-1].append(file_name)
+
+            for segment_files in segment_groups:
+
+                # a lone file is not worth a segment until it has company (unless it fills one)
+                if len(segment_files) == 1 and spool_index[segment_files[0]]["size"] < segment_max_bytes // 2:
+                    continue
+
+                segment_time = max(spool_index[file_name]["time"] for file_name in segment_files)
+                time_str = datetime.datetime.fromtimestamp(segment_time).strftime('%Y-%m-%d_%H-%M-%S')
+                segment_name = "{0}-segment-{1}.tar.gz".format(self.archived_data_pattern_segs[0], time_str)
+                segment_count = 1
+                while segment_name in spool_index or os.path.exists(os.path.join(self.transfer_dir, segment_name)):
+                    segment_name = "{0}-segment-{1}-{2}.tar.gz".format(self.archived_data_pattern_segs[0], time_str, segment_count)
+                    segment_count += 1
+                segment_path = os.path.join(self.transfer_dir, segment_name)
+
+                # the segment is written under a temporary name, then the compressed files are deleted
+                with tarfile.open(segment_path + ".part", "w:gz") as segment_h:
+                    for file_name in segment_files:
+                        segment_h.add(os.path.join(self.transfer_dir, file_name), arcname=file_name)
+                os.rename(segment_path + ".part", segment_path)
+
+                for file_name in segment_files:
+                    spool_index.pop(file_name)
+                    os.remove(os.path.join(self.transfer_dir, file_name))
+                spool_index[segment_name] = {"size" : os.stat(segment_path).st_size, "time" : segment_time,
+                                             "segment" : True, "downsampled" : False}
+                created_segments.append(segment_name)
+
+        return created_segments
+
+
+    def _downsample_segment(self, segment_name, spool_index):
+
+        ''' Keeps one file out of "spool-downsample-factor" in the specified segment '''
+
+        segment_path = os.path.join(self.transfer_dir, segment_name)
+        downsample_factor = max(2, self.config_manager.config_data["spool-downsample-factor"])
+
+        with tarfile.open(segment_path, "r:gz") as segment_h, tarfile.open(segment_path + ".part", "w:gz") as downsampled_h:
+            for member in segment_h.getmembers()[ : : downsample_factor]:
+                downsampled_h.addfile(member, segment_h.extractfile(member))
+        os.rename(segment_path + ".part", segment_path)
+
+        spool_index[segment_name]["size"] = os.stat(segment_path).st_size
+        spool_index[segment_name]["downsampled"] = True
+
+
+    def get_budget(self):
+
+        ''' Returns the disk budget of the spool (bytes), the file system always keeps "spool-min-free-bytes" free '''
+
+        with self._locked_index() as spool_index:
+            spool_size = sum(entry["size"] for entry in spool_index.values())
+
+        file_system_stat = os.statvfs(self.transfer_dir)
+        free_bytes = file_system_stat.f_bavail * file_system_stat.f_frsize
+        return min(self.config_manager.config_data["spool-max-bytes"],
+                   spool_size + free_bytes - self.config_manager.config_data["spool-min-free-bytes"])
+
+
+    def enforce_budget(self, budget=None):
+
+        '''
+        Applies the drop policy until the spool fits in its budget, returns the names of the dropped files
+
+        Parameters
+        ----------
+        budget (int) : disk budget of the spool (bytes), defaults to get_budget()
+        '''
+
+        if budget is None:
+            budget = self.get_budget()
+
+        current_time = time.time()
+        dropped_files = []
+        with self._locked_index() as spool_index:
+
+            spool_size = sum(entry["size"] for entry in spool_index.values())
+
+            # downsampling the oldest segments first
+            if self.config_manager.config_data["spool-drop-policy"] == DROP_DOWNSAMPLE:
+                segments = sorted((entry["time"], file_name) for file_name, entry in spool_index.items()
+                                  if entry["segment"] and not entry["downsampled"] and self._is_available(entry, current_time))
+                for _, segment_name in segments:
+                    if spool_size <= budget: break
+                    previous_size = spool_index[segment_name]["size"]
+                    self._downsample_segment(segment_name, spool_index)
+                    spool_size -= previous_size - spool_index[segment_name]["size"]
+
+            # dropping the oldest files (flagged data last)
+            drop_candidates = sorted((self._is_flagged(file_name), entry["time"], file_name) for file_name, entry in spool_index.items()
+                                     if self._is_available(entry, current_time))
+            for _, _, file_name in drop_candidates:
+                if spool_size <= budget: break
+                spool_size -= spool_index.pop(file_name)["size"]
+                try : os.remove(os.path.join(self.transfer_dir, file_name))
+                except FileNotFoundError: pass
+                dropped_files.append(file_name)
+
+        if len(dropped_files) > 0:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.warning("{0} - DataSpool over budget ({1} B), dropped data files : {2}".format(time_str, budget, dropped_files))
+
+        return dropped_files
+
+
+    def update_throttle(self, cache, budget=None):
+
+        '''
+        Asks acquisition to throttle while the spool is above "spool-throttle-ratio" of its budget,
+        returns True if acquisition is throttled
+
+        Parameters
+        ----------
+        cache (NodeCacheModel) : connection to the Node's cache
+        budget (int) : disk budget of the spool (bytes), defaults to get_budget()
+        '''
+
+        if budget is None:
+            budget = self.get_budget()
+
+        with self._locked_index() as spool_index:
+            spool_size = sum(entry["size"] for entry in spool_index.values())
+
+        throttled = spool_size > budget * self.config_manager.config_data["spool-throttle-ratio"]
+        if throttled != cache.check_data_collection_throttle():
+            if throttled: cache.throttle_data_collection()
+            else : cache.release_data_collection_throttle()
+
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - DataSpool acquisition throttle : {1} (spool {2} B, budget {3} B)".format(time_str, throttled,
+                         spool_size, budget))
+
+        return throttled
+
+
+    def maintain(self, cache):
+
+        '''
+        Runs a spool maintenance pass : claim of the closed data segments (or rotation of the main
+        data file), compression of the aged files, drop policy and acquisition throttle
+
+        Parameters
+        ----------
+        cache (NodeCacheModel) : connection to the Node's cache
+        '''
+
+        self.claim_closed_segments(cache)
+        self.compress_aged_files()
+        budget = self.get_budget()
+        self.enforce_budget(budget)
+        self.update_throttle(cache, budget)
+
+
+def run_spool_manager(config_file_path):
+
+    '''
+    Runs the spool maintenance every "spool-check-time" seconds (meant to run in a background process)
+
+    Parameters
+    ----------
+    config_file_path (str) : path to the node configuration file
+    '''
+
+    from .cache import NodeCacheModel
+
+    config_manager = NodeConfigurationManager(config_file_path)
+    data_spool = DataSpool(config_manager)
+    cache = NodeCacheModel(config_file_path)
+
+    while True:
+        try : data_spool.maintain(cache)
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - DataSpool maintenance failed : {1}".format(time_str, e))
+
+        time.sleep(config_manager.config_data["spool-check-time"])
@@ -0,0 +1,429 @@
+import os
+import os.path
+import json
+
+import time
+import fcntl
+import logging
+import datetime
+import threading
+
+
+# first line of a traced request : TRACE (trace id) (parent span id)
+TRACE_HEADER_PREFIX = b"TRACE "
+
+# session being traced in the current process, and the spans open in every thread
+_current_session = None
+_thread_state = threading.local()
+
+
+class _NullSpan():
+
+    ''' Span used when no session is being traced (does nothing) '''
+
+    span_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+def new_trace_id():
+    return os.urandom(8).hex()
+
+
+def new_span_id():
+    return os.urandom(4).hex()
+
+
+def get_tracing_settings(config_manager):
+
+    '''
+    Returns the tracing settings (dict) if tracing is enabled ("tracing-enabled"), None otherwise
+
+    Parameters
+    ----------
+    config_manager (ConfigurationManager) : holds the Hub or Node configurations
+    '''
+
+    if not config_manager.config_data.get("tracing-enabled", False):
+        return None
+
+    return {
+        "output_dir" : config_manager.config_data["tracing-dir"],
+        "max_file_size" : config_manager.config_data["tracing-max-file-size"]
+    }
+
+
+class TraceSession():
+
+    '''
+    Trace of a single session (node maintenance, hub connection), the spans are written out when it ends
+        - the session is the root span of the process, every span has a trace id, a span id and a parent span id
+        - a hub connection continues the trace of the node request it handles (trace header of the request)
+        - spans are appended to (host id)_trace.jsonl in "tracing-dir" (one write per session, compact
+          JSON lines), the file is rotated to (.1) past "tracing-max-file-size" bytes
+    The trace files of the nodes and of the hub can be merged into a single timeline (see merge_trace_files).
+    '''
+
+    def __init__(self, config_manager, name, host_id, trace_id=None, parent_span_id=None, start_time=None):
+
+        '''
+        Parameters
+        ----------
+        config_manager (ConfigurationManager) : holds the Hub or Node configurations
+        name (str) : name of the session
+        host_id (str) : id of the node or of the hub
+        trace_id (str) : id of the trace the session belongs to (None : new trace)
+        parent_span_id (str) : span the session was started from (remote request)
+        start_time (float) : start of the session (defaults to when it is entered)
+        '''
+
+        self.settings = get_tracing_settings(config_manager)
+        self.name = name
+        self.host_id = host_id
+        self.trace_id = trace_id if trace_id is not None else new_trace_id()
+        self.parent_span_id = parent_span_id
+        self.span_id = new_span_id()
+        self.start_time = start_time
+        self.records = []
+        self.lock = threading.Lock()
+
+
+    def __enter__(self):
+
+        global _current_session
+
+        if self.settings is not None:
+            self.start_time = time.time() if self.start_time is None else self.start_time
+            _current_session = self
+        return self
+
+
+    def __exit__(self, *exc_info):
+
+        global _current_session
+
+        if self.settings is None:
+            return False
+
+        if _current_session is self:
+            _current_session = None
+        self.record(self.name, self.span_id, self.parent_span_id, self.start_time, time.time())
+
+        try :
+            self._write_records()
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - TraceSession failed to write the trace of ({1}) : {2}".format(time_str, self.name, e))
+        return False
+
+
+    def record(self, name, span_id, parent_span_id, start_time, end_time, **attributes):
+
+        ''' Records a finished span of the session '''
+
+        span_record = {"trace" : self.trace_id, "span" : span_id, "parent" : parent_span_id, "name" : name,
+                       "host" : self.host_id, "pid" : os.getpid(), "start" : round(start_time, 6),
+                       "dur" : round(end_time - start_time, 6)}
+        span_record.update(attributes)
+        with self.lock:
+            self.records.append(span_record)
+
+
+    def _write_records(self):
+
+        ''' Appends the spans of the session to the trace file of the host (single write) '''
+
+        output_dir = self.settings["output_dir"]
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+
+        trace_file_path = os.path.join(output_dir, "{}_trace.jsonl".format(self.host_id))
+        trace_data = "".join(json.dumps(span_record, separators=(",", ":")) + "\n" for span_record in self.records)
+
+        # hub connections are handled in their own processes, they share the trace file
+        with open(trace_file_path + ".lock", "a") as lock_file_h:
+            fcntl.flock(lock_file_h, fcntl.LOCK_EX)
+            try :
+                if os.path.isfile(trace_file_path) and os.path.getsize(trace_file_path) > self.settings["max_file_size"]:
+                    os.replace(trace_file_path, trace_file_path + ".1")
+                trace_file_fd = os.open(trace_file_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                try : os.write(trace_file_fd, trace_data.encode("utf-8"))
+                finally:
+                    os.close(trace_file_fd)
+            finally:
+                fcntl.flock(lock_file_h, fcntl.LOCK_UN)
+
+
+class _Span():
+
+    ''' Timed span of the current trace session (nested spans of a thread are its children) '''
+
+    def __init__(self, session, name, attributes):
+        self.session = session
+        self.name = name
+        self.attributes = attributes
+        self.span_id = new_span_id()
+        self.parent_span_id = None
+        self.start_time = None
+
+
+    def __enter__(self):
+        span_stack = _get_span_stack()
+        self.parent_span_id = span_stack[-1] if len(span_stack) > 0 else self.session.span_id
+        span_stack.append(self.span_id)
+        self.start_time = time.time()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        end_time = time.time()
+        span_stack = _get_span_stack()
+        if len(span_stack) > 0 and span_stack[-1] == self.span_id:
+            span_stack.pop()
+        if exc_info[0] is not None:
+            self.attributes["error"] = exc_info[0].__name__
+        self.session.record(self.name, self.span_id, self.parent_span_id, self.start_time, end_time, **self.attributes)
+        return False
+
+
+    def set(self, **attributes):
+
+        ''' Adds attributes to the span (ex : sizes known once the span started) '''
+
+        self.attributes.update(attributes)
+
+
+def _get_span_stack():
+    if not hasattr(_thread_state, "span_stack"):
+        _thread_state.span_stack = []
+    return _thread_state.span_stack
+
+
+def get_current_span_id():
+
+    ''' Returns the id of the innermost open span of the thread (the session span when there is none) '''
+
+    if _current_session is None:
+        return None
+    span_stack = _get_span_stack()
+    return span_stack[-1] if len(span_stack) > 0 else _current_session.span_id
+
+
+def trace_span(name, **attributes):
+
+    '''
+    Returns a context manager recording a timed span of the current trace session
+    (does nothing when no session is being traced)
+
+    Parameters
+    ----------
+    name (str) : name of the span
+    attributes (dict) : attributes recorded with the span (ex : file name, size)
+    '''
+
+    if _current_session is None:
+        return NULL_SPAN
+    return _Span(_current_session, name, attributes)
+
+
+class TracedSocket():
+
+    '''
+    Connection of a traced request (node side)
+        - the trace header is sent along with the first message (the request line)
+        - the request is a span, from the request to the closing of the connection, with the
+          bytes sent / received and the time spent in send / recv calls
+    Every other socket operation goes to the wrapped socket.
+    '''
+
+    def __init__(self, sock, session, parent_span_id):
+
+        '''
+        Parameters
+        ----------
+        sock (socket) : connection to the hub (IP network or Bluetooth)
+        session (TraceSession) : current trace session
+        parent_span_id (str) : span the request is made from
+        '''
+
+        self.sock = sock
+        self.session = session
+        self.parent_span_id = parent_span_id
+        self.span_id = new_span_id()
+        self.request_name = None
+        self.start_time = time.time()
+        self.counters = {"sent" : 0, "received" : 0, "send_time" : 0.0, "recv_time" : 0.0}
+
+
+    def _get_payload(self, data):
+
+        ''' Prepends the trace header to the request line (first message) '''
+
+        if self.request_name is not None:
+            return data
+        self.request_name = bytes(data[ : 64]).split(b" ")[0].split(b"\n")[0].decode("utf-8", errors="replace")
+        return TRACE_HEADER_PREFIX + "{0} {1}\n".format(self.session.trace_id, self.span_id).encode("utf-8") + data
+
+
+    def send(self, data):
+
+        # the request line goes out whole with its header
+        if self.request_name is None:
+            self.sendall(data)
+            return len(data)
+
+        call_start_time = time.time()
+        sent_size = self.sock.send(data)
+        self.counters["send_time"] += time.time() - call_start_time
+        self.counters["sent"] += sent_size
+        return sent_size
+
+
+    def sendall(self, data):
+        payload = self._get_payload(data)
+        call_start_time = time.time()
+        self.sock.sendall(payload)
+        self.counters["send_time"] += time.time() - call_start_time
+        self.counters["sent"] += len(data)
+
+
+    def recv(self, size, *args):
+        call_start_time = time.time()
+        data = self.sock.recv(size, *args)
+        self.counters["recv_time"] += time.time() - call_start_time
+        self.counters["received"] += len(data)
+        return data
+
+
+    def close(self):
+        if self.start_time is not None:
+            counters = {name : round(value, 6) if isinstance(value, float) else value for name, value in self.counters.items()}
+            self.session.record("request " + str(self.request_name), self.span_id, self.parent_span_id,
+                                self.start_time, time.time(), **counters)
+            self.start_time = None
+        self.sock.close()
+
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def trace_connection(sock):
+
+    '''
+    Returns the connection wrapped for tracing when a session is being traced (the connection itself otherwise)
+
+    Parameters
+    ----------
+    sock (socket) : connection to the hub
+    '''
+
+    if _current_session is None:
+        return sock
+    return TracedSocket(sock, _current_session, get_current_span_id())
+
+
+def parse_trace_header(message_data):
+
+    '''
+    Splits the trace header off a received message (hub side)
+    Returns ((trace id, parent span id) or None, rest of the message)
+
+    Parameters
+    ----------
+    message_data (bytes) : first data received on the connection
+    '''
+
+    if not message_data.startswith(TRACE_HEADER_PREFIX):
+        return None, message_data
+
+    header_line, _, message_data = message_data.partition(b"\n")
+    header_segs = header_line.decode("utf-8", errors="replace").split()
+    if len(header_segs) != 3:
+        return None, message_data
+    return (header_segs[1], header_segs[2]), message_data
+
+
+def load_trace_files(trace_file_paths):
+
+    ''' Returns the span records of the specified trace files (rotated files included) '''
+
+    span_records = []
+    for trace_file_path in trace_file_paths:
+        for file_path in (trace_file_path + ".1", trace_file_path):
+            if not os.path.isfile(file_path):
+                continue
+            with open(file_path, "r") as trace_file_h:
+                for line in trace_file_h:
+                    try : span_records.append(json.loads(line))
+                    except ValueError:
+                        pass
+    return span_records
+
+
+def get_clock_offsets(span_records):
+
+    '''
+    Estimates the clock offset of every host, relative to the hosts that start traces (nodes)
+    The hub handling of a request is assumed centered in the node request span (median over the requests).
+    Returns {host id : offset (seconds) to add to its times}.
+
+    Parameters
+    ----------
+    span_records (list) : span records of every host
+    '''
+
+    spans = {(span_record["trace"], span_record["span"]) : span_record for span_record in span_records}
+    host_offsets = {}
+    for span_record in span_records:
+        parent_record = spans.get((span_record["trace"], span_record["parent"]))
+        if parent_record is None or parent_record["host"] == span_record["host"]:
+            continue
+        offset = (parent_record["start"] + parent_record["dur"] / 2) - (span_record["start"] + span_record["dur"] / 2)
+        host_offsets.setdefault(span_record["host"], []).append(offset)
+
+    return {host_id : sorted(offsets)[len(offsets) // 2] for host_id, offsets in host_offsets.items()}
+
+
+def merge_trace_files(trace_file_paths, output_path, trace_id=None):
+
+    '''
+    Merges the trace files of nodes and hubs into a single timeline, in the Chrome trace event format
+    (chrome://tracing, Perfetto) : one process row per host, the clocks of the hubs are aligned on the nodes.
+    Returns the number of merged spans.
+
+    Parameters
+    ----------
+    trace_file_paths (list) : paths to the (host id)_trace.jsonl files
+    output_path (str) : path of the merged .json trace
+    trace_id (str) : only merges the spans of this trace (None : every trace)
+    '''
+
+    span_records = load_trace_files(trace_file_paths)
+    clock_offsets = get_clock_offsets(span_records)
+    if trace_id is not None:
+        span_records = [span_record for span_record in span_records if span_record["trace"] == trace_id]
+
+    host_ids = sorted(set(span_record["host"] for span_record in span_records))
+    trace_events = [{"name" : "process_name", "ph" : "M", "pid" : host_index, "args" : {"name" : host_id}}
+                    for host_index, host_id in enumerate(host_ids)]
+    for span_record in span_records:
+        span_args = {name : value for name, value in span_record.items() if name not in ("name", "host", "start", "dur", "pid")}
+        trace_events.append({"name" : span_record["name"], "ph" : "X", "pid" : host_ids.index(span_record["host"]),
+                             "tid" : span_record["pid"], "args" : span_args,
+                             "ts" : int((span_record["start"] + clock_offsets.get(span_record["host"], 0.0)) * 1e6),
+                             "dur" : int(span_record["dur"] * 1e6)})
+
+    with open(output_path, "w") as output_h:
+        json.dump({"traceEvents" : trace_events, "displayTimeUnit" : "ms"}, output_h)
+    return len(span_records)
@@ -0,0 +1,297 @@
+import os
+import os.path
+
+import select
+import socket
+import contextlib
+
+
+class SocketReader():
+
+    '''
+    Buffered reader over a connected socket, used by the batch transfer commands.
+    Batch streams are made of newline terminated headers followed by payloads of known size.
+    '''
+
+    def __init__(self, sock, buffer_size, buffered_data=b""):
+
+        '''
+        Parameters
+        ----------
+        sock (socket) : connected socket
+        buffer_size (int) : maximum size of a single socket read
+        buffered_data (bytes) : data already received from the socket
+        '''
+
+        self.sock = sock
+        self.buffer_size = buffer_size
+        self.buffered_data = buffered_data
+
+
+    def _fill_buffer(self):
+
+        ''' Receives data from the socket, raises an exception if the connection was closed '''
+
+        data = self.sock.recv(self.buffer_size)
+        if not data:
+            raise ConnectionError("connection closed in the middle of a transfer")
+        self.buffered_data += data
+
+
+    def read_line(self):
+
+        ''' Returns the next (decoded) newline terminated line, without the newline '''
+
+        while b"\n" not in self.buffered_data:
+            self._fill_buffer()
+
+        line, self.buffered_data = self.buffered_data.split(b"\n", 1)
+        return line.decode("utf-8")
+
+
+    def read_to_file(self, file_h, size, grant=None):
+
+        '''
+        Writes the next (size) bytes of the stream to the specified file
+
+        Parameters
+        ----------
+        file_h (file) : file opened for binary writing
+        size (int) : number of bytes to transfer
+        grant (callable) : returns a context manager held while a chunk of the given size is received
+        '''
+
+        remaining_size = size
+        while remaining_size > 0:
+            if len(self.buffered_data) == 0:
+                wait_for_socket(self.sock, grant)
+                with get_chunk_grant(grant, min(self.buffer_size, remaining_size)):
+                    self._fill_buffer()
+
+            data = self.buffered_data[ : remaining_size]
+            self.buffered_data = self.buffered_data[len(data) : ]
+            file_h.write(data)
+            remaining_size -= len(data)
+
+
+def get_chunk_grant(grant, size):
+
+    '''
+    Returns the context manager held while a chunk is transfered (no-op without scheduler)
+
+    Parameters
+    ----------
+    grant (callable) : returns a context manager for a chunk of the given size, or None
+    size (int) : size of the chunk
+    '''
+
+    if grant is None:
+        # no-op context manager (contextlib.nullcontext is not available on the node's python 3.6)
+        return contextlib.suppress()
+    return grant(size)
+
+
+def wait_for_socket(sock, grant, write=False):
+
+    '''
+    Waits until the socket is ready for the next chunk, before the chunk grant is requested : the grant
+    held by the stream is given back while it waits, a stalled node holds no grant (no-op without scheduler)
+
+    Parameters
+    ----------
+    sock (socket) : connected socket
+    grant (callable) : grant function of the stream (see get_chunk_grant), or None
+    write (bool) : waits until data can be sent (received otherwise)
+    '''
+
+    if grant is None:
+        return
+
+    read_socks, write_socks = ([], [sock]) if write else ([sock], [])
+    if any(select.select(read_socks, write_socks, [], 0)[ : 2]):
+        return
+
+    if hasattr(grant, "release"):
+        grant.release()
+    if not any(select.select(read_socks, write_socks, [], sock.gettimeout())[ : 2]):
+        raise socket.timeout("timed out waiting for the peer")
+
+
+def send_file(sock, file_path, buffer_size, offset=0, size=None, grant=None):
+
+    '''
+    Sends the contents of a file through the specified socket
+
+    Parameters
+    ----------
+    sock (socket) : connected socket
+    file_path (str) : path to the file to send
+    buffer_size (int) : size of the chunks read from the file
+    offset (int) : position of the first byte to send
+    size (int) : number of bytes to send (None : until the end of the file)
+    grant (callable) : returns a context manager held while a chunk of the given size is sent
+    '''
+
+    with open(file_path, "rb") as file_h:
+        file_h.seek(offset)
+        remaining_size = size
+        while remaining_size is None or remaining_size > 0:
+            read_size = buffer_size if remaining_size is None else min(buffer_size, remaining_size)
+            data = file_h.read(read_size)
+            if not data: break
+            wait_for_socket(sock, grant, write=True)
+            with get_chunk_grant(grant, len(data)):
+                sock.sendall(data)
+            if remaining_size is not None:
+                remaining_size -= len(data)
+
+
+def send_file_batch(sock, node_id, file_paths, buffer_size):
+
+    '''
+    Uploads several files in a single request (PUT_FILE_BATCH), returns the names of the files
+    the Hub confirmed as stored.
+        - request : "PUT_FILE_BATCH (node id) (file count)\n"
+        - entries : "(file name) (size)\n" followed by the file data
+        - the Hub responds with a "OK (file name)\n" or "ERROR (file name)\n" status per entry
+
+    Parameters
+    ----------
+    sock (socket) : socket connected to the Hub
+    node_id (str) : id of the uploading Node
+    file_paths (list) : paths of the files to upload
+    buffer_size (int) : size of the chunks read from the files
+    '''
+
+    sock.sendall(bytes("PUT_FILE_BATCH {0} {1}\n".format(node_id, len(file_paths)), "UTF-8"))
+
+    # streaming the file entries
+    for file_path in file_paths:
+        file_size = os.stat(file_path).st_size
+        sock.sendall(bytes("{0} {1}\n".format(os.path.basename(file_path), file_size), "UTF-8"))
+        send_file(sock, file_path, buffer_size, size=file_size)
+
+    # collecting the status of every entry
+    stored_files = []
+    reader = SocketReader(sock, buffer_size)
+    for _ in file_paths:
+        status_segs = reader.read_line().split()
+        if len(status_segs) == 2 and status_segs[0] == "OK":
+            stored_files.append(status_segs[1])
+
+    return stored_files
+
+
+def send_file_tails(sock, node_id, file_tails, buffer_size):
+
+    '''
+    Ships the new tails of several (append only) files in a single request (APPEND_FILE).
+    Returns {file name : offset} with the offset the Hub's copy of every file reached.
+        - request : "APPEND_FILE (node id) (entry count)\n"
+        - entries : "(file name) (generation) (offset) (size)\n" followed by the bytes [offset, offset + size) 
+          of the file, the generation changes when the file is replaced (ex : truncated)
+        - the Hub responds with a "OK (file name) (offset)\n" or "ERROR (file name)\n" status per entry
+
+    Parameters
+    ----------
+    sock (socket) : socket connected to the Hub
+    node_id (str) : id of the shipping Node
+    file_tails (list) : (file path, file name, generation, offset, size) of every tail to ship
+    buffer_size (int) : size of the chunks read from the files
+    '''
+
+    sock.sendall(bytes("APPEND_FILE {0} {1}\n".format(node_id, len(file_tails)), "UTF-8"))
+
+    # streaming the tails
+    for file_path, file_name, generation, offset, size in file_tails:
+        sock.sendall(bytes("{0} {1} {2} {3}\n".format(file_name, generation, offset, size), "UTF-8"))
+        send_file(sock, file_path, buffer_size, offset=offset, size=size)
+
+    # collecting the offset reached by every file
+    file_offsets = {}
+    reader = SocketReader(sock, buffer_size)
+    for _ in file_tails:
+        status_segs = reader.read_line().split()
+        if len(status_segs) == 3 and status_segs[0] == "OK":
+            file_offsets[status_segs[1]] = int(status_segs[2])
+
+    return file_offsets
+
+
+def receive_update_batch(sock, archive_names, output_dir, buffer_size, entry_callback=None):
+
+    '''
+    Downloads several update archives in a single request (FETCH_UPDATE_BATCH).
+    Every archive is written to a (.part) file in the output folder, the caller verifies and
+    renames it. Returns the list of (archive name, digest) received.
+        - request : "FETCH_UPDATE_BATCH (comma seperated archive names)\n"
+        - entries : "OK (archive name) (size) (digest)\n" followed by the archive data,
+                    or "MISSING (archive name)\n"
+        - the Hub ends the stream with "END\n"
+
+    Parameters
+    ----------
+    sock (socket) : socket connected to the Hub
+    archive_names (list) : names of the archives to download
+    output_dir (str) : folder the archives are written to
+    buffer_size (int) : maximum size of a single socket read
+    entry_callback (callable) : called with (archive name, size, digest) before an archive is received
+    '''
+
+    sock.sendall(bytes("FETCH_UPDATE_BATCH {}\n".format(",".join(archive_names)), "UTF-8"))
+
+    received_archives = []
+    reader = SocketReader(sock, buffer_size)
+    header_segs = reader.read_line().split()
+    while header_segs != ["END"]:
+
+        if len(header_segs) == 4 and header_segs[0] == "OK":
+            _, archive_name, archive_size, archive_digest = header_segs
+            if archive_name not in archive_names:
+                raise ValueError("unexpected archive in batch : {}".format(archive_name))
+            if entry_callback is not None:
+                entry_callback(archive_name, int(archive_size), archive_digest)
+
+            with open(os.path.join(output_dir, archive_name + ".part"), "wb") as archive_h:
+                reader.read_to_file(archive_h, int(archive_size))
+            received_archives.append((archive_name, archive_digest))
+
+        elif len(header_segs) != 2 or header_segs[0] != "MISSING":
+            raise ValueError("invalid batch entry header : {}".format(" ".join(header_segs)))
+
+        header_segs = reader.read_line().split()
+
+    return received_archives
+
+
+def receive_update_range(sock, archive_name, start, end, file_path, buffer_size):
+
+    '''
+    Downloads a byte range of an update archive (FETCH_UPDATE_RANGE) and writes it at the same
+    position in the output file (the output file must already exist).
+    Returns the number of bytes received.
+        - request : "FETCH_UPDATE_RANGE (archive name) (start) (end)\n", end is exclusive
+        - response : "OK (size)\n" followed by the range data, or "MISSING (archive name)\n"
+
+    Parameters
+    ----------
+    sock (socket) : socket connected to the Hub
+    archive_name (str) : name of the archive
+    start (int) : position of the first byte of the range
+    end (int) : position following the last byte of the range
+    file_path (str) : path to the output file
+    buffer_size (int) : maximum size of a single socket read
+    '''
+
+    sock.sendall(bytes("FETCH_UPDATE_RANGE {0} {1} {2}\n".format(archive_name, start, end), "UTF-8"))
+
+    reader = SocketReader(sock, buffer_size)
+    header_segs = reader.read_line().split()
+    if len(header_segs) != 2 or header_segs[0] != "OK" or int(header_segs[1]) != end - start:
+        raise ValueError("invalid range response for ({0}) : {1}".format(archive_name, " ".join(header_segs)))
+
+    with open(file_path, "r+b") as archive_h:
+        archive_h.seek(start)
+        reader.read_to_file(archive_h, end - start)
+
+    return end - start
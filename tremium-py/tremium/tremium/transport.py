@@ -0,0 +1,417 @@
+import socket
+
+import time
+import logging
+import datetime
+
+
+# transports the hub and the nodes can communicate over
+TRANSPORT_BLUETOOTH = "bluetooth"
+TRANSPORT_TCP = "tcp"
+
+
+def get_node_transports(config_manager):
+
+    '''
+    Returns the transports the node connects to the hub with, in order of preference ("transport-mode")
+        - "bluetooth" : RFCOMM only
+        - "tcp" : IP network only
+        - "auto" : IP network when the hub can be reached over it, RFCOMM otherwise
+
+    Parameters
+    ----------
+    config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+    '''
+
+    transport_mode = config_manager.config_data["transport-mode"]
+    if transport_mode == "auto":
+        return [TRANSPORT_TCP, TRANSPORT_BLUETOOTH]
+    if transport_mode in (TRANSPORT_TCP, TRANSPORT_BLUETOOTH):
+        return [transport_mode]
+    raise ValueError("unknown transport mode : {}".format(transport_mode))
+
+
+def get_node_hubs(config_manager):
+
+    '''
+    Returns the hubs the node can connect to ("hub-list"), every hub is a dict :
+    {"hub-id" : id, "bluetooth-address" : MAC address, "tcp-address" : host name or IP, "tcp-port" : port}
+        - the fields a hub leaves out take the single hub settings ("bluetooth-adapter-mac-server",
+          "hub-tcp-address", "hub-tcp-port"), the id defaults to the bluetooth address
+        - without a hub list, the node connects to the single hub
+
+    Parameters
+    ----------
+    config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+    '''
+
+    hubs = []
+    for hub in config_manager.config_data.get("hub-list", []) or [{}]:
+        hub_id = hub.get("hub-id", hub.get("bluetooth-address", config_manager.config_data["bluetooth-adapter-mac-server"]))
+        hubs.append(dict(hub, **{"hub-id" : hub_id}))
+    return hubs
+
+
+def get_timeout_errors():
+
+    ''' Returns the exceptions raised when a read times out, for every available transport '''
+
+    timeout_errors = (socket.timeout,)
+    try :
+        from bluetooth import BluetoothError
+        timeout_errors += (BluetoothError,)
+    except ImportError:
+        pass
+    return timeout_errors
+
+
+def connect_bluetooth(config_manager, local_port, hub=None):
+
+    '''
+    Returns a socket connected to the hub over RFCOMM
+
+    Parameters
+    ----------
+    config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+    local_port (int) : local RFCOMM port (0 : any port)
+    hub (dict) : hub to connect to (see get_node_hubs), defaults to the single hub
+    '''
+
+    hub_address = (hub or {}).get("bluetooth-address", config_manager.config_data["bluetooth-adapter-mac-server"])
+
+    from bluetooth import BluetoothSocket
+
+    hub_s = BluetoothSocket()
+    try :
+        hub_s.bind((config_manager.config_data["bluetooth-adapter-mac-client"], local_port))
+
+        # connecting to the hub
+        time.sleep(0.25)
+        hub_s.connect((hub_address, config_manager.config_data["bluetooth-port"]))
+        hub_s.settimeout(config_manager.config_data["bluetooth-comm-timeout"])
+        time.sleep(0.25)
+
+    except Exception:
+        hub_s.close()
+        raise
+
+    return hub_s
+
+
+def connect_tcp(config_manager, hub=None):
+
+    '''
+    Returns a socket connected to the hub over the IP network
+
+    Parameters
+    ----------
+    config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+    hub (dict) : hub to connect to (see get_node_hubs), defaults to the single hub
+    '''
+
+    hub_address = ((hub or {}).get("tcp-address", config_manager.config_data["hub-tcp-address"]),
+                   (hub or {}).get("tcp-port", config_manager.config_data["hub-tcp-port"]))
+    hub_s = socket.create_connection(hub_address, timeout=config_manager.config_data["tcp-connect-timeout"])
+    hub_s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    hub_s.settimeout(config_manager.config_data["bluetooth-comm-timeout"])
+    return hub_s
+
+
+def is_hub_reachable_tcp(config_manager, hub=None):
+
+    '''
+    Checks if the hub accepts connections over the IP network (the probe connection is closed
+    without a request, the hub drops it)
+
+    Parameters
+    ----------
+    config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+    hub (dict) : hub to probe (see get_node_hubs), defaults to the single hub
+    '''
+
+    try :
+        connect_tcp(config_manager, hub).close()
+        return True
+    except OSError:
+        return False
+
+
+class TransportSelector():
+
+    '''
+    Connects the node to the hub over the preferred transport available ("transport-mode")
+        - a transport that fails to connect is skipped for "transport-fallback-time" seconds,
+          the next transport is used instead (IP network --> RFCOMM)
+        - the requests (and their responses) are the same over every transport
+    '''
+
+    def __init__(self, config_manager, hub=None):
+
+        '''
+        Parameters
+        ----------
+        config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+        hub (dict) : hub to connect to (see get_node_hubs), defaults to the single hub
+        '''
+
+        self.config_manager = config_manager
+        self.hub = hub
+        self.transports = get_node_transports(config_manager)
+        self.fallback_time = config_manager.config_data["transport-fallback-time"]
+
+        # {transport : time until which it is skipped}
+        self.skipped_until = {}
+        self.current_transport = None
+
+
+    def connect(self, local_port=0):
+
+        '''
+        Returns a socket connected to the hub, over the first transport that connects
+            ** raises the error of the last transport tried when none connects
+
+        Parameters
+        ----------
+        local_port (int) : local RFCOMM port (0 : any port)
+        '''
+
+        # every transport is tried when they are all skipped
+        transports = [transport for transport in self.transports if self.skipped_until.get(transport, 0) <= time.time()]
+        if len(transports) == 0:
+            transports = self.transports
+
+        last_error = None
+        for transport in transports:
+            try :
+                if transport == TRANSPORT_TCP:
+                    hub_s = connect_tcp(self.config_manager, self.hub)
+                else :
+                    hub_s = connect_bluetooth(self.config_manager, local_port, self.hub)
+
+                self.skipped_until.pop(transport, None)
+                if transport != self.current_transport:
+                    time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                    logging.info("{0} - TransportSelector connected to the hub over : {1}".format(time_str, transport))
+                self.current_transport = transport
+                return hub_s
+
+            except Exception as e:
+                last_error = e
+                self.skipped_until[transport] = time.time() + self.fallback_time
+                if len(self.transports) > 1:
+                    time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                    logging.warning("{0} - TransportSelector could not connect over {1}, skipped for {2} seconds : {3}\
+                                    ".format(time_str, transport, self.fallback_time, e))
+
+        raise last_error
+
+
+class HubSelector():
+
+    '''
+    Connects the node to the least loaded hub it can reach ("hub-list"), capacity scales by adding hubs
+        - every hub is probed with HUB_STATUS (active sessions, transfer queue depth), the reachable
+          hubs are ranked by load : fewest active sessions, then shortest queue (hubs that do not
+          report their load come last, the configured order breaks ties)
+        - the maintenance runs against the first hub of the ranking, when that hub can no longer be
+          reached the next connections fail over to the next hub
+        - every hub has its own TransportSelector (IP network / RFCOMM fallback)
+    '''
+
+    def __init__(self, config_manager):
+
+        '''
+        Parameters
+        ----------
+        config_manager (NodeConfigurationManager) : holds configurations for the Tremium Node
+        '''
+
+        self.config_manager = config_manager
+        self.hubs = get_node_hubs(config_manager)
+        self.transport_selectors = dict((hub["hub-id"], TransportSelector(config_manager, hub)) for hub in self.hubs)
+
+        # {hub id : (active sessions, queue depth) or None} of the hubs that answered the last probe
+        self.hub_loads = {}
+        self.current_hub = None
+
+
+    @property
+    def current_transport(self):
+
+        ''' Transport of the last connection to the current hub '''
+
+        if self.current_hub is None:
+            return None
+        return self.transport_selectors[self.current_hub["hub-id"]].current_transport
+
+
+    def get_hub_load(self, hub):
+
+        '''
+        Returns the load reported by the hub (active sessions, transfer queue depth), None when the
+        hub does not report it (hub without HUB_STATUS support)
+            ** raises the connection error when the hub can not be reached
+
+        Parameters
+        ----------
+        hub (dict) : hub to probe (see get_node_hubs)
+        '''
+
+        hub_s = self.transport_selectors[hub["hub-id"]].connect()
+        try :
+            hub_s.sendall(b"HUB_STATUS\n")
+            response_str = hub_s.recv(self.config_manager.config_data["bluetooth-message-max-size"]).decode("utf-8")
+        finally:
+            hub_s.close()
+
+        response_segs = response_str.split()
+        if len(response_segs) != 4 or response_segs[0] != "HUB_STATUS":
+            return None
+        return int(response_segs[2]), int(response_segs[3])
+
+
+    def rank_hubs(self):
+
+        ''' Returns the hubs that answered the last probe, least loaded first '''
+
+        reachable_hubs = [hub for hub in self.hubs if hub["hub-id"] in self.hub_loads]
+        return sorted(reachable_hubs, key=lambda hub : (self.hub_loads[hub["hub-id"]] is None, self.hub_loads[hub["hub-id"]] or (0, 0)))
+
+
+    def select_hub(self):
+
+        ''' Probes every hub, returns the least loaded hub in reach (None when no hub can be reached) '''
+
+        self.hub_loads = {}
+        for hub in self.hubs:
+            try :
+                self.hub_loads[hub["hub-id"]] = self.get_hub_load(hub)
+            except Exception as e:
+                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                logging.info("{0} - HubSelector could not reach hub {1} : {2}".format(time_str, hub["hub-id"], e))
+
+        ranked_hubs = self.rank_hubs()
+        self.current_hub = ranked_hubs[0] if len(ranked_hubs) > 0 else None
+        if self.current_hub is not None and len(self.hubs) > 1:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - HubSelector selected hub {1}, hub loads (sessions, queue depth) : {2}\
+                         ".format(time_str, self.current_hub["hub-id"], self.hub_loads))
+        return self.current_hub
+
+
+    def connect(self, local_port=0):
+
+        '''
+        Returns a socket connected to the current hub, or to the next hub of the ranking when the current
+        hub can not be reached (fail over), the hubs that were not reached by the probe are tried last
+            ** raises the error of the last hub tried when none connects
+
+        Parameters
+        ----------
+        local_port (int) : local RFCOMM port (0 : any port)
+        '''
+
+        candidate_hubs = ([self.current_hub] if self.current_hub is not None else []) + self.rank_hubs() + self.hubs
+        tried_hub_ids = set()
+        last_error = None
+        for hub in candidate_hubs:
+            if hub["hub-id"] in tried_hub_ids:
+                continue
+            tried_hub_ids.add(hub["hub-id"])
+
+            try :
+                hub_s = self.transport_selectors[hub["hub-id"]].connect(local_port)
+            except Exception as e:
+                last_error = e
+                continue
+
+            if self.current_hub is not None and hub["hub-id"] != self.current_hub["hub-id"]:
+                time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+                logging.warning("{0} - HubSelector failed over from hub {1} to hub {2} : {3}\
+                                ".format(time_str, self.current_hub["hub-id"], hub["hub-id"], last_error))
+            self.current_hub = hub
+            return hub_s
+
+        raise last_error
+
+
+class HubLoad():
+
+    '''
+    Load indicators of the hub (reported to the nodes, HUB_STATUS), shared by the server process
+    and the connection handler processes
+        - active sessions : connection handlers running (counted by the server on every new connection)
+        - queue depth : transfer chunk requests waiting for a grant (set by the transfer scheduler)
+    '''
+
+    def __init__(self):
+
+        from multiprocessing import Value
+
+        self.active_sessions = Value("i", 0)
+        self.queue_depth = Value("i", 0)
+
+
+    def set_active_sessions(self, active_sessions):
+        self.active_sessions.value = active_sessions
+
+
+    def set_queue_depth(self, queue_depth):
+        self.queue_depth.value = queue_depth
+
+
+    def get(self):
+
+        ''' Returns (active sessions, queue depth) '''
+
+        return self.active_sessions.value, self.queue_depth.value
+
+
+def create_hub_listeners(config_manager):
+
+    '''
+    Returns the (transport, listening socket) of every transport the hub serves ("hub-transports").
+    A transport that fails to listen is left out, an exception is raised if none listens.
+        ** the RFCOMM listener is advertised (service discovery by the nodes)
+        ** the requests are not authenticated : the TCP listener is bound to a single interface ("hub-tcp-bind-address"),
+           binding to all interfaces has to be allowed explicitly ("hub-tcp-allow-all-interfaces")
+
+    Parameters
+    ----------
+    config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+    '''
+
+    listeners = []
+    for transport in config_manager.config_data["hub-transports"]:
+        try :
+            if transport == TRANSPORT_TCP:
+                bind_address = config_manager.config_data["hub-tcp-bind-address"]
+                if bind_address in ["", "0.0.0.0", "::"] and not config_manager.config_data.get("hub-tcp-allow-all-interfaces", False):
+                    raise ValueError("binding to all interfaces ({}) is not allowed, set hub-tcp-allow-all-interfaces".format(bind_address))
+                listener_s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                listener_s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                listener_s.bind((bind_address, config_manager.config_data["hub-tcp-port"]))
+                listener_s.listen(5)
+
+            elif transport == TRANSPORT_BLUETOOTH:
+                from bluetooth import BluetoothSocket, advertise_service
+                listener_s = BluetoothSocket()
+                listener_s.bind((config_manager.config_data["bluetooth-adapter-mac-server"],
+                                 config_manager.config_data["bluetooth-port"]))
+                listener_s.listen(1)
+                advertise_service(listener_s, config_manager.config_data["hub-id"])
+
+            else :
+                raise ValueError("unknown transport : {}".format(transport))
+
+            listeners.append((transport, listener_s))
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.info("{0} - Hub server listening over {1} on address : {2}".format(time_str, transport, listener_s.getsockname()))
+
+        except Exception as e:
+            time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+            logging.error("{0} - Hub server failed to listen over {1} : {2}".format(time_str, transport, e))
+
+    if len(listeners) == 0:
+        raise ConnectionError("the hub server could not listen over any transport")
+    return listeners
@@ -0,0 +1,241 @@
+import os
+import os.path
+
+import time
+import logging
+import datetime
+
+from .bandwidth import TokenBucket
+from .file_management import load_state_file, locked_state_file
+
+
+# upload priority classes, lower is sent first
+PRIORITY_FRESH = 0
+PRIORITY_LOGS = 1
+PRIORITY_BACKFILL = 2
+
+# chunk sizes of resumable uploads are multiples of 256 KB (cloud storage)
+UPLOAD_CHUNK_MULTIPLE = 262144
+
+
+class RateLimitedReader():
+
+    ''' File object wrapper, the reads (upload of the file) are held back by a token bucket '''
+
+    def __init__(self, file_h, token_bucket, chunk_size):
+
+        '''
+        Parameters
+        ----------
+        file_h (file object) : file opened for reading (binary)
+        token_bucket (TokenBucket) : uplink rate limiter (shared by every upload)
+        chunk_size (int) : the file is read (and rate limited) in chunks of this size
+        '''
+
+        self.file_h = file_h
+        self.token_bucket = token_bucket
+        self.chunk_size = chunk_size
+
+
+    def read(self, size=-1):
+
+        data_chunks = []
+        remaining_size = size if size is not None and size >= 0 else None
+        while remaining_size is None or remaining_size > 0:
+            chunk = self.file_h.read(self.chunk_size if remaining_size is None else min(self.chunk_size, remaining_size))
+            if len(chunk) == 0:
+                break
+
+            time.sleep(self.token_bucket.wait_time(len(chunk), time.time()))
+            self.token_bucket.consume(len(chunk), time.time())
+            data_chunks.append(chunk)
+            if remaining_size is not None:
+                remaining_size -= len(chunk)
+
+        return b"".join(data_chunks)
+
+
+    def __getattr__(self, name):
+        return getattr(self.file_h, name)
+
+
+class UplinkScheduler():
+
+    '''
+    Schedules the uploads of the data collector over a (metered / slow) uplink
+        - uploads are ordered by priority class : fresh data files, then log files, then backfill
+          (data files older than "uplink-fresh-time", ex : left over from a previous day)
+        - the upload rate is capped at "uplink-max-rate" bytes per second (headroom for the update notifications),
+          capped uploads are sent a chunk at a time (see upload)
+        - at most "uplink-daily-budget" bytes are sent per day, a class only uploads while the bytes sent
+          stay within its share of the budget ("uplink-class-budget-ratios"), so the lower classes
+          never use the budget left for fresh data
+        - files that do not fit the budget are deferred until the next day, the deferral is persisted
+          ("hub-uplink-state-file") so they are skipped without being retried in the meantime
+    '''
+
+    def __init__(self, config_manager):
+
+        '''
+        Parameters
+        ----------
+        config_manager (HubConfigurationManager) : holds configurations for the Tremium Hub
+        '''
+
+        self.config_manager = config_manager
+        self.file_transfer_dir = config_manager.config_data["hub-file-transfer-dir"]
+        self.token_bucket = TokenBucket(config_manager.config_data["uplink-max-rate"])
+        self.chunk_size = config_manager.config_data["uplink-chunk-size"]
+        self.daily_budget = config_manager.config_data["uplink-daily-budget"]
+        self.class_budget_ratios = config_manager.config_data["uplink-class-budget-ratios"]
+        self.fresh_time = config_manager.config_data["uplink-fresh-time"]
+        self.state_file_path = config_manager.get_state_file_path("hub-uplink-state-file")
+
+
+    @staticmethod
+    def _get_day(current_time):
+        return datetime.datetime.fromtimestamp(current_time).strftime('%Y-%m-%d')
+
+
+    def _check_day(self, state, current_time):
+
+        ''' Resets the sent bytes and the deferred files when a new day starts (state lock held) '''
+
+        day = self._get_day(current_time)
+        if state.get("day") != day:
+            state.clear()
+            state.update({"day" : day, "sent-bytes" : 0, "deferred" : {}})
+
+
+    def get_priority(self, element, current_time=None):
+
+        '''
+        Returns the priority class of a file of the transfer folder
+
+        Parameters
+        ----------
+        element (str) : name of the file (in the transfer folder)
+        current_time (float) : current time (defaults to now)
+        '''
+
+        if element.endswith(".log"):
+            return PRIORITY_LOGS
+
+        current_time = time.time() if current_time is None else current_time
+        if current_time - os.stat(os.path.join(self.file_transfer_dir, element)).st_mtime > self.fresh_time:
+            return PRIORITY_BACKFILL
+        return PRIORITY_FRESH
+
+
+    def order(self, elements, current_time=None):
+
+        '''
+        Returns the files to upload in priority order (oldest first within a class), files deferred
+        for the day and files that no longer exist are left out
+
+        Parameters
+        ----------
+        elements (iterable) : names of the files (in the transfer folder)
+        current_time (float) : current time (defaults to now)
+        '''
+
+        current_time = time.time() if current_time is None else current_time
+        state = load_state_file(self.state_file_path, {})
+        deferred = state.get("deferred", {}) if state.get("day") == self._get_day(current_time) else {}
+
+        ordered_elements = []
+        for element in elements:
+            if element in deferred:
+                continue
+            try :
+                element_mtime = os.stat(os.path.join(self.file_transfer_dir, element)).st_mtime
+                ordered_elements.append((self.get_priority(element, current_time), element_mtime, element))
+            except OSError:
+                pass
+
+        return [element for _, _, element in sorted(ordered_elements)]
+
+
+    def admit(self, size, priority, element=None, current_time=None):
+
+        '''
+        Checks if (size) bytes of the specified class fit the daily budget. A refused file is deferred
+        until the next day (when its name is given).
+
+        Parameters
+        ----------
+        size (int) : size of the upload
+        priority (int) : priority class of the upload
+        element (str) : name of the file (in the transfer folder), None for uploads that are not deferred
+        current_time (float) : current time (defaults to now)
+        '''
+
+        if self.daily_budget <= 0:
+            return True
+
+        current_time = time.time() if current_time is None else current_time
+        with locked_state_file(self.state_file_path, {}) as state:
+            self._check_day(state, current_time)
+            if state["sent-bytes"] + size <= self.daily_budget * self.class_budget_ratios[priority]:
+                return True
+
+            if element is not None:
+                state["deferred"][element] = priority
+
+        time_str = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H-%M-%S')
+        logging.info("{0} - Hub data collector deferred upload ({1}, priority {2}, {3} bytes), daily budget used : {4} bytes\
+                     ".format(time_str, element, priority, size, state["sent-bytes"]))
+        return False
+
+
+    def record_upload(self, size, current_time=None):
+
+        '''
+        Counts the bytes of a completed upload against the daily budget
+
+        Parameters
+        ----------
+        size (int) : size of the upload
+        current_time (float) : current time (defaults to now)
+        '''
+
+        if self.daily_budget <= 0:
+            return
+
+        current_time = time.time() if current_time is None else current_time
+        with locked_state_file(self.state_file_path, {}) as state:
+            self._check_day(state, current_time)
+            state["sent-bytes"] += size
+
+
+    def limit_rate(self, file_h):
+
+        '''
+        Returns a wrapper of the file, reading it (uploading it) at most at the uplink rate cap
+
+        Parameters
+        ----------
+        file_h (file object) : file opened for reading (binary)
+        '''
+
+        return RateLimitedReader(file_h, self.token_bucket, self.chunk_size)
+
+
+    def upload(self, blob, file_h, size):
+
+        '''
+        Uploads a file to a cloud storage blob, at most at the uplink rate cap. A capped upload is
+        resumable, sent in chunks of "uplink-chunk-size" rounded up to a multiple of 256 KB : every chunk
+        is read (rate limited) then sent, instead of the whole file (single request uploads, under 8 MB)
+        being read then sent at once.
+
+        Parameters
+        ----------
+        blob (storage.Blob) : destination blob
+        file_h (file object) : file opened for reading (binary)
+        size (int) : number of bytes to upload
+        '''
+
+        if self.token_bucket.rate > 0:
+            blob.chunk_size = max(1, -(-self.chunk_size // UPLOAD_CHUNK_MULTIPLE)) * UPLOAD_CHUNK_MULTIPLE
+        blob.upload_from_file(self.limit_rate(file_h), size=size)